@@ -0,0 +1,75 @@
+"""
+Cold start benchmark based on `python -X importtime`.
+
+    python benchmarks/import_time.py            # check budgets, exit 1 if exceeded
+    python benchmarks/import_time.py --top 15   # also show the slowest imports
+
+Every module is imported in a fresh interpreter several times and the best cumulative
+time is compared with its budget. Heavy libraries (Gemini SDK, lxml, bs4, python-docx,
+ebooklib, Pillow, PyQt6) must not be imported by the headless entry points at all:
+they are loaded lazily when a format/API call actually needs them.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> budget in milliseconds (cumulative import time, best of N runs)
+BUDGETS_MS = {
+    "transgemini.config": 30,
+    "transgemini.cli": 80,
+    "transgemini.core.engine": 120,
+}
+FORBIDDEN_MODULES = ("google.generativeai", "google.api_core", "lxml", "bs4", "docx", "ebooklib", "PIL", "PyQt6")
+
+
+def measure(module):
+    """Returns (total_ms, [(cumulative_us, self_us, name), ...]) for one fresh import of `module`."""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)  # measure with warm .pyc like a normal install
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env, cwd=REPO_ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if name.strip() == "site":
+            rows = []  # interpreter startup (site-packages .pth files), not ours
+            continue
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    total_us = next(cumulative for cumulative, _, name in reversed(rows) if name.strip() == module)
+    return total_us / 1000.0, rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="transgemini import time budget check")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="Show N slowest imports per module.")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, budget_ms in BUDGETS_MS.items():
+        measure(module)  # warm-up: writes .pyc files
+        runs = [measure(module) for _ in range(args.runs)]
+        best_ms, rows = min(runs, key=lambda run: run[0])
+        loaded = {name.strip() for _, _, name in rows}
+        heavy = sorted(name for name in loaded
+                       if any(name == m or name.startswith(m + ".") for m in FORBIDDEN_MODULES))
+        status = "OK" if best_ms <= budget_ms and not heavy else "FAIL"
+        failed = failed or status == "FAIL"
+        print(f"[{status}] {module}: {best_ms:.1f} ms (budget {budget_ms} ms, best of {args.runs})")
+        if heavy:
+            print(f"       eagerly imports: {', '.join(heavy[:10])}{' ...' if len(heavy) > 10 else ''}")
+        if args.top:
+            for cumulative_us, self_us, name in sorted(rows, reverse=True)[:args.top]:
+                print(f"       {cumulative_us / 1000.0:8.1f} ms  (self {self_us / 1000.0:6.1f})  {name.strip()}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
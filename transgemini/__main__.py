@@ -0,0 +1,6 @@
+import sys
+
+from transgemini.cli import main
+
+if __name__ == "__main__":  # extraction processes (spawn) re-import this module as __mp_main__
+    sys.exit(main())
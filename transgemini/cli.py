@@ -0,0 +1,282 @@
+"""
+Headless command line entry point (no PyQt6 / display required).
+
+    python -m transgemini book.epub -o out/ -f epub
+    python -m transgemini docs/ -o out/ -f docx -m "Gemini 2.0 Flash" -c 5 --prompt-file prompt.txt
+    python -m transgemini book.epub -f epub --dry-run   # оценка объема/времени без запросов к API
+"""
+import argparse
+import os
+import sys
+import time
+
+from transgemini.config import (MODELS, DEFAULT_MODEL_NAME, OUTPUT_FORMATS, DEFAULT_PROMPT_TEMPLATE,
+                                DEFAULT_CHARACTER_LIMIT_FOR_CHUNK, DEFAULT_CHUNK_SEARCH_WINDOW,
+                                METRICS_PORT, METRICS_TEXTFILE_PATH, DEFAULT_EXTRACTION_WORKERS, RUN_LOG_FILENAME,
+                                SCHEDULING_POLICIES, DEFAULT_SCHEDULING_POLICY, API_TIMEOUT_SECONDS,
+                                CHUNK_DEADLINE_SECONDS, HEDGING_ENABLED,
+                                find_missing_packages)
+from transgemini.core.epub_structure import load_epub_structure, select_epub_parts, make_epub_rebuild_entry
+
+SUPPORTED_INPUT_EXTENSIONS = ('.txt', '.docx', '.epub')
+QUIET_PREFIXES = ("[INFO]", "[USAGE]")
+
+EXIT_OK = 0
+EXIT_ERRORS = 1
+EXIT_USAGE = 2
+EXIT_CANCELLED = 130
+
+# import names needed per input/output format (google.generativeai is always needed)
+FORMAT_DEPENDENCIES = {
+    'docx': ('docx',),
+    'epub': ('bs4', 'lxml'),
+    'epub_out': ('bs4', 'lxml'),
+    'fb2': ('lxml',),
+}
+
+
+class CliUsageError(Exception):
+    pass
+
+
+def _log(message, quiet=False):
+    current_time = time.strftime("%H:%M:%S")
+    for line in str(message).strip().splitlines():
+        if quiet and line.lstrip().startswith(QUIET_PREFIXES):
+            continue
+        print(f"[{current_time}] {line}", file=sys.stderr, flush=True)
+
+
+def resolve_model(name_or_id):
+    """Returns (display_name, model_config) for a MODELS display name or model id (with or without 'models/')."""
+    if not name_or_id:
+        name_or_id = DEFAULT_MODEL_NAME if DEFAULT_MODEL_NAME in MODELS else list(MODELS.keys())[0]
+    if name_or_id in MODELS:
+        return name_or_id, MODELS[name_or_id]
+    wanted = name_or_id if name_or_id.startswith("models/") else f"models/{name_or_id}"
+    for display_name, model_config in MODELS.items():
+        if model_config['id'] == wanted:
+            return display_name, model_config
+    raise CliUsageError(f"Неизвестная модель '{name_or_id}'. Доступны: " +
+                        ", ".join(f"'{name}' ({cfg['id']})" for name, cfg in MODELS.items()))
+
+
+def expand_inputs(paths):
+    """Expands directories (non-recursive) into supported files, keeping the given order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(SUPPORTED_INPUT_EXTENSIONS)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise CliUsageError(f"Файл не найден: {path}")
+    unsupported = [f for f in files if not f.lower().endswith(SUPPORTED_INPUT_EXTENSIONS)]
+    if unsupported:
+        raise CliUsageError(f"Неподдерживаемые файлы: {', '.join(unsupported)}")
+    if not files:
+        raise CliUsageError("Нет входных файлов (.txt, .docx, .epub).")
+    return files
+
+
+def check_dependencies(files, output_format, need_api=True):
+    """Raises CliUsageError listing the packages missing for these inputs and output format."""
+    needed = {'google.generativeai'} if need_api else set()
+    for file_path in files:
+        needed.update(FORMAT_DEPENDENCIES.get(os.path.splitext(file_path)[1].lower()[1:], ()))
+    needed.update(FORMAT_DEPENDENCIES.get('epub_out' if output_format == 'epub' else output_format, ()))
+    missing = find_missing_packages(include_gui=False, import_names=needed)
+    if missing:
+        raise CliUsageError("Не установлены пакеты: " + ", ".join(name for name, _ in missing) +
+                            ". Установить: pip install " + " ".join(name for name, _ in missing))
+
+
+def build_job_data(files, output_format, epub_parts, include_patterns, exclude_patterns, log):
+    """
+    Builds files_to_process_data for TranslationEngine: a dict {epub_path: entry} for EPUB->EPUB,
+    otherwise a list of (type, path, html_path_or_None) tuples.
+    """
+    if output_format == 'epub':
+        non_epub = [f for f in files if not f.lower().endswith('.epub')]
+        if non_epub:
+            raise CliUsageError(f"Вывод EPUB возможен только из EPUB файлов: {', '.join(non_epub)}")
+
+    epub_jobs = {}
+    file_tuples = []
+    for file_path in files:
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext != '.epub':
+            file_tuples.append((ext[1:], file_path, None))
+            continue
+        manifest, toc_paths = load_epub_structure(file_path, log_callback=log)
+        if manifest is None:
+            log(f"[ERROR] Не удалось определить структуру EPUB {os.path.basename(file_path)}. Пропуск.")
+            continue
+        html_files = manifest['html_files']
+        selected = select_epub_parts(html_files, toc_paths[0], epub_parts, include_patterns, exclude_patterns)
+        log(f"EPUB {os.path.basename(file_path)}: выбрано {len(selected)} из {len(html_files)} HTML частей.")
+        for html_path in selected:
+            log(f"  + {html_path}")
+        if output_format == 'epub':
+            epub_jobs[file_path] = make_epub_rebuild_entry(selected, toc_paths, manifest)
+        else:
+            file_tuples.extend(('epub', file_path, html_path) for html_path in selected)
+
+    return epub_jobs if output_format == 'epub' else file_tuples
+
+
+def run_dry_run(args, job_data, model_config, concurrency, chunking, prompt_template, log):
+    """Prints the pre-flight report (core/preflight.py) to stdout; no API calls, nothing is written."""
+    from transgemini.core.preflight import run_preflight, format_preflight_report
+    try:
+        report = run_preflight(job_data, model_config, concurrency, chunking, args.chunk_limit, args.chunk_window,
+                               prompt_template, chunk_delay_seconds=args.chunk_delay,
+                               extraction_workers=args.extract_workers, log_callback=log)
+    except KeyboardInterrupt:
+        return EXIT_CANCELLED
+    for line in format_preflight_report(report):
+        print(line, flush=True)
+    return EXIT_ERRORS if report['totals']['errors'] else EXIT_OK
+
+
+def build_arg_parser():
+    formats = sorted(set(OUTPUT_FORMATS.values()))
+    parser = argparse.ArgumentParser(
+        prog="transgemini",
+        description="Пакетный перевод TXT/DOCX/EPUB через Gemini API без GUI.")
+    parser.add_argument("inputs", nargs="+", help="Входные файлы или папки (.txt, .docx, .epub).")
+    parser.add_argument("-o", "--output-dir", help="Папка для результатов (не нужна для --dry-run).")
+    parser.add_argument("-f", "--format", dest="output_format", choices=formats, default="txt",
+                        help="Формат вывода (epub = пересборка EPUB->EPUB).")
+    parser.add_argument("-m", "--model", help="Модель: имя из списка GUI или id (например gemini-2.0-flash).")
+    parser.add_argument("-c", "--concurrency", type=int,
+                        help="Макс. параллельных запросов (по умолчанию min(RPM модели, 15)).")
+    parser.add_argument("-t", "--temperature", type=float, default=1.0)
+    parser.add_argument("--prompt-file", help="Файл промпта (должен содержать {text}). По умолчанию встроенный.")
+    chunking = parser.add_mutually_exclusive_group()
+    chunking.add_argument("--chunking", dest="chunking", action="store_true", default=None,
+                          help="Включить чанкинг (по умолчанию - как требует модель).")
+    chunking.add_argument("--no-chunking", dest="chunking", action="store_false")
+    parser.add_argument("--chunk-limit", type=int, default=DEFAULT_CHARACTER_LIMIT_FOR_CHUNK)
+    parser.add_argument("--chunk-window", type=int, default=DEFAULT_CHUNK_SEARCH_WINDOW)
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Задержка между чанками, сек.")
+    parser.add_argument("--epub-parts", choices=("auto", "all"), default="auto",
+                        help="Выбор HTML частей EPUB: auto - эвристика как в GUI, all - все кроме NAV.")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="Всегда переводить части EPUB по маске (можно несколько раз).")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="Никогда не переводить части EPUB по маске (приоритетнее --include).")
+    parser.add_argument("--extract-workers", type=int, default=DEFAULT_EXTRACTION_WORKERS, metavar="N",
+                        help="Процессы извлечения текста из HTML/DOCX (0 = в потоках, без процессов).")
+    parser.add_argument("--schedule", choices=tuple(SCHEDULING_POLICIES.values()), default=DEFAULT_SCHEDULING_POLICY,
+                        help="Порядок задач: balanced - крупные первыми, EPUB по очереди; lpt - крупные первыми; "
+                             "fifo - по порядку файлов.")
+    parser.add_argument("--request-timeout", type=float, default=API_TIMEOUT_SECONDS, metavar="SEC",
+                        help="Таймаут одного запроса к API, сек.")
+    parser.add_argument("--chunk-deadline", type=float, default=CHUNK_DEADLINE_SECONDS, metavar="SEC",
+                        help="Срок на чанк со всеми повторами, сек. (0 = без срока).")
+    hedging = parser.add_mutually_exclusive_group()
+    hedging.add_argument("--hedge", dest="hedging", action="store_true", default=HEDGING_ENABLED,
+                         help="Дублировать запросы, идущие дольше p95 для чанков того же размера "
+                              "(при запасе по RPM/TPM), брать первый ответ.")
+    hedging.add_argument("--no-hedge", dest="hedging", action="store_false")
+    fallback = parser.add_mutually_exclusive_group()
+    fallback.add_argument("--fallback", action="append", default=None, metavar="MODEL",
+                          help="Резервная модель на время разомкнутого автомата основной (можно несколько раз, "
+                               "по порядку). По умолчанию - MODEL_FALLBACK_CHAIN из config.py.")
+    fallback.add_argument("--no-fallback", dest="fallback", action="store_const", const=[],
+                          help="Без резервных моделей.")
+    parser.add_argument("--api-key", help="Google API Key (или GOOGLE_API_KEY / GEMINI_API_KEY).")
+    parser.add_argument("--proxy", help="URL прокси (http(s)://, socks5(h)://).")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Порт Prometheus /metrics на 127.0.0.1 (0 = выкл).")
+    parser.add_argument("--metrics-textfile", default=METRICS_TEXTFILE_PATH,
+                        help="Файл для textfile collector node_exporter.")
+    parser.add_argument("--run-log", default=None, metavar="PATH",
+                        help=f"Журнал событий JSONL (по умолчанию {RUN_LOG_FILENAME} в папке вывода, \"\" = выкл).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Только извлечь и разбить на чанки, без API: символы, токены, запросы, время по RPM.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Не выводить [INFO]/[USAGE] строки.")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    log = lambda message: _log(message, quiet=args.quiet)
+
+    try:
+        model_name, model_config = resolve_model(args.model)
+        files = expand_inputs(args.inputs)
+        prompt_template = DEFAULT_PROMPT_TEMPLATE
+        if args.prompt_file:
+            with open(args.prompt_file, 'r', encoding='utf-8') as f:
+                prompt_template = f.read()
+        if args.request_timeout <= 0 or args.chunk_deadline < 0:
+            raise CliUsageError("--request-timeout должен быть > 0, --chunk-deadline >= 0.")
+        if args.extract_workers < 0:
+            raise CliUsageError("--extract-workers не может быть отрицательным.")
+        if "{text}" not in prompt_template:
+            raise CliUsageError("Промпт ДОЛЖЕН содержать плейсхолдер {text}.")
+        api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
+        if not api_key and not args.dry_run:
+            raise CliUsageError("API ключ не предоставлен (--api-key или GOOGLE_API_KEY).")
+        if not args.output_dir and not args.dry_run:
+            raise CliUsageError("Не указана папка для результатов (-o/--output-dir).")
+        check_dependencies(files, args.output_format, need_api=not args.dry_run)
+        if not args.dry_run:
+            os.makedirs(args.output_dir, exist_ok=True)
+        fallback_models = None if args.fallback is None else [resolve_model(name)[0] for name in args.fallback]
+        job_data = build_job_data(files, args.output_format, args.epub_parts, args.include, args.exclude, log)
+    except (CliUsageError, OSError) as e:
+        print(f"transgemini: ошибка: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    concurrency = args.concurrency or max(1, min(model_config.get('rpm', 1), 15))
+    chunking = model_config.get('needs_chunking', False) if args.chunking is None else args.chunking
+
+    if args.dry_run:
+        return run_dry_run(args, job_data, model_config, concurrency, chunking, prompt_template, log)
+
+    from transgemini.core.engine import TranslationEngine
+
+    engine = TranslationEngine(
+        api_key, args.output_dir, prompt_template, job_data,
+        model_config, concurrency, args.output_format,
+        chunking, args.chunk_limit, args.chunk_window,
+        args.temperature, args.chunk_delay,
+        proxy_string=args.proxy,
+        metrics_port=args.metrics_port,
+        metrics_textfile=args.metrics_textfile,
+        extraction_workers=args.extract_workers,
+        run_log_path=args.run_log,
+        scheduling_policy=args.schedule,
+        request_timeout=args.request_timeout,
+        chunk_deadline=args.chunk_deadline,
+        hedging=args.hedging,
+        fallback_models=fallback_models
+    )
+    result = {}
+    engine.log_message.connect(log)
+    engine.finished.connect(lambda success, errors, details: result.update(
+        success=success, errors=errors, details=details))
+
+    log(f"Модель: {model_name}, параллельно: {concurrency}, формат: .{args.output_format}, "
+        f"чанкинг: {'да' if chunking else 'нет'}")
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        engine.cancel()
+        return EXIT_CANCELLED
+
+    if result.get('details'):
+        log("Детали ошибок/отмен/пропусков:")
+        for error in result['details']:
+            log(f"- {error}")
+    if engine.is_cancelled:
+        return EXIT_CANCELLED
+    return EXIT_OK if result.get('errors', 1) == 0 else EXIT_ERRORS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
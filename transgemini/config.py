@@ -1,4 +1,5 @@
-import importlib
+import importlib.util
+import os
 import subprocess
 import sys
 
@@ -7,6 +8,7 @@ MODELS = {
     "Gemini 2.5 Flash Preview 05-20": {  # From user list / original code
         "id": "models/gemini-2.5-flash-preview-05-20",
         "rpm": 10,  # Moderate RPM
+        "tpm": 250_000,  # Tokens per minute limit
         "needs_chunking": True,  # Assume requires chunking
         "post_request_delay": 60  # Delay for Flash models
     },
@@ -14,6 +16,7 @@ MODELS = {
     "Gemini 2.5 Flash-Lite Preview": {  # From user list / original code
         "id": "models/gemini-2.5-flash-lite-preview-06-17",
         "rpm": 15,  # Moderate RPM
+        "tpm": 250_000,  # Tokens per minute limit
         "needs_chunking": True,  # Assume requires chunking
         "post_request_delay": 60  # Delay for Flash models
     },
@@ -21,6 +24,7 @@ MODELS = {
     "Gemini 2.5 Pro Experimental 03-25": {  # From user list / original code
         "id": "models/gemini-2.5-pro-preview-03-25",
         "rpm": 10,  # Moderate RPM
+        "tpm": 250_000,  # Tokens per minute limit
         "needs_chunking": True,  # Assume requires chunking
         "post_request_delay": 60  # Delay for Flash models
     },
@@ -28,24 +32,28 @@ MODELS = {
     "Gemini 2.0 Flash": {  # From user list / original code
         "id": "models/gemini-2.0-flash",
         "rpm": 15,  # Higher RPM for Flash
+        "tpm": 1_000_000,  # Tokens per minute limit
         "needs_chunking": True,  # Requires chunking for large inputs
         "post_request_delay": 60  # Delay for Flash models
     },
     "Gemini 2.0 Flash Experimental": {  # From user list / original code
         "id": "models/gemini-2.0-flash-exp",
         "rpm": 10,  # Higher RPM for Flash
+        "tpm": 1_000_000,  # Tokens per minute limit
         "needs_chunking": True,  # Requires chunking for large inputs
         "post_request_delay": 60  # Delay for Flash models
     },
     "Gemini 2.0 Flash-Lite": {  # From user list
         "id": "models/gemini-2.0-flash-lite",
         "rpm": 20,  # Guess: Higher than standard Flash
+        "tpm": 1_000_000,  # Guess
         "needs_chunking": True,  # Assume needs chunking like other Flash
         "post_request_delay": 60  # Assume needs delay like other Flash
     },
     "Gemini 2.0 Flash Live": {  # From user list
         "id": "models/gemini-2.0-flash-live-001",
         "rpm": 15,  # Guess: Similar to standard Flash
+        "tpm": 1_000_000,  # Guess
         "needs_chunking": True,  # Assume needs chunking
         "post_request_delay": 60  # Assume needs delay
     },
@@ -53,6 +61,7 @@ MODELS = {
     "Gemini 1.5 Flash": {  # From user list (using recommended 'latest' tag)
         "id": "models/gemini-1.5-flash-latest",
         "rpm": 20,  # Guess: Higher RPM for Flash models
+        "tpm": 1_000_000,  # Guess
         "needs_chunking": True,  # Assume needs chunking
         "post_request_delay": 60  # Assume needs delay
     },
@@ -64,14 +73,89 @@ DEFAULT_MODEL_NAME = "Gemini 2.5 Flash Preview" if "Gemini 2.0 Flash" in MODELS
 MAX_RETRIES = 3
 RETRY_DELAY_SECONDS = 25
 API_TIMEOUT_SECONDS = 600  # 10 минут
+# Срок на один чанк со всеми повторами: таймаут запроса урезается до остатка срока,
+# повтор, который начался бы после срока, не назначается (0 = без срока)
+CHUNK_DEADLINE_SECONDS = 1800
+# Запрос, не ответивший за таймаут + столько секунд, бросается (поток API освобождается)
+API_CALL_GRACE_SECONDS = 30
+FINISH_INFLIGHT_GRACE_SECONDS = 60  # "Завершить": сколько ждать запросы, уже отправленные к API
+
+# Хеджирование: запрос, идущий дольше p95 задержек для промптов того же размера, дублируется,
+# берется первый успешный ответ (второй бросается, его токены все равно расходуются)
+HEDGING_ENABLED = False
+HEDGE_LATENCY_PERCENTILE = 0.95
+HEDGE_LATENCY_WINDOW = 200  # Последних успешных запросов на класс размера
+HEDGE_MIN_SAMPLES = 10  # Меньше замеров - порога нет, дубликаты не отправляются
+HEDGE_MIN_DELAY_SECONDS = 5.0  # Нижняя граница порога
+HEDGE_MAX_FRACTION = 0.1  # Не больше стольких дубликатов на запрос
+HEDGE_RATE_HEADROOM = 0.8  # Дубликат - только пока RPM/TPM (с ним) ниже этой доли лимитов модели
+
+# Автомат (circuit breaker) на модель: после стольких ошибок подряд (квота, перегрузка) модель
+# не получает запросов CIRCUIT_BREAKER_OPEN_SECONDS, затем пропускает пробные запросы
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_OPEN_SECONDS = 120
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = 1  # Пробных запросов одновременно
+CIRCUIT_BREAKER_ERROR_TYPES = ("429", "503", "500", "504", "retry_failed")  # см. metrics.classify_api_error
+# Резервные модели (ключи MODELS) по порядку: пока автомат модели разомкнут, чанки уходят следующей
+# доступной модели цепочки после выбранной. Модель не из цепочки работает без резерва.
+MODEL_FALLBACK_CHAIN = ["Gemini 2.5 Flash Preview 05-20", "Gemini 2.0 Flash", "Gemini 2.0 Flash-Lite"]
 
 DEFAULT_CHARACTER_LIMIT_FOR_CHUNK = 900_000  # Default limit (can be adjusted in GUI)
 DEFAULT_CHUNK_SEARCH_WINDOW = 500  # Default window (can be adjusted in GUI)
 MIN_CHUNK_SIZE = 500  # Minimum size to avoid tiny chunks
 CHUNK_HTML_SOURCE = True  # Keep False: HTML chunking with embedded images is complex and disabled by default
 
+# Конвейер обработки: parse (чтение/извлечение) -> translate (API) -> write (запись/сборка EPUB)
+PIPELINE_STAGES = ('parse', 'translate', 'write')
+PIPELINE_PARSE_WORKERS = 2  # Потоки чтения входных файлов и HTML частей EPUB
+PIPELINE_WRITE_WORKERS = 2  # Потоки записи результатов и сборки EPUB
+PIPELINE_QUEUE_FACTOR = 2  # Размер очереди стадии = потоки стадии * factor (ограничивает память)
+# Процессы для извлечения текста из HTML/DOCX (BeautifulSoup/python-docx не отпускают GIL).
+# 0 = извлечение в потоках стадии parse, без дочерних процессов.
+DEFAULT_EXTRACTION_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+MAX_EXTRACTION_WORKERS = max(1, os.cpu_count() or 1)
+# Общий ZipFile на EPUB (core/epub_reader.py): кэш прочитанных частей на одну книгу
+EPUB_READER_CACHE_BYTES = 32 * 1024 * 1024
+EPUB_READER_CACHE_MAX_MEMBER = 4 * 1024 * 1024  # Большие части (изображения, шрифты) не кэшируются
+# Хранилище изображений (core/image_store.py): ключ - sha256 содержимого, одинаковые картинки хранятся один раз.
+# Сверх бюджета байты сбрасываются в одну временную папку запуска.
+IMAGE_STORE_MEMORY_BYTES = 256 * 1024 * 1024
+# Сжатие выходных ZIP (EPUB, DOCX; core/zip_writer.py).
+# Уже сжатые форматы пишутся без сжатия (deflate их не уменьшает, только тратит время).
+ZIP_STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.woff', '.woff2',
+                         '.mp3', '.mp4', '.m4a', '.ogg', '.zip', '.gz')
+ZIP_STORED_MEDIA_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'font/woff', 'font/woff2',
+                          'application/font-woff', 'audio/mpeg', 'audio/mp4', 'video/mp4')
+ZIP_DEFAULT_DEFLATE_LEVEL = 6
+# Уровень deflate по расширению: текст хорошо сжимается и дешев, шрифты/EMF - средний уровень
+ZIP_DEFLATE_LEVELS = {
+    '.xhtml': 9, '.html': 9, '.htm': 9, '.css': 9, '.xml': 9, '.opf': 9, '.ncx': 9, '.svg': 9, '.rels': 9,
+    '.txt': 9, '.ttf': 6, '.otf': 6, '.emf': 6, '.wmf': 6, '.bmp': 6, '.tif': 6, '.tiff': 6,
+}
+ZIP_PARALLEL_MIN_BYTES = 256 * 1024  # Члены больше этого сжимаются в потоках (zlib отпускает GIL)
+ZIP_COMPRESS_WORKERS = max(1, min(4, os.cpu_count() or 1))
+EPUB_SCAN_WORKERS = max(1, min(8, os.cpu_count() or 1))  # Потоки фонового анализа EPUB при выборе файлов
+# Порядок подачи задач (core/scheduler.py): отображаемое имя -> политика. В ini: SchedulingPolicy
+SCHEDULING_POLICIES = {
+    "Крупные первыми, EPUB по очереди": "balanced",
+    "Крупные первыми": "lpt",
+    "По порядку списка": "fifo",
+}
+DEFAULT_SCHEDULING_POLICY = "balanced"
+
+# <title> с такими значениями не считается названием главы
+GENERIC_DOC_TITLES = (
+    'untitled', 'unknown', 'navigation', 'toc', 'table of contents', 'index',
+    'contents', 'оглавление', 'содержание', 'индекс',
+    'cover', 'title page', 'copyright', 'chapter'
+)
+
 SETTINGS_FILE = 'translator_settings.ini'
 
+# Кэш разобранной структуры EPUB (OPF/NAV/NCX) по отпечатку архива; None отключает кэш на диске
+EPUB_MANIFEST_CACHE_DIR = os.environ.get(
+    'TRANSGEMINI_EPUB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'transgemini', 'epub_manifest'))
+
 OUTPUT_FORMATS = {
     "Текстовый файл (.txt)": "txt",
     "Документ Word (.docx)": "docx",
@@ -84,32 +168,148 @@ DEFAULT_OUTPUT_FORMAT_DISPLAY = "Текстовый файл (.txt)"  # Default
 
 IMAGE_PLACEHOLDER_PREFIX = "img_placeholder_"
 
+DEFAULT_PROMPT_TEMPLATE = """--- PROMPT START ---
+
+**Твоя Роль:** Переводчик и редактор, адаптирующий тексты (литература, статьи, DOCX, HTML) с разных языков на русский. Учитывай культурные особенности (Япония, Китай, Корея, США), речевые обороты, форматирование текста и HTML.
+
+**Твоя Задача:** Адаптируй текст `{text}` на русский, сохраняя смысл, стиль, исходное форматирование и плейсхолдеры изображений `<||img_placeholder_...||>`.
+
+**II. ПРИНЦИПЫ АДАПТАЦИИ**
+
+1.  **Естественный русский:** Избегай буквальности, ищи русские эквиваленты.
+2.  **Смысл и тон:** Точно передавай смысл, атмосферу, авторский стиль.
+3.  **Культурная адаптация:**
+    *   **Хонорифики (-сан, -кун):** Опускай или заменяй естественными обращениями (по имени, господин/госпожа). Транслитерация – крайне редко.
+    *   **Реалии:** Адаптируй (русский эквивалент, краткое пояснение в тексте). Без сносок.
+    *   **Ономатопея:** Заменяй русскими звукоподражаниями или описаниями.
+
+**III. ФОРМАТИРОВАНИЕ И СПЕЦТЕГИ**
+
+1.  **Простой Текст / Markdown:**
+    *   **Абзацы:** Сохраняй; если нет – расставляй по правилам русского языка.
+    *   **Заголовки (Markdown `#`, `##`):** Сохраняй разметку.
+    *   **Списки (`*`, `-`, `1.`):** Переводи текст элемента, сохраняй маркеры.
+    *   **Оглавления:** Формат: **Глава X: Название главы** ... текст ... (Конец главы).
+
+2.  **HTML Контент:**
+    *   **ВАЖНО: СОХРАНЯЙ ВСЕ HTML-ТЕГИ!** Переводи **ТОЛЬКО видимый текст** (внутри `<p>`, `<h1>`, `<li>`, `<td>`, `<span>`, `<a>`, значения атрибутов `title`, `alt` и т.д.).
+    *   **НЕ МЕНЯЙ, НЕ УДАЛЯЙ, НЕ ДОБАВЛЯЙ** HTML-теги, атрибуты или структуру (исключение: плейсхолдеры изображений).
+    *   HTML-комментарии (`<!-- ... -->`), `<script>`, `<style>` – **БЕЗ ИЗМЕНЕНИЙ.**
+
+3.  **<|| ПЛЕЙСХОЛДЕРЫ ИЗОБРАЖЕНИЙ ||>**
+    *   Теги вида `<||img_placeholder_xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx||>` (где `x` - 32 шестнадцатеричных символа).
+    *   **КРИТИЧЕСКИ ВАЖНО: КОПИРУЙ ЭТИ ТЕГИ АБСОЛЮТНО ТОЧНО, СИМВОЛ В СИМВОЛ. НЕ МЕНЯЙ, НЕ УДАЛЯЙ, НЕ ДОБАВЛЯЙ ПРОБЕЛОВ ВНУТРИ, НЕ ПЕРЕВОДИ. ОНИ ДОЛЖНЫ ОСТАТЬСЯ НА СВОИХ МЕСТАХ.**
+
+4.  **Стилизация и Пунктуация (для ВСЕХ типов контента):**
+    *   Реплики `[]` -> `— Реплика`.
+    *   Японские кавычки `『』` -> русские «елочки» (`«Цитата»`).
+    *   Мысли персонажей в скобках -> `«Мысль...»` (без тире перед кавычками).
+    *   Названия навыков, предметов, квестов -> `[Название]`.
+    *   Длинные повторы символов -> 4-5 (напр., `А-а-а-а...`). Используй дефис: `П-привет`, `А-а-ах!`.
+    *   Фразы с `...!` или `...?` -> знак препинания *перед* многоточием (`Текст!..`, `Текст?..`).
+    *   Избегай множественных знаков препинания в конце фраз -> `А?`, `А!`, `А?!`.
+
+**V. ГЛОССАРИЙ**
+
+*   Если предоставлен – **строго придерживайся**.
+
+**VI. ИТОГОВЫЙ РЕЗУЛЬТАТ**
+
+*   **ТОЛЬКО** переведенный и адаптированный текст/HTML, **СОХРАНЯЯ ПЛЕЙСХОЛДЕРЫ `<||img_placeholder_...||>` БЕЗ ИЗМЕНЕНИЙ.**
+*   **БЕЗ** вводных фраз («Вот перевод:»).
+*   **БЕЗ** оригинального текста.
+*   **БЕЗ** твоих комментариев (кроме неизмененных HTML-комментариев).
+
+--- PROMPT END ---
+    """
+
 TRANSLATED_SUFFIX = "_translated"
 
+USAGE_REPORT_FILENAME = "transgemini_usage_report.json"  # Token usage report written to the output folder
+RUN_LOG_FILENAME = "transgemini_run_log.jsonl"  # Machine-readable event log (JSON Lines) in the output folder
+RUN_LOG_FLUSH_INTERVAL_SECONDS = 1.0
+
+METRICS_PORT = 0  # Prometheus /metrics endpoint on 127.0.0.1 (0 = disabled)
+METRICS_TEXTFILE_PATH = ""  # node_exporter textfile collector output, e.g. /var/lib/node_exporter/transgemini.prom
+METRICS_TEXTFILE_INTERVAL_SECONDS = 15
+
+# Лог GUI: сообщения копятся в буфере и выводятся пачкой по таймеру, виджет хранит последние строки,
+# полный лог (без фильтра по уровню) пишется в файл. В ini: GuiLogLevel / GuiLogFile
+GUI_LOG_MAX_LINES = 5000
+GUI_LOG_FLUSH_INTERVAL_MS = 200
+GUI_LOG_LEVEL = "INFO"  # Минимальный уровень в окне: DEBUG, INFO, WARN, ERROR
+GUI_LOG_FILE = "translator_gui.log"  # "" - не писать лог в файл
+
+# Пробный прогон (--dry-run, core/preflight.py): грубые оценки без токенизатора модели
+PREFLIGHT_CHARS_PER_TOKEN = 4.0  # Латиница и разметка
+PREFLIGHT_NON_ASCII_CHARS_PER_TOKEN = 1.5  # Кириллица, CJK и прочие не-ASCII символы
+PREFLIGHT_OUTPUT_TOKEN_RATIO = 1.3  # Выходных токенов на входной токен текста (русский перевод длиннее)
+PREFLIGHT_REQUEST_OVERHEAD_SECONDS = 5.0  # Задержка ответа без учета генерации
+PREFLIGHT_OUTPUT_TOKENS_PER_SECOND = 150.0  # Скорость генерации ответа
+
+# Панель мониторинга GUI: снимок состояния движка читается по таймеру, а не на каждое событие
+DASHBOARD_REFRESH_INTERVAL_MS = 1000
+DASHBOARD_MAX_FILE_ROWS = 200  # Строк в таблице файлов (сначала файлы в работе)
+
+# (pip package, import name) of every dependency. Nothing is checked or installed at
+# import time: entry points call find_missing_packages()/ensure_packages() explicitly.
+REQUIRED_PACKAGES = [
+    ("beautifulsoup4", "bs4"),
+    ("PySocks", "socks"),  # For SOCKS proxy support
+    ("PyQt6", "PyQt6"),
+    ("google-generativeai", "google.generativeai"),
+    ("python-docx", "docx"),
+    ("lxml", "lxml"),
+    ("Pillow", "PIL"),
+]
+GUI_ONLY_PACKAGES = ("PyQt6",)
+
+
+def is_package_available(import_name):
+    """find_spec-based check, does not import the package itself."""
+    try:
+        return importlib.util.find_spec(import_name) is not None
+    except (ImportError, ValueError):  # parent package missing
+        return False
+
+
+def find_missing_packages(include_gui=True, import_names=None):
+    """Returns [(package_name, import_name), ...] of missing dependencies."""
+    return [(package_name, import_name) for package_name, import_name in REQUIRED_PACKAGES
+            if (include_gui or package_name not in GUI_ONLY_PACKAGES)
+            and (import_names is None or import_name in import_names)
+            and not is_package_available(import_name)]
+
+
 def ensure_package(package_name, import_name=None, extras=None):
     """Проверяет наличие пакета и устанавливает его при необходимости."""
     import_name = import_name or package_name
-    if importlib.util.find_spec(import_name) is None:
+    if not is_package_available(import_name):
         print(f"Пакет '{package_name}' не найден. Устанавливаю...")
         try:
             install_target = package_name + extras if extras else package_name
             subprocess.check_call([sys.executable, "-m", "pip", "install", install_target])
+            importlib.invalidate_caches()
         except Exception as e:
             print(f"Не удалось установить пакет '{package_name}': {e}")
             return False
     return True
 
-ensure_package("bs4", "bs4")
-ensure_package("PySocks", "socks")  # For SOCKS proxy support
-ensure_package("PyQt6", "PyQt6")
-ensure_package("google-generativeai", "google")
-ensure_package("python-docx", "docx")
-ensure_package("lxml", "lxml")
-ensure_package("ebooklib", "ebooklib")
-ensure_package("Pillow", "PIL")
-
-DOCX_AVAILABLE = importlib.util.find_spec("docx") is not None
-LXML_AVAILABLE = importlib.util.find_spec("lxml") is not None
-EBOOKLIB_AVAILABLE = importlib.util.find_spec("ebooklib") is not None
-PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
-BS4_AVAILABLE = importlib.util.find_spec("bs4") is not None
\ No newline at end of file
+
+def ensure_packages(include_gui=True):
+    """Installs missing dependencies via pip (GUI start). Returns the packages still missing."""
+    for package_name, import_name in find_missing_packages(include_gui):
+        ensure_package(package_name, import_name)
+    refresh_available_flags()
+    return find_missing_packages(include_gui)
+
+
+def refresh_available_flags():
+    global DOCX_AVAILABLE, LXML_AVAILABLE, PILLOW_AVAILABLE, BS4_AVAILABLE
+    DOCX_AVAILABLE = is_package_available("docx")
+    LXML_AVAILABLE = is_package_available("lxml")
+    PILLOW_AVAILABLE = is_package_available("PIL")
+    BS4_AVAILABLE = is_package_available("bs4")
+
+
+refresh_available_flags()
@@ -0,0 +1,2 @@
+class ChunkDeadlineError(Exception):
+    """Raised when the chunk deadline (CHUNK_DEADLINE_SECONDS) is reached before a successful API call."""
@@ -0,0 +1,6 @@
+class CircuitOpenError(Exception):
+    """Raised when every model of the fallback chain has an open circuit breaker (retry_in: seconds to a probe)."""
+
+    def __init__(self, message, retry_in=None):
+        super().__init__(message)
+        self.retry_in = retry_in
@@ -0,0 +1,83 @@
+from PyQt6 import QtWidgets
+from PyQt6.QtWidgets import QGroupBox, QGridLayout, QLabel, QTableWidget, QTableWidgetItem, QHeaderView
+
+from transgemini.config import DASHBOARD_MAX_FILE_ROWS
+from transgemini.core.utils import format_duration
+
+STATUS_LABELS = {'active': "в работе", 'stopped': "остановлен", 'done': "готово", 'original': "оригинал",
+                 'failed': "ошибка"}
+_STATUS_ORDER = {'active': 0, 'stopped': 1, 'failed': 2, 'original': 3, 'done': 4}
+
+
+class DashboardPanel(QGroupBox):
+    """Throughput panel fed with TranslationEngine.dashboard_snapshot() dicts (update_snapshot)."""
+
+    def __init__(self, parent=None):
+        super().__init__("Мониторинг", parent)
+        layout = QGridLayout(self)
+        self.rpm_label = QLabel()
+        self.tpm_label = QLabel()
+        self.inflight_label = QLabel()
+        self.retry_label = QLabel()
+        self.chunks_label = QLabel()
+        self.eta_label = QLabel()
+        for i, label in enumerate((self.rpm_label, self.tpm_label, self.inflight_label,
+                                   self.retry_label, self.chunks_label, self.eta_label)):
+            layout.addWidget(label, i // 3, i % 3)
+
+        self.files_table = QTableWidget(0, 3)
+        self.files_table.setHorizontalHeaderLabels(["Файл", "Чанки", "Статус"])
+        self.files_table.verticalHeader().setVisible(False)
+        self.files_table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.files_table.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.NoSelection)
+        header = self.files_table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
+        self.files_table.setMinimumHeight(100)
+        layout.addWidget(self.files_table, 2, 0, 1, 3)
+        self.reset()
+
+    def reset(self):
+        self.rpm_label.setText("Запросы/мин: —")
+        self.tpm_label.setText("Токены/мин: —")
+        self.inflight_label.setText("В работе: —")
+        self.retry_label.setText("Ретраи: —")
+        self.chunks_label.setText("Чанки: —")
+        self.eta_label.setText("Осталось: —")
+        self.files_table.setRowCount(0)
+
+    def update_snapshot(self, snapshot):
+        rpm_limit, tpm_limit = snapshot['rpm_limit'], snapshot['tpm_limit']
+        self.rpm_label.setText(f"Запросы/мин: {snapshot['requests_per_minute']:.0f}" +
+                               (f" / {rpm_limit}" if rpm_limit else ""))
+        self.tpm_label.setText(f"Токены/мин: {snapshot['tokens_per_minute']:,.0f}" +
+                               (f" / {tpm_limit:,}" if tpm_limit else ""))
+        self.inflight_label.setText(f"В работе: {snapshot['inflight_requests']} / {snapshot['concurrency_limit']}")
+        backoff = f", ждут ретрая: {snapshot['retry_waiting']}" if snapshot['retry_waiting'] else ""
+        hedges = f", дубликатов: {snapshot['hedged_total']} (выиграли {snapshot['hedge_wins']})" \
+            if snapshot['hedged_total'] else ""
+        self.retry_label.setText(f"Ретраи: {snapshot['retries_total']}, ошибки: {snapshot['errors_total']}"
+                                 f"{backoff}{hedges}")
+        self.chunks_label.setText(f"Чанки: {snapshot['chunks_finished']} готово, ~{snapshot['chunks_remaining']} осталось")
+        self.eta_label.setText(f"Прошло: {format_duration(snapshot['elapsed_seconds'])}, "
+                               f"осталось: {format_duration(snapshot['eta_seconds'])}")
+        self._update_files(snapshot['files'])
+
+    def _update_files(self, files):
+        rows = sorted(files, key=lambda f: _STATUS_ORDER.get(f['status'], len(_STATUS_ORDER)))[:DASHBOARD_MAX_FILE_ROWS]
+        table = self.files_table
+        table.setUpdatesEnabled(False)
+        try:
+            table.setRowCount(len(rows))
+            for row, file_info in enumerate(rows):
+                values = (file_info['file'], f"{file_info['done']}/{file_info['total']}",
+                          STATUS_LABELS.get(file_info['status'], file_info['status']))
+                for column, value in enumerate(values):
+                    item = table.item(row, column)
+                    if item is None:
+                        table.setItem(row, column, QTableWidgetItem(value))
+                    elif item.text() != value:
+                        item.setText(value)
+        finally:
+            table.setUpdatesEnabled(True)
@@ -1,17 +1,63 @@
 import os
-import re
-from pathlib import Path
 
 from PyQt6 import QtWidgets, QtCore, QtGui
-from PyQt6.QtWidgets import (
-    QApplication, QDialog, QVBoxLayout, QListWidget, QPushButton,
-    QDialogButtonBox, QLabel, QWidget, QLineEdit, QComboBox, QSpinBox,
-    QCheckBox, QPlainTextEdit, QDoubleSpinBox, QProgressBar, QTextEdit,
-    QGridLayout, QGroupBox, QHBoxLayout, QMessageBox, QFileDialog, QScrollArea
-)
-from PyQt6.QtCore import QStandardPaths, Qt
+from PyQt6.QtWidgets import QDialog, QVBoxLayout, QListView, QDialogButtonBox, QLabel, QCheckBox
+from PyQt6.QtCore import Qt
 
-from transgemini.config import TRANSLATED_SUFFIX
+from transgemini.core.epub_structure import classify_epub_html_part
+
+NAV_BACKGROUND_COLOR = "#fff0f0"
+
+
+class EpubPartsModel(QtCore.QAbstractListModel):
+    """Read-only list of EPUB HTML parts; classification (classify_epub_html_part) is computed once per file."""
+
+    def __init__(self, html_files, nav_path, parent=None):
+        super().__init__(parent)
+        self.parts = []
+        for file_path in html_files:
+            part_info = classify_epub_html_part(file_path, nav_path)
+            self.parts.append({
+                'text': file_path,
+                'is_nav': part_info['is_nav'],
+                'is_translated': part_info['is_translated'],
+                'auto_select': part_info['auto_select'],
+                'tooltip': (f"{file_path}\n(Это файл ОГЛАВЛЕНИЯ EPUB3 (NAV).\nНЕ РЕКОМЕНДУЕТСЯ переводить - ссылки обновятся автоматически.)"
+                            if part_info['is_nav'] else file_path),
+            })
+        self._nav_brush = QtGui.QBrush(QtGui.QColor(NAV_BACKGROUND_COLOR))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.parts)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        part = self.parts[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return part['text']
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return part['tooltip']
+        if role == Qt.ItemDataRole.BackgroundRole and part['is_nav']:
+            return self._nav_brush
+        return None
+
+
+class TranslatedFilterProxyModel(QtCore.QSortFilterProxyModel):
+    """Hides '_translated' parts when hide_translated is set (reads the source model's flags directly)."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.hide_translated = False
+
+    def set_hide_translated(self, hide):
+        # сброс вместо invalidateFilter(): при чередовании строк тот сигналит удаление каждой строки отдельно
+        self.beginResetModel()
+        self.hide_translated = hide
+        self.endResetModel()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return not (self.hide_translated and self.sourceModel().parts[source_row]['is_translated'])
 
 
 class EpubHtmlSelectorDialog(QDialog):
@@ -34,67 +80,20 @@ class EpubHtmlSelectorDialog(QDialog):
             "Если отмечено, файлы с суффиксом _translated (например, chapter1_translated.html) будут скрыты из списка."
         )
         self.hide_translated_checkbox.setChecked(False)
-        self.hide_translated_checkbox.stateChanged.connect(self.update_file_visibility)  # Эта строка остается
+        self.hide_translated_checkbox.stateChanged.connect(self.update_file_visibility)
         layout.addWidget(self.hide_translated_checkbox)
 
-        self.list_widget = QListWidget()
-        self.list_widget.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
-
-        self.list_widget.itemSelectionChanged.connect(self.update_selection_count_label)
-
-        self.all_html_files_with_data = []  # Эта часть остается как была
-        for file_path in html_files:
-            item = QtWidgets.QListWidgetItem(file_path)
-            is_nav = (nav_path and file_path == nav_path)
-            is_translated = Path(file_path).stem.endswith(TRANSLATED_SUFFIX)  # Проверяем суффикс
-
-            self.all_html_files_with_data.append({
-                'text': file_path,
-                'is_nav': is_nav,
-                'is_translated': is_translated  # Сохраняем, является ли файл переведенным
-            })
+        # Модель/представление: строки рисуются только видимые, фильтр не пересоздает элементы
+        self.parts_model = EpubPartsModel(html_files, nav_path, self)
+        self.proxy_model = TranslatedFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.parts_model)
 
-            if is_nav:
-                item.setBackground(QtGui.QColor("#fff0f0"))  # Light red background for NAV
-                item.setToolTip(
-                    f"{file_path}\n(Это файл ОГЛАВЛЕНИЯ EPUB3 (NAV).\nНЕ РЕКОМЕНДУЕТСЯ переводить - ссылки обновятся автоматически.)")
-                item.setSelected(False)  # Deselect NAV by default
-            else:
-                item_text_lower = item.text().lower()
-                path = Path(item_text_lower)
-                filename_lower = path.name
-                filename_base = path.stem.split('.')[0]  # Get stem before first dot
-
-                skip_indicators = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                                   'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                                   'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                                   'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                                   'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
-                content_indicators = ['chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main',
-                                      'article',
-                                      'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue']
-
-                is_likely_skip = any(skip in filename_base for skip in skip_indicators)
-                parent_dir_lower = str(path.parent).lower()
-                is_likely_skip = is_likely_skip or any(skip in parent_dir_lower for skip in
-                                                       ['toc', 'nav', 'meta', 'frontmatter', 'backmatter', 'index',
-                                                        'notes'])
-                is_likely_content = any(indicator in filename_base for indicator in content_indicators)
-                is_chapter_like = re.fullmatch(r'(ch|gl|chap|chapter|part|section|sec|glava)[\d_-]+.*',
-                                               filename_base) or \
-                                  re.fullmatch(r'[\d]+', filename_base) or \
-                                  re.match(r'^[ivxlcdm]+$', filename_base)
-
-                if not is_likely_skip and (is_likely_content or is_chapter_like):
-                    item.setSelected(True)
-                else:
-                    if not is_likely_skip and 'text' in filename_base:
-                        item.setSelected(True)
-                    else:
-                        item.setSelected(False)
-                item.setToolTip(file_path)
-
-        layout.addWidget(self.list_widget)  # Добавляем список
+        self.list_view = QListView()
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setModel(self.proxy_model)
+        self.list_view.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.list_view.selectionModel().selectionChanged.connect(self.update_selection_count_label)
+        layout.addWidget(self.list_view)  # Добавляем список
 
         self.selection_count_label = QLabel("Выбрано: 0 из 0")
         layout.addWidget(self.selection_count_label)
@@ -104,84 +103,46 @@ class EpubHtmlSelectorDialog(QDialog):
         self.button_box.rejected.connect(self.reject)
         layout.addWidget(self.button_box)
 
-        self.update_file_visibility()
+        self.select_source_rows(row for row, part in enumerate(self.parts_model.parts) if part['auto_select'])
+
+    def select_source_rows(self, source_rows):
+        """Selects the given (visible) parts with one selection change, contiguous rows merged into ranges."""
+        source_rows = set(source_rows)
+        selection = QtCore.QItemSelection()
+        run_start = None
+        row_count = self.proxy_model.rowCount()
+        for row in range(row_count + 1):
+            selected = row < row_count and \
+                self.proxy_model.mapToSource(self.proxy_model.index(row, 0)).row() in source_rows
+            if selected and run_start is None:
+                run_start = row
+            elif not selected and run_start is not None:
+                selection.select(self.proxy_model.index(run_start, 0), self.proxy_model.index(row - 1, 0))
+                run_start = None
+        self.list_view.selectionModel().select(selection, QtCore.QItemSelectionModel.SelectionFlag.ClearAndSelect)
+        self.update_selection_count_label()
 
     def update_selection_count_label(self):
         """Обновляет метку, показывающую количество выбранных и общее количество видимых файлов."""
-        selected_items_count = len(self.list_widget.selectedItems())
-        total_visible_items_count = self.list_widget.count()  # count() дает количество элементов в виджете
+        selected_items_count = sum(rng.height() for rng in self.list_view.selectionModel().selection())
+        total_visible_items_count = self.proxy_model.rowCount()
         self.selection_count_label.setText(f"Выбрано: {selected_items_count} из {total_visible_items_count} (видимых)")
 
     def update_file_visibility(self):
-        hide_translated = self.hide_translated_checkbox.isChecked()
-
-        current_selected_text = None
-        selected_items_list = self.list_widget.selectedItems()  # QListWidget.selectedItems() returns a list
-        if selected_items_list:  # Check if the list is not empty
-            current_selected_text = selected_items_list[0].text()
-
-        self.list_widget.clear()
-
-        for file_data in self.all_html_files_with_data:
-            if hide_translated and file_data['is_translated']:
-                continue
-
-            item = QtWidgets.QListWidgetItem(file_data['text'])
-
-            if file_data['is_nav']:
-                item.setBackground(QtGui.QColor("#fff0f0"))
-                item.setToolTip(
-                    f"{file_data['text']}\n(Это файл ОГЛАВЛЕНИЯ EPUB3 (NAV).\nНЕ РЕКОМЕНДУЕТСЯ переводить - ссылки обновятся автоматически.)")
-                item.setSelected(False)
-            else:
-                item_text_lower = item.text().lower()
-                path = Path(item_text_lower)
-                filename_base = path.stem.split('.')[0]
-
-                skip_indicators = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
-                                   'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
-                                   'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
-                                   'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
-                                   'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
-                content_indicators = ['chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main',
-                                      'article',
-                                      'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue']
-
-                is_likely_skip = any(skip in filename_base for skip in skip_indicators)
-                parent_dir_lower = str(path.parent).lower()
-                is_likely_skip = is_likely_skip or any(skip in parent_dir_lower for skip in
-                                                       ['toc', 'nav', 'meta', 'frontmatter', 'backmatter', 'index',
-                                                        'notes'])
-
-                is_likely_content = any(indicator in filename_base for indicator in content_indicators)
-
-                is_chapter_like_match = re.fullmatch(r'(ch|gl|chap|chapter|part|section|sec|glava)[\d_-]+.*',
-                                                     filename_base) or \
-                                        re.fullmatch(r'[\d]+', filename_base) or \
-                                        re.match(r'^[ivxlcdm]+$', filename_base)
-
-                content_topic_criteria = bool(is_likely_content or is_chapter_like_match)
-
-                should_be_selected = (not file_data['is_translated'] and
-                                      not is_likely_skip and
-                                      content_topic_criteria)
-
-                if (not should_be_selected and
-                        not file_data['is_translated'] and
-                        not is_likely_skip and
-                        'text' in filename_base):
-                    should_be_selected = True
-
-                item.setSelected(should_be_selected)  # should_be_selected теперь всегда будет True или False
-                item.setToolTip(file_data['text'])
-
-            self.list_widget.addItem(item)
-
-            if current_selected_text and item.text() == current_selected_text:
-                item.setSelected(True)
-
-        self.update_selection_count_label()  # <<< ВОТ ЭТУ СТРОЧКУ ДОБАВИЛИ В КОНЕЦ
+        # Выделение видимых строк сохраняется, скрытые строки выходят из выделения.
+        # Выделение снимается до смены фильтра и ставится заново одним изменением:
+        # иначе прокси обновляет индексы каждого диапазона выделения по отдельности.
+        selected_rows = self.selected_source_rows()
+        self.list_view.selectionModel().clear()
+        self.proxy_model.set_hide_translated(self.hide_translated_checkbox.isChecked())
+        self.select_source_rows(selected_rows)
+
+    def selected_source_rows(self):
+        selected_rows = []
+        for rng in self.list_view.selectionModel().selection():
+            for row in range(rng.top(), rng.bottom() + 1):
+                selected_rows.append(self.proxy_model.mapToSource(self.proxy_model.index(row, 0)).row())
+        return sorted(selected_rows)
 
     def get_selected_files(self):
-        return [self.list_widget.item(i).text() for i in range(self.list_widget.count()) if
-                self.list_widget.item(i).isSelected()]
\ No newline at end of file
+        return [self.parts_model.parts[row]['text'] for row in self.selected_source_rows()]
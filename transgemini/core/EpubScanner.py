@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6 import QtCore
+
+from transgemini.config import EPUB_SCAN_WORKERS
+from transgemini.core.epub_structure import load_epub_structure
+
+
+class EpubScanner(QtCore.QObject):
+    """
+    Scans EPUB structure (load_epub_structure) in a thread pool, several books at once.
+    Results arrive as signals in the thread that owns the scanner (the GUI thread), in completion order.
+    """
+    scanned = QtCore.pyqtSignal(str, object, object)  # epub_path, manifest (None on failure), toc_paths
+    log_message = QtCore.pyqtSignal(str)
+    all_finished = QtCore.pyqtSignal()
+    _scan_done = QtCore.pyqtSignal(int, str, object, object)
+
+    def __init__(self, max_workers=EPUB_SCAN_WORKERS, parent=None):
+        super().__init__(parent)
+        self._max_workers = max_workers
+        self._executor = None
+        self._pending = 0
+        self._generation = 0  # результаты сканирований до cancel() отбрасываются
+        self._scan_done.connect(self._on_scan_done)  # из потока пула -> очередь событий владельца
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def scan(self, epub_path):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="EpubScan")
+        self._pending += 1
+        self._executor.submit(self._scan, self._generation, epub_path)
+
+    def _scan(self, generation, epub_path):
+        try:
+            manifest, toc_paths = load_epub_structure(epub_path, log_callback=self.log_message.emit)
+        except Exception as e:
+            self.log_message.emit(f"[ERROR] Ошибка анализа EPUB {epub_path}: {e}")
+            manifest, toc_paths = None, (None, None, None, None, None)
+        self._scan_done.emit(generation, epub_path, manifest, toc_paths)
+
+    @QtCore.pyqtSlot(int, str, object, object)
+    def _on_scan_done(self, generation, epub_path, manifest, toc_paths):
+        if generation != self._generation:
+            return
+        self._pending -= 1
+        self.scanned.emit(epub_path, manifest, toc_paths)
+        if self._pending == 0:
+            self.all_finished.emit()
+
+    def cancel(self):
+        """Drops pending scans: their results are no longer emitted."""
+        self._generation += 1
+        self._pending = 0
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,2 @@
+class FinishAbandonedError(Exception):
+    """Raised when an in-flight API call is abandoned in finish mode (past FINISH_INFLIGHT_GRACE_SECONDS)."""
@@ -0,0 +1,97 @@
+import re
+import time
+from collections import deque
+
+from PyQt6 import QtCore
+
+from transgemini.config import GUI_LOG_MAX_LINES, GUI_LOG_FLUSH_INTERVAL_MS, GUI_LOG_LEVEL
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARN': 30, 'WARNING': 30, 'ERROR': 40, 'FAIL': 40, 'CRITICAL': 50}
+_LEVEL_PREFIX_RE = re.compile(r'^\[(DEBUG|INFO|WARN|WARNING|ERROR|FAIL|CRITICAL)\b', re.IGNORECASE)
+
+
+def message_level(message):
+    """Level of a log message from its '[WARN]'-style prefix; messages without one are INFO."""
+    match = _LEVEL_PREFIX_RE.match(message)
+    return LOG_LEVELS[match.group(1).upper()] if match else LOG_LEVELS['INFO']
+
+
+class GuiLogSink(QtCore.QObject):
+    """
+    Buffered log output for a QPlainTextEdit: add() only queues lines, a timer appends them in one
+    call, the widget keeps the last max_lines blocks (maximumBlockCount). Lines below min_level are
+    not shown; the log file gets every line.
+    """
+
+    def __init__(self, widget, log_file_path="", min_level=GUI_LOG_LEVEL, max_lines=GUI_LOG_MAX_LINES,
+                 flush_interval_ms=GUI_LOG_FLUSH_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.widget = widget
+        self.widget.setMaximumBlockCount(max_lines)
+        self.min_level = LOG_LEVELS.get(str(min_level).upper(), LOG_LEVELS['INFO'])
+        self._pending = deque(maxlen=max_lines)  # строки сверх лимита виджет все равно бы отбросил
+        self._file_pending = []
+        self._log_file = None
+        self.set_log_file(log_file_path)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(flush_interval_ms)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start()
+
+    def set_min_level(self, level_name):
+        self.min_level = LOG_LEVELS.get(str(level_name).upper(), LOG_LEVELS['INFO'])
+
+    def set_log_file(self, log_file_path):
+        if self._log_file is not None:
+            self._write_file()
+            self._log_file.close()
+            self._log_file = None
+        if log_file_path:
+            try:
+                self._log_file = open(log_file_path, 'a', encoding='utf-8')
+            except OSError as e:
+                self._pending.append(f"[{time.strftime('%H:%M:%S')}] [WARN] Не удалось открыть файл лога '{log_file_path}': {e}")
+
+    def add(self, message):
+        """Queues a (possibly multi-line) message with a timestamp; shown on the next flush()."""
+        message_str = str(message).strip()
+        current_time = time.strftime("%H:%M:%S")
+        lines = [f"[{current_time}] {line}" for line in message_str.splitlines()]
+        if self._log_file is not None:
+            self._file_pending.extend(lines)
+        if message_level(message_str) >= self.min_level:
+            self._pending.extend(lines)
+
+    def flush(self):
+        self._write_file()
+        if not self._pending:
+            return
+        scrollbar = self.widget.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 2  # не дергать, если пользователь листает лог
+        text = "\n".join(self._pending)
+        self._pending.clear()
+        self.widget.appendPlainText(text)
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def _write_file(self):
+        if self._log_file is None or not self._file_pending:
+            return
+        try:
+            self._log_file.write("\n".join(self._file_pending) + "\n")
+            self._log_file.flush()
+        except OSError:
+            pass
+        self._file_pending.clear()
+
+    def clear(self):
+        """Clears the widget (the log file keeps everything)."""
+        self._pending.clear()
+        self.widget.clear()
+
+    def close(self):
+        self._timer.stop()
+        self.flush()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
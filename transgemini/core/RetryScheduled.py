@@ -0,0 +1,8 @@
+class RetryScheduled(Exception):
+    """Raised instead of sleeping when an API call should be retried after `delay` seconds (attempt retries done)."""
+
+    def __init__(self, delay, attempt, error):
+        super().__init__(f"Повтор через {delay} сек. (попытка {attempt}): {error}")
+        self.delay = delay
+        self.attempt = attempt
+        self.error = error
@@ -0,0 +1,2161 @@
+
+import html
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from collections import deque
+from pathlib import Path
+
+from transgemini.config import *
+
+from transgemini.core.ChunkDeadlineError import ChunkDeadlineError
+from transgemini.core.CircuitOpenError import CircuitOpenError
+from transgemini.core.FinishAbandonedError import FinishAbandonedError
+from transgemini.core.OperationCancelledError import OperationCancelledError
+from transgemini.core.RetryScheduled import RetryScheduled
+
+# google.generativeai, parser (docx/bs4/lxml) and the EPUB/FB2 writers are imported
+# where they are used: importing them costs ~1 s and most runs need only a few formats.
+from transgemini.core.metrics import MetricsExporter, TranslationMetrics, classify_api_error
+from transgemini.core.pipeline import Pipeline
+from transgemini.core.run_log import RunLog
+from transgemini.core.scheduler import BUILD_JOB_PRIORITY, order_jobs
+from transgemini.core.epub_reader import get_epub_reader, close_epub_readers
+from transgemini.core.image_store import get_image_store, close_image_store
+from transgemini.core.extraction import ExtractionPool, extract_docx, extract_epub_html
+from transgemini.core.hedging import HedgeTracker
+from transgemini.core.model_router import CLOSED, ModelRouter, STATE_VALUES, fallback_models_for, model_name_for
+from transgemini.core.html_builder import write_to_html
+from transgemini.core.usage_stats import UsageTracker, extract_usage
+from transgemini.core.utils import create_image_placeholder, find_image_placeholders, format_size, \
+    split_text_into_chunks, add_translated_suffix
+
+from concurrent.futures import CancelledError, Future, FIRST_COMPLETED, wait as futures_wait
+
+
+class EngineEvent:
+    """
+    Minimal callback list with the same connect()/emit() interface as pyqtSignal,
+    so the engine can run without Qt (CLI, servers) and be bridged to Qt by Worker.
+    Callbacks are invoked synchronously in the emitting thread.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+
+    def connect(self, callback):
+        self._callbacks.append(callback)
+
+    def disconnect(self, callback=None):
+        if callback is None:
+            self._callbacks = []
+        elif callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def emit(self, *args):
+        for callback in list(self._callbacks):
+            callback(*args)
+
+
+class TranslationEngine:
+    """
+    Qt-free translation engine. Reports progress through EngineEvent attributes:
+      file_progress(int), chunk_progress(str, int, int), current_file_status(str),
+      log_message(str), finished(int, int, list), total_tasks_calculated(int).
+    Machine-readable per-chunk/per-request events go to the JSONL run log (core/run_log.py).
+    """
+
+    def __init__(self, api_key, out_folder, prompt_template, files_to_process_data,
+                 model_config, max_concurrent_requests, output_format,
+                 chunking_enabled_gui, chunk_limit, chunk_window,
+                 temperature, chunk_delay_seconds, proxy_string=None,  # <-- Добавлен proxy_string
+                 metrics_port=None, metrics_textfile=None, extraction_workers=None, run_log_path=None,
+                 scheduling_policy=None, request_timeout=None, chunk_deadline=None, hedging=None,
+                 fallback_models=None):
+        self.file_progress = EngineEvent()
+        self.chunk_progress = EngineEvent()
+        self.current_file_status = EngineEvent()
+        self.log_message = EngineEvent()
+        self.finished = EngineEvent()
+        self.total_tasks_calculated = EngineEvent()
+
+        self.api_key = api_key
+        self.out_folder = out_folder
+        self.prompt_template = prompt_template
+        self.files_to_process_data = files_to_process_data
+        self.model_config = model_config
+        self.max_concurrent_requests = max_concurrent_requests
+        self.output_format = output_format
+        self.chunking_enabled_gui = chunking_enabled_gui
+        self.chunk_limit = chunk_limit
+        self.chunk_window = chunk_window
+        self.temperature = temperature  # <-- Сохраняем температуру
+        self.chunk_delay_seconds = chunk_delay_seconds  # <-- Сохраняем новую настройку
+        self.proxy_string = proxy_string  # <-- Сохраняем строку прокси
+        self.metrics_port = METRICS_PORT if metrics_port is None else metrics_port
+        self.metrics_textfile = METRICS_TEXTFILE_PATH if metrics_textfile is None else metrics_textfile
+        self.extraction_workers = DEFAULT_EXTRACTION_WORKERS if extraction_workers is None else extraction_workers
+        self.scheduling_policy = scheduling_policy or DEFAULT_SCHEDULING_POLICY
+        self.request_timeout = request_timeout or API_TIMEOUT_SECONDS
+        self.chunk_deadline = CHUNK_DEADLINE_SECONDS if chunk_deadline is None else chunk_deadline
+        # Дубликаты медленных запросов (core/hedging.py); None - выключено
+        self.hedge_tracker = HedgeTracker() if (HEDGING_ENABLED if hedging is None else hedging) else None
+        # Резервные модели (ключи MODELS); None - по MODEL_FALLBACK_CHAIN (core/model_router.py)
+        self.fallback_models = fallback_models_for(model_config) if fallback_models is None else list(fallback_models)
+        self.model_router = None
+        # JSONL журнал событий: None - файл RUN_LOG_FILENAME в папке вывода, "" - выключен
+        if run_log_path is None:
+            run_log_path = os.path.join(out_folder, RUN_LOG_FILENAME) if out_folder else ""
+        self.run_log_path = run_log_path
+        self.run_log = None
+        self.run_id = None  # id запуска в каждой записи журнала событий (журнал дописывается)
+
+        self.is_cancelled = False
+        self.is_finishing = False  # <--- НОВЫЙ ФЛАГ
+        self.finish_requested_at = None
+        self._critical_error_occurred = False
+        self.model = None
+        self.pipeline = None
+        self.extraction_pool = None
+        self.epub_build_states = {}
+        self.total_tasks = 0
+        self.processed_task_count = 0
+        self.success_count = 0
+        self.error_count = 0
+        self.errors_list = []
+        self.usage_tracker = UsageTracker()
+        # Метрики обновляются напрямую из потоков пула, без Qt-сигналов
+        self.metrics = TranslationMetrics()
+        self.metrics_exporter = None
+        # Прогресс чанков по файлам для dashboard_snapshot(): log_prefix -> {'done', 'total', 'status'}
+        self.run_started = None
+        self._file_chunks = {}
+        self._file_chunks_lock = threading.Lock()
+        self.chunk_progress.connect(self._track_chunk_progress)
+
+    def finish_processing(self):  # <--- ВОТ ЭТОТ МЕТОД
+        if not self.is_finishing and not self.is_cancelled:  # Не устанавливать, если уже отменяется
+            self.log_message.emit("[SIGNAL] Получен сигнал ЗАВЕРШЕНИЯ (finish_processing)...")
+            self.finish_requested_at = time.monotonic()
+            self.is_finishing = True
+
+    def setup_client(self):
+        """Initializes the Gemini API client and configures proxy."""
+        try:
+            if not self.api_key: raise ValueError("API ключ не предоставлен.")
+
+            # --- НАЧАЛО ИЗМЕНЕНИЙ ДЛЯ ПРОКСИ ---
+            # Сначала очистим переменные окружения, чтобы избежать конфликтов
+            # с предыдущими запусками или системными настройками, если мы собираемся
+            # использовать PySocks.
+            if 'HTTP_PROXY' in os.environ: os.environ.pop('HTTP_PROXY')
+            if 'HTTPS_PROXY' in os.environ: os.environ.pop('HTTPS_PROXY')
+            applied_proxy_method = "None"
+            proxy_url_for_env = None  # URL, который будет установлен в env, если это HTTP/S
+
+            if self.proxy_string and self.proxy_string.strip():
+                proxy_url_config = self.proxy_string.strip()
+
+                # Автокоррекция socks5(h) -> socks5h
+                if proxy_url_config.lower().startswith("socks5(h)://"):
+                    corrected_url = "socks5h://" + proxy_url_config[len("socks5(h)://"):]
+                    self.log_message.emit(
+                        f"[INFO] Proxy scheme '{proxy_url_config}' auto-corrected to '{corrected_url}'.")
+                    proxy_url_config = corrected_url
+
+                parsed_url = None
+                try:
+                    from urllib.parse import urlparse
+                    parsed_url = urlparse(proxy_url_config)
+                except Exception as e_parse_url:
+                    self.log_message.emit(f"[ERROR] Could not parse proxy URL '{proxy_url_config}': {e_parse_url}")
+                    # Ошибка парсинга URL, прокси не будет применен.
+                    # genai.configure может упасть позже, если сеть недоступна.
+
+                if parsed_url and parsed_url.scheme.lower() in ["socks5", "socks5h"]:
+                    try:
+                        import socks  # PySocks
+                        import socket
+
+                        host = parsed_url.hostname
+                        port = parsed_url.port
+                        username = parsed_url.username
+                        password = parsed_url.password
+
+                        if not host or not port:
+                            raise ValueError("SOCKS5/SOCKS5h URL is missing host or port.")
+
+                        is_rdns = parsed_url.scheme.lower() == "socks5h"
+
+                        # Сохраняем оригинальный socket.socket, если он еще не сохранен PySocks
+                        if not hasattr(socks, '_original_socket_module_attrs'):
+                            socks._original_socket_module_attrs = {'socket': socket.socket}  # Простой способ сохранить
+                        elif 'socket' not in socks._original_socket_module_attrs:
+                            socks._original_socket_module_attrs['socket'] = socket.socket
+
+                        socks.set_default_proxy(
+                            socks.SOCKS5,
+                            host,
+                            port,
+                            rdns=is_rdns,
+                            username=username if username else None,
+                            password=password if password else None
+                        )
+                        socket.socket = socks.socksocket  # Monkeypatch
+
+                        applied_proxy_method = f"{parsed_url.scheme.upper()} via PySocks: {host}:{port} (RDNS={is_rdns})"
+                        self.log_message.emit(f"[INFO] {applied_proxy_method}")
+                        # Важно: Не устанавливаем HTTP_PROXY/HTTPS_PROXY для SOCKS, когда используется PySocks.
+                    except ImportError:
+                        self.log_message.emit(
+                            "[ERROR] PySocks library not found, but SOCKS proxy specified. Please install 'PySocks'.")
+                        self.log_message.emit(f"       Прокси '{proxy_url_config}' НЕ будет применен.")
+                        applied_proxy_method = "SOCKS Error (PySocks missing)"
+                    except ValueError as ve:
+                        self.log_message.emit(f"[ERROR] Invalid SOCKS5/SOCKS5h URL '{proxy_url_config}': {ve}")
+                        applied_proxy_method = "SOCKS Error (URL invalid)"
+                    except Exception as e_socks:
+                        self.log_message.emit(
+                            f"[ERROR] Failed to set SOCKS proxy '{proxy_url_config}' using PySocks: {e_socks}\n{traceback.format_exc()}")
+                        applied_proxy_method = f"SOCKS Error ({type(e_socks).__name__})"
+
+                elif parsed_url and parsed_url.scheme.lower() in ["http", "https"]:
+                    proxy_url_for_env = proxy_url_config  # Этот URL пойдет в переменные окружения
+                    applied_proxy_method = f"{parsed_url.scheme.upper()} via ENV: {proxy_url_for_env}"
+                    self.log_message.emit(f"[INFO] {applied_proxy_method}")
+                elif self.proxy_string and self.proxy_string.strip():  # Если URL был, но схема неизвестна или не парсится
+                    self.log_message.emit(
+                        f"[WARN] Unknown or unparseable proxy URL: '{self.proxy_string.strip()}'. Proxy settings via environment variables will be attempted.")
+                    proxy_url_for_env = self.proxy_string.strip()  # Попытка установить "как есть"
+                    applied_proxy_method = "Unknown scheme (attempting ENV)"
+
+            # Устанавливаем переменные окружения только если это HTTP/HTTPS прокси
+            # или если это была неизвестная схема, где мы пытаемся установить "как есть".
+            if proxy_url_for_env:
+                os.environ['HTTP_PROXY'] = proxy_url_for_env
+                os.environ['HTTPS_PROXY'] = proxy_url_for_env
+                if applied_proxy_method == "Unknown scheme (attempting ENV)":
+                    self.log_message.emit(f"        (Set HTTP_PROXY/HTTPS_PROXY to '{proxy_url_for_env}')")
+            elif not (applied_proxy_method.startswith("SOCKS5 via PySocks") or applied_proxy_method.startswith(
+                    "SOCKS5H via PySocks")):
+                if self.proxy_string and self.proxy_string.strip() and applied_proxy_method == "None":  # Если был proxy_string, но не распознался
+                    self.log_message.emit(
+                        f"[WARN] Proxy '{self.proxy_string.strip()}' was provided but not applied due to parsing/scheme issues. No proxy configured by application.")
+                elif not (self.proxy_string and self.proxy_string.strip()):
+                    self.log_message.emit("[INFO] No proxy string provided. Proxy not configured by the application.")
+
+            # --- КОНЕЦ ИЗМЕНЕНИЙ ДЛЯ ПРОКСИ ---
+
+            from google import generativeai as genai
+            genai.configure(api_key=self.api_key)
+            self.model = genai.GenerativeModel(
+                self.model_config['id']
+            )
+            self.model_router = ModelRouter(model_name_for(self.model_config), self.model_config,
+                                            self.fallback_models, log_callback=self.log_message.emit,
+                                            on_state_change=self._on_circuit_change)
+            for route in self.model_router.routes:
+                route['model'] = self.model if not route['fallback'] else genai.GenerativeModel(route['config']['id'])
+                self.metrics.circuit_state.set(STATE_VALUES[route['breaker'].state], model=route['config']['id'])
+
+            self.log_message.emit(f"Используется модель: {self.model_config['id']}")
+            if len(self.model_router.routes) > 1:
+                self.log_message.emit(
+                    "Резервные модели (при разомкнутом автомате): " +
+                    " -> ".join(route['name'] for route in self.model_router.routes[1:]))
+            self.log_message.emit(f"Температура: {self.temperature:.1f}")
+
+            self.log_message.emit(f"Параллельные запросы (макс): {self.max_concurrent_requests}")
+            self.log_message.emit(f"Формат вывода: .{self.output_format}")
+            self.log_message.emit(f"Таймаут API: {self.request_timeout} сек., срок чанка: "
+                                  f"{f'{self.chunk_deadline} сек.' if self.chunk_deadline else 'нет'}")
+            if self.hedge_tracker:
+                self.log_message.emit(f"Хеджирование: дубликат запроса после p{HEDGE_LATENCY_PERCENTILE * 100:.0f} "
+                                      f"задержек (мин. {HEDGE_MIN_DELAY_SECONDS} сек., до "
+                                      f"{HEDGE_MAX_FRACTION:.0%} запросов)")
+            self.log_message.emit(f"Макс. ретраев при 429/503/500/504: {MAX_RETRIES}")
+            if self.model_config.get('post_request_delay', 0) > 0:
+                self.log_message.emit(f"Доп. задержка после запроса: {self.model_config['post_request_delay']} сек.")
+
+            model_needs_chunking = self.model_config.get('needs_chunking', False)
+            actual_chunking_behavior = "ВКЛЮЧЕН (GUI)" if self.chunking_enabled_gui else "ОТКЛЮЧЕН (GUI)"
+            reason = ""
+            if self.chunking_enabled_gui:
+                chunk_info = f"(Лимит: {self.chunk_limit:,} симв., Окно: {self.chunk_window:,} симв.)"
+                if self.chunk_delay_seconds > 0:
+                    chunk_info += f", Задержка: {self.chunk_delay_seconds:.1f} сек.)"
+                else:
+                    chunk_info += ")"
+                if model_needs_chunking:
+                    reason = f"{chunk_info} - Модель его требует."
+                else:
+                    reason = f"{chunk_info} - Применяется если файл > лимита."
+                if not CHUNK_HTML_SOURCE: reason += " [Чанкинг HTML отключен]"
+            else:
+                reason = "(ВНИМАНИЕ: модель может требовать чанкинг!)" if model_needs_chunking else "(модель не требует)"
+            self.log_message.emit(f"Чанкинг: {actual_chunking_behavior} {reason}")
+            self.log_message.emit(f"Формат плейсхолдера изображения: {create_image_placeholder('uuid_example')}")
+            self.log_message.emit("Клиент Gemini API успешно настроен.")
+            return True
+        except Exception as e:
+            self.log_message.emit(f"[ERROR] Ошибка настройки клиента Gemini API: {e}\n{traceback.format_exc()}")
+            # Попытка отменить monkeypatch, если он был применен
+            if 'applied_proxy_method' in locals() and applied_proxy_method.endswith("via PySocks"):
+                try:
+                    import socket
+                    import socks
+                    # Простой способ сбросить настройки прокси в PySocks
+                    socks.set_default_proxy()
+                    # Восстановить оригинальный socket.socket
+                    if hasattr(socks,
+                               '_original_socket_module_attrs') and 'socket' in socks._original_socket_module_attrs:
+                        socket.socket = socks._original_socket_module_attrs['socket']
+                        self.log_message.emit("[INFO] Attempted to revert PySocks monkeypatch on error.")
+                    else:
+                        self.log_message.emit(
+                            "[WARN] Could not reliably revert PySocks monkeypatch on error (original socket not found).")
+                except Exception as e_revert:
+                    self.log_message.emit(f"[WARN] Error trying to revert PySocks monkeypatch: {e_revert}")
+            # Очищаем переменные окружения на всякий случай, если они были установлены ошибочно
+            if 'HTTP_PROXY' in os.environ: os.environ.pop('HTTP_PROXY')
+            if 'HTTPS_PROXY' in os.environ: os.environ.pop('HTTPS_PROXY')
+            return False
+
+    def _generate_content_with_retry(self, prompt_for_api, context_log_prefix="API Call", usage_context=None,
+                                     event_context=None, attempt=0, defer_retries=False, deadline=None):
+        """
+        Makes the API call with retry logic for specific errors and applies temperature.
+        Checks for cancellation and handles various API errors robustly.
+        Simplified version focusing on correct content extraction and error reporting.
+        usage_context: optional {'file': ..., 'epub': ...} used to attribute token usage.
+        event_context: optional {'file': ..., 'chunk': ...} added to the JSONL run log 'request'/'retry' events.
+        attempt: retries already made for this prompt (a deferred retry resumes the count).
+        defer_retries: raise RetryScheduled(delay, ...) instead of sleeping before a retry.
+        deadline: time.monotonic() value; each request timeout is cut to what is left of it and no retry
+        is scheduled past it (ChunkDeadlineError once it is reached).
+        Each attempt goes to the first model of self.model_router whose circuit breaker is closed; when an
+        error opens the breaker, the next attempt goes to a fallback model without waiting. The id of the
+        model that answered is put in event_context['model'].
+        """
+        from google import generativeai as genai
+        from google.api_core import exceptions as google_exceptions
+
+        retries = attempt
+        failovers = 0
+        last_error = None
+
+        safety_settings = [
+            {"category": c, "threshold": "BLOCK_NONE"} for c in [
+                "HARM_CATEGORY_HARASSMENT",
+                "HARM_CATEGORY_HATE_SPEECH",
+                "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                "HARM_CATEGORY_DANGEROUS_CONTENT",
+            ]
+        ]
+
+        generation_config_dict = {"temperature": self.temperature}
+        if hasattr(genai, 'GenerationConfig'):
+            generation_config_obj = genai.GenerationConfig(temperature=self.temperature)
+        else:
+            generation_config_obj = generation_config_dict
+
+        while retries <= MAX_RETRIES:  # Основной цикл для сетевых ошибок
+            if self.is_cancelled:
+                raise OperationCancelledError(f"Отменено ({context_log_prefix})")
+
+            response_obj = None
+            request_event = dict(event_context or {}, attempt=retries + 1, latency_s=None)
+            request_timeout = self.request_timeout
+            if deadline is not None:
+                request_timeout = min(request_timeout, deadline - time.monotonic())
+                if request_timeout <= 0:
+                    deadline_error = ChunkDeadlineError(f"Истек срок чанка ({context_log_prefix})")
+                    self._note_api_error(deadline_error, request_event=request_event)
+                    self.log_message.emit(f"[FAIL] {context_log_prefix}: {deadline_error}")
+                    raise deadline_error
+            request_event['timeout_s'] = round(request_timeout, 1)
+            lease = self.model_router.acquire()
+            if lease is None:  # автоматы всех моделей разомкнуты: ожидание пробного запроса - как попытка
+                retry_in = round(self.model_router.retry_in(), 1)
+                circuit_error = CircuitOpenError("Все модели недоступны (автоматы разомкнуты)", retry_in)
+                retries += 1
+                if retries > MAX_RETRIES or (deadline is not None and time.monotonic() + retry_in >= deadline):
+                    self.log_message.emit(f"[FAIL] {context_log_prefix}: {circuit_error}, попытки или срок чанка "
+                                          f"исчерпаны.")
+                    raise circuit_error
+                self.log_message.emit(f"[WARN] {context_log_prefix}: {circuit_error}. Попытка {retries}/{MAX_RETRIES} "
+                                      f"через {retry_in} сек...")
+                if defer_retries:
+                    raise RetryScheduled(retry_in, retries, circuit_error)
+                self._wait_before_retry(retry_in, "Отменено во время ожидания доступной модели")
+                continue
+            route = lease['route']
+            model_id = request_event['model'] = route['config']['id']
+            try:
+                self.metrics.inflight_requests.inc()
+                request_started = time.monotonic()
+                try:
+                    response_obj = self._call_abortable(
+                        lambda call_timeout, model=route['model']: model.generate_content(
+                            contents=prompt_for_api,
+                            safety_settings=safety_settings,
+                            generation_config=generation_config_obj,
+                            request_options={'timeout': call_timeout}
+                        ), request_timeout, context_log_prefix,
+                        hedge_size=len(prompt_for_api) if isinstance(prompt_for_api, str) else None,
+                        request_event=request_event)
+                finally:
+                    self.metrics.inflight_requests.dec()
+                    request_latency = time.monotonic() - request_started
+                    request_event['latency_s'] = round(request_latency, 3)
+                    self.metrics.latency.observe(request_latency, model=model_id)
+
+                translated_text = None
+                problem_details = ""
+
+                # 1. Проверяем prompt_feedback (если есть) на явный блок
+                if hasattr(response_obj, 'prompt_feedback') and response_obj.prompt_feedback:
+                    if hasattr(response_obj.prompt_feedback,
+                               'block_reason') and response_obj.prompt_feedback.block_reason:
+                        block_reason_name = str(response_obj.prompt_feedback.block_reason)
+                        if block_reason_name not in ["BLOCK_REASON_UNSPECIFIED", "0"]:
+                            problem_details = f"Запрос заблокирован API (Prompt Feedback): {block_reason_name}. Full Feedback: {str(response_obj.prompt_feedback)}"
+                            self.log_message.emit(f"[API BLOCK] {context_log_prefix}: {problem_details}")
+                            raise RuntimeError(problem_details)  # Это фатальная ошибка для данного запроса
+
+                # 2. Проверяем кандидатов
+                if hasattr(response_obj, 'candidates') and response_obj.candidates:
+                    candidate = response_obj.candidates[0]
+                    candidate_finish_reason = getattr(candidate, 'finish_reason', None)
+
+                    # Проверяем на проблемные finish_reason
+                    # Важно: FinishReason может быть объектом enum или числом.
+                    # В вашем логе 'FinishReason.PROHIBITED_CONTENT' - это объект.
+                    # finish_reason == 8 также был 'OTHER' или проблемой.
+
+                    finish_reason_name = ""
+                    if candidate_finish_reason is not None:
+                        try:  # Пытаемся получить имя из enum, если это объект enum
+                            finish_reason_name = candidate_finish_reason.name
+                        except AttributeError:  # Если это число или строка
+                            finish_reason_name = str(candidate_finish_reason)
+                    request_event['finish_reason'] = finish_reason_name or None
+
+                    # Список "плохих" причин завершения (можно расширить)
+                    # PROHIBITED_CONTENT было в вашем логе, SAFETY - стандартная, OTHER(8) - тоже проблема
+                    bad_finish_reasons_names = ["SAFETY", "PROHIBITED_CONTENT", "RECITATION", "OTHER"]
+                    # Числовые эквиваленты (если SDK возвращает числа)
+                    bad_finish_reasons_numbers_str = ["2", "3", "4", "8"]  # "2" для SAFETY, "8" для OTHER и т.д.
+
+                    if finish_reason_name.upper() in bad_finish_reasons_names or \
+                            finish_reason_name in bad_finish_reasons_numbers_str:
+                        problem_details = (f"Проблема с генерацией контента у кандидата. "
+                                           f"Finish Reason: {finish_reason_name}. "
+                                           f"Safety Ratings: {getattr(candidate, 'safety_ratings', 'N/A')}")
+                        self.log_message.emit(f"[API CONTENT ISSUE] {context_log_prefix}: {problem_details}")
+                        raise RuntimeError(problem_details)  # Фатально для этого запроса
+
+                    # Если finish_reason хороший, пытаемся извлечь текст
+                    if hasattr(candidate, 'content') and hasattr(candidate.content,
+                                                                 'parts') and candidate.content.parts:
+                        text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
+                        if text_parts:
+                            translated_text = "".join(text_parts)
+
+                # 3. Если текст не извлечен из кандидата, пробуем response.text (с осторожностью)
+                if translated_text is None:
+                    if hasattr(response_obj, 'text'):
+                        try:
+                            # Эта строка вызывала ValueError в вашем случае
+                            # Если finish_reason был плохим, мы уже должны были выйти с RuntimeError
+                            # Значит, если мы здесь, finish_reason должен быть нормальным (STOP, UNSPECIFIED, MAX_TOKENS)
+                            # но .text все равно может вызвать ошибку, если Parts пустые по другой причине.
+                            current_text = response_obj.text  # Попытка доступа
+                            if current_text is not None:  # Убедимся, что это не None
+                                translated_text = current_text
+                            else:  # .text вернул None, но явной ошибки не было
+                                problem_details = ("response.text вернул None, но finish_reason был нормальным. "
+                                                   f"Кандидаты: {getattr(response_obj, 'candidates', 'N/A')}")
+                                self.log_message.emit(f"[API CONTENT WARNING] {context_log_prefix}: {problem_details}")
+                                raise RuntimeError(problem_details)
+                        except ValueError as ve:  # Перехватываем ValueError от response.text
+                            problem_details = (f"Ошибка ValueError при доступе к response.text: {ve}. "
+                                               f"FinishReason (из лога): {finish_reason_name if 'finish_reason_name' in locals() else 'неизвестно'}. "
+                                               f"Кандидаты: {getattr(response_obj, 'candidates', 'N/A')}")
+                            self.log_message.emit(f"[API CONTENT ERROR] {context_log_prefix}: {problem_details}")
+                            raise RuntimeError(problem_details) from ve  # Перевыбрасываем с деталями
+
+                if translated_text is None:  # Если текст так и не получен
+                    problem_details = (f"Не удалось извлечь текст из ответа API. "
+                                       f"FinishReason (из лога): {finish_reason_name if 'finish_reason_name' in locals() else 'неизвестно'}. "
+                                       f"Кандидаты: {getattr(response_obj, 'candidates', 'N/A')}")
+                    self.log_message.emit(f"[API CONTENT FAIL] {context_log_prefix}: {problem_details}")
+                    raise RuntimeError(problem_details)
+
+                # Если все хорошо, и текст получен:
+                self.model_router.settle(lease, True)
+                self.metrics.requests.inc(model=model_id, outcome="ok")
+                usage = self._record_usage(response_obj, context_log_prefix, usage_context, model_id=model_id)
+                if event_context is not None:
+                    event_context['model'] = model_id
+                if route['fallback']:
+                    self.log_message.emit(f"[INFO] {context_log_prefix}: переведено резервной моделью {route['name']}.")
+                self._log_event('request', outcome="ok",
+                                prompt_tokens=usage['prompt_tokens'] if usage else None,
+                                candidates_tokens=usage['candidates_tokens'] if usage else None,
+                                total_tokens=usage['total_tokens'] if usage else None,
+                                response_chars=len(translated_text), **request_event)
+                delay_needed = route['config'].get('post_request_delay', 0)
+                if delay_needed > 0:
+                    self.log_message.emit(f"[INFO] {context_log_prefix}: Применяем задержку {delay_needed} сек...")
+                    slept_time = 0
+                    while slept_time < delay_needed:
+                        if self.is_cancelled: raise OperationCancelledError("Отменено во время пост-задержки")
+                        time.sleep(1);
+                        slept_time += 1
+                return translated_text
+
+            except (google_exceptions.ResourceExhausted,
+                    google_exceptions.DeadlineExceeded,
+                    google_exceptions.ServiceUnavailable,
+                    google_exceptions.InternalServerError,
+                    google_exceptions.RetryError
+                    ) as retryable_error:
+                error_code_map = {
+                    google_exceptions.ResourceExhausted: "429 Limit",
+                    google_exceptions.ServiceUnavailable: "503 Unavailable",
+                    google_exceptions.InternalServerError: "500 Internal",
+                    google_exceptions.DeadlineExceeded: "504 Timeout",
+                    google_exceptions.RetryError: "Retry Failed"
+                }
+                error_code = error_code_map.get(type(retryable_error), "API Transient")
+                if isinstance(retryable_error, google_exceptions.RetryError) and retryable_error.__cause__:
+                    nested_code = error_code_map.get(type(retryable_error.__cause__), "Unknown")
+                    error_code = f"Retry Failed ({nested_code})"
+
+                last_error = retryable_error
+                if classify_api_error(retryable_error) in CIRCUIT_BREAKER_ERROR_TYPES:
+                    self.model_router.settle(lease, False)
+                    if route['breaker'].state != CLOSED and failovers < len(self.model_router.routes) and \
+                            self.model_router.has_alternative(route):
+                        # модель выключена автоматом: сразу на резервную, без ожидания и без траты попытки
+                        failovers += 1
+                        self._note_api_error(last_error, retry_delay=0, request_event=request_event)
+                        self.log_message.emit(f"[WARN] {context_log_prefix}: Ошибка {error_code} модели {route['name']}, "
+                                              f"автомат разомкнут - повтор на резервной модели.")
+                        continue
+                retries += 1
+                error_details_log = f"  Полная ошибка: {str(last_error)}\n  Args: {getattr(last_error, 'args', 'N/A')}"
+                if hasattr(last_error, 'debug_error_string') and callable(
+                        getattr(last_error, 'debug_error_string', None)):
+                    error_details_log += f"\n  Debug String: {last_error.debug_error_string()}"
+
+                delay = RETRY_DELAY_SECONDS * (2 ** (retries - 1))
+                if retries > MAX_RETRIES:
+                    self._note_api_error(last_error, request_event=request_event)
+                    self.log_message.emit(
+                        f"[FAIL] {context_log_prefix}: Ошибка {error_code}, исчерпаны попытки ({MAX_RETRIES}).\n{error_details_log}")
+                    raise last_error
+                elif deadline is not None and time.monotonic() + delay >= deadline:
+                    self._note_api_error(last_error, request_event=request_event)
+                    self.log_message.emit(
+                        f"[FAIL] {context_log_prefix}: Ошибка {error_code}, повтор через {delay} сек. "
+                        f"не успевает до срока чанка.\n{error_details_log}")
+                    raise last_error
+                else:
+                    self._note_api_error(last_error, retry_delay=delay, request_event=request_event)
+                    self.log_message.emit(
+                        f"[WARN] {context_log_prefix}: Ошибка {error_code}. Попытка {retries}/{MAX_RETRIES} через {delay} сек...\n{error_details_log}")
+                    if defer_retries:
+                        raise RetryScheduled(delay, retries, last_error)
+                    self._wait_before_retry(delay, f"Отменено во время ожидания retry ({error_code})")
+                    continue
+
+            except (google_exceptions.InvalidArgument,
+                    google_exceptions.PermissionDenied,
+                    google_exceptions.Unauthenticated,
+                    google_exceptions.NotFound
+                    ) as non_retryable_error:
+                error_type_name = type(non_retryable_error).__name__
+                self._note_api_error(non_retryable_error, request_event=request_event)
+                self.log_message.emit(
+                    f"[API FAIL] {context_log_prefix}: Неисправимая ошибка API ({error_type_name}): {non_retryable_error}\n"
+                    f"  Args: {getattr(non_retryable_error, 'args', 'N/A')}"
+                )
+                raise non_retryable_error
+
+            except RuntimeError as rte:  # Перехватываем наши собственные RuntimeError (проблемы с контентом)
+                self.model_router.settle(lease, True)  # модель отвечает: для автомата это не сбой
+                # Эти ошибки уже залогированы там, где они возникли
+                # Если это была первая сетевая попытка (retries == 0) и мы хотим дать шанс основному циклу ретраев,
+                # то нужно увеличить retries и continue, если retries < MAX_RETRIES.
+                # Но для PROHIBITED_CONTENT и SAFETY это не поможет.
+                # Для OTHER - может быть.
+                # Пока что, если RuntimeError из-за контента, считаем это фатальной ошибкой для этой сетевой попытки.
+                # Основной цикл ретраев сработает, если это была не последняя сетевая попытка.
+                if "Запрос заблокирован API" in str(rte) or "Критическая причина завершения" in str(
+                        rte) or "Проблема с генерацией контента у кандидата" in str(rte):
+                    # Для этих случаев ретрай бессмысленен
+                    self._note_api_error(rte, request_event=request_event)
+                    raise rte  # Перевыбрасываем
+
+                # Для других RuntimeError (например, "Не удалось извлечь текст...") можно попробовать сетевой ретрай, если он есть
+                rte_delay = RETRY_DELAY_SECONDS * (2 ** retries)
+                if retries < MAX_RETRIES and (deadline is None or time.monotonic() + rte_delay < deadline):
+                    self.log_message.emit(
+                        f"[WARN] {context_log_prefix}: Ошибка контента ({rte}). Попытка сетевого ретрая {retries + 1}/{MAX_RETRIES}...")
+                    last_error = rte  # Сохраняем ошибку
+                    retries += 1
+                    # Задержка перед следующим сетевым ретраем
+                    delay = RETRY_DELAY_SECONDS * (2 ** (retries - 1))  # Используем уже инкрементированный retries
+                    self._note_api_error(rte, retry_delay=delay, request_event=request_event)
+                    self.log_message.emit(f"       Ожидание {delay} сек перед сетевым ретраем...")
+                    if defer_retries:
+                        raise RetryScheduled(delay, retries, rte)
+                    self._wait_before_retry(delay, "Отменено во время ожидания RTE-ретрая")
+                    continue
+                else:  # Если сетевые ретраи исчерпаны
+                    self._note_api_error(rte, request_event=request_event)
+                    raise rte  # Перевыбрасываем исходную ошибку контента
+
+
+            except OperationCancelledError:  # отмена во время запроса (_call_abortable)
+                raise
+
+            except FinishAbandonedError as abandoned_error:  # запрос брошен в режиме завершения (_call_abortable)
+                self._note_api_error(abandoned_error, request_event=request_event)
+                self.log_message.emit(f"[FINISHING] {context_log_prefix}: {abandoned_error}")
+                raise abandoned_error
+
+            except Exception as e:  # Общий обработчик
+                error_type_name = type(e).__name__
+                self._note_api_error(e, request_event=request_event)
+                tb_str = traceback.format_exc()
+                response_details_log = ""
+                # ... (блок извлечения деталей из response_obj, как был раньше)
+                if 'response_obj' in locals() and response_obj is not None:
+                    fr_name = "N/A";
+                    pf_log = "N/A";
+                    cand_log = "N/A"
+                    try:
+                        if hasattr(response_obj, 'prompt_feedback'): pf_log = str(response_obj.prompt_feedback)
+                        if hasattr(response_obj, 'candidates') and response_obj.candidates:
+                            cand_log = str(response_obj.candidates)
+                            if hasattr(response_obj.candidates[0], 'finish_reason'):
+                                # Попробуем получить .name, если это enum, иначе строку
+                                raw_fr = response_obj.candidates[0].finish_reason
+                                fr_name = getattr(raw_fr, 'name', str(raw_fr))
+                        response_details_log = (f"\n  Детали ответа (если доступны):\n"
+                                                f"    FinishReason: {fr_name}\n"
+                                                f"    Prompt Feedback: {pf_log}\n"
+                                                f"    Candidates: {cand_log}")
+                    except Exception:
+                        response_details_log = "\n  (Не удалось получить доп. детали ответа при ошибке)"
+                self.log_message.emit(
+                    f"[CALL ERROR] {context_log_prefix}: Неожиданная ошибка ({error_type_name}): {e}\n"
+                    f"  Args: {getattr(e, 'args', 'N/A')}"
+                    f"{response_details_log}\n{tb_str}"
+                )
+                raise e
+
+            finally:
+                self.model_router.settle(lease)  # без исхода для автомата (отмена, ошибка клиента)
+
+        # Если вышли из цикла без return (т.е. все MAX_RETRIES исчерпаны)
+        final_error = last_error if last_error else RuntimeError(
+            f"Неизвестная ошибка API после {MAX_RETRIES} ретраев ({context_log_prefix}).")
+        self.log_message.emit(f"[FAIL] {context_log_prefix}: Исчерпаны все попытки. Последняя ошибка: {final_error}")
+        raise final_error
+
+    def _record_usage(self, response_obj, context_log_prefix, usage_context=None, model_id=None):
+        """Accounts tokens from response.usage_metadata and logs live TPM/RPM against model limits."""
+        usage = extract_usage(response_obj)
+        usage_context = usage_context or {}
+        if usage:
+            self.metrics.tokens.inc(usage['prompt_tokens'], kind="prompt")
+            self.metrics.tokens.inc(usage['candidates_tokens'], kind="candidates")
+            self.metrics.tokens.inc(usage['total_tokens'], kind="total")
+        self.usage_tracker.record(usage,
+                                  file_label=usage_context.get('file'),
+                                  epub_path=usage_context.get('epub'),
+                                  model_id=model_id or self.model_config['id'],
+                                  api_key=self.api_key)
+        if usage:
+            self.log_message.emit(
+                f"[USAGE] {context_log_prefix}: Токены: запрос {usage['prompt_tokens']:,}, "
+                f"ответ {usage['candidates_tokens']:,}, всего {usage['total_tokens']:,} | "
+                f"{self.usage_tracker.format_rates(self.model_config)}")
+        else:
+            self.log_message.emit(f"[USAGE] {context_log_prefix}: Ответ без usage_metadata.")
+        return usage
+
+    def _call_abortable(self, call, timeout, context_log_prefix, hedge_size=None, request_event=None):
+        """
+        Runs a blocking API call call(timeout) in its own daemon thread and waits for it, so the caller can
+        leave it: on cancel, FINISH_INFLIGHT_GRACE_SECONDS after 'finish', or when it hangs past timeout +
+        API_CALL_GRACE_SECONDS (DeadlineExceeded, retried like 504). The abandoned call ends in the
+        background when its HTTP timeout fires and its result is dropped.
+        hedge_size: prompt length; with hedging on, a duplicate call is started when this one runs past the
+        HedgeTracker threshold for the size and the rate limits have headroom. The first valid response wins,
+        the other call is abandoned. request_event gets 'hedged'/'hedge_won' for the run log.
+        """
+        from google.api_core import exceptions as google_exceptions
+
+        def start_call(call_timeout, name_suffix):
+            future = Future()
+            self.usage_tracker.note_request()  # в RPM каждый отправленный запрос, а не только успешные
+
+            def run_call():
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(call(call_timeout))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            threading.Thread(target=run_call, name=f"{threading.current_thread().name}_{name_suffix}",
+                             daemon=True).start()
+            return future
+
+        started = time.monotonic()
+        abandon_at = started + timeout + API_CALL_GRACE_SECONDS
+        primary = start_call(timeout, 'Call')
+        pending = [primary]
+        call_started = {primary: started}
+        hedge = None
+        hedge_at = hedge_threshold = None
+        if self.hedge_tracker is not None and hedge_size is not None:
+            self.hedge_tracker.count_call()
+            hedge_threshold = self.hedge_tracker.threshold(hedge_size)
+            if hedge_threshold is not None and hedge_threshold < timeout:
+                hedge_at = started + hedge_threshold
+        fallback = None  # первый ответ без текста, пока второй запрос еще идет
+        last_error = None
+        try:
+            while True:
+                done, _ = futures_wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=call_started.get):
+                    pending.remove(future)
+                    if future.exception() is not None:
+                        last_error = future.exception()
+                        continue
+                    if hedge is not None and pending and not self._response_has_text(future.result()):
+                        fallback = fallback or future
+                        continue
+                    return self._settle_call(future, hedge, pending, call_started, hedge_size,
+                                             context_log_prefix, request_event)
+                if not pending:
+                    if fallback is not None:  # ни один ответ не годен: ошибку разберет вызывающий
+                        return self._settle_call(fallback, hedge, pending, call_started, hedge_size,
+                                                 context_log_prefix, request_event)
+                    if hedge is not None:
+                        self.metrics.hedges.inc(outcome="failed")
+                    raise last_error
+                now = time.monotonic()
+                if self.is_cancelled:
+                    self.metrics.abandoned_calls.inc(len(pending), reason="cancel")
+                    raise OperationCancelledError(f"Запрос к API прерван отменой ({context_log_prefix})")
+                if self.finish_requested_at is not None and \
+                        now - self.finish_requested_at > FINISH_INFLIGHT_GRACE_SECONDS:
+                    # ошибка чанка, а не отмена: уже переведенные чанки файла сохраняются
+                    self.metrics.abandoned_calls.inc(len(pending), reason="finish")
+                    raise FinishAbandonedError(f"Запрос к API прерван: режим завершения, ожидание > "
+                                              f"{FINISH_INFLIGHT_GRACE_SECONDS} сек. ({context_log_prefix})")
+                if now > abandon_at:
+                    self.metrics.abandoned_calls.inc(len(pending), reason="timeout")
+                    raise google_exceptions.DeadlineExceeded(
+                        f"Запрос к API не ответил за {timeout:.0f} сек. ({context_log_prefix})")
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if primary in pending and not self.is_finishing and self._hedge_headroom(hedge_size) \
+                            and self.hedge_tracker.try_hedge():
+                        # дубликат укладывается в тот же срок, что и исходный запрос
+                        hedge = start_call(max(1.0, abandon_at - API_CALL_GRACE_SECONDS - now), 'Hedge')
+                        pending.append(hedge)
+                        call_started[hedge] = now
+                        self.metrics.inflight_requests.inc()
+                        self.log_message.emit(f"[INFO] {context_log_prefix}: запрос идет {now - started:.1f} сек. "
+                                              f"(порог {hedge_threshold:.1f}), отправлен дубликат.")
+        finally:
+            if hedge is not None:
+                self.metrics.inflight_requests.dec()
+
+    def _settle_call(self, winner, hedge, pending, call_started, hedge_size, context_log_prefix, request_event):
+        """Records the winning call of _call_abortable (latency sample, hedge outcome) and returns its response."""
+        now = time.monotonic()
+        latency = now - call_started[winner]
+        if self.hedge_tracker is not None and hedge_size is not None:
+            # замер - время исходного запроса: иначе выигрыши дубликатов занижали бы порог
+            self.hedge_tracker.observe(hedge_size, now - min(call_started.values()))
+        if hedge is not None:
+            hedge_won = winner is hedge
+            if hedge_won:
+                self.hedge_tracker.count_win()
+            self.metrics.hedges.inc(outcome="won" if hedge_won else "lost")
+            if pending:
+                self.metrics.abandoned_calls.inc(len(pending), reason="hedge")
+            if request_event is not None:
+                request_event.update(hedged=True, hedge_won=hedge_won)
+            self.log_message.emit(f"[INFO] {context_log_prefix}: первым ответил "
+                                  f"{'дубликат' if hedge_won else 'исходный запрос'} ({latency:.1f} сек.).")
+        return winner.result()
+
+    @staticmethod
+    def _response_has_text(response_obj):
+        """True when the first candidate has text parts (the response can be used as a translation)."""
+        try:
+            parts = response_obj.candidates[0].content.parts
+            return any(getattr(part, 'text', None) for part in parts)
+        except (AttributeError, IndexError, TypeError):
+            return False
+
+    def _hedge_headroom(self, prompt_chars):
+        """True when one more request of this prompt size keeps RPM/TPM under HEDGE_RATE_HEADROOM of the limits."""
+        tpm, rpm = self.usage_tracker.rates()  # rpm уже включает запросы в полете и ответы с ошибкой
+        rpm_limit = self.model_config.get('rpm') or 0
+        tpm_limit = self.model_config.get('tpm') or 0
+        if rpm_limit and rpm + 1 > rpm_limit * HEDGE_RATE_HEADROOM:
+            return False
+        # оценка токенов дубликата: промпт + ответ (как в пробном прогоне, core/preflight.py)
+        hedge_tokens = prompt_chars / PREFLIGHT_CHARS_PER_TOKEN * (1 + PREFLIGHT_OUTPUT_TOKEN_RATIO)
+        if tpm_limit and tpm + hedge_tokens > tpm_limit * HEDGE_RATE_HEADROOM:
+            return False
+        return True
+
+    def _on_circuit_change(self, route, state):
+        self.metrics.circuit_state.set(STATE_VALUES[state], model=route['config']['id'])
+        self._log_event('circuit', model=route['config']['id'], state=state,
+                        consecutive_failures=route['breaker'].consecutive_failures)
+
+    def _wait_before_retry(self, delay, cancel_message):
+        """Sleeps `delay` seconds before a retry (counted in metrics.retry_waiting), checking cancellation."""
+        self.metrics.retry_waiting.inc()
+        try:
+            slept_time = 0
+            while slept_time < delay:
+                if self.is_cancelled:
+                    raise OperationCancelledError(cancel_message)
+                time.sleep(1);
+                slept_time += 1
+        finally:
+            self.metrics.retry_waiting.dec()
+
+    def _note_api_error(self, error, retry_delay=None, request_event=None):
+        """
+        Counts a failed API attempt in the metrics and the run log; retry_delay is set when a retry is scheduled.
+        request_event: {'file', 'chunk', 'attempt', 'model', 'latency_s', ...} of the failed attempt.
+        """
+        error_type = classify_api_error(error)
+        event_fields = dict(request_event or {}, error_type=error_type, error_class=type(error).__name__)
+        event_fields.setdefault('model', self.model_config['id'])
+        self._log_event('request', outcome="error", **event_fields)
+        if retry_delay is not None:
+            self._log_event('retry', delay_s=retry_delay, **event_fields)
+        self.metrics.errors.inc(type=error_type)
+        if retry_delay is None:
+            self.metrics.requests.inc(model=event_fields['model'], outcome="error")
+        else:
+            self.metrics.retries.inc(type=error_type)
+            self.metrics.retry_sleep.inc(retry_delay)
+
+    def _track_chunk_progress(self, log_prefix, done_chunks, total_chunks):
+        # ("", 0, 0) - сброс индикатора координатором; (prefix, 0, 0) - обработка чанков файла прекращена
+        # (ошибка, отмена, пропуск или оригинал), итоговый статус ставит _set_file_status()
+        if not log_prefix:
+            return
+        with self._file_chunks_lock:
+            entry = self._file_chunks.setdefault(log_prefix, {'done': 0, 'total': 0, 'status': 'active'})
+            if total_chunks == 0:
+                entry['status'] = 'stopped'
+            else:
+                entry.update(done=done_chunks, total=total_chunks,
+                             status='done' if done_chunks >= total_chunks else 'active')
+
+    def _set_file_status(self, log_prefix, status):
+        """Final dashboard status of a finished file/EPUB part: 'done', 'original' or 'failed'."""
+        with self._file_chunks_lock:
+            self._file_chunks.setdefault(log_prefix, {'done': 0, 'total': 0, 'status': status})['status'] = status
+
+    def dashboard_snapshot(self):
+        """
+        Throughput and progress snapshot for a dashboard, safe to call from any thread:
+        requests/tokens per minute vs model limits, in-flight and retry-waiting calls,
+        per-file chunk progress and an ETA from the chunk rate observed so far.
+        """
+        tpm, rpm = self.usage_tracker.rates()
+        with self._file_chunks_lock:
+            files = [dict(entry, file=name) for name, entry in self._file_chunks.items()]
+        elapsed = time.monotonic() - self.run_started if self.run_started else 0.0
+        chunks_finished = int(self.metrics.chunks.total())
+        known_total = sum(f['total'] for f in files)
+        known_remaining = sum(f['total'] - f['done'] for f in files if f['status'] == 'active')
+        # файлы, еще не разбитые на чанки, оцениваются средним числом чанков уже известных файлов
+        file_tasks = self.total_tasks - len(self.epub_build_states)
+        unseen_files = max(0, file_tasks - len(files))
+        avg_chunks = known_total / len(files) if files and known_total else 1.0
+        remaining_chunks = known_remaining + unseen_files * avg_chunks
+        chunk_rate = chunks_finished / elapsed if elapsed > 0 and chunks_finished else 0.0
+        eta_seconds = remaining_chunks / chunk_rate if chunk_rate > 0 else None
+        return {
+            'elapsed_seconds': elapsed,
+            'requests_per_minute': rpm, 'rpm_limit': self.model_config.get('rpm') or 0,
+            'tokens_per_minute': tpm, 'tpm_limit': self.model_config.get('tpm') or 0,
+            'inflight_requests': int(self.metrics.inflight_requests.get()),
+            'concurrency_limit': self.max_concurrent_requests,
+            'retry_waiting': int(self.metrics.retry_waiting.get()),
+            'retries_total': int(self.metrics.retries.total()),
+            'errors_total': int(self.metrics.errors.total()),
+            'hedged_total': int(self.metrics.hedges.total()),
+            'hedge_wins': int(self.metrics.hedges.get(outcome="won")),
+            'tasks_done': self.processed_task_count, 'tasks_total': self.total_tasks,
+            'chunks_finished': chunks_finished, 'chunks_remaining': round(remaining_chunks),
+            'eta_seconds': eta_seconds,
+            'files': files,
+        }
+
+    def _start_metrics_exporter(self):
+        """Starts the optional Prometheus endpoint / textfile writer (settings METRICS_*)."""
+        self.metrics.concurrency_limit.set(self.max_concurrent_requests)
+        if not self.metrics_port and not self.metrics_textfile:
+            return
+        try:
+            self.metrics_exporter = MetricsExporter(self.metrics, port=self.metrics_port,
+                                                    textfile_path=self.metrics_textfile,
+                                                    textfile_interval=METRICS_TEXTFILE_INTERVAL_SECONDS)
+            self.metrics_exporter.start()
+            self.log_message.emit(f"[INFO] Метрики Prometheus: {self.metrics_exporter.describe()}")
+        except Exception as e_metrics:
+            self.metrics_exporter = None
+            self.log_message.emit(f"[WARN] Не удалось запустить экспорт метрик: {e_metrics}")
+
+    def _stop_metrics_exporter(self):
+        for stage_name in PIPELINE_STAGES:
+            self.metrics.queue_depth.set(0, stage=stage_name)
+        self.metrics.inflight_requests.set(0)
+        if self.metrics_exporter:
+            try:
+                self.metrics_exporter.stop()
+            except Exception as e_metrics:
+                self.log_message.emit(f"[WARN] Ошибка остановки экспорта метрик: {e_metrics}")
+            self.metrics_exporter = None
+
+    def _start_run_log(self):
+        if not self.run_log_path:
+            return
+        try:
+            self.run_log = RunLog(self.run_log_path)
+            self.log_message.emit(f"[INFO] Журнал событий (JSONL): {self.run_log_path}, run_id {self.run_id}")
+        except OSError as e_run_log:
+            self.run_log = None
+            self.log_message.emit(f"[WARN] Не удалось открыть журнал событий {self.run_log_path}: {e_run_log}")
+            return
+        self._log_event('run_start', model=self.model_config['id'], output_format=self.output_format,
+                        concurrency=self.max_concurrent_requests, chunking=self.chunking_enabled_gui,
+                        chunk_limit=self.chunk_limit, temperature=self.temperature)
+
+    def _stop_run_log(self):
+        if self.run_log is None:
+            return
+        totals = self.usage_tracker.snapshot()['totals']
+        self._log_event('run_end', success=self.success_count, errors=self.error_count, tasks=self.total_tasks,
+                        cancelled=self.is_cancelled, requests=totals['requests'],
+                        total_tokens=totals['total_tokens'],
+                        hedging=self.hedge_tracker.stats() if self.hedge_tracker else None,
+                        models=self.model_router.stats() if self.model_router else None,
+                        elapsed_s=round(time.monotonic() - self.run_started, 3) if self.run_started else None)
+        self.run_log.close()
+        self.run_log = None
+
+    def _log_event(self, kind, **fields):
+        """Queues one JSONL run log event (no-op when the log is off); never blocks the calling thread."""
+        run_log = self.run_log
+        if run_log is not None:
+            run_log.event(kind, run_id=self.run_id, **fields)
+
+    def _write_usage_report(self):
+        """Logs token totals and saves them to the run report in the output folder."""
+        totals = self.usage_tracker.snapshot()['totals']
+        self.log_message.emit(
+            f"Токены за запуск: запрос {totals['prompt_tokens']:,}, ответ {totals['candidates_tokens']:,}, "
+            f"всего {totals['total_tokens']:,} ({totals['requests']} запросов).")
+        hedge_stats = self.hedge_tracker.stats() if self.hedge_tracker else None
+        if self.model_router and len(self.model_router.routes) > 1:
+            self.log_message.emit("Запросы по моделям: " + ", ".join(
+                f"{name} - {model_stats['ok_requests']} (автомат размыкался {model_stats['opens']} раз)"
+                for name, model_stats in self.model_router.stats().items()))
+        if hedge_stats:
+            self.log_message.emit(
+                f"Хеджирование: дубликатов {hedge_stats['hedged']} из {hedge_stats['calls']} запросов "
+                f"({hedge_stats['hedge_rate']:.1%}), выиграли {hedge_stats['hedge_wins']} ({hedge_stats['win_rate']:.1%}).")
+        if not totals['requests'] or not self.out_folder:
+            return
+        report_path = os.path.join(self.out_folder, USAGE_REPORT_FILENAME)
+        try:
+            self.usage_tracker.write_report(report_path, extra={
+                'model': self.model_config['id'],
+                'declared_limits': {'rpm': self.model_config.get('rpm'), 'tpm': self.model_config.get('tpm')},
+                'success_count': self.success_count,
+                'error_count': self.error_count,
+                'hedging': hedge_stats,
+                'models': self.model_router.stats() if self.model_router else None,
+            })
+            self.log_message.emit(f"[INFO] Отчет об использовании токенов сохранен: {report_path}")
+        except Exception as e_report:
+            self.log_message.emit(f"[WARN] Не удалось сохранить отчет об использовании токенов: {e_report}")
+
+    def process_single_chunk(self, chunk_text, base_filename_for_log, chunk_index, total_chunks,
+                             usage_context=None, attempt=0, defer_retries=False, deadline=None):
+        """
+        Processes a single chunk of text by calling the API.
+        With defer_retries a retryable error raises RetryScheduled; the caller resubmits the chunk
+        later with attempt=RetryScheduled.attempt. deadline (time.monotonic()) bounds all attempts.
+        """
+        if self.is_cancelled:
+            raise OperationCancelledError(f"Отменено перед чанком {chunk_index + 1}/{total_chunks}")
+        chunk_log_prefix = f"{base_filename_for_log} [Chunk {chunk_index + 1}/{total_chunks}]"
+        prompt_for_chunk = self.prompt_template.replace("{text}", chunk_text)
+        event_context = {'file': base_filename_for_log, 'chunk': chunk_index}
+        chunk_started = time.monotonic()
+        try:
+
+            placeholders_before = find_image_placeholders(chunk_text)
+            placeholders_before_uuids = {p[1] for p in placeholders_before}
+            self._log_event('chunk_start', total_chunks=total_chunks, chars=len(chunk_text),
+                            bytes=len(chunk_text.encode('utf-8')), placeholders=len(placeholders_before),
+                            attempt=attempt + 1, **event_context)
+
+            if placeholders_before:
+                self.log_message.emit(
+                    f"[INFO] {chunk_log_prefix}: Отправка чанка с {len(placeholders_before)} плейсхолдерами (UUIDs: {sorted(list(placeholders_before_uuids))}).")
+
+            translated_chunk = self._generate_content_with_retry(prompt_for_chunk, chunk_log_prefix,
+                                                                 usage_context=usage_context,
+                                                                 event_context=event_context,
+                                                                 attempt=attempt, defer_retries=defer_retries,
+                                                                 deadline=deadline)
+
+            translated_chunk = html.unescape(translated_chunk)
+
+            placeholders_after_translation_raw = find_image_placeholders(translated_chunk)
+
+            newly_appeared_placeholders_tags_to_remove = []
+            if placeholders_after_translation_raw:  # Только если в переведенном тексте вообще есть плейсхолдеры
+                for p_tag, p_uuid in placeholders_after_translation_raw:
+                    if p_uuid not in placeholders_before_uuids:
+                        newly_appeared_placeholders_tags_to_remove.append(p_tag)  # Собираем именно теги для удаления
+
+            if newly_appeared_placeholders_tags_to_remove:
+                self.log_message.emit(
+                    f"[WARN] {chunk_log_prefix}: Обнаружены новые плейсхолдеры ({len(newly_appeared_placeholders_tags_to_remove)} шт.) после перевода, которых не было в оригинале. Они будут удалены.")
+                for p_tag_to_remove in newly_appeared_placeholders_tags_to_remove:
+                    match_uuid_in_tag = re.search(r"<\|\|" + IMAGE_PLACEHOLDER_PREFIX + r"([a-f0-9]{32})\|\|>",
+                                                  p_tag_to_remove)
+                    uuid_for_log = match_uuid_in_tag.group(1) if match_uuid_in_tag else "неизвестный UUID"
+                    self.log_message.emit(f"  - Удаляется новый плейсхолдер: {p_tag_to_remove} (UUID: {uuid_for_log})")
+                    translated_chunk = translated_chunk.replace(p_tag_to_remove, "")
+
+            placeholders_after_cleaning = find_image_placeholders(translated_chunk)
+            placeholders_after_cleaning_uuids = {p[1] for p in placeholders_after_cleaning}
+
+            if len(placeholders_before) != len(placeholders_after_cleaning):
+                self.log_message.emit(
+                    f"[WARN] {chunk_log_prefix}: Количество плейсхолдеров ИЗМЕНИЛОСЬ! (Оригинал: {len(placeholders_before)}, После перевода и очистки: {len(placeholders_after_cleaning)})")
+                self.log_message.emit(f"  Оригинальные UUIDs: {sorted(list(placeholders_before_uuids))}")
+                self.log_message.emit(f"  Итоговые UUIDs: {sorted(list(placeholders_after_cleaning_uuids))}")
+
+            elif placeholders_before:  # Если были плейсхолдеры и количество совпало
+
+                if placeholders_before_uuids != placeholders_after_cleaning_uuids:
+                    self.log_message.emit(
+                        f"[WARN] {chunk_log_prefix}: Набор UUID плейсхолдеров ИЗМЕНИЛСЯ (даже после очистки)! (Оригинал: {sorted(list(placeholders_before_uuids))}, Итог: {sorted(list(placeholders_after_cleaning_uuids))})")
+
+                if not all(p[0].startswith("<||") and p[0].endswith("||>") and len(p[1]) == 32 for p in
+                           placeholders_after_cleaning):
+                    self.log_message.emit(
+                        f"[WARN] {chunk_log_prefix}: Плейсхолдеры в итоговом тексте выглядят поврежденными.")
+
+            if placeholders_before or placeholders_after_translation_raw:
+                self._log_event('placeholder_check', expected=len(placeholders_before),
+                                found=len(placeholders_after_cleaning),
+                                removed_new=len(newly_appeared_placeholders_tags_to_remove),
+                                ok=placeholders_before_uuids == placeholders_after_cleaning_uuids and
+                                   len(placeholders_before) == len(placeholders_after_cleaning),
+                                **event_context)
+
+            self.log_message.emit(f"[INFO] {chunk_log_prefix}: Чанк успешно переведен и обработан.")
+            self.metrics.chunks.inc(status="ok")
+            self._log_event('chunk_end', status="ok", duration_s=round(time.monotonic() - chunk_started, 3),
+                            out_chars=len(translated_chunk), out_bytes=len(translated_chunk.encode('utf-8')),
+                            **event_context)
+            return chunk_index, translated_chunk
+        except OperationCancelledError as oce:
+            self.log_message.emit(f"[CANCELLED] {chunk_log_prefix}: Обработка чанка отменена.");
+            self._log_event('chunk_end', status="cancelled", duration_s=round(time.monotonic() - chunk_started, 3),
+                            **event_context)
+            raise oce
+        except RetryScheduled:
+            self._log_event('chunk_end', status="deferred", duration_s=round(time.monotonic() - chunk_started, 3),
+                            **event_context)
+            raise
+
+        except Exception as e:
+            self.metrics.chunks.inc(status="failed")
+            self._log_event('chunk_end', status="failed", duration_s=round(time.monotonic() - chunk_started, 3),
+                            error_type=classify_api_error(e), error_class=type(e).__name__, **event_context)
+            self.log_message.emit(f"[FAIL] {chunk_log_prefix}: Ошибка API вызова/обработки чанка: {e}");
+            raise e  # Re-raise
+
+    # --- Конвейер: parse -> translate -> write ---
+    # parse: чтение входных файлов / HTML частей EPUB, извлечение текста и изображений (локальная работа)
+    # translate: вызовы API, max_concurrent_requests потоков
+    # write: запись результатов и сборка EPUB (локальная работа)
+    # Стадии связаны ограниченными очередями, поэтому локальная работа не занимает слоты API.
+
+    def _new_job(self, kind, log_prefix, **fields):
+        job = {
+            'kind': kind,  # 'single_file' | 'epub_html' | 'epub_build'
+            'log_prefix': log_prefix,
+            'priority': 0,
+            'image_map': {},
+            'image_keys': [],  # ссылки задачи в хранилище изображений (core/image_store.py)
+            'chunks': [],
+            'translated_chunks': {},
+            'next_chunk': 0,  # первый еще не переведенный чанк
+            'chunk_retries': 0,  # повторы, уже сделанные для чанка next_chunk (повтор ждет в pipeline.delayed)
+            'chunk_deadline': None,  # срок чанка next_chunk (time.monotonic()), общий для всех его попыток
+            'chunk_error': None,  # (номер чанка, исключение) первой ошибки
+            'finish_chunk_done': False,  # чанк, начатый в режиме завершения, уже обработан
+            'usage_context': None,
+            'result': None,  # (file_info, success, error) / (prep_success, html_path, content, image_map, is_original, warning) / (epub_path, success, error)
+        }
+        job.update(fields)
+        return job
+
+    def _cleanup_job(self, job):
+        if job.get('image_keys'):
+            get_image_store().release(job['image_keys'])
+            job['image_keys'] = []
+
+    def _add_job_images(self, job, image_map, images):
+        """Puts extracted images ({image_key: bytes}) into the store and the job's image_map."""
+        image_store = get_image_store()
+        for image_key, data in images.items():
+            image_store.put(data, image_key)
+            job['image_keys'].append(image_key)
+        job['image_map'].update(image_map)
+
+    def _parse_stage(self, job):
+        if job['kind'] == 'single_file':
+            return self._guard_single_file_stage(job, self._parse_single_file)
+        return self._parse_epub_html(job)
+
+    def _translate_stage(self, job):
+        if job['kind'] == 'single_file':
+            return self._guard_single_file_stage(job, self._translate_single_file)
+        return self._translate_epub_html(job)
+
+    def _write_stage(self, job):
+        if job['kind'] == 'epub_build':
+            job['result'] = self.build_translated_epub(job['epub_path'], job['builder'])
+            return None
+        if job['kind'] == 'epub_html':
+            return self._stage_epub_part(job)
+        return self._guard_single_file_stage(job, self._write_single_file)
+
+    def _translate_chunks(self, job):
+        """
+        Sends job['chunks'] to the API in order, starting from job['next_chunk'].
+        Stops after the chunk in flight when 'finish' is requested, and on the first chunk error.
+        Returns True when the chunk was deferred for a retry: job['resubmit_delay'] is set and the
+        stage hands the job back to the pipeline, which resubmits it after the delay.
+        """
+        log_prefix = job['log_prefix']
+        chunks = job['chunks']
+        total_chunks = len(chunks)
+        if job['next_chunk'] == 0:
+            self.chunk_progress.emit(log_prefix, 0, total_chunks)
+
+        while job['next_chunk'] < total_chunks:
+            i = job['next_chunk']
+            if self.is_cancelled:
+                raise OperationCancelledError(f"Отменено перед чанком {i + 1} для {log_prefix}")
+            if self.is_finishing and job['finish_chunk_done']:
+                self.log_message.emit(
+                    f"[FINISHING] {log_prefix}: Пропуск оставшихся чанков ({i + 1} из {total_chunks}).")
+                break
+            if job['chunk_deadline'] is None and self.chunk_deadline:
+                job['chunk_deadline'] = time.monotonic() + self.chunk_deadline
+            try:
+                _, job['translated_chunks'][i] = self.process_single_chunk(
+                    chunks[i], log_prefix, i, total_chunks, usage_context=job['usage_context'],
+                    attempt=job['chunk_retries'], defer_retries=True, deadline=job['chunk_deadline'])
+            except OperationCancelledError:
+                raise
+            except RetryScheduled as retry:
+                # ожидание повтора не занимает поток API: он берет другие готовые задания
+                job['chunk_retries'] = retry.attempt
+                job['resubmit_delay'] = retry.delay
+                self.log_message.emit(
+                    f"[RETRY] {log_prefix}: Чанк {i + 1}/{total_chunks} отложен на {retry.delay} сек. "
+                    f"(в очереди повторов: {self.pipeline.delayed.pending() + 1})")
+                return True
+            except Exception as e_chunk:
+                job['chunk_error'] = (i, e_chunk)
+                if self.is_finishing:
+                    self.log_message.emit(
+                        f"[FINISHING-ERROR] {log_prefix}: Ошибка на чанке {i + 1} во время завершения: {e_chunk}. Попытка сохранить предыдущие.")
+                    job['finish_chunk_done'] = True
+                break
+
+            job['next_chunk'] = i + 1
+            job['chunk_retries'] = 0
+            job['chunk_deadline'] = None
+            self.chunk_progress.emit(log_prefix, i + 1, total_chunks)
+
+            if self.is_finishing:  # Если флаг установился во время или после этого чанка
+                self.log_message.emit(
+                    f"[FINISHING] {log_prefix}: Чанк {i + 1}/{total_chunks} обработан. Завершение обработки...")
+                job['finish_chunk_done'] = True
+                continue
+
+            if self.chunk_delay_seconds > 0 and i < total_chunks - 1:
+                delay_val = self.chunk_delay_seconds
+                self.log_message.emit(
+                    f"[INFO] {log_prefix}: Задержка {delay_val:.1f} сек. перед следующим чанком...")
+                start_sleep = time.monotonic()
+                while time.monotonic() - start_sleep < delay_val:
+                    if self.is_cancelled: raise OperationCancelledError(
+                        "Отменено во время задержки между чанками")
+                    time.sleep(min(0.1, delay_val - (time.monotonic() - start_sleep)))
+
+    def _guard_single_file_stage(self, job, stage_func):
+        """Runs one stage of a single-file job, turning exceptions into the job result."""
+        file_info_tuple = job['info']
+        log_prefix = job['log_prefix']
+        try:
+            return stage_func(job)
+        except FileNotFoundError as fnf_err:
+            self.log_message.emit(f"[FAIL] {log_prefix}: Файл не найден: {fnf_err}")
+            job['result'] = (file_info_tuple, False, f"Файл не найден: {fnf_err}")
+        except IOError as e:
+            self.log_message.emit(f"[FAIL] {log_prefix}: Ошибка чтения/записи файла: {e}")
+            job['result'] = (file_info_tuple, False, f"Ошибка I/O: {e}")
+        except OperationCancelledError as oce:
+            self.log_message.emit(f"[CANCELLED] {log_prefix}: Обработка файла прервана ({oce})")
+            self.chunk_progress.emit(log_prefix, 0, 0)
+            job['result'] = (file_info_tuple, False, str(oce))
+        except Exception as e:
+            self.log_message.emit(
+                f"[CRITICAL] {log_prefix}: Неожиданная ошибка обработки файла: {e}\n{traceback.format_exc()}")
+            self.chunk_progress.emit(log_prefix, 0, 0)
+            job['result'] = (file_info_tuple, False, f"Критическая ошибка файла: {e}")
+        return None
+
+    def _new_single_file_job(self, file_info_tuple):
+        input_type, filepath, epub_html_path_or_none = file_info_tuple
+        base_name = os.path.basename(filepath)
+        log_prefix = f"{base_name}" + (f" -> {epub_html_path_or_none}" if epub_html_path_or_none else "")
+
+        effective_path_obj_for_stem = None
+        if input_type == 'epub' and epub_html_path_or_none:
+            # Если обрабатывается HTML-часть из EPUB для вывода не в EPUB,
+            # имя выходного файла должно базироваться на имени HTML-части.
+            effective_path_obj_for_stem = Path(epub_html_path_or_none)
+        else:
+            # Для других типов ввода (txt, docx) или если это EPUB, но epub_html_path_or_none не указан (маловероятно здесь),
+            # базируемся на имени входного файла.
+            effective_path_obj_for_stem = Path(filepath)
+
+        # Получаем "чистое" имя файла без всех расширений
+        true_stem = effective_path_obj_for_stem.name
+        all_suffixes = "".join(effective_path_obj_for_stem.suffixes)
+        if all_suffixes:
+            true_stem = true_stem.replace(all_suffixes, "")
+
+        if not true_stem:  # Обработка случаев типа ".bashrc" или если имя было пустым
+            temp_name = effective_path_obj_for_stem.name
+            true_stem = os.path.splitext(temp_name[1:] if temp_name.startswith('.') else temp_name)[0]
+            if not true_stem: true_stem = "file"  # Крайний случай
+
+        final_out_filename = f"{true_stem}{TRANSLATED_SUFFIX}.{self.output_format}"
+        return self._new_job(
+            'single_file', log_prefix,
+            info=file_info_tuple,
+            out_path=os.path.join(self.out_folder, final_out_filename),
+            book_title=Path(filepath).stem.replace('_translated', ''),
+            # Для HTML частей EPUB (вывод не в EPUB) режим завершения проверяется по чанкам
+            skip_on_finish=not (input_type == 'epub' and epub_html_path_or_none),
+            usage_context={'file': log_prefix, 'epub': filepath if input_type == 'epub' else None})
+
+    def _parse_single_file(self, job):
+        """Parse stage of a single file: reads TXT/DOCX/EPUB part and splits it into chunks."""
+        input_type, filepath, epub_html_path_or_none = job['info']
+        log_prefix = job['log_prefix']
+        self.current_file_status.emit(f"Обработка: {log_prefix}")
+        self.log_message.emit(f"Начало обработки: {log_prefix}")
+
+        if self.is_cancelled: raise OperationCancelledError("Отменено перед чтением файла")
+        if self.is_finishing and job['skip_on_finish']:
+            self.log_message.emit(
+                f"[FINISHING] {log_prefix}: Файл пропущен из-за режима завершения (активирован до начала обработки этого файла).")
+            job['result'] = (job['info'], False, "Пропущено (режим завершения)")
+            return None
+
+        image_map = job['image_map']
+        original_content = ""
+
+        if input_type == 'txt':
+            with open(filepath, 'r', encoding='utf-8') as f:
+                original_content = f.read()
+        elif input_type == 'docx':
+            if not DOCX_AVAILABLE: raise ImportError("python-docx не установлен")
+            original_content, docx_image_map, docx_images = self.extraction_pool.run(
+                extract_docx, filepath, is_cancelled=lambda: self.is_cancelled)
+            self._add_job_images(job, docx_image_map, docx_images)
+        elif input_type == 'epub':  # Это для EPUB -> TXT/DOCX/MD/HTML (не EPUB->EPUB)
+            if not epub_html_path_or_none: raise ValueError("Путь к HTML в EPUB не указан.")
+            if not BS4_AVAILABLE: raise ImportError("beautifulsoup4 не установлен")
+            html_str, html_encoding = get_epub_reader(filepath).read_text(epub_html_path_or_none)
+            if html_encoding != 'utf-8':
+                self.log_message.emit(f"[WARN] {log_prefix}: {html_encoding} для HTML.")
+
+            original_content, html_image_map, html_images = self.extraction_pool.run(
+                extract_epub_html, html_str, filepath, epub_html_path_or_none,
+                is_cancelled=lambda: self.is_cancelled)
+            self._add_job_images(job, html_image_map, html_images)
+            job['book_title'] = Path(epub_html_path_or_none).stem  # Используем имя HTML файла для заголовка
+        else:
+            raise ValueError(f"Неподдерживаемый тип ввода: {input_type}")
+
+        if self.is_cancelled: raise OperationCancelledError("Отменено после чтения файла")
+        if not original_content.strip() and not image_map:
+            self.log_message.emit(f"[INFO] {log_prefix}: Пропущен (пустой контент).");
+            job['result'] = (job['info'], True, "Пустой контент")  # Считаем успехом, если пустой
+            return None
+
+        original_content_len = len(original_content)
+        job['has_content'] = True
+        self.log_message.emit(
+            f"[INFO] {log_prefix}: Прочитано ({format_size(original_content_len)} симв., {len(image_map)} изобр.).")
+
+        chunks = []
+
+        can_chunk_this_input = not (input_type == 'epub' and not CHUNK_HTML_SOURCE)
+
+        if self.chunking_enabled_gui and original_content_len > self.chunk_limit and can_chunk_this_input:
+            self.log_message.emit(
+                f"[INFO] {log_prefix}: Контент ({original_content_len:,} симв.) > лимита ({self.chunk_limit:,}). Разделяем...");
+            chunks = split_text_into_chunks(original_content, self.chunk_limit, self.chunk_window,
+                                            MIN_CHUNK_SIZE)
+            self.log_message.emit(f"[INFO] {log_prefix}: Разделено на {len(chunks)} чанков.")
+        else:
+            chunks.append(original_content)
+            reason_no_chunk = ""
+            if not self.chunking_enabled_gui:
+                reason_no_chunk = "(чанкинг выключен)"
+            elif original_content_len <= self.chunk_limit:
+                reason_no_chunk = "(размер < лимита)"
+            elif not can_chunk_this_input:
+                reason_no_chunk = "(чанкинг HTML/EPUB отключен)"
+            self.log_message.emit(
+                f"[INFO] {log_prefix}: Контент ({original_content_len:,} симв.) отправляется целиком {reason_no_chunk}.")
+
+        if not chunks:  # Если split_text_into_chunks вернул пустой список
+            self.log_message.emit(
+                f"[WARN] {log_prefix}: Не удалось разделить на чанки (пустой результат). Пропускаем.");
+            job['result'] = (job['info'], False, "Ошибка разделения на чанки")
+            return None
+
+        job['chunks'] = chunks
+        return 'translate'
+
+    def _translate_single_file(self, job):
+        """Translate stage of a single file; hands the joined translation to the write stage."""
+        file_info_tuple = job['info']
+        log_prefix = job['log_prefix']
+        if self.is_finishing and job['skip_on_finish'] and job['next_chunk'] == 0 and not job['chunk_retries']:
+            self.log_message.emit(
+                f"[FINISHING] {log_prefix}: Файл пропущен из-за режима завершения (активирован до начала обработки этого файла).")
+            job['result'] = (file_info_tuple, False, "Пропущено (режим завершения)")
+            return None
+
+        if self._translate_chunks(job):
+            return 'translate'  # повтор чанка ждет в очереди таймеров конвейера
+        translated_chunks_map = job['translated_chunks']
+        total_chunks = len(job['chunks'])
+
+        if job['chunk_error'] and not self.is_finishing:
+            failed_index, chunk_exc = job['chunk_error']
+            job['result'] = (file_info_tuple, False, f"Ошибка обработки чанка {failed_index + 1}: {chunk_exc}")
+            return None
+
+        # После цикла обработки чанков
+        if self.is_cancelled and not translated_chunks_map:
+            raise OperationCancelledError(
+                f"Отменено во время обработки чанков для {log_prefix}, нет данных для сохранения")
+
+        if not translated_chunks_map:
+            if self.is_finishing:  # Если завершаем и для этого файла ничего не успело перевестись
+                self.log_message.emit(
+                    f"[FINISHING] {log_prefix}: Нет переведенных чанков для сохранения (режим завершения).")
+                job['result'] = (file_info_tuple, False, "Пропущено (режим завершения, нет данных)")
+            elif job.get('has_content'):  # Если был контент, но не перевелся (и не режим завершения)
+                self.log_message.emit(f"[FAIL] {log_prefix}: Не удалось перевести ни одного чанка.")
+                job['result'] = (file_info_tuple, False, "Ошибка: Не удалось перевести ни одного чанка.")
+            else:  # Пустой файл изначально
+                self.log_message.emit(f"[INFO] {log_prefix}: Пропущен (пустой контент).")
+                job['result'] = (file_info_tuple, True, "Пустой контент")
+            return None
+
+        # Если есть что сохранять (translated_chunks_map не пуст)
+        if self.is_finishing and len(translated_chunks_map) < total_chunks:
+            self.log_message.emit(
+                f"[FINISHING] {log_prefix}: Сохранение частично переведенного файла ({len(translated_chunks_map)}/{total_chunks} чанков).")
+        elif not self.is_finishing and len(
+                translated_chunks_map) != total_chunks:  # Обычный режим, но не все чанки (ошибка где-то выше не отловлена)
+            job['result'] = (file_info_tuple, False,
+                             f"Ошибка: Не все чанки ({len(translated_chunks_map)}/{total_chunks}) были успешно обработаны.")
+            return None
+
+        join_char = "\n\n" if self.output_format in ['txt', 'md'] and len(translated_chunks_map) > 1 else "\n";
+        job['translated_content'] = join_char.join(
+            translated_chunks_map[i] for i in sorted(translated_chunks_map.keys())).strip()
+        job['chunks'] = []  # оригинал больше не нужен, очередь записи держит только перевод
+        return 'write'
+
+    def _write_single_file(self, job):
+        """Write stage of a single file: saves the translation in the selected output format."""
+        from transgemini.core.parser import write_markdown_to_docx
+        file_info_tuple = job['info']
+        log_prefix = job['log_prefix']
+        out_path = job['out_path']
+        image_map = job['image_map']
+        book_title_guess = job['book_title']
+        final_translated_content = job['translated_content']
+        total_chunks = len(job['translated_chunks'])
+
+        self.log_message.emit(f"[INFO] {log_prefix}: Запись результата ({self.output_format}) в: {out_path}");
+        write_success_log = ""
+
+        content_to_write = final_translated_content
+        if self.output_format in ['txt', 'md', 'docx', 'fb2']:
+            content_to_write = re.sub(r'<br\s*/?>', '\n', final_translated_content, flags=re.IGNORECASE)
+
+        try:
+            if self.output_format == 'fb2':
+                if not LXML_AVAILABLE: raise RuntimeError("LXML недоступна для записи FB2.")
+                from transgemini.core.fb2_builder import write_to_fb2
+                write_to_fb2(out_path, content_to_write, image_map, book_title_guess);
+                write_success_log = "Файл FB2 сохранен."
+            elif self.output_format == 'docx':
+                if not DOCX_AVAILABLE: raise RuntimeError("python-docx недоступна для записи DOCX.")
+                write_markdown_to_docx(out_path, content_to_write, image_map);
+                write_success_log = "Файл DOCX сохранен."
+            elif self.output_format == 'html':  # Это для write_to_html, не для EPUB
+
+                write_to_html(out_path, final_translated_content, image_map, book_title_guess);
+                write_success_log = "Файл HTML сохранен."
+            elif self.output_format in ['txt', 'md']:
+
+                final_text_no_placeholders = content_to_write;
+                markers = find_image_placeholders(final_text_no_placeholders)
+                if markers: self.log_message.emit(
+                    f"[INFO] {log_prefix}: Замена {len(markers)} плейсхолдеров для {self.output_format.upper()}...");
+                for tag, uuid_val in markers: replacement = f"[Image: {image_map.get(uuid_val, {}).get('original_filename', uuid_val)}]"; final_text_no_placeholders = final_text_no_placeholders.replace(
+                    tag, replacement)
+                with open(out_path, 'w', encoding='utf-8') as f:
+                    f.write(
+                        final_text_no_placeholders); write_success_log = f"Файл {self.output_format.upper()} сохранен."
+            else:
+                raise RuntimeError(f"Неподдерживаемый формат вывода '{self.output_format}' для записи.")
+
+            self.log_message.emit(f"[SUCCESS] {log_prefix}: {write_success_log}");
+            self.chunk_progress.emit(log_prefix, total_chunks, total_chunks);
+            job['result'] = (file_info_tuple, True, None)
+        except Exception as write_err:
+            self.log_message.emit(
+                f"[FAIL] {log_prefix}: Ошибка записи файла {out_path}: {write_err}\n{traceback.format_exc()}"); self.chunk_progress.emit(
+                log_prefix, 0,
+                0); job['result'] = (file_info_tuple, False, f"Ошибка записи {self.output_format.upper()}: {write_err}")
+        return None
+
+    def _epub_html_done(self, job, prep_success, content, image_map, is_original, warning):
+        """
+        Stores the EPUB part result (prep_success, html_path, content, image_map, is_original, warning).
+        A prepared part goes to the write stage, which stages it into the book right away.
+        """
+        job['result'] = (prep_success, job['html_path'], content, image_map, is_original, warning)
+        return 'write' if prep_success and job.get('builder') is not None else None
+
+    def _stage_epub_part(self, job):
+        """Write stage of an EPUB part: renders it and writes it into the book being assembled."""
+        prep_success, html_path, content, image_map, is_original, warning = job['result']
+        if self.is_cancelled:
+            raise OperationCancelledError(f"Отменено перед сборкой части {job['log_prefix']}")
+        build_state = self.epub_build_states.get(job['epub_path'])
+        if build_state is not None and build_state.get('failed'):
+            return None  # книга уже не будет собрана
+        job['builder'].add_part({
+            'original_filename': html_path, 'content_to_write': content,
+            'image_map': image_map or {}, 'is_original_content': is_original,
+            'translation_warning': warning if is_original and warning else None
+        })
+        # часть уже в архиве: текст и изображения задачи больше не нужны
+        job['result'] = (prep_success, html_path, None, image_map, is_original, warning)
+        self._cleanup_job(job)
+        return None
+
+    def _new_epub_html_job(self, original_epub_path, html_path_in_epub):
+        log_prefix = f"{os.path.basename(original_epub_path)} -> {html_path_in_epub}"
+        return self._new_job('epub_html', log_prefix, epub_path=original_epub_path, html_path=html_path_in_epub,
+                             original_bytes=None, builder=self.epub_build_states[original_epub_path]['builder'],
+                             usage_context={'file': log_prefix, 'epub': original_epub_path})
+
+    def _parse_epub_html(self, job):
+        """
+        Parse stage of an HTML part for EPUB->EPUB mode: reads it from the EPUB and extracts text and images.
+        The original content is kept in the job, the build uses it if translation fails or 'finish' is requested.
+        """
+        original_epub_path = job['epub_path']
+        html_path_in_epub = job['html_path']
+        log_prefix = job['log_prefix']
+
+        if self.is_cancelled:
+            # Возвращаем False, чтобы эта задача не считалась успешной для сборки EPUB
+            return self._epub_html_done(job, False, None, None, False, f"Отменено перед началом: {log_prefix}")
+
+        # Если "Завершить" вызвано до начала обработки этого HTML, используем оригинал
+        if self.is_finishing:
+            self.log_message.emit(
+                f"[FINISHING] {log_prefix}: HTML часть пропущена (режим завершения). Попытка использовать оригинал.")
+            self.chunk_progress.emit(log_prefix, 0, 0)
+            # Пытаемся прочитать оригинал, чтобы сборка EPUB могла его использовать
+            try:
+                original_html_bytes_for_finish = get_epub_reader(original_epub_path).read(html_path_in_epub)
+                # Возвращаем True, чтобы эта оригинальная часть была включена в сборку
+                return self._epub_html_done(job, True, original_html_bytes_for_finish, {}, True,
+                                            "Пропущено (режим завершения)")
+            except Exception as e_read_orig:
+                self.log_message.emit(
+                    f"[FINISHING-ERROR] {log_prefix}: Не удалось прочитать оригинал при завершении: {e_read_orig}")
+                # Возвращаем False, так как даже оригинал не удалось получить
+                return self._epub_html_done(job, False, None, None, False,
+                                            f"Пропущено (режим завершения, оригинал недоступен: {e_read_orig})")
+
+        image_map = job['image_map']
+        content_with_placeholders = ""
+        original_html_bytes = None
+
+        try:
+            self.log_message.emit(f"Обработка EPUB HTML: {log_prefix}")
+
+            epub_reader = get_epub_reader(original_epub_path)
+            try:
+                original_html_bytes = epub_reader.read(html_path_in_epub)
+                job['original_bytes'] = original_html_bytes
+                file_size_bytes = len(original_html_bytes)
+                original_html_str, html_encoding = epub_reader.read_text(html_path_in_epub)
+                if html_encoding == 'cp1251':
+                    self.log_message.emit(f"[WARN] {log_prefix}: Использовано cp1251.")
+                elif html_encoding == 'latin-1':
+                    self.log_message.emit(f"[WARN] {log_prefix}: Использовано latin-1 (с потерями).")
+
+                if not original_html_str and original_html_bytes:
+                    self.log_message.emit(
+                        f"[ERROR] {log_prefix}: Не удалось декодировать HTML. Используется оригинал.")
+                    return self._epub_html_done(job, True, original_html_bytes, {}, True, "Ошибка декодирования HTML")
+
+                # EPUB->EPUB: изображения остаются ссылками, сборка берет их из оригинального EPUB
+                content_with_placeholders, html_image_map, _ = self.extraction_pool.run(
+                    extract_epub_html, original_html_str, original_epub_path, html_path_in_epub, False,
+                    is_cancelled=lambda: self.is_cancelled)
+                image_map.update(html_image_map)
+                original_content_len_text = len(content_with_placeholders)
+                self.log_message.emit(
+                    f"[INFO] {log_prefix}: HTML прочитан/обработан (Размер: {format_size(file_size_bytes)}, {original_content_len_text:,} симв. текста, {len(image_map)} изобр.).")
+
+            except KeyError:
+                return self._epub_html_done(job, False, None, None, False,
+                                            f"Ошибка: HTML '{html_path_in_epub}' не найден в EPUB.")
+            except OperationCancelledError:
+                raise
+            except Exception as html_proc_err:
+                self.log_message.emit(
+                    f"[ERROR] {log_prefix}: Ошибка подготовки HTML для перевода: {html_proc_err}. Используется оригинал (если доступен).")
+                if original_html_bytes:
+                    return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                                f"Ошибка обработки HTML: {html_proc_err}")
+                else:
+                    return self._epub_html_done(job, False, None, None, False,
+                                                f"Критическая ошибка обработки HTML '{html_path_in_epub}': {html_proc_err}")
+
+            if not content_with_placeholders.strip():
+                self.log_message.emit(f"[INFO] {log_prefix}: Пропущен (пустой контент после извлечения текста).")
+                return self._epub_html_done(job, True, original_html_bytes if original_html_bytes is not None else b"",
+                                            image_map or {}, True, "Пустой контент после обработки")
+
+            chunks = []
+            can_chunk_html = CHUNK_HTML_SOURCE
+            potential_chunking = self.chunking_enabled_gui and original_content_len_text > self.chunk_limit
+
+            if potential_chunking and not can_chunk_html:
+                chunks.append(content_with_placeholders)
+                self.log_message.emit(
+                    f"[INFO] {log_prefix}: Чанкинг HTML отключен, отправляется целиком ({original_content_len_text:,} симв.).")
+            elif potential_chunking and can_chunk_html:
+                self.log_message.emit(
+                    f"[INFO] {log_prefix}: Контент ({original_content_len_text:,} симв.) > лимита ({self.chunk_limit:,}). Разделяем...")
+                chunks = split_text_into_chunks(content_with_placeholders, self.chunk_limit, self.chunk_window,
+                                                MIN_CHUNK_SIZE)
+                self.log_message.emit(f"[INFO] {log_prefix}: Разделено на {len(chunks)} чанков.")
+                if not chunks:
+                    self.log_message.emit(
+                        f"[WARN] {log_prefix}: Ошибка разделения на чанки (пустой результат). Используется оригинал.")
+                    return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                                "Ошибка разделения на чанки")
+            else:
+                chunks.append(content_with_placeholders)
+                self.log_message.emit(
+                    f"[INFO] {log_prefix}: Контент ({original_content_len_text:,} симв.) отправляется целиком (чанкинг выкл/не нужен/HTML выкл).")
+
+            if not chunks:
+                self.log_message.emit(f"[ERROR] {log_prefix}: Нет чанков для обработки. Используется оригинал.")
+                return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                            "Ошибка подготовки чанков")
+
+            job['chunks'] = chunks
+            return 'translate'
+
+        except OperationCancelledError as oce:
+            self.log_message.emit(f"[CANCELLED] {log_prefix}: Обработка HTML части прервана ({oce})")
+            return self._epub_html_done(job, False, None, None, False, str(oce))
+        except Exception as e_outer:
+            return self._epub_html_unexpected_error(job, e_outer)
+
+    def _translate_epub_html(self, job):
+        """Translate stage of an EPUB part; falls back to the original HTML if nothing was translated."""
+        log_prefix = job['log_prefix']
+        original_html_bytes = job['original_bytes']
+        image_map = job['image_map']
+        try:
+            if self.is_finishing and job['next_chunk'] == 0 and not job['chunk_retries']:
+                self.log_message.emit(
+                    f"[FINISHING] {log_prefix}: HTML часть пропущена (режим завершения). Используется оригинал.")
+                self.chunk_progress.emit(log_prefix, 0, 0)
+                return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                            "Пропущено (режим завершения)")
+
+            if self._translate_chunks(job):
+                return 'translate'  # повтор чанка ждет в очереди таймеров конвейера
+            translated_chunks_map = job['translated_chunks']
+            total_chunks = len(job['chunks'])
+
+            if self.is_cancelled:  # Если отмена произошла во время цикла чанков
+                raise OperationCancelledError(f"Отменено во время или после обработки чанков для {log_prefix}")
+
+            first_chunk_error_msg = None
+            if job['chunk_error']:
+                failed_index, chunk_exc = job['chunk_error']
+                first_chunk_error_msg = f"Ошибка перевода чанка HTML {failed_index + 1}: {chunk_exc}"
+                self.log_message.emit(f"[FAIL] {log_prefix}: {first_chunk_error_msg}")
+
+            if first_chunk_error_msg and not translated_chunks_map:  # Ошибка на первом же чанке или ничего не собрано
+                self.log_message.emit(
+                    f"[WARN] {log_prefix}: Не удалось перевести HTML. Используется оригинал. Причина: {first_chunk_error_msg}")
+                self.chunk_progress.emit(log_prefix, 0, 0)
+                return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True, first_chunk_error_msg)
+
+            if not translated_chunks_map:  # Если карта пуста (может быть, если is_finishing и первый чанк не успел)
+                if self.is_finishing:
+                    self.log_message.emit(
+                        f"[FINISHING] {log_prefix}: Нет переведенных чанков для HTML. Используется оригинал.")
+                    self.chunk_progress.emit(log_prefix, 0, 0)
+                    return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                                "Пропущено (режим завершения, нет данных для HTML)")
+                self.log_message.emit(
+                    f"[ERROR] {log_prefix}: Нет переведенных чанков для HTML по неизвестной причине. Используется оригинал.")
+                return self._epub_html_done(job, True, original_html_bytes, image_map or {}, True,
+                                            "Нет переведенных чанков HTML")
+
+            # Если есть какие-то чанки в translated_chunks_map
+            final_translated_content_str = "\n".join(
+                translated_chunks_map[i] for i in sorted(translated_chunks_map.keys())).strip()
+
+            warning_msg_for_return = None
+            if self.is_finishing and len(translated_chunks_map) < total_chunks:
+                self.log_message.emit(
+                    f"[FINISHING] {log_prefix}: HTML часть переведена частично ({len(translated_chunks_map)}/{total_chunks} чанков).")
+                warning_msg_for_return = "Частично переведено (завершение)"
+            elif first_chunk_error_msg and translated_chunks_map:  # Была ошибка, но есть что сохранить
+                self.log_message.emit(
+                    f"[WARN] {log_prefix}: HTML часть переведена частично из-за ошибки ({len(translated_chunks_map)}/{total_chunks} чанков). Причина первой ошибки: {first_chunk_error_msg}")
+                warning_msg_for_return = f"Частично из-за ошибки: {first_chunk_error_msg}"
+
+            self.log_message.emit(
+                f"[SUCCESS/PARTIAL] {log_prefix}: HTML часть (возможно, частично) подготовлена для сборки EPUB.")
+            self.chunk_progress.emit(log_prefix, len(translated_chunks_map), total_chunks)
+            return self._epub_html_done(job, True, final_translated_content_str, image_map or {}, False,
+                                        warning_msg_for_return)
+
+        except OperationCancelledError as oce:
+            self.log_message.emit(f"[CANCELLED] {log_prefix}: Обработка HTML части прервана ({oce})")
+            self.chunk_progress.emit(log_prefix, 0, 0)
+            return self._epub_html_done(job, False, None, None, False, str(oce))
+
+        except Exception as e_outer:
+            return self._epub_html_unexpected_error(job, e_outer)
+
+    def _epub_html_unexpected_error(self, job, e_outer):
+        log_prefix = job['log_prefix']
+        original_html_bytes = job.get('original_bytes')
+        detailed_error_msg = f"[CRITICAL] {log_prefix}: Неожиданная ошибка при обработке HTML файла: {type(e_outer).__name__}: {e_outer}"
+        tb_str = traceback.format_exc()
+        self.log_message.emit(detailed_error_msg + "\n" + tb_str)
+        self.chunk_progress.emit(log_prefix, 0, 0)
+        final_error_msg_return = f"Неожиданная ошибка HTML ({log_prefix}): {type(e_outer).__name__}"
+        if original_html_bytes is not None:
+            self.log_message.emit(
+                f"[WARN] {log_prefix}: Использование оригинала из-за неожиданной ошибки: {final_error_msg_return}")
+            return self._epub_html_done(job, True, original_html_bytes, job['image_map'] or {}, True,
+                                        final_error_msg_return)
+        return self._epub_html_done(job, False, None, None, False,
+                                    f"Критическая ошибка И оригинал не доступен: {final_error_msg_return}")
+
+    def _new_epub_builder(self, original_epub_path, build_metadata):
+        """Incremental builder of the translated EPUB: parts are staged as they finish."""
+        from transgemini.core.epub_builder import EpubIncrementalBuilder
+        output_epub_path = os.path.join(self.out_folder, add_translated_suffix(Path(original_epub_path).name))
+        return EpubIncrementalBuilder(output_epub_path, original_epub_path, build_metadata,
+                                      book_title_override=Path(original_epub_path).stem)
+
+    def build_translated_epub(self, original_epub_path, builder):
+        """Finalizes the EPUB: all parts are already in the archive, only manifest/spine/NAV/NCX are left."""
+        base_name = Path(original_epub_path).name;
+        log_prefix = f"EPUB Rebuild: {base_name}"
+        self.log_message.emit(f"[INFO] {log_prefix}: Запуск финальной сборки EPUB...")
+        self.current_file_status.emit(f"Сборка EPUB: {base_name}...")
+        output_epub_path = builder.out_path
+        if self.is_cancelled: return original_epub_path, False, f"Отменено перед сборкой EPUB: {log_prefix}"
+        try:
+            success, error = builder.finish()
+
+            if success:
+                self.log_message.emit(
+                    f"[SUCCESS] {log_prefix}: Финальный EPUB успешно сохранен: {output_epub_path}"); self.current_file_status.emit(
+                    f"EPUB собран: {base_name}"); return original_epub_path, True, None
+            else:
+                self.log_message.emit(
+                    f"[FAIL] {log_prefix}: Ошибка сборки EPUB: {error}"); self.current_file_status.emit(
+                    f"Ошибка сборки EPUB: {base_name}"); return original_epub_path, False, f"Ошибка сборки EPUB: {error}"
+        except OperationCancelledError as oce:
+            self.log_message.emit(
+                f"[CANCELLED] {log_prefix}: Сборка EPUB прервана."); return original_epub_path, False, f"Сборка EPUB отменена: {oce}"
+        except Exception as e:
+            self.log_message.emit(
+                f"[CRITICAL] {log_prefix}: Неожиданная ошибка при сборке EPUB: {e}\n{traceback.format_exc()}"); self.current_file_status.emit(
+                f"Критическая ошибка сборки: {base_name}"); return original_epub_path, False, f"Критическая ошибка сборки EPUB: {e}"
+
+    def _new_epub_build_job(self, epub_path):
+        state = self.epub_build_states[epub_path]
+        state['future'] = self._new_job('epub_build', f"EPUB Rebuild: {Path(epub_path).name}", epub_path=epub_path,
+                                        builder=state['builder'], priority=BUILD_JOB_PRIORITY)
+        return state['future']
+
+    def _job_size(self, job):
+        """Estimated size of a job for scheduling: file size, or the uncompressed size of the EPUB part."""
+        if job['kind'] == 'single_file':
+            _, filepath, html_path = job['info']
+        else:
+            filepath, html_path = job['epub_path'], job['html_path']
+        try:
+            if html_path:
+                epub_reader = get_epub_reader(filepath)
+                return epub_reader.zip_file.getinfo(epub_reader.resolve(html_path)).file_size
+            return os.path.getsize(filepath)
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return 0  # нечитаемый файл: ошибку сообщит стадия чтения
+
+    def _job_group(self, job):
+        return job['info'][1] if job['kind'] == 'single_file' else job['epub_path']
+
+    def _schedule_jobs(self, jobs):
+        """Orders the initial jobs by self.scheduling_policy (core/scheduler.py)."""
+        sizes = {id(job): self._job_size(job) for job in jobs}
+        ordered = order_jobs(jobs, self.scheduling_policy, lambda job: sizes[id(job)], self._job_group)
+        self.log_message.emit(f"[INFO] Порядок задач: {self.scheduling_policy} ({len(ordered)} задач).")
+        return ordered
+
+    def _job_origin(self, job):
+        if job['kind'] == 'single_file':
+            return Path(job['info'][1]).name
+        if job['kind'] == 'epub_html':
+            return f"{Path(job['epub_path']).name} -> {job['html_path']}"
+        return f"Сборка EPUB: {Path(job['epub_path']).name}"
+
+    def _handle_completed_job(self, job, google_exceptions):
+        """
+        Coordinator side of a finished job: counters, error list, EPUB build states.
+        Returns new jobs for the write stage (EPUB builds whose parts are all done).
+        """
+        new_write_jobs = []
+        task_type = job['kind']
+        epub_path = job.get('epub_path')
+        build_state = self.epub_build_states.get(epub_path) if epub_path else None
+        if task_type != 'epub_build':
+            self._cleanup_job(job)
+
+        error = job.get('exception')
+        if error is not None:
+            err_origin = self._job_origin(job)
+            if isinstance(error, (OperationCancelledError, CancelledError)):
+                self.processed_task_count += 1
+                self.error_count += 1
+                self.errors_list.append(f"{err_origin}: Отменено ({type(error).__name__})")
+                self.log_message.emit(f"[CANCELLED] Задача отменена: {err_origin}")
+            elif isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.RetryError,
+                                    google_exceptions.ResourceExhausted)):
+                self.processed_task_count += 1
+                self.error_count += 1
+                err_detail_api = f"{err_origin}: Критическая ошибка API ({type(error).__name__}), остановка: {error}"
+                self.errors_list.append(err_detail_api)
+                self.log_message.emit(f"[CRITICAL] {err_detail_api}")
+                self.log_message.emit(
+                    "[STOPPING] Обнаружена критическая ошибка API. Попытка сохранить прогресс и остановить...")
+                self.is_cancelled = True
+                self._critical_error_occurred = True
+            else:
+                self.processed_task_count += 1
+                self.error_count += 1
+                err_msg_exc = f"Критическая ошибка обработки результата для {err_origin}: {error}"
+                self.errors_list.append(err_msg_exc)
+                self.log_message.emit(f"[CRITICAL] {err_msg_exc}\n" + "".join(
+                    traceback.format_exception(type(error), error, error.__traceback__)))
+            if build_state is not None:
+                build_state['failed'] = True
+                if task_type == 'epub_build':
+                    build_state['processed_build_result'] = True
+                else:
+                    build_state['html_errors_count'] += 1
+                    build_state['pending'].discard(job['html_path'])
+            if task_type != 'epub_build':
+                self._set_file_status(job['log_prefix'], 'failed')
+            self.file_progress.emit(self.processed_task_count)
+            return new_write_jobs
+
+        if task_type == 'single_file':
+            file_info_tuple, success, error_message = job['result']
+            self.processed_task_count += 1
+            self.metrics.files.inc(status="ok" if success else "failed")
+            self._set_file_status(job['log_prefix'], 'done' if success else 'failed')
+            if success:
+                self.success_count += 1
+            else:
+                self.error_count += 1
+                err_detail = f"{Path(file_info_tuple[1]).name}: {error_message or 'Неизвестная ошибка'}"
+                self.errors_list.append(err_detail);
+                self.log_message.emit(f"[FAIL] {err_detail}")
+            self.file_progress.emit(self.processed_task_count)
+
+        elif task_type == 'epub_html':
+            html_path = job['html_path']
+            if not build_state or build_state.get('failed'):  # Если сам EPUB уже помечен как failed
+                return new_write_jobs
+
+            prep_success, _, content_data, img_map_data, is_orig, err_warn = job['result']
+            self.processed_task_count += 1
+            self.metrics.files.inc(status="failed" if not prep_success else "original" if is_orig else "ok")
+            self._set_file_status(job['log_prefix'],
+                                  'failed' if not prep_success else 'original' if is_orig else 'done')
+
+            if prep_success:
+                # часть уже записана в архив стадией записи (_stage_epub_part)
+                if is_orig and err_warn:
+                    self.log_message.emit(
+                        f"[WARN] {Path(epub_path).name} -> {html_path}: Использован оригинал. Причина: {err_warn}")
+                    # Не считаем это глобальной ошибкой, если файл включен в сборку
+                    build_state['html_errors_count'] += 1
+                    self.errors_list.append(f"{Path(epub_path).name} -> {html_path}: {err_warn}")
+                # Если is_orig=False, это успешный перевод чанка(ов)
+            else:  # prep_success is False - HTML-часть не удалось подготовить, даже оригинал
+                self.error_count += 1  # Учитываем как глобальную ошибку
+                build_state['failed'] = True  # Весь EPUB считается неуспешным
+                build_state['html_errors_count'] += 1
+                err_detail = f"{Path(epub_path).name} -> {html_path}: {err_warn or 'Критическая ошибка подготовки HTML'}"
+                self.errors_list.append(err_detail);
+                self.log_message.emit(f"[FAIL] {err_detail}")
+
+            build_state['pending'].discard(html_path)
+
+            # Запуск сборки, если все HTML для этого EPUB обработаны
+            # И сборка еще не была запущена, И сам EPUB не помечен как failed
+            if not build_state['pending'] and not build_state.get('future') and not build_state.get('failed'):
+                self.log_message.emit(
+                    f"[INFO] Все HTML части для {Path(epub_path).name} обработаны. Запуск задачи сборки...")
+                new_write_jobs.append(self._new_epub_build_job(epub_path))
+
+            self.file_progress.emit(self.processed_task_count)
+
+        elif task_type == 'epub_build':
+            _, success_build, error_message_build = job['result']
+            self.processed_task_count += 1  # Задача сборки - это тоже задача
+            self.metrics.files.inc(status="ok" if success_build else "failed")
+            build_state['processed_build_result'] = True
+            if success_build:
+                self.success_count += 1
+                # success_count инкрементируется, если сборка физически произошла,
+                # даже если часть HTML использовала оригинал (см. html_errors_count).
+                log_msg_build = f"[OK] Сборка EPUB {Path(epub_path).name} завершена."
+                if build_state['html_errors_count'] > 0:
+                    log_msg_build += f" (ВНИМАНИЕ: {build_state['html_errors_count']} HTML-частей использовал(и) оригинал или не были обработаны)."
+                self.log_message.emit(log_msg_build)
+            else:
+                self.error_count += 1;
+                build_state['failed'] = True
+                err_detail_build = f"Ошибка сборки EPUB {Path(epub_path).name}: {error_message_build or 'N/A'}"
+                self.errors_list.append(err_detail_build);
+                self.log_message.emit(f"[FAIL] {err_detail_build}")
+            self.file_progress.emit(self.processed_task_count)
+
+        return new_write_jobs
+
+    def _on_stage_queue_change(self, stage_name, pending):
+        self.metrics.queue_depth.set(pending, stage=stage_name)
+        if stage_name == 'delayed':  # отложенные задания конвейера - только повторы API
+            self.metrics.retry_waiting.set(pending)
+
+    def run(self):
+        from google.api_core import exceptions as google_exceptions
+        self.run_started = time.monotonic()
+        self.run_id = uuid.uuid4().hex
+        self._start_metrics_exporter()
+        self._start_run_log()
+        if not self.setup_client():
+            self._stop_metrics_exporter()
+            self._stop_run_log()
+            self.finished.emit(0, 1, ["Критическая ошибка: Не удалось инициализировать Gemini API клиент."])
+            return
+
+        is_epub_to_epub_mode = isinstance(self.files_to_process_data, dict)
+        self.total_tasks = 0
+        self.epub_build_states = {}
+
+        if not is_epub_to_epub_mode:
+            self.total_tasks = len(self.files_to_process_data)
+        else:
+            actual_html_tasks_count = 0
+            build_tasks_count = 0
+            for epub_path, epub_data in self.files_to_process_data.items():
+                html_paths_to_process = epub_data.get('html_paths', [])
+                self.epub_build_states[epub_path] = {
+                    'pending': set(html_paths_to_process),
+                    'builder': self._new_epub_builder(epub_path, epub_data['build_metadata']),
+                    'future': None,  # задание сборки, когда оно создано
+                    'build_metadata': epub_data['build_metadata'],
+                    'failed': False,  # Флаг, если сам EPUB (сборка или критическая ошибка HTML) не удался
+                    'processed_build_result': False,
+                    'html_errors_count': 0  # Счетчик ошибок именно для HTML-частей этого EPUB
+                }
+                actual_html_tasks_count += len(html_paths_to_process)
+                build_tasks_count += 1
+            self.total_tasks = actual_html_tasks_count + build_tasks_count
+            if actual_html_tasks_count == 0 and build_tasks_count > 0:
+                self.log_message.emit("[INFO] EPUB->EPUB режим: Нет HTML для перевода, только сборка.")
+
+        self.total_tasks_calculated.emit(self.total_tasks)
+        if self.total_tasks == 0:
+            self.log_message.emit("[WARN] Нет задач для выполнения.")
+            self._stop_metrics_exporter()
+            self._stop_run_log()
+            self.finished.emit(0, 0, [])
+            return
+
+        self.processed_task_count = 0
+        self.success_count = 0
+        self.error_count = 0
+        self.errors_list = []
+        self._critical_error_occurred = False
+        executor_exception = None
+
+        # потоков чтения не меньше, чем процессов извлечения, иначе часть процессов простаивает
+        parse_workers = max(1, PIPELINE_PARSE_WORKERS, self.extraction_workers)
+        self.extraction_pool = ExtractionPool(self.extraction_workers, log_callback=self.log_message.emit)
+        write_workers = max(1, PIPELINE_WRITE_WORKERS)
+        self.pipeline = Pipeline(thread_name_prefix='Translate', on_queue_change=self._on_stage_queue_change,
+                                 on_discard=self._cleanup_job)
+        self.pipeline.add_stage('parse', self._parse_stage, parse_workers,
+                                maxsize=parse_workers * PIPELINE_QUEUE_FACTOR)
+        self.pipeline.add_stage('translate', self._translate_stage, self.max_concurrent_requests,
+                                maxsize=self.max_concurrent_requests * PIPELINE_QUEUE_FACTOR)
+        self.pipeline.add_stage('write', self._write_stage, write_workers,
+                                maxsize=max(write_workers * PIPELINE_QUEUE_FACTOR, self.max_concurrent_requests))
+        self.log_message.emit(
+            f"Запуск конвейера: чтение {parse_workers} поток(а), API {self.max_concurrent_requests}, запись {write_workers}")
+        try:
+            self.pipeline.start()
+
+            # 1. Задания: одиночные файлы или HTML части EPUB (сборки EPUB добавляются по мере готовности частей)
+            waiting_jobs = deque()
+            write_jobs = []
+            if not is_epub_to_epub_mode:
+                self.log_message.emit(f"Отправка {self.total_tasks} задач (Стандартный режим)...")
+                waiting_jobs.extend(self._schedule_jobs(
+                    [self._new_single_file_job(info) for info in self.files_to_process_data]))
+            else:
+                self.log_message.emit(f"Отправка задач на обработку HTML для {len(self.epub_build_states)} EPUB...")
+                html_jobs = []
+                for epub_path, build_state in self.epub_build_states.items():
+                    html_to_submit = sorted(build_state['pending'])
+                    if not html_to_submit:
+                        self.log_message.emit(
+                            f"[INFO] EPUB {Path(epub_path).name}: Нет HTML для перевода. Запуск сборки...")
+                        write_jobs.append(self._new_epub_build_job(epub_path))
+                    html_jobs.extend(self._new_epub_html_job(epub_path, html_path) for html_path in html_to_submit)
+                waiting_jobs.extend(self._schedule_jobs(html_jobs))
+
+            # 2. Координатор: подает задания в стадию чтения, пока в ее очереди есть место,
+            # и обрабатывает готовые задания (счетчики, состояния сборки EPUB).
+            outstanding = 0
+            finishing_logged = False
+            while waiting_jobs or write_jobs or outstanding:
+                if self.is_cancelled or self._critical_error_occurred:
+                    break
+                while write_jobs:
+                    if not self.pipeline.submit('write', write_jobs[0], priority=write_jobs[0]['priority']):
+                        break
+                    write_jobs.pop(0)
+                    outstanding += 1
+                while waiting_jobs:
+                    if not self.pipeline.submit('parse', waiting_jobs[0], priority=waiting_jobs[0]['priority'],
+                                                block=False):
+                        break
+                    waiting_jobs.popleft()
+                    outstanding += 1
+
+                if self.is_finishing and not finishing_logged:
+                    finishing_logged = True
+                    self.log_message.emit(
+                        "[FINISHING] Новые части не переводятся; ожидание активных задач и сборки EPUB...")
+
+                job = self.pipeline.next_completed(timeout=0.2)
+                if job is None:
+                    continue
+                outstanding -= 1
+                self.current_file_status.emit(f"Завершение: {self._job_origin(job)}...")
+                try:
+                    write_jobs.extend(self._handle_completed_job(job, google_exceptions))
+                except Exception as e:
+                    self.processed_task_count += 1
+                    self.error_count += 1
+                    err_msg_exc = f"Критическая ошибка обработки результата для {self._job_origin(job)}: {e}"
+                    self.errors_list.append(err_msg_exc)
+                    self.log_message.emit(f"[CRITICAL] {err_msg_exc}\n{traceback.format_exc()}")
+                    self.file_progress.emit(self.processed_task_count)
+                finally:
+                    self.current_file_status.emit("")
+                    self.chunk_progress.emit("", 0, 0)
+
+            self.log_message.emit(
+                "Обработка задач (файлы/HTML/сборка EPUB) завершена или прервана (is_finishing/is_cancelled/_critical).")
+
+        except KeyboardInterrupt:
+            self.log_message.emit("[SIGNAL] Получен KeyboardInterrupt, отмена...")
+            self.is_cancelled = True
+            executor_exception = KeyboardInterrupt("Отменено пользователем")
+        except Exception as exec_err:
+            self.log_message.emit(f"[CRITICAL] Ошибка в конвейере: {exec_err}\n{traceback.format_exc()}")
+            executor_exception = exec_err
+            self.is_cancelled = True
+        finally:
+            # 3. Остановка конвейера и итоги
+            if self.is_cancelled or self._critical_error_occurred:
+                self.log_message.emit(
+                    "[INFO] Отмена/Ошибка: Остановка конвейера, ожидание активных задач, отмена ожидающих...")
+                self.pipeline.abort()
+            else:
+                self.log_message.emit("[INFO] Нормальное завершение: Остановка конвейера...")
+            self.pipeline.shutdown()
+            self.extraction_pool.shutdown(cancel=self.is_cancelled)
+            # недособранные книги (отмена, ошибка части): частичный архив удаляется
+            for state in self.epub_build_states.values():
+                if not state.get('processed_build_result') or state.get('failed'):
+                    state['builder'].abort()
+            close_epub_readers()
+            # результаты после отмены не учитываются (как отмененные futures)
+            job = self.pipeline.next_completed(timeout=0)
+            while job is not None:
+                self._cleanup_job(job)
+                job = self.pipeline.next_completed(timeout=0)
+            close_image_store()
+            self.log_message.emit("Конвейер остановлен.")
+
+            # Финальный подсчет ошибок/успехов для EPUB
+            if is_epub_to_epub_mode:
+                for epub_path, state in self.epub_build_states.items():
+                    # Если сборка не была обработана (т.е. processed_build_result=False)
+                    # и EPUB не был помечен как 'failed' из-за ошибки HTML,
+                    # но при этом был is_finishing или is_cancelled, считаем это пропуском/ошибкой сборки.
+                    if not state.get('processed_build_result'):
+                        reason = "не завершена (отмена)" if self.is_cancelled else \
+                            "не завершена (завершение)" if self.is_finishing else \
+                                "не обработана (ошибка)"
+                        if not state.get('failed'):  # Если не было ошибки до этого
+                            self.error_count += 1  # Считаем незавершенную/незапущенную сборку как ошибку
+                            self.errors_list.append(f"Сборка EPUB: {Path(epub_path).name}: {reason}")
+                        state['failed'] = True  # Помечаем, что EPUB не был успешно собран
+                        state['processed_build_result'] = True  # Помечаем, что результат учтен
+                        self.log_message.emit(
+                            f"[WARN] Задача сборки {Path(epub_path).name} учтена как неуспешная ({reason}).")
+                # Пересчитываем общий максимум прогресса, если total_tasks был 0
+                if self.total_tasks == 0 and self.processed_task_count > 0:
+                    self.total_tasks_calculated.emit(self.processed_task_count)
+                self.file_progress.emit(self.processed_task_count)
+
+            final_status_msg = "Завершено"
+            log_separator = "\n" + "=" * 40 + "\n"
+            if self._critical_error_occurred:
+                final_status_msg = "Остановлено (ошибка API)"
+                self.log_message.emit(f"{log_separator}--- ПРОЦЕСС ОСТАНОВЛЕН (КРИТ. ОШИБКА API) ---")
+            elif self.is_cancelled:
+                final_status_msg = "Отменено"
+                self.log_message.emit(f"{log_separator}--- ПРОЦЕСС ОТМЕНЕН ПОЛЬЗОВАТЕЛЕМ ---")
+            elif self.is_finishing:
+                final_status_msg = "Завершено (частично)"
+                self.log_message.emit(f"{log_separator}--- ПРОЦЕСС ЗАВЕРШЕН ПО КОМАНДЕ (частично) ---")
+            elif executor_exception:
+                final_status_msg = "Ошибка Executor"
+                self.log_message.emit(f"{log_separator}--- ПРОЦЕСС ЗАВЕРШЕН С ОШИБКОЙ EXECUTOR ---")
+            else:
+                self.log_message.emit(f"{log_separator}--- ОБРАБОТКА ЗАВЕРШЕНА ---")
+
+            self.current_file_status.emit(final_status_msg)
+            self.chunk_progress.emit("", 0, 0)
+
+            if executor_exception: self.errors_list.insert(0, f"Критическая ошибка Executor: {executor_exception}")
+
+            # Коррекция счетчиков для более точного отображения
+            # processed_task_count должен быть равен total_tasks в идеале, но может быть меньше при отмене/ошибке
+            # error_count = (общее количество задач, которые должны были быть выполнены) - (успешно выполненные)
+            # Если total_tasks = 0, то error_count должен быть 0, если нет executor_exception.
+            if self.total_tasks > 0:
+                # error_count не должен превышать количество задач, которые не были успешными
+                max_possible_errors = self.total_tasks - self.success_count
+                if self.error_count > max_possible_errors: self.error_count = max_possible_errors
+                if self.error_count < 0: self.error_count = 0
+            elif not executor_exception:  # total_tasks == 0 и нет других ошибок
+                self.error_count = 0
+
+            self.log_message.emit(
+                f"ИТОГ: Успешно: {self.success_count}, Ошибок/Отменено/Пропущено: {self.error_count} из {self.total_tasks} задач.")
+            self._write_usage_report()
+            self._stop_metrics_exporter()
+            self._stop_run_log()
+            self.finished.emit(self.success_count, self.error_count, self.errors_list)
+
+    def cancel(self):
+        if not self.is_cancelled:
+            self.log_message.emit("[SIGNAL] Получен сигнал отмены (cancel)...")
+            self.is_cancelled = True
\ No newline at end of file
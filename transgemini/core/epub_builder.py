@@ -1,6 +1,7 @@
 import html
 import os
 import re
+import threading
 import time
 import traceback
 import uuid
@@ -8,13 +9,16 @@ import zipfile
 from pathlib import Path
 
 from bs4 import BeautifulSoup
-from ebooklib import epub
 from lxml import etree
 
 from urllib.parse import urlparse, urljoin, unquote
 
 from transgemini.config import *
-from transgemini.core.html_builder import _convert_placeholders_to_html_img
+from transgemini.core.epub_manifest import load_epub_manifest, manifest_matches
+from transgemini.core.epub_reader import get_epub_reader
+from transgemini.core.epub_writer import EpubZipWriter
+from transgemini.core.image_store import get_image_store
+from transgemini.core.html_builder import render_epub_part_html, scan_html_title
 from transgemini.core.utils import add_translated_suffix
 
 
@@ -407,622 +411,647 @@ def update_ncx_content(ncx_content_bytes, opf_dir, filename_map, canonical_title
         print(f"[ERROR NCX Update] Failed to update NCX content: {e}\n{traceback.format_exc()}")
         return None  # Возвращаем None в случае ошибки
 
-def write_to_epub(out_path, processed_epub_parts, original_epub_path, build_metadata, book_title_override=None):
-    start_time = time.time()
-    if not EBOOKLIB_AVAILABLE: return False, "EbookLib library is required"
-    if not LXML_AVAILABLE: return False, "lxml library is required"
-    if not BS4_AVAILABLE: return False, "BeautifulSoup4 required"
-    if not os.path.exists(original_epub_path): return False, f"Original EPUB not found: {original_epub_path}"
+def generate_opf(metadata, manifest_items, spine_idrefs, ncx_item_id=None):
+    """
+    Generates an EPUB 3 package document.
 
-    print(f"[INFO] EPUB Rebuild: Starting rebuild for '{os.path.basename(original_epub_path)}' -> '{out_path}'")
-    book = epub.EpubBook()
+    Args:
+        metadata (dict): 'identifier', 'title', 'language', 'author', optional 'cover_id'.
+        manifest_items (list): item dicts with 'id', 'href' (relative to the OPF), 'media_type', 'properties'.
+        spine_idrefs (list): ids of the reading order.
+        ncx_item_id (str): id of the NCX item for <spine toc="...">, or None.
 
-    nav_path_orig_from_meta = build_metadata.get('nav_path_in_zip')
-    ncx_path_orig_from_meta = build_metadata.get('ncx_path_in_zip')
-    opf_dir_from_meta = build_metadata.get('opf_dir', '')  # Это директория OPF в оригинальном EPUB
-    nav_id_orig_from_meta = build_metadata.get('nav_item_id')
-    ncx_id_orig_from_meta = build_metadata.get('ncx_item_id')
+    Returns:
+        bytes: The OPF content (UTF-8 encoded XML).
+    """
+    opf_lines = []
+    opf_lines.append("<?xml version='1.0' encoding='utf-8'?>")
+    opf_lines.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">')
+    opf_lines.append('  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">')
+    opf_lines.append(f'    <dc:identifier id="id">{html.escape(metadata.get("identifier") or f"urn:uuid:{uuid.uuid4()}")}</dc:identifier>')
+    opf_lines.append(f'    <dc:title>{html.escape(metadata.get("title") or "Untitled")}</dc:title>')
+    opf_lines.append(f'    <dc:language>{html.escape(metadata.get("language") or "ru")}</dc:language>')
+    opf_lines.append(f'    <dc:creator id="creator">{html.escape(metadata.get("author") or "Translator")}</dc:creator>')
+    opf_lines.append(f'    <meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>')
+    if metadata.get('cover_id'):
+        opf_lines.append(f'    <meta name="cover" content="{html.escape(metadata["cover_id"], quote=True)}"/>')
+    opf_lines.append('  </metadata>')
+
+    opf_lines.append('  <manifest>')
+    for item in manifest_items:
+        safe_props = ""
+        if item.get('properties'):
+            safe_props = f' properties="{html.escape(" ".join(item["properties"]), quote=True)}"'
+        opf_lines.append(f'    <item href="{html.escape(item["href"], quote=True)}" id="{html.escape(item["id"], quote=True)}"'
+                         f' media-type="{html.escape(item["media_type"], quote=True)}"{safe_props}/>')
+    opf_lines.append('  </manifest>')
+
+    safe_toc = f' toc="{html.escape(ncx_item_id, quote=True)}"' if ncx_item_id else ""
+    opf_lines.append(f'  <spine{safe_toc}>')
+    for idref in spine_idrefs:
+        opf_lines.append(f'    <itemref idref="{html.escape(idref, quote=True)}"/>')
+    opf_lines.append('  </spine>')
+    opf_lines.append('</package>')
+
+    return "\n".join(opf_lines).encode('utf-8')
+
+
+def _href_to_zip_path(opf_dir, href):
+    return os.path.normpath(os.path.join(opf_dir, unquote(href))).replace('\\', '/').lstrip('/')
+
+
+def _well_formed_xhtml(part_bytes, part_path):
+    """
+    part_bytes if they parse as XML; otherwise the part re-serialized by lxml.html as XML (strict readers
+    and epubcheck reject a book with a part that is not well-formed).
+    """
+    try:
+        etree.fromstring(part_bytes)
+        return part_bytes
+    except etree.XMLSyntaxError as xml_err:
+        print(f"[WARN write_epub] Часть {part_path} не является корректным XHTML ({xml_err}), исправление через lxml.html.")
+    import lxml.html
+    document = lxml.html.document_fromstring(part_bytes)
+    return etree.tostring(document, method='xml', encoding='utf-8', xml_declaration=True, doctype='<!DOCTYPE html>')
+
+
+def _rebuild_error_message(error):
+    if isinstance(error, FileNotFoundError):
+        return f"EPUB Rebuild Error: Файл не найден - {error}"
+    if isinstance(error, (zipfile.BadZipFile, etree.XMLSyntaxError)):
+        return f"EPUB Rebuild Error: Не удалось разобрать структуру EPUB - {error}"
+    if isinstance(error, ImportError):
+        return f"EPUB Rebuild Error: Отсутствует библиотека - {error}"
+    if isinstance(error, ValueError):
+        return f"EPUB Rebuild Error: {error}"
+    return f"EPUB Rebuild Error: Неожиданная ошибка - {type(error).__name__}: {error}"
+
+
+class EpubIncrementalBuilder:
+    """
+    Rebuilds a translated EPUB part by part.
 
-    final_book_title = book_title_override or Path(original_epub_path).stem
-    final_author = "Translator";
-    final_identifier = f"urn:uuid:{uuid.uuid4()}";
-    final_language = "ru"
+    add_part() renders a finished HTML part and streams it into the new archive right away
+    (several threads may call it); finish() only copies the untouched members and writes
+    NAV, NCX and the OPF. Unchanged members are copied with their compressed bytes (core/epub_writer.py).
+    The archive is written to '<out_path>.part' and renamed by finish(); abort() removes it.
+    """
 
-    original_manifest_items_from_zip = {}  # {path_in_zip: {id, media_type, properties, original_href}}
-    original_spine_idrefs_from_zip = []
+    def __init__(self, out_path, original_epub_path, build_metadata, book_title_override=None):
+        self.out_path = out_path
+        self.partial_path = out_path + ".part"
+        self.original_epub_path = original_epub_path
+        self.build_metadata = build_metadata
+        self.book_title_override = book_title_override
+        self.start_time = time.time()
+
+        self.nav_path_orig_from_meta = build_metadata.get('nav_path_in_zip')
+        self.ncx_path_orig_from_meta = build_metadata.get('ncx_path_in_zip')
+        self.opf_dir_from_meta = build_metadata.get('opf_dir', '')  # Это директория OPF в оригинальном EPUB
+        self.opf_dir_for_new_epub = self.opf_dir_from_meta  # Директория OPF в НОВОМ EPUB (обычно та же)
+
+        self.final_book_title = book_title_override or Path(original_epub_path).stem
+        self.final_author = "Translator"
+        self.final_identifier = f"urn:uuid:{uuid.uuid4()}"
+        self.final_language = "ru"
+        self.cover_id_from_meta = None
+        self.manifest = None
+
+        self.original_zip = None
+        self.opf_path_in_zip_abs = None
+        self.original_manifest_items_from_zip = {}  # {path_in_zip: {id, media_type, properties, original_href}}
+        self.original_spine_idrefs_from_zip = []
+        self.ncx_id_from_spine_attr = None
+
+        self.filename_map = {}  # original_full_path_in_zip -> new_full_path_in_zip (для обновления NAV/NCX)
+        self.final_book_item_ids = set()  # Для отслеживания уникальности ID
+        # Элементы манифеста новой книги: {id, href, media_type, properties, content | source}.
+        # content - байты нового файла (NAV/NCX), source - имя члена оригинального ZIP (копируется сжатым как есть).
+        # Переведенные части и новые изображения пишутся в архив сразу и хранятся без байтов.
+        self.book_items_to_add_to_epub_obj = []
+        self.new_book_items_structure_map = {}
+        self.id_to_new_item_map = {}  # Для быстрого доступа по ID в spine
+        self.processed_original_paths_from_zip = set()  # Отслеживать, какие файлы из ZIP уже обработаны
+        self.canonical_titles_map = {}  # original_full_path_in_zip -> canonical_title
+        self.new_image_objects_for_manifest = {}  # uuid -> элемент манифеста нового изображения
+        self.img_counter = 1
+
+        self.writer = None
+        self._source_file = None
+        self.parts_added = 0
+        self._prepared = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    # --- Разбор оригинала ---
+
+    def _prepare(self):
+        """Takes the OPF data and NAV/NCX titles from the manifest model; opens the output archive."""
+        if self._prepared:
+            return
+        if not LXML_AVAILABLE: raise ImportError("lxml library is required")
+        if not BS4_AVAILABLE: raise ImportError("BeautifulSoup4 required")
+        if not os.path.exists(self.original_epub_path):
+            raise FileNotFoundError(f"Original EPUB not found: {self.original_epub_path}")
+        print(f"[INFO] EPUB Rebuild: Starting rebuild for '{os.path.basename(self.original_epub_path)}' -> '{self.out_path}'")
+
+        # общий EpubReader книги (тот же, что у задач HTML частей, с кэшем); закрывается в конце запуска
+        original_zip = self.original_zip = get_epub_reader(self.original_epub_path)
+        # модель структуры уже разобрана при выборе файлов (build_metadata['manifest']); разбор заново -
+        # только если ее нет или архив с тех пор изменился
+        manifest = self.build_metadata.get('manifest')
+        if not manifest_matches(manifest, original_zip.zip_file):
+            manifest = load_epub_manifest(self.original_epub_path, zip_file=original_zip.zip_file)
+            if manifest is None: raise FileNotFoundError("Cannot find OPF in original EPUB.")
+        self.manifest = manifest
+        self.opf_path_in_zip_abs = manifest['opf_path']
+        if self.opf_dir_for_new_epub != manifest['opf_dir']:
+            print(
+                f"[WARN] OPF directory mismatch: Meta='{self.opf_dir_for_new_epub}', Re-check='{manifest['opf_dir']}'. Using meta: '{self.opf_dir_for_new_epub}'.")
+
+        book_meta = manifest['metadata']
+        self.final_language = book_meta['language'] or self.final_language
+        self.final_book_title = self.book_title_override or book_meta['title'] or self.final_book_title
+        self.final_author = book_meta['author'] or self.final_author
+        self.final_identifier = book_meta['identifier'] or self.final_identifier
+        self.cover_id_from_meta = book_meta['cover_id']
+
+        for item in manifest['items']:
+            self.original_manifest_items_from_zip[item['path']] = {
+                'id': item['id'], 'media_type': item['media_type'],
+                'properties': item['properties'], 'original_href': item['href']}
+        self.ncx_id_from_spine_attr = manifest['spine_toc']  # Это ID NCX файла из манифеста
+        self.original_spine_idrefs_from_zip = list(manifest['spine'])
+        self.canonical_titles_map.update(manifest['toc_titles'])
+
+        self.writer = EpubZipWriter(self.partial_path)
+        # отдельный дескриптор для копирования, чтобы не занимать общий дескриптор EpubReader
+        self._source_file = open(original_zip.path, 'rb')
+        self._prepared = True
+
+    # --- Части ---
+
+    def _add_new_images(self, image_map):
+        """Writes new images of a part (entries with 'image_key') once per UUID; returns nothing."""
+        image_store = get_image_store()
+        for img_uuid, new_img_info in (image_map or {}).items():
+            image_key = new_img_info.get('image_key')
+            if not image_key or img_uuid in self.new_image_objects_for_manifest:
+                continue
+            if image_key not in image_store:
+                print(
+                    f"[WARN write_epub] New image for UUID {img_uuid} is not in the image store: '{image_key}'. Skipping.")
+                continue
+            try:
+                content_type = new_img_info.get('content_type', 'image/jpeg')
+                ext_new_img = content_type.split('/')[-1];
+                ext_new_img = 'jpg' if ext_new_img == 'jpeg' else ext_new_img
+                orig_fname_for_new = new_img_info.get('original_filename',
+                                                      f'new_image_{img_uuid[:6]}.{ext_new_img}')
+
+                img_folder_in_epub = "Images"  # Можно сделать настраиваемым
+                new_img_rel_path_in_epub = os.path.join(img_folder_in_epub,
+                                                        re.sub(r'[^\w\.\-]', '_', orig_fname_for_new)).replace('\\',
+                                                                                                               '/')
 
-    combined_new_image_map_from_worker = build_metadata.get('combined_image_map', {})
+                new_img_id = f"new_img_{img_uuid[:6]}_{self.img_counter}"
+                if new_img_id in self.final_book_item_ids: new_img_id = f"{new_img_id}_{uuid.uuid4().hex[:3]}"
 
-    filename_map = {}  # original_full_path_in_zip -> new_full_path_in_zip (для обновления NAV/NCX)
-    final_book_item_ids = set()  # Для отслеживания уникальности ID
-    book_items_to_add_to_epub_obj = []  # Список объектов EpubItem, EpubHtml, EpubImage для добавления в book
+                new_img_abs_path_in_epub = _href_to_zip_path(self.opf_dir_for_new_epub, new_img_rel_path_in_epub)
+                if new_img_abs_path_in_epub in self.writer:  # то же изображение уже записано другой частью
+                    existing_entry = self.new_book_items_structure_map.get(new_img_abs_path_in_epub)
+                    if existing_entry:
+                        self.new_image_objects_for_manifest[img_uuid] = existing_entry['item']
+                    continue
+                self.writer.writestr(new_img_abs_path_in_epub, image_store.get(image_key), media_type=content_type)
+
+                epub_img_obj_new = {'id': new_img_id, 'href': new_img_rel_path_in_epub,
+                                    'media_type': content_type, 'properties': []}
+                self.book_items_to_add_to_epub_obj.append(epub_img_obj_new)
+                self.new_image_objects_for_manifest[img_uuid] = epub_img_obj_new
+                self.final_book_item_ids.add(new_img_id)
+
+                self.new_book_items_structure_map[new_img_abs_path_in_epub] = {'item': epub_img_obj_new,
+                                                                               'canonical_title': None}
+                self.id_to_new_item_map[new_img_id] = self.new_book_items_structure_map[new_img_abs_path_in_epub]
+                self.processed_original_paths_from_zip.add(
+                    new_img_abs_path_in_epub)  # Помечаем, что этот путь уже занят новым изображением
+                self.img_counter += 1
+            except Exception as e_new_img:
+                print(f"[ERROR write_epub] Failed to add new image (UUID {img_uuid}): {e_new_img}")
+
+    def add_part(self, part_data):
+        """
+        Renders one processed HTML part and writes it into the new archive.
+        part_data: {'original_filename', 'content_to_write', 'image_map', 'is_original_content', 'translation_warning'}.
+        Rendering runs outside the lock, so parts of one book can be staged from several threads.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("EPUB уже собран или прерван")
+            self._prepare()
+            self._add_new_images(part_data.get('image_map'))
+            new_image_objects = dict(self.new_image_objects_for_manifest)
+
+        if 'content_to_write' not in part_data or part_data['content_to_write'] is None:
+            original_fn_for_skip = part_data.get('original_filename', 'Неизвестный HTML')
+            warning_msg_for_skip = part_data.get('translation_warning',
+                                                 'Данные контента отсутствуют или повреждены')
+            print(
+                f"[WARN write_epub] Пропуск HTML-части '{original_fn_for_skip}', так как 'content_to_write' отсутствует или None. Причина: {warning_msg_for_skip}")
+            if original_fn_for_skip:
+                with self._lock:
+                    self.processed_original_paths_from_zip.add(original_fn_for_skip)
+            return
+
+        original_html_path_in_zip = part_data['original_filename']
+        content_to_use = part_data['content_to_write']
+        image_map_for_this_part = part_data.get('image_map', {})
+        is_original = part_data.get('is_original_content', False)
+
+        original_item_info = self.original_manifest_items_from_zip.get(original_html_path_in_zip)
+        if not original_item_info:
+            print(
+                f"[WARN write_epub] Нет записи в манифесте для оригинального HTML: {original_html_path_in_zip}. Пропуск этой части.")
+            with self._lock:
+                self.processed_original_paths_from_zip.add(original_html_path_in_zip)
+            return
 
-    new_book_items_structure_map = {}
-    id_to_new_item_map = {}  # Для быстрого доступа по ID в spine
+        original_item_id = original_item_info['id']
+        original_href_from_manifest = original_item_info['original_href']  # Путь относительно OPF
 
-    processed_original_paths_from_zip = set()  # Отслеживать, какие файлы из ZIP уже обработаны
-    canonical_titles_map = {}  # original_full_path_in_zip -> canonical_title
+        new_html_rel_path_in_epub = ""  # Путь нового файла относительно OPF
+        final_html_content_bytes = None
+        original_member_to_copy = None
 
-    opf_dir_for_new_epub = opf_dir_from_meta  # Директория OPF в НОВОМ EPUB (обычно та же)
+        current_part_canonical_title = self.canonical_titles_map.get(original_html_path_in_zip)
 
-    try:
-        with zipfile.ZipFile(original_epub_path, 'r') as original_zip:
-            zip_contents_normalized = {name.replace('\\', '/'): name for name in original_zip.namelist()}
-            opf_path_in_zip_abs = None
+        if is_original:
+            new_html_rel_path_in_epub = original_href_from_manifest.replace('\\', '/')
+            # непереведенная часть копируется из оригинального ZIP без пересжатия
+            if original_html_path_in_zip in self.original_zip:
+                original_member_to_copy = self.original_zip.resolve(original_html_path_in_zip)
+            else:
+                final_html_content_bytes = content_to_use  # Это уже bytes
 
-            try:
-                container_data = original_zip.read('META-INF/container.xml')
-                container_root = etree.fromstring(container_data);
-                cnt_ns = {'c': 'urn:oasis:names:tc:opendocument:xmlns:container'}
-                opf_path_rel_to_container = container_root.xpath('//c:rootfile/@full-path', namespaces=cnt_ns)[0]
-                opf_path_in_zip_abs = opf_path_rel_to_container.replace('\\', '/')
-
-                temp_opf_dir_check = os.path.dirname(opf_path_in_zip_abs).replace('\\', '/')
-                temp_opf_dir_check = "" if temp_opf_dir_check == '.' else temp_opf_dir_check.lstrip('/')
-                if opf_dir_for_new_epub != temp_opf_dir_check:
-                    print(
-                        f"[WARN] OPF directory mismatch: Meta='{opf_dir_for_new_epub}', Re-check='{temp_opf_dir_check}'. Using meta: '{opf_dir_for_new_epub}'.")
-            except Exception:  # Fallback
-                pot_opf = [p for p in zip_contents_normalized if
-                           p.lower().endswith('.opf') and not p.lower().startswith(
-                               'meta-inf/') and p.lower() != 'mimetype']
-                if not pot_opf: pot_opf = [p for p in zip_contents_normalized if
-                                           p.lower().endswith('.opf') and p.lower() != 'mimetype']
-                if not pot_opf: raise FileNotFoundError("Cannot find OPF in original EPUB.")
-                opf_path_in_zip_abs = pot_opf[0]
-
-            if not opf_path_in_zip_abs: raise FileNotFoundError("OPF path could not be determined.")
-
-            opf_data_bytes = original_zip.read(zip_contents_normalized[opf_path_in_zip_abs])
-            opf_root = etree.fromstring(opf_data_bytes)
-            ns_opf_parse = {'opf': 'http://www.idpf.org/2007/opf', 'dc': 'http://purl.org/dc/elements/1.1/'}
-
-            meta_node = opf_root.find('.//opf:metadata', ns_opf_parse) or opf_root.find('.//metadata')
-            if meta_node is not None:
-                def get_text_meta(
-                        element): return element.text.strip() if element is not None and element.text else None
-
-                lang_node = meta_node.find('.//dc:language', ns_opf_parse) or meta_node.find('.//language')
-                title_node = meta_node.find('.//dc:title', ns_opf_parse) or meta_node.find('.//title')
-                creator_node = meta_node.find('.//dc:creator', ns_opf_parse) or meta_node.find('.//creator')
-                id_element = meta_node.find('.//dc:identifier[@id]', ns_opf_parse) or \
-                             meta_node.find('.//identifier[@id]', ns_opf_parse) or \
-                             meta_node.find('.//dc:identifier', ns_opf_parse) or \
-                             meta_node.find('.//identifier')
-                final_language = get_text_meta(lang_node) or final_language
-                final_book_title = book_title_override or get_text_meta(title_node) or final_book_title
-                final_author = get_text_meta(creator_node) or final_author
-                final_identifier = get_text_meta(id_element) or final_identifier or f"urn:uuid:{uuid.uuid4()}"
-            book.set_title(final_book_title);
-            book.add_author(final_author);
-            book.set_identifier(final_identifier);
-            book.set_language(final_language)
-
-            manifest_node = opf_root.find('.//opf:manifest', ns_opf_parse) or opf_root.find('.//manifest')
-            if manifest_node is not None:
-                for item_mf_loop in (
-                        manifest_node.findall('.//opf:item', ns_opf_parse) or manifest_node.findall('.//item')):
-                    item_id = item_mf_loop.get('id');
-                    href = item_mf_loop.get('href');
-                    media_type = item_mf_loop.get('media-type');
-                    props = item_mf_loop.get('properties')
-                    if not item_id or not href or not media_type: continue
-
-                    full_path_in_zip = os.path.normpath(os.path.join(opf_dir_from_meta, unquote(href))).replace('\\',
-                                                                                                                '/').lstrip(
-                        '/')
-                    original_manifest_items_from_zip[full_path_in_zip] = {'id': item_id, 'media_type': media_type,
-                                                                          'properties': props, 'original_href': href}
-
-            spine_node = opf_root.find('.//opf:spine', ns_opf_parse) or opf_root.find('.//spine')
-            ncx_id_from_spine_attr = None
-            if spine_node is not None:
-                ncx_id_from_spine_attr = spine_node.get('toc')  # Это ID NCX файла из манифеста
-                original_spine_idrefs_from_zip = [i_ref.get('idref') for i_ref in (
-                            spine_node.findall('.//opf:itemref', ns_opf_parse) or spine_node.findall('.//itemref')) if
-                                                  i_ref.get('idref')]
-
-            if nav_path_orig_from_meta and nav_path_orig_from_meta in zip_contents_normalized:
-                try:
-                    nav_data_bytes = original_zip.read(zip_contents_normalized[nav_path_orig_from_meta])
-                    nav_soup = BeautifulSoup(nav_data_bytes, 'lxml-xml')
-                    nav_list_el = nav_soup.find('nav', attrs={'epub:type': 'toc'}) or nav_soup
-                    list_tag_nav = nav_list_el.find(['ol', 'ul'])
-                    if list_tag_nav:
-                        nav_dir_current = os.path.dirname(nav_path_orig_from_meta).replace('\\', '/')
-                        if nav_dir_current == '.': nav_dir_current = ""
-                        for link in list_tag_nav.find_all('a', href=True):
-                            href = link.get('href');
-                            title_text = link.get_text(strip=True)
-                            if not href or not title_text or href.startswith(('#', 'http:', 'mailto:')): continue
-                            try:
-                                target_full_path = os.path.normpath(
-                                    os.path.join(nav_dir_current, unquote(urlparse(href).path))).replace('\\',
-                                                                                                         '/').lstrip(
-                                    '/')
-                                if target_full_path not in canonical_titles_map: canonical_titles_map[
-                                    target_full_path] = title_text
-                            except Exception:
-                                pass
-                except Exception as nav_err_read:
-                    print(f"[WARN write_epub] Error reading original NAV for titles: {nav_err_read}")
-            elif ncx_path_orig_from_meta and ncx_path_orig_from_meta in zip_contents_normalized:
-                try:
-                    ncx_data_bytes = original_zip.read(zip_contents_normalized[ncx_path_orig_from_meta])
-                    ncx_root_titles = etree.fromstring(ncx_data_bytes);
-                    ncx_ns_titles = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-                    for nav_point in ncx_root_titles.xpath('//ncx:navMap/ncx:navPoint', namespaces=ncx_ns_titles):
-                        content_tag = nav_point.find('ncx:content', ncx_ns_titles);
-                        label_tag = nav_point.find('.//ncx:text', ncx_ns_titles)
-                        if content_tag is not None and label_tag is not None and content_tag.get('src'):
-                            src_attr = content_tag.get('src');
-                            title_text = label_tag.text.strip() if label_tag.text else None
-                            if not src_attr or not title_text: continue
-                            try:
-                                target_full_path = os.path.normpath(
-                                    os.path.join(opf_dir_from_meta, unquote(urlparse(src_attr).path))).replace('\\',
-                                                                                                               '/').lstrip(
-                                    '/')
-                                if target_full_path not in canonical_titles_map: canonical_titles_map[
-                                    target_full_path] = title_text
-                            except Exception:
-                                pass
-                except Exception as ncx_err_read:
-                    print(f"[WARN write_epub] Error reading original NCX for titles: {ncx_err_read}")
-
-            new_image_objects_for_manifest = {}  # uuid -> EpubImage object
-            img_counter = 1
-            for img_uuid, new_img_info in combined_new_image_map_from_worker.items():
-                temp_img_path = new_img_info.get('saved_path')
-                if not temp_img_path or not os.path.exists(temp_img_path):
-                    print(
-                        f"[WARN write_epub] New image for UUID {img_uuid} has invalid temp path: '{temp_img_path}'. Skipping.")
-                    continue
+            if not current_part_canonical_title and content_to_use:
                 try:
-                    with open(temp_img_path, 'rb') as f_new_img:
-                        img_data_bytes = f_new_img.read()
-                    content_type = new_img_info.get('content_type', 'image/jpeg')
-                    ext_new_img = content_type.split('/')[-1];
-                    ext_new_img = 'jpg' if ext_new_img == 'jpeg' else ext_new_img
-                    orig_fname_for_new = new_img_info.get('original_filename',
-                                                          f'new_image_{img_uuid[:6]}.{ext_new_img}')
-
-                    img_folder_in_epub = "Images"  # Можно сделать настраиваемым
-                    new_img_rel_path_in_epub = os.path.join(img_folder_in_epub,
-                                                            re.sub(r'[^\w\.\-]', '_', orig_fname_for_new)).replace('\\',
-                                                                                                                   '/')
-
-                    new_img_id = f"new_img_{img_uuid[:6]}_{img_counter}"
-                    if new_img_id in final_book_item_ids: new_img_id = f"{new_img_id}_{uuid.uuid4().hex[:3]}"
-
-                    epub_img_obj_new = epub.EpubImage(uid=new_img_id, file_name=new_img_rel_path_in_epub,
-                                                      media_type=content_type, content=img_data_bytes)
-                    book_items_to_add_to_epub_obj.append(epub_img_obj_new)
-                    new_image_objects_for_manifest[
-                        img_uuid] = epub_img_obj_new  # Для использования в _convert_placeholders
-                    final_book_item_ids.add(new_img_id)
-
-                    new_img_abs_path_in_epub = os.path.normpath(
-                        os.path.join(opf_dir_for_new_epub, new_img_rel_path_in_epub)).replace('\\', '/').lstrip('/')
-                    new_book_items_structure_map[new_img_abs_path_in_epub] = {'item': epub_img_obj_new,
-                                                                              'content_bytes': None,
-                                                                              'canonical_title': None}
-                    id_to_new_item_map[new_img_id] = new_book_items_structure_map[new_img_abs_path_in_epub]
-                    processed_original_paths_from_zip.add(
-                        new_img_abs_path_in_epub)  # Помечаем, что этот путь уже занят новым изображением
-                    img_counter += 1
-                except Exception as e_new_img:
-                    print(f"[ERROR write_epub] Failed to add new image (UUID {img_uuid}): {e_new_img}")
-
-            print(f"[INFO write_epub] Начало обработки {len(processed_epub_parts)} HTML-частей для сборки...")
-
-            for part_data in processed_epub_parts:
-
-                if 'content_to_write' not in part_data or part_data['content_to_write'] is None:
-                    original_fn_for_skip = part_data.get('original_filename', 'Неизвестный HTML')
-                    warning_msg_for_skip = part_data.get('translation_warning',
-                                                         'Данные контента отсутствуют или повреждены')
+                    extracted_title = scan_html_title(content_to_use.decode('utf-8', errors='replace'))
+                    if extracted_title: current_part_canonical_title = extracted_title
+                except Exception as e_title_orig_extract:
                     print(
-                        f"[WARN write_epub] Пропуск HTML-части '{original_fn_for_skip}', так как 'content_to_write' отсутствует или None. Причина: {warning_msg_for_skip}")
-                    if original_fn_for_skip:
-                        processed_original_paths_from_zip.add(original_fn_for_skip)
-                    continue
-
-                original_html_path_in_zip = part_data['original_filename']
-                content_to_use = part_data['content_to_write']
-                image_map_for_this_part = part_data.get('image_map', {})
-                is_original = part_data.get('is_original_content', False)
-
-                original_item_info = original_manifest_items_from_zip.get(original_html_path_in_zip)
-                if not original_item_info:
-                    print(
-                        f"[WARN write_epub] Нет записи в манифесте для оригинального HTML: {original_html_path_in_zip}. Пропуск этой части.")
-                    processed_original_paths_from_zip.add(original_html_path_in_zip)
-                    continue
-
-                original_item_id = original_item_info['id']
-                original_href_from_manifest = original_item_info['original_href']  # Путь относительно OPF
-
-                new_html_rel_path_in_epub = ""  # Путь нового файла относительно OPF
-                final_html_content_bytes = None
-
-                current_part_canonical_title = canonical_titles_map.get(original_html_path_in_zip)
-
-                if is_original:
-                    new_html_rel_path_in_epub = original_href_from_manifest.replace('\\', '/')
-                    final_html_content_bytes = content_to_use  # Это уже bytes
-
-                    abs_path_for_map = os.path.normpath(
-                        os.path.join(opf_dir_for_new_epub, new_html_rel_path_in_epub)).replace('\\', '/').lstrip('/')
-                    filename_map[original_html_path_in_zip] = abs_path_for_map
-
-                    if not current_part_canonical_title and final_html_content_bytes:
-                        try:
-                            temp_html_str_orig = final_html_content_bytes.decode('utf-8', errors='replace')
-                            temp_soup_orig = BeautifulSoup(temp_html_str_orig, 'lxml')
-                            extracted_title = None
-                            h_tag = temp_soup_orig.find(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-                            title_tag = temp_soup_orig.head.title if temp_soup_orig.head else None
-                            if h_tag and h_tag.get_text(strip=True):
-                                extracted_title = h_tag.get_text(strip=True)
-                            elif title_tag and title_tag.string:
-                                stripped_title = title_tag.string.strip()
-                                generic_titles = ['untitled', 'unknown', 'navigation', 'toc', 'table of contents',
-                                                  'index', 'contents', 'оглавление', 'содержание', 'индекс', 'cover',
-                                                  'title page', 'copyright', 'chapter']
-                                if stripped_title and stripped_title.lower() not in generic_titles and len(
-                                        stripped_title) > 1:
-                                    extracted_title = stripped_title
-                            if extracted_title: current_part_canonical_title = extracted_title
-                        except Exception as e_title_orig_extract:
-                            print(
-                                f"[DEBUG write_epub] Ошибка извлечения заголовка из оригинального HTML {original_html_path_in_zip}: {e_title_orig_extract}")
-
-                else:  # Переведенный контент (content_to_use это строка с Markdown-like разметкой и плейсхолдерами)
-                    new_html_rel_path_in_epub = add_translated_suffix(original_href_from_manifest).replace('\\', '/')
-
-                    temp_title_for_conversion = current_part_canonical_title
-                    if not temp_title_for_conversion and isinstance(content_to_use, str):
-                        first_line_md = content_to_use.split('\n', 1)[0].strip()
-                        md_h_match = re.match(r'^(#{1,6})\s+(.*)', first_line_md)
-                        if md_h_match: temp_title_for_conversion = md_h_match.group(2).strip()
-                    if not temp_title_for_conversion:  # Если все еще нет, используем имя файла
-                        temp_title_for_conversion = Path(new_html_rel_path_in_epub).stem.replace('_translated',
-                                                                                                 '').replace('_',
-                                                                                                             ' ').capitalize()
-
-                    final_html_str_rendered = _convert_placeholders_to_html_img(
-                        text_with_placeholders=content_to_use,
-                        item_image_map_for_this_html=image_map_for_this_part,
-                        epub_new_image_objects=new_image_objects_for_manifest,
-                        canonical_title=temp_title_for_conversion,  # Используем временный/предполагаемый заголовок
-                        current_html_file_path_relative_to_opf=new_html_rel_path_in_epub,
-                        opf_dir_path=opf_dir_for_new_epub
-                    )
-
-                    actual_translated_title_from_html = None
-                    try:
-                        soup_final_html = BeautifulSoup(final_html_str_rendered, 'lxml')
-                        h1_tag = soup_final_html.body.find('h1') if soup_final_html.body else None
-                        if h1_tag and h1_tag.get_text(strip=True):
-                            actual_translated_title_from_html = h1_tag.get_text(strip=True)
-                        else:
-                            title_tag_final = soup_final_html.head.title if soup_final_html.head else None
-                            if title_tag_final and title_tag_final.string:
-                                stripped_final_title = title_tag_final.string.strip()
-                                generic_titles_check = ['untitled', 'unknown', 'navigation', 'toc', 'table of contents',
-                                                        'index', 'contents', 'оглавление', 'содержание', 'индекс',
-                                                        'cover', 'title page', 'copyright', 'chapter']
-                                if stripped_final_title and stripped_final_title.lower() not in generic_titles_check and len(
-                                        stripped_final_title) > 1:
-                                    actual_translated_title_from_html = stripped_final_title
-
-                        if actual_translated_title_from_html:
-                            current_part_canonical_title = actual_translated_title_from_html
-
-                    except Exception as e_title_extract_final:
-                        print(
-                            f"[WARN write_epub] Не удалось извлечь заголовок из финального HTML для {new_html_rel_path_in_epub}: {e_title_extract_final}")
-
-                    if actual_translated_title_from_html:
-                        try:
-
-                            soup_to_update_title = BeautifulSoup(final_html_str_rendered, 'lxml')
-                            if soup_to_update_title.head:
-                                if soup_to_update_title.head.title:
-                                    soup_to_update_title.head.title.string = html.escape(
-                                        actual_translated_title_from_html)
-                                else:  # Если тега <title> нет, но есть <head>
-                                    new_title_tag_in_head = soup_to_update_title.new_tag("title")
-                                    new_title_tag_in_head.string = html.escape(actual_translated_title_from_html)
-                                    soup_to_update_title.head.insert(0, new_title_tag_in_head)
-                                final_html_str_rendered = str(soup_to_update_title)  # Обновляем строку
-
-                        except Exception as e_title_force_update:
-                            print(
-                                f"[WARN write_epub] Не удалось принудительно обновить тег <title> в {new_html_rel_path_in_epub}: {e_title_force_update}")
-
-                    final_html_content_bytes = final_html_str_rendered.encode('utf-8')
-                    abs_path_for_map_translated = os.path.normpath(
-                        os.path.join(opf_dir_for_new_epub, new_html_rel_path_in_epub)).replace('\\', '/').lstrip('/')
-                    filename_map[original_html_path_in_zip] = abs_path_for_map_translated
-
-                if not current_part_canonical_title:
-                    cleaned_stem = Path(new_html_rel_path_in_epub).stem.replace('_translated', '')
-                    cleaned_stem = re.sub(r'^[\d_-]+', '', cleaned_stem)  # Удаляем префиксы типа "01_", "001-"
-                    cleaned_stem = cleaned_stem.replace('_', ' ').replace('-', ' ').strip()
-                    current_part_canonical_title = cleaned_stem.capitalize() if cleaned_stem else f"Документ {original_item_id}"
-
-                canonical_titles_map[
-                    original_html_path_in_zip] = current_part_canonical_title  # Обновляем глобальную карту заголовков
-
-                final_html_item_id = original_item_id
-                if final_html_item_id in final_book_item_ids:  # Обеспечиваем уникальность ID
-                    final_html_item_id = f"html_{Path(new_html_rel_path_in_epub).stem}_{uuid.uuid4().hex[:4]}"
-
-                epub_html_obj = epub.EpubHtml(
-                    uid=final_html_item_id,
-                    file_name=new_html_rel_path_in_epub,  # Путь относительно OPF
-                    title=html.escape(current_part_canonical_title),  # Используем финальный канонический заголовок
-                    lang=final_language,
-                    content=final_html_content_bytes  # Это всегда bytes
-                )
-                epub_html_obj.media_type = 'application/xhtml+xml'
-
-                book_items_to_add_to_epub_obj.append(epub_html_obj)
-                final_book_item_ids.add(final_html_item_id)
-
-                new_html_abs_path_in_epub_map_key = os.path.normpath(
-                    os.path.join(opf_dir_for_new_epub, new_html_rel_path_in_epub)).replace('\\', '/').lstrip('/')
-                new_book_items_structure_map[new_html_abs_path_in_epub_map_key] = {
-                    'item': epub_html_obj,
-                    'content_bytes': final_html_content_bytes,
-                    # Сохраняем байты для возможного повторного использования
-                    'canonical_title': current_part_canonical_title
-                }
-                id_to_new_item_map[final_html_item_id] = new_book_items_structure_map[new_html_abs_path_in_epub_map_key]
-                processed_original_paths_from_zip.add(
-                    original_html_path_in_zip)  # Помечаем оригинальный путь как обработанный
-
-            items_to_skip_copying = set()  # NAV, NCX из build_metadata
-            if nav_path_orig_from_meta: items_to_skip_copying.add(nav_path_orig_from_meta)
-            if ncx_path_orig_from_meta: items_to_skip_copying.add(ncx_path_orig_from_meta)
-
-            for orig_full_path, orig_item_info in original_manifest_items_from_zip.items():
-                if orig_full_path in processed_original_paths_from_zip:  # Уже обработан (HTML или замененное изображение)
-                    continue
-                if orig_full_path in items_to_skip_copying:  # Явно пропускаемые (старые NAV/NCX)
-                    continue
-                if orig_item_info.get('properties') and 'nav' in orig_item_info[
-                    'properties'].split():  # Пропуск старого NAV по свойству
-                    continue
+                        f"[DEBUG write_epub] Ошибка извлечения заголовка из оригинального HTML {original_html_path_in_zip}: {e_title_orig_extract}")
+
+        else:  # Переведенный контент (content_to_use это строка с Markdown-like разметкой и плейсхолдерами)
+            new_html_rel_path_in_epub = add_translated_suffix(original_href_from_manifest).replace('\\', '/')
+
+            temp_title_for_conversion = current_part_canonical_title
+            if not temp_title_for_conversion and isinstance(content_to_use, str):
+                first_line_md = content_to_use.split('\n', 1)[0].strip()
+                md_h_match = re.match(r'^(#{1,6})\s+(.*)', first_line_md)
+                if md_h_match: temp_title_for_conversion = md_h_match.group(2).strip()
+            if not temp_title_for_conversion:  # Если все еще нет, используем имя файла
+                temp_title_for_conversion = Path(new_html_rel_path_in_epub).stem.replace('_translated',
+                                                                                         '').replace('_',
+                                                                                                     ' ').capitalize()
+
+            # рендер сразу возвращает заголовок части (первый <h1> или не общий <title>), без повторного разбора
+            rendered_part = render_epub_part_html(
+                text_with_placeholders=content_to_use,
+                item_image_map_for_this_html=image_map_for_this_part,
+                epub_new_image_objects=new_image_objects,
+                canonical_title=temp_title_for_conversion,  # Используем временный/предполагаемый заголовок
+                current_html_file_path_relative_to_opf=new_html_rel_path_in_epub,
+                opf_dir_path=self.opf_dir_for_new_epub
+            )
+            if rendered_part['title']:
+                current_part_canonical_title = rendered_part['title']
+            final_html_content_bytes = _well_formed_xhtml(rendered_part['html'].encode('utf-8'),
+                                                          new_html_rel_path_in_epub)
+
+        if not current_part_canonical_title:
+            cleaned_stem = Path(new_html_rel_path_in_epub).stem.replace('_translated', '')
+            cleaned_stem = re.sub(r'^[\d_-]+', '', cleaned_stem)  # Удаляем префиксы типа "01_", "001-"
+            cleaned_stem = cleaned_stem.replace('_', ' ').replace('-', ' ').strip()
+            current_part_canonical_title = cleaned_stem.capitalize() if cleaned_stem else f"Документ {original_item_id}"
+
+        new_html_abs_path_in_epub_map_key = _href_to_zip_path(self.opf_dir_for_new_epub, new_html_rel_path_in_epub)
+        epub_html_obj = {'href': new_html_rel_path_in_epub,  # Путь относительно OPF
+                         'media_type': 'application/xhtml+xml', 'properties': []}
+        if original_member_to_copy:
+            # свойства (svg, scripted...) описывают оригинальный файл, он не меняется
+            epub_html_obj['source'] = original_member_to_copy
+            epub_html_obj['properties'] = [prop for prop in (original_item_info.get('properties') or '').split()
+                                           if prop != 'nav']
+
+        with self._lock:
+            if self._closed:
+                raise ValueError("EPUB уже собран или прерван")
+            if original_member_to_copy:
+                self._copy_member(original_member_to_copy)
+            else:
+                self.writer.writestr(new_html_abs_path_in_epub_map_key, final_html_content_bytes)
+
+            self.filename_map[original_html_path_in_zip] = new_html_abs_path_in_epub_map_key
+            self.canonical_titles_map[
+                original_html_path_in_zip] = current_part_canonical_title  # Обновляем глобальную карту заголовков
+
+            final_html_item_id = original_item_id
+            if final_html_item_id in self.final_book_item_ids:  # Обеспечиваем уникальность ID
+                final_html_item_id = f"html_{Path(new_html_rel_path_in_epub).stem}_{uuid.uuid4().hex[:4]}"
+            epub_html_obj['id'] = final_html_item_id
+
+            self.book_items_to_add_to_epub_obj.append(epub_html_obj)
+            self.final_book_item_ids.add(final_html_item_id)
+            self.new_book_items_structure_map[new_html_abs_path_in_epub_map_key] = {
+                'item': epub_html_obj,
+                'canonical_title': current_part_canonical_title
+            }
+            self.id_to_new_item_map[final_html_item_id] = self.new_book_items_structure_map[
+                new_html_abs_path_in_epub_map_key]
+            self.processed_original_paths_from_zip.add(
+                original_html_path_in_zip)  # Помечаем оригинальный путь как обработанный
+            self.parts_added += 1
+
+    # --- Завершение ---
+
+    def finish(self):
+        """Copies the untouched members, writes NAV/NCX/OPF and renames the archive. Returns (success, error)."""
+        try:
+            with self._lock:
+                if self._closed:
+                    raise ValueError("EPUB уже собран или прерван")
+                self._prepare()
+                self._finish_locked()
+                self._closed = True
+            os.replace(self.partial_path, self.out_path)
+            end_time = time.time()
+            print(f"[SUCCESS] EPUB Rebuild: Файл сохранен: {self.out_path} (Заняло {end_time - self.start_time:.2f} сек)")
+            return True, None
+        except Exception as e_finish:
+            err_msg = _rebuild_error_message(e_finish)
+            if not isinstance(e_finish, (FileNotFoundError, zipfile.BadZipFile, etree.XMLSyntaxError, ImportError,
+                                         ValueError)):
+                err_msg_print = f"{err_msg}\n{traceback.format_exc()}"
+            else:
+                err_msg_print = err_msg
+            print(f"[ERROR] {err_msg_print}")
+            self.abort()
+            return False, err_msg
+
+    def abort(self):
+        """Closes and removes the partial archive (cancel, failed part, failed finish)."""
+        with self._lock:
+            self._closed = True
+            try:
+                self._close_files()
+            except Exception:
+                pass
+        if os.path.exists(self.partial_path):
+            try:
+                os.remove(self.partial_path)
+            except OSError:
+                pass
 
-                actual_zip_entry_name = zip_contents_normalized.get(orig_full_path)
-                if not actual_zip_entry_name:  # Fallback if case mismatch or slight path variation
-                    actual_zip_entry_name = next((o_name for norm_name, o_name in zip_contents_normalized.items() if
-                                                  norm_name.lower() == orig_full_path.lower()), None)
-                if not actual_zip_entry_name:
-                    print(
-                        f"[WARN write_epub] Original manifest item '{orig_full_path}' not found in ZIP. Skipping copy.")
-                    continue
+    def _copy_member(self, member_name):
+        return self.writer.copy_member(self.original_zip.zip_file, member_name, source_file=self._source_file)
 
-                try:
-                    item_content_bytes = original_zip.read(actual_zip_entry_name)
-                    item_id_copy = orig_item_info['id']
-                    item_href_copy = orig_item_info['original_href']  # Это путь относительно OPF
-                    item_media_type_copy = orig_item_info['media_type']
-
-                    if item_id_copy in final_book_item_ids: item_id_copy = f"item_copy_{Path(item_href_copy).stem}_{uuid.uuid4().hex[:3]}"
-
-                    new_item_obj_copy = None
-                    if item_media_type_copy.startswith('image/'):
-                        new_item_obj_copy = epub.EpubImage(uid=item_id_copy, file_name=item_href_copy,
-                                                           media_type=item_media_type_copy, content=item_content_bytes)
-                    elif item_media_type_copy == 'text/css':
-                        new_item_obj_copy = epub.EpubItem(uid=item_id_copy, file_name=item_href_copy,
-                                                          media_type=item_media_type_copy, content=item_content_bytes)
-                    elif item_media_type_copy.startswith('font/') or item_media_type_copy in ['application/font-woff',
-                                                                                              'application/vnd.ms-opentype',
-                                                                                              'application/octet-stream',
-                                                                                              'application/x-font-ttf']:
-                        new_item_obj_copy = epub.EpubItem(uid=item_id_copy, file_name=item_href_copy,
-                                                          media_type=item_media_type_copy, content=item_content_bytes)
-                    else:  # Другие типы файлов
-                        new_item_obj_copy = epub.EpubItem(uid=item_id_copy, file_name=item_href_copy,
-                                                          media_type=item_media_type_copy, content=item_content_bytes)
-
-                    if new_item_obj_copy:
-                        book_items_to_add_to_epub_obj.append(new_item_obj_copy)
-                        final_book_item_ids.add(item_id_copy)
-
-                        filename_map[orig_full_path] = os.path.normpath(
-                            os.path.join(opf_dir_for_new_epub, item_href_copy)).replace('\\', '/').lstrip('/')
-
-                        new_abs_path_copy = filename_map[orig_full_path]
-                        new_book_items_structure_map[new_abs_path_copy] = {'item': new_item_obj_copy,
-                                                                           'content_bytes': item_content_bytes,
-                                                                           'canonical_title': None}
-                        id_to_new_item_map[item_id_copy] = new_book_items_structure_map[new_abs_path_copy]
-                        processed_original_paths_from_zip.add(orig_full_path)
-                except KeyError:
-                    print(
-                        f"[WARN write_epub] Original manifest item '{orig_full_path}' (href: {orig_item_info.get('original_href')}) could not be read from ZIP. Skipping.")
-                except Exception as e_copy:
-                    print(f"[ERROR write_epub] Failed to copy original manifest item '{orig_full_path}': {e_copy}")
+    def _close_files(self):
+        writer, self.writer = self.writer, None
+        source_file, self._source_file = self._source_file, None
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            if source_file is not None:
+                source_file.close()
+
+    def _finish_locked(self):
+        original_zip = self.original_zip
+        zip_contents_normalized = original_zip.names
+        nav_path_orig_from_meta = self.nav_path_orig_from_meta
+        ncx_path_orig_from_meta = self.ncx_path_orig_from_meta
+        opf_dir_for_new_epub = self.opf_dir_for_new_epub
+        filename_map = self.filename_map
+        canonical_titles_map = self.canonical_titles_map
+        final_book_item_ids = self.final_book_item_ids
+        book_items_to_add_to_epub_obj = self.book_items_to_add_to_epub_obj
+        new_book_items_structure_map = self.new_book_items_structure_map
+        original_manifest_items_from_zip = self.original_manifest_items_from_zip
+        original_spine_idrefs_from_zip = self.original_spine_idrefs_from_zip
+        ncx_id_from_spine_attr = self.ncx_id_from_spine_attr
+
+        print(f"[INFO write_epub] Финализация: {self.parts_added} HTML-частей уже в архиве.")
+
+        items_to_skip_copying = set()  # NAV, NCX из build_metadata
+        if nav_path_orig_from_meta: items_to_skip_copying.add(nav_path_orig_from_meta)
+        if ncx_path_orig_from_meta: items_to_skip_copying.add(ncx_path_orig_from_meta)
+
+        for orig_full_path, orig_item_info in original_manifest_items_from_zip.items():
+            if orig_full_path in self.processed_original_paths_from_zip:  # Уже обработан (HTML или замененное изображение)
+                continue
+            if orig_full_path in items_to_skip_copying:  # Явно пропускаемые (старые NAV/NCX)
+                continue
+            if orig_item_info.get('properties') and 'nav' in orig_item_info[
+                'properties'].split():  # Пропуск старого NAV по свойству
+                continue
 
-            for item_obj in book_items_to_add_to_epub_obj:
-                try:
-                    book.add_item(item_obj)
-                except Exception as add_final_err:
-                    print(
-                        f"[ERROR write_epub] Failed to add item ID='{getattr(item_obj, 'id', 'N/A')}' to book: {add_final_err}")
-
-            final_nav_item_obj = None;
-            final_ncx_item_obj = None
-            new_nav_content_bytes = None;
-            new_ncx_content_bytes = None
-
-            final_nav_rel_path_in_epub = "nav.xhtml"  # Стандартное имя
-            final_ncx_rel_path_in_epub = "toc.ncx"  # Стандартное имя
-
-            spine_item_objects_for_toc_gen = []
-            for orig_idref in original_spine_idrefs_from_zip:
-
-                original_item_path_for_idref = next(
-                    (p for p, i_info in original_manifest_items_from_zip.items() if i_info['id'] == orig_idref), None)
-                if not original_item_path_for_idref: continue
-
-                new_item_abs_path = filename_map.get(original_item_path_for_idref)
-                if not new_item_abs_path: continue
-
-                new_item_entry = new_book_items_structure_map.get(new_item_abs_path)
-                if not new_item_entry or not new_item_entry.get('item'): continue
-
-                new_epub_item_obj = new_item_entry['item']
-                if isinstance(new_epub_item_obj, epub.EpubHtml) and new_epub_item_obj.file_name.replace('\\',
-                                                                                                        '/') != final_nav_rel_path_in_epub:
-                    item_title_for_toc = canonical_titles_map.get(original_item_path_for_idref,
-                                                                  Path(new_epub_item_obj.file_name).stem)
-                    spine_item_objects_for_toc_gen.append((new_epub_item_obj, item_title_for_toc))
-
-            nav_item_id_to_use = nav_id_orig_from_meta or "nav"
-            ncx_item_id_to_use = ncx_id_orig_from_meta or ncx_id_from_spine_attr or "ncx"
-
-            if nav_path_orig_from_meta and nav_path_orig_from_meta in zip_contents_normalized:  # Был NAV
-                print(f"[INFO write_epub] Обновление существующего NAV: {nav_path_orig_from_meta}")
-                orig_nav_bytes = original_zip.read(zip_contents_normalized[nav_path_orig_from_meta])
-                new_nav_content_bytes = update_nav_content(orig_nav_bytes, nav_path_orig_from_meta, filename_map,
-                                                           canonical_titles_map)
-                if new_nav_content_bytes: final_nav_rel_path_in_epub = Path(
-                    nav_path_orig_from_meta).name  # Сохраняем оригинальное имя файла NAV
-            elif spine_item_objects_for_toc_gen:  # Не было NAV, но есть что добавить в spine
-                print("[INFO write_epub] Генерация нового NAV из элементов spine...")
-                nav_data_for_gen_html = []
-                for item_obj_nav, title_nav in spine_item_objects_for_toc_gen:
-                    abs_path_for_nav_href = os.path.normpath(
-                        os.path.join(opf_dir_for_new_epub, item_obj_nav.file_name)).replace('\\', '/').lstrip('/')
-                    nav_data_for_gen_html.append((abs_path_for_nav_href, title_nav))
-                new_nav_content_bytes = generate_nav_html(nav_data_for_gen_html,
-                                                          os.path.join(opf_dir_for_new_epub,
-                                                                       final_nav_rel_path_in_epub).replace('\\',
-                                                                                                           '/').lstrip(
-                                                              '/'),
-                                                          final_book_title, final_language)
-
-            if ncx_path_orig_from_meta and ncx_path_orig_from_meta in zip_contents_normalized:  # Был NCX
-                print(f"[INFO write_epub] Обновление существующего NCX: {ncx_path_orig_from_meta}")
-                orig_ncx_bytes = original_zip.read(zip_contents_normalized[ncx_path_orig_from_meta])
-                new_ncx_content_bytes = update_ncx_content(orig_ncx_bytes, opf_dir_from_meta, filename_map,
-                                                           canonical_titles_map)
-                if new_ncx_content_bytes: final_ncx_rel_path_in_epub = Path(
-                    ncx_path_orig_from_meta).name  # Сохраняем оригинальное имя файла NCX
-            elif new_nav_content_bytes:  # Не было NCX, но сгенерировали NAV, из него генерируем NCX
-                print("[INFO write_epub] Генерация нового NCX из данных нового NAV...")
-
-                nav_path_for_ncx_parse_abs = os.path.normpath(
-                    os.path.join(opf_dir_for_new_epub, final_nav_rel_path_in_epub)).replace('\\', '/').lstrip('/')
-                ncx_data_from_new_nav = parse_nav_for_ncx_data(new_nav_content_bytes, nav_path_for_ncx_parse_abs)
-                if ncx_data_from_new_nav:
-                    new_ncx_content_bytes = generate_ncx_manual(final_identifier, final_book_title,
-                                                                ncx_data_from_new_nav)
-            elif spine_item_objects_for_toc_gen:  # Не было ни NAV, ни NCX, генерируем NCX из spine
-                print("[INFO write_epub] Генерация нового NCX из элементов spine (NAV не был сгенерирован)...")
-                ncx_data_from_spine_gen = []
-                for i_ncx, (item_obj_ncx, title_ncx) in enumerate(spine_item_objects_for_toc_gen):
-                    ncx_src_for_gen = item_obj_ncx.file_name.replace('\\', '/')  # Относительно OPF
-                    safe_base_ncx = re.sub(r'[^\w\-]+', '_', Path(ncx_src_for_gen).stem);
-                    nav_point_id_ncx = f"navpoint_{safe_base_ncx}_{i_ncx + 1}"
-                    ncx_data_from_spine_gen.append((nav_point_id_ncx, ncx_src_for_gen, title_ncx))
-                if ncx_data_from_spine_gen:
-                    new_ncx_content_bytes = generate_ncx_manual(final_identifier, final_book_title,
-                                                                ncx_data_from_spine_gen)
-
-            if new_nav_content_bytes:
-                if nav_item_id_to_use in final_book_item_ids: nav_item_id_to_use = f"{nav_item_id_to_use}_{uuid.uuid4().hex[:4]}"
-                final_nav_item_obj = epub.EpubHtml(uid=nav_item_id_to_use, file_name=final_nav_rel_path_in_epub,
-                                                   title=final_book_title, lang=final_language,
-                                                   content=new_nav_content_bytes)
-                final_nav_item_obj.media_type = 'application/xhtml+xml'
-
-                if 'nav' not in final_nav_item_obj.properties:  # Проверяем, нет ли уже такого свойства
-                    final_nav_item_obj.properties.append('nav')
-
-                book.add_item(final_nav_item_obj);
-                final_book_item_ids.add(nav_item_id_to_use)
-                book.toc = (final_nav_item_obj,)  # Устанавливаем NAV как TOC
+            actual_zip_entry_name = zip_contents_normalized.get(orig_full_path)
+            if not actual_zip_entry_name:  # Fallback if case mismatch or slight path variation
+                actual_zip_entry_name = next((o_name for norm_name, o_name in zip_contents_normalized.items() if
+                                              norm_name.lower() == orig_full_path.lower()), None)
+            if not actual_zip_entry_name:
                 print(
-                    f"[INFO write_epub] NAV добавлен/обновлен. ID: {nav_item_id_to_use}, Path: {final_nav_rel_path_in_epub}")
-            else:
-                book.toc = ()
-                print(f"[INFO write_epub] NAV контент не был сгенерирован/обновлен. book.toc будет пуст.")
+                    f"[WARN write_epub] Original manifest item '{orig_full_path}' not found in ZIP. Skipping copy.")
+                continue
 
-            if new_ncx_content_bytes:
-                if ncx_item_id_to_use in final_book_item_ids: ncx_item_id_to_use = f"{ncx_item_id_to_use}_{uuid.uuid4().hex[:4]}"
-                final_ncx_item_obj = epub.EpubItem(uid=ncx_item_id_to_use, file_name=final_ncx_rel_path_in_epub,
-                                                   media_type='application/x-dtbncx+xml', content=new_ncx_content_bytes)
-                book.add_item(final_ncx_item_obj);
-                final_book_item_ids.add(ncx_item_id_to_use)
+            item_id_copy = orig_item_info['id']
+            item_href_copy = orig_item_info['original_href']  # Это путь относительно OPF
+            if item_id_copy in final_book_item_ids: item_id_copy = f"item_copy_{Path(item_href_copy).stem}_{uuid.uuid4().hex[:3]}"
 
-                book.spine_toc = final_ncx_item_obj.id
+            # байты не читаются: член копируется сжатым как есть
+            new_item_obj_copy = {'id': item_id_copy, 'href': item_href_copy,
+                                 'media_type': orig_item_info['media_type'],
+                                 'properties': (orig_item_info.get('properties') or '').split(),
+                                 'source': actual_zip_entry_name}
+            if not self._copy_member(actual_zip_entry_name):
+                continue
+            book_items_to_add_to_epub_obj.append(new_item_obj_copy)
+            final_book_item_ids.add(item_id_copy)
+
+            filename_map[orig_full_path] = _href_to_zip_path(opf_dir_for_new_epub, item_href_copy)
+            new_book_items_structure_map[filename_map[orig_full_path]] = {'item': new_item_obj_copy,
+                                                                          'canonical_title': None}
+            self.id_to_new_item_map[item_id_copy] = new_book_items_structure_map[filename_map[orig_full_path]]
+            self.processed_original_paths_from_zip.add(orig_full_path)
+
+        final_nav_item_obj = None;
+        final_ncx_item_obj = None
+        new_nav_content_bytes = None;
+        new_ncx_content_bytes = None
+
+        final_nav_rel_path_in_epub = "nav.xhtml"  # Стандартное имя
+        final_ncx_rel_path_in_epub = "toc.ncx"  # Стандартное имя
+
+        spine_item_objects_for_toc_gen = []
+        for orig_idref in original_spine_idrefs_from_zip:
+
+            original_item_path_for_idref = next(
+                (p for p, i_info in original_manifest_items_from_zip.items() if i_info['id'] == orig_idref), None)
+            if not original_item_path_for_idref: continue
+
+            new_item_abs_path = filename_map.get(original_item_path_for_idref)
+            if not new_item_abs_path: continue
+
+            new_item_entry = new_book_items_structure_map.get(new_item_abs_path)
+            if not new_item_entry or not new_item_entry.get('item'): continue
+
+            new_epub_item_obj = new_item_entry['item']
+            # только HTML-части книги (у них есть канонический заголовок), не скопированные файлы
+            if new_item_entry.get('canonical_title') and new_epub_item_obj['href'].replace('\\',
+                                                                                           '/') != final_nav_rel_path_in_epub:
+                item_title_for_toc = canonical_titles_map.get(original_item_path_for_idref,
+                                                              Path(new_epub_item_obj['href']).stem)
+                spine_item_objects_for_toc_gen.append((new_epub_item_obj, item_title_for_toc))
+
+        nav_item_id_to_use = self.build_metadata.get('nav_item_id') or "nav"
+        ncx_item_id_to_use = self.build_metadata.get('ncx_item_id') or ncx_id_from_spine_attr or "ncx"
+
+        if nav_path_orig_from_meta and nav_path_orig_from_meta in zip_contents_normalized:  # Был NAV
+            print(f"[INFO write_epub] Обновление существующего NAV: {nav_path_orig_from_meta}")
+            orig_nav_bytes = original_zip.read(zip_contents_normalized[nav_path_orig_from_meta])
+            new_nav_content_bytes = update_nav_content(orig_nav_bytes, nav_path_orig_from_meta, filename_map,
+                                                       canonical_titles_map)
+            if new_nav_content_bytes:  # NAV остается на своем месте: его ссылки посчитаны от этого пути
+                final_nav_rel_path_in_epub = os.path.relpath(nav_path_orig_from_meta,
+                                                             start=opf_dir_for_new_epub or '.').replace('\\', '/')
+        elif spine_item_objects_for_toc_gen:  # Не было NAV, но есть что добавить в spine
+            print("[INFO write_epub] Генерация нового NAV из элементов spine...")
+            nav_data_for_gen_html = []
+            for item_obj_nav, title_nav in spine_item_objects_for_toc_gen:
+                abs_path_for_nav_href = _href_to_zip_path(opf_dir_for_new_epub, item_obj_nav['href'])
+                nav_data_for_gen_html.append((abs_path_for_nav_href, title_nav))
+            new_nav_content_bytes = generate_nav_html(nav_data_for_gen_html,
+                                                      os.path.join(opf_dir_for_new_epub,
+                                                                   final_nav_rel_path_in_epub).replace('\\',
+                                                                                                       '/').lstrip(
+                                                          '/'),
+                                                      self.final_book_title, self.final_language)
+
+        if ncx_path_orig_from_meta and ncx_path_orig_from_meta in zip_contents_normalized:  # Был NCX
+            print(f"[INFO write_epub] Обновление существующего NCX: {ncx_path_orig_from_meta}")
+            orig_ncx_bytes = original_zip.read(zip_contents_normalized[ncx_path_orig_from_meta])
+            new_ncx_content_bytes = update_ncx_content(orig_ncx_bytes, self.opf_dir_from_meta, filename_map,
+                                                       canonical_titles_map)
+            if new_ncx_content_bytes: final_ncx_rel_path_in_epub = Path(
+                ncx_path_orig_from_meta).name  # Сохраняем оригинальное имя файла NCX
+        elif new_nav_content_bytes:  # Не было NCX, но сгенерировали NAV, из него генерируем NCX
+            print("[INFO write_epub] Генерация нового NCX из данных нового NAV...")
+
+            nav_path_for_ncx_parse_abs = os.path.normpath(
+                os.path.join(opf_dir_for_new_epub, final_nav_rel_path_in_epub)).replace('\\', '/').lstrip('/')
+            ncx_data_from_new_nav = parse_nav_for_ncx_data(new_nav_content_bytes, nav_path_for_ncx_parse_abs)
+            if ncx_data_from_new_nav:
+                new_ncx_content_bytes = generate_ncx_manual(self.final_identifier, self.final_book_title,
+                                                            ncx_data_from_new_nav)
+        elif spine_item_objects_for_toc_gen:  # Не было ни NAV, ни NCX, генерируем NCX из spine
+            print("[INFO write_epub] Генерация нового NCX из элементов spine (NAV не был сгенерирован)...")
+            ncx_data_from_spine_gen = []
+            for i_ncx, (item_obj_ncx, title_ncx) in enumerate(spine_item_objects_for_toc_gen):
+                ncx_src_for_gen = item_obj_ncx['href'].replace('\\', '/')  # Относительно OPF
+                safe_base_ncx = re.sub(r'[^\w\-]+', '_', Path(ncx_src_for_gen).stem);
+                nav_point_id_ncx = f"navpoint_{safe_base_ncx}_{i_ncx + 1}"
+                ncx_data_from_spine_gen.append((nav_point_id_ncx, ncx_src_for_gen, title_ncx))
+            if ncx_data_from_spine_gen:
+                new_ncx_content_bytes = generate_ncx_manual(self.final_identifier, self.final_book_title,
+                                                            ncx_data_from_spine_gen)
+
+        if new_nav_content_bytes:
+            if nav_item_id_to_use in final_book_item_ids: nav_item_id_to_use = f"{nav_item_id_to_use}_{uuid.uuid4().hex[:4]}"
+            final_nav_item_obj = {'id': nav_item_id_to_use, 'href': final_nav_rel_path_in_epub,
+                                  'media_type': 'application/xhtml+xml', 'properties': ['nav'],
+                                  'content': new_nav_content_bytes}
+            book_items_to_add_to_epub_obj.append(final_nav_item_obj)
+            final_book_item_ids.add(nav_item_id_to_use)
+            print(
+                f"[INFO write_epub] NAV добавлен/обновлен. ID: {nav_item_id_to_use}, Path: {final_nav_rel_path_in_epub}")
+        else:
+            print(f"[INFO write_epub] NAV контент не был сгенерирован/обновлен. Книга будет без NAV.")
+
+        spine_toc_id = None
+        if new_ncx_content_bytes:
+            if ncx_item_id_to_use in final_book_item_ids: ncx_item_id_to_use = f"{ncx_item_id_to_use}_{uuid.uuid4().hex[:4]}"
+            final_ncx_item_obj = {'id': ncx_item_id_to_use, 'href': final_ncx_rel_path_in_epub,
+                                  'media_type': 'application/x-dtbncx+xml', 'properties': [],
+                                  'content': new_ncx_content_bytes}
+            book_items_to_add_to_epub_obj.append(final_ncx_item_obj)
+            final_book_item_ids.add(ncx_item_id_to_use)
+            spine_toc_id = ncx_item_id_to_use
+            print(
+                f"[INFO write_epub] NCX добавлен/обновлен. ID: {ncx_item_id_to_use}, Path: {final_ncx_rel_path_in_epub}")
+        elif ncx_id_from_spine_attr:
+            existing_ncx_item = self.id_to_new_item_map.get(ncx_id_from_spine_attr, {}).get('item')
+            if existing_ncx_item and existing_ncx_item['media_type'] == 'application/x-dtbncx+xml':
+                spine_toc_id = ncx_id_from_spine_attr
+                print(f"[INFO write_epub] Использован существующий NCX из spine: ID={ncx_id_from_spine_attr}")
+
+        final_spine_idrefs_for_book = []
+        for orig_idref_spine in original_spine_idrefs_from_zip:
+            original_path_for_idref_spine = next(
+                (p for p, item_info_spine in original_manifest_items_from_zip.items() if
+                 item_info_spine['id'] == orig_idref_spine), None)
+            if not original_path_for_idref_spine: continue
+            new_abs_path_for_idref_spine = filename_map.get(original_path_for_idref_spine)
+            if not new_abs_path_for_idref_spine: continue
+            new_item_entry_for_idref_spine = new_book_items_structure_map.get(new_abs_path_for_idref_spine)
+            if new_item_entry_for_idref_spine and new_item_entry_for_idref_spine.get('item'):
+                final_spine_idrefs_for_book.append(new_item_entry_for_idref_spine['item']['id'])
+
+        if not final_spine_idrefs_for_book and spine_item_objects_for_toc_gen:  # Fallback, если original_spine_idrefs_from_zip пуст
+            final_spine_idrefs_for_book = [item_obj_s['id'] for item_obj_s, _ in spine_item_objects_for_toc_gen]
+
+        if not final_spine_idrefs_for_book:  # Крайний случай: добавляем первый HTML, если spine пуст
+            first_html_item = next(
+                (item for item in book_items_to_add_to_epub_obj if item['media_type'] == 'application/xhtml+xml'
+                 and item is not final_nav_item_obj), None)
+            if first_html_item:
+                final_spine_idrefs_for_book = [first_html_item['id']]
+            else:
+                print("[WARN write_epub] Не удалось сформировать spine, нет подходящих HTML элементов.")
+
+        opf_metadata = {'identifier': self.final_identifier, 'title': self.final_book_title,
+                        'language': self.final_language, 'author': self.final_author,
+                        'cover_id': self.cover_id_from_meta if self.cover_id_from_meta in final_book_item_ids else None}
+        opf_content_bytes = generate_opf(opf_metadata, book_items_to_add_to_epub_obj, final_spine_idrefs_for_book,
+                                         spine_toc_id)
+
+        print(f"[INFO write_epub] Запись финального EPUB файла в: {self.out_path}...")
+        writer = self.writer
+        writer.write_container(self.opf_path_in_zip_abs)
+        writer.writestr(self.opf_path_in_zip_abs, opf_content_bytes)
+        # прочие файлы META-INF (encryption.xml и т.п.) копируются как есть
+        for norm_name, member_name in zip_contents_normalized.items():
+            if norm_name.startswith('META-INF/') and not norm_name.endswith('/') \
+                    and norm_name != 'META-INF/container.xml':
+                self._copy_member(member_name)
+        for item in (final_nav_item_obj, final_ncx_item_obj):
+            if item:
+                writer.writestr(_href_to_zip_path(opf_dir_for_new_epub, item['href']), item['content'])
+        self._close_files()
+        print(f"[INFO write_epub] Скопировано без пересжатия: {writer.copied_members} файлов "
+              f"({writer.copied_bytes / (1024 * 1024):.1f} МБ).")
 
-                print(
-                    f"[INFO write_epub] NCX добавлен/обновлен. ID: {ncx_item_id_to_use}, Path: {final_ncx_rel_path_in_epub}")
-            elif ncx_id_from_spine_attr:
-                existing_ncx_item = book.get_item_with_id(ncx_id_from_spine_attr)
-                if existing_ncx_item and existing_ncx_item.media_type == 'application/x-dtbncx+xml':
-                    book.spine_toc = ncx_id_from_spine_attr
-                    print(f"[INFO write_epub] Использован существующий NCX из spine: ID={ncx_id_from_spine_attr}")
-
-            final_spine_idrefs_for_book = []
-            for orig_idref_spine in original_spine_idrefs_from_zip:
-                original_path_for_idref_spine = next(
-                    (p for p, item_info_spine in original_manifest_items_from_zip.items() if
-                     item_info_spine['id'] == orig_idref_spine), None)
-                if not original_path_for_idref_spine: continue
-                new_abs_path_for_idref_spine = filename_map.get(original_path_for_idref_spine)
-                if not new_abs_path_for_idref_spine: continue
-                new_item_entry_for_idref_spine = new_book_items_structure_map.get(new_abs_path_for_idref_spine)
-                if new_item_entry_for_idref_spine and new_item_entry_for_idref_spine.get('item'):
-                    final_spine_idrefs_for_book.append(new_item_entry_for_idref_spine['item'].id)
-
-            if not final_spine_idrefs_for_book and spine_item_objects_for_toc_gen:  # Fallback, если original_spine_idrefs_from_zip пуст
-                final_spine_idrefs_for_book = [item_obj_s.id for item_obj_s, _ in spine_item_objects_for_toc_gen]
-
-            book.spine = final_spine_idrefs_for_book
-            if not book.spine:  # Крайний случай: добавляем первый HTML, если spine пуст
-                first_html_item = next(
-                    (item for item in book.items if isinstance(item, epub.EpubHtml) and item != final_nav_item_obj),
-                    None)
-                if first_html_item:
-                    book.spine = [first_html_item.id]
-                else:
-                    print("[WARN write_epub] Не удалось сформировать spine, нет подходящих HTML элементов.")
-
-            print(f"[INFO write_epub] Запись финального EPUB файла в: {out_path}...")
-            epub.write_epub(out_path, book, {})  # Опции по умолчанию
-            end_time = time.time()
-            print(f"[SUCCESS] EPUB Rebuild: Файл сохранен: {out_path} (Заняло {end_time - start_time:.2f} сек)")
-            return True, None
 
-    except FileNotFoundError as e_fnf:
-        err_msg = f"EPUB Rebuild Error: Файл не найден - {e_fnf}";
-        print(f"[ERROR] {err_msg}");
-        return False, err_msg
-    except (zipfile.BadZipFile, etree.XMLSyntaxError) as e_xml_zip:
-        err_msg = f"EPUB Rebuild Error: Не удалось разобрать структуру EPUB - {e_xml_zip}";
-        print(f"[ERROR] {err_msg}");
-        return False, err_msg
-    except ImportError as e_imp:
-        err_msg = f"EPUB Rebuild Error: Отсутствует библиотека - {e_imp}";
-        print(f"[ERROR] {err_msg}");
-        return False, err_msg
-    except ValueError as e_val:
-        err_msg = f"EPUB Rebuild Error: {e_val}";
-        print(f"[ERROR] {err_msg}");
-        return False, err_msg
-    except Exception as e_generic:
-        tb_str = traceback.format_exc()
-        err_msg = f"EPUB Rebuild Error: Неожиданная ошибка - {type(e_generic).__name__}: {e_generic}"
-        print(f"[ERROR] {err_msg}\n{tb_str}");
+def write_to_epub(out_path, processed_epub_parts, original_epub_path, build_metadata, book_title_override=None):
+    """Rebuilds the EPUB from all processed parts at once (see EpubIncrementalBuilder)."""
+    builder = EpubIncrementalBuilder(out_path, original_epub_path, build_metadata, book_title_override)
+    print(f"[INFO write_epub] Начало обработки {len(processed_epub_parts)} HTML-частей для сборки...")
+    try:
+        for part_data in processed_epub_parts:
+            builder.add_part(part_data)
+    except Exception as e_part:
+        err_msg = _rebuild_error_message(e_part)
+        print(f"[ERROR] {err_msg}\n{traceback.format_exc()}")
+        builder.abort()
         return False, err_msg
-
+    return builder.finish()
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import threading
+import zipfile
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+from transgemini.config import EPUB_MANIFEST_CACHE_DIR
+
+# Модель структуры EPUB, разбираемая один раз на книгу: container.xml -> OPF (метаданные, манифест, spine),
+# NAV/NCX (дерево оглавления и индекс заголовков по пути файла), список HTML частей.
+# Выбор частей (GUI/CLI) и сборка EPUB (EpubIncrementalBuilder) используют одну и ту же модель,
+# она передается в build_metadata['manifest'] и кэшируется на диске по отпечатку архива.
+# Модель - обычный dict, сериализуемый в JSON.
+
+MANIFEST_FORMAT_VERSION = 1
+
+_NS = {
+    'c': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'x': 'http://www.w3.org/1999/xhtml',
+    'epub': 'http://www.idpf.org/2007/ops',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+}
+
+_memory_cache = {}  # abspath -> (size, mtime_ns, manifest)
+_memory_cache_lock = threading.Lock()
+
+
+def zip_path_join(base_dir, href):
+    """Archive path of an href relative to base_dir (percent-decoded, normalized, without leading '/')."""
+    return posixpath.normpath(posixpath.join(base_dir or '', unquote(href).replace('\\', '/'))).lstrip('/')
+
+
+def epub_fingerprint(zip_file):
+    """sha256 of the central directory entries (name, CRC, sizes): changes with any member content."""
+    digest = hashlib.sha256()
+    for info in sorted(zip_file.infolist(), key=lambda i: i.filename):
+        digest.update(f"{info.filename}\0{info.CRC}\0{info.file_size}\0{info.compress_size}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def list_html_members(names):
+    """Sorted HTML/XHTML members (without META-INF/__MACOSX)."""
+    return sorted([
+        name for name in names
+        if name.lower().endswith(('.html', '.xhtml', '.htm'))
+           and not name.startswith(('__MACOSX', 'META-INF/'))  # Exclude common non-content paths
+    ])
+
+
+def load_epub_manifest(epub_path, log_callback=print, zip_file=None, use_disk_cache=True):
+    """
+    Returns the manifest model of an EPUB (see parse_epub_manifest), or None if the OPF cannot be found.
+    Served from memory while the file is unchanged, then from the disk cache by fingerprint.
+    zip_file: an already opened zipfile.ZipFile of this EPUB (avoids opening it again).
+    Raises zipfile.BadZipFile for a broken archive.
+    """
+    abs_path = os.path.abspath(epub_path)
+    try:
+        stat = os.stat(abs_path)
+        file_key = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        file_key = None
+    with _memory_cache_lock:
+        cached = _memory_cache.get(abs_path)
+    if cached and file_key and cached[:2] == file_key:
+        return cached[2]
+
+    own_zip = zip_file is None
+    if own_zip:
+        zip_file = zipfile.ZipFile(abs_path, 'r')
+    try:
+        fingerprint = epub_fingerprint(zip_file)
+        manifest = _read_disk_cache(fingerprint) if use_disk_cache else None
+        if manifest is None:
+            manifest = parse_epub_manifest(zip_file, Path(epub_path).name, log_callback)
+            if manifest is None:
+                return None
+            manifest['fingerprint'] = fingerprint
+            if use_disk_cache:
+                _write_disk_cache(fingerprint, manifest, log_callback)
+    finally:
+        if own_zip:
+            zip_file.close()
+
+    if file_key:
+        with _memory_cache_lock:
+            _memory_cache[abs_path] = (file_key[0], file_key[1], manifest)
+    return manifest
+
+
+def manifest_matches(manifest, zip_file):
+    """True if the manifest was built for this archive content."""
+    return bool(manifest) and manifest.get('version') == MANIFEST_FORMAT_VERSION and \
+        manifest.get('fingerprint') == epub_fingerprint(zip_file)
+
+
+def toc_paths_from_manifest(manifest):
+    """(nav_path, ncx_path, opf_dir, nav_item_id, ncx_item_id), as find_epub_toc_paths() returns it."""
+    if not manifest:
+        return None, None, None, None, None
+    return (manifest['nav_path'], manifest['ncx_path'], manifest['opf_dir'],
+            manifest['nav_item_id'], manifest['ncx_item_id'])
+
+
+def parse_epub_manifest(zip_file, epub_name, log_callback=print):
+    """
+    Parses the EPUB structure. Returns dict:
+      opf_path, opf_dir, metadata {title, language, author, identifier, cover_id},
+      items [{id, href, path, media_type, properties}] in manifest order, spine [idref], spine_toc,
+      nav_path, nav_item_id, ncx_path, ncx_item_id, html_files,
+      toc [{path, fragment, title, depth}] (NAV if present, else NCX), toc_titles {path: first title}.
+    Returns None if no OPF is found.
+    """
+    from lxml import etree
+    names = {name.replace('\\', '/'): name for name in zip_file.namelist()}
+
+    opf_path = None
+    try:
+        container_root = etree.fromstring(zip_file.read('META-INF/container.xml'))
+        opf_path = container_root.xpath('//c:rootfile/@full-path', namespaces=_NS)[0].replace('\\', '/')
+    except (KeyError, IndexError, etree.XMLSyntaxError) as container_err:
+        log_callback(f"[WARN] EPUB {epub_name}: container.xml не найден/некорректен ({container_err}). Поиск OPF...")
+        opf_path = next((name for name in names if name.lower().endswith('.opf')
+                         and not name.lower().startswith('meta-inf/')), None)
+        if opf_path is None:
+            log_callback(f"[ERROR] EPUB {epub_name}: Не удалось найти OPF файл (ни через container.xml, ни поиском).")
+            return None
+        log_callback(f"[INFO] EPUB {epub_name}: Найден OPF: {opf_path}")
+    if opf_path not in names:
+        log_callback(f"[ERROR] EPUB {epub_name}: OPF '{opf_path}' отсутствует в архиве.")
+        return None
+    opf_dir = posixpath.dirname(opf_path)
+    if opf_dir == '.': opf_dir = ""
+
+    opf_root = etree.fromstring(zip_file.read(names[opf_path]))
+
+    def find_first(parent, *paths):
+        for path in paths:
+            found = parent.find(path, _NS)
+            if found is not None:
+                return found
+        return None
+
+    def node_text(node):
+        return node.text.strip() if node is not None and node.text and node.text.strip() else None
+
+    metadata = {'title': None, 'language': None, 'author': None, 'identifier': None, 'cover_id': None}
+    meta_node = find_first(opf_root, './/opf:metadata', './/metadata')
+    if meta_node is not None:
+        unique_id = opf_root.get('unique-identifier')
+        identifier_node = None
+        if unique_id:
+            identifier_node = next((node for node in meta_node.iter('{%s}identifier' % _NS['dc'])
+                                    if node.get('id') == unique_id), None)
+        if identifier_node is None:
+            identifier_node = find_first(meta_node, './/dc:identifier[@id]', './/dc:identifier', './/identifier')
+        metadata['title'] = node_text(find_first(meta_node, './/dc:title', './/title'))
+        metadata['language'] = node_text(find_first(meta_node, './/dc:language', './/language'))
+        metadata['author'] = node_text(find_first(meta_node, './/dc:creator', './/creator'))
+        metadata['identifier'] = node_text(identifier_node)
+        cover_meta = find_first(meta_node, './/opf:meta[@name="cover"]', './/meta[@name="cover"]')
+        if cover_meta is not None: metadata['cover_id'] = cover_meta.get('content')
+
+    spine_node = find_first(opf_root, './/opf:spine', './/spine')
+    spine_toc = spine_node.get('toc') if spine_node is not None else None
+    spine = []
+    if spine_node is not None:
+        spine = [ref.get('idref') for ref in (spine_node.findall('.//opf:itemref', _NS) or
+                                              spine_node.findall('.//itemref')) if ref.get('idref')]
+
+    items = []
+    nav_path = nav_item_id = ncx_path = ncx_item_id = None
+    manifest_node = find_first(opf_root, './/opf:manifest', './/manifest')
+    if manifest_node is not None:
+        for item in (manifest_node.findall('.//opf:item', _NS) or manifest_node.findall('.//item')):
+            item_id, href, media_type = item.get('id'), item.get('href'), item.get('media-type')
+            if not item_id or not href or not media_type: continue
+            properties = item.get('properties')
+            path = zip_path_join(opf_dir, href)
+            items.append({'id': item_id, 'href': href, 'path': path, 'media_type': media_type,
+                          'properties': properties})
+            if properties and 'nav' in properties.split():
+                if nav_path is None:
+                    nav_path, nav_item_id = path, item_id
+                else:
+                    log_callback(
+                        f"[WARN] EPUB {epub_name}: Найдено несколько элементов с 'properties=nav'. Используется первый: {nav_path}")
+            if media_type == 'application/x-dtbncx+xml' or (spine_toc and item_id == spine_toc):
+                if ncx_path is None:
+                    ncx_path, ncx_item_id = path, item_id
+                else:
+                    log_callback(
+                        f"[WARN] EPUB {epub_name}: Найдено несколько NCX файлов. Используется первый: {ncx_path}")
+
+    toc = []
+    if nav_path and nav_path in names:
+        toc = _parse_nav_toc(zip_file.read(names[nav_path]), nav_path, epub_name, log_callback)
+    if not toc and ncx_path and ncx_path in names:
+        toc = _parse_ncx_toc(zip_file.read(names[ncx_path]), ncx_path, epub_name, log_callback)
+    toc_titles = {}
+    for entry in toc:
+        if entry['title'] and entry['path'] not in toc_titles:
+            toc_titles[entry['path']] = entry['title']
+
+    return {
+        'version': MANIFEST_FORMAT_VERSION,
+        'fingerprint': None,
+        'opf_path': opf_path, 'opf_dir': opf_dir,
+        'metadata': metadata,
+        'items': items, 'spine': spine, 'spine_toc': spine_toc,
+        'nav_path': nav_path, 'nav_item_id': nav_item_id, 'ncx_path': ncx_path, 'ncx_item_id': ncx_item_id,
+        'html_files': list_html_members(zip_file.namelist()),
+        'toc': toc, 'toc_titles': toc_titles,
+    }
+
+
+def _toc_entry(base_dir, href, title, depth):
+    parsed = urlparse(href)
+    if not parsed.path or parsed.scheme or href.startswith(('#', 'mailto:')):
+        return None
+    return {'path': zip_path_join(base_dir, parsed.path), 'fragment': parsed.fragment or None,
+            'title': " ".join(title.split()) if title else None, 'depth': depth}
+
+
+def _parse_nav_toc(nav_bytes, nav_path, epub_name, log_callback):
+    from lxml import etree
+    try:
+        root = etree.fromstring(nav_bytes, etree.XMLParser(recover=True, resolve_entities=False))
+    except etree.XMLSyntaxError as nav_err:
+        log_callback(f"[WARN] EPUB {epub_name}: Не удалось разобрать NAV ({nav_err}).")
+        return []
+    if root is None:
+        return []
+    nav_dir = posixpath.dirname(nav_path)
+    toc_nav = root.xpath("//*[local-name()='nav'][@*[local-name()='type']='toc']")
+    container = toc_nav[0] if toc_nav else (root.xpath("//*[local-name()='nav']") or [root])[0]
+    top_list = container.xpath(".//*[local-name()='ol' or local-name()='ul']")
+    if not top_list:
+        return []
+    entries = []
+    for link in top_list[0].xpath(".//*[local-name()='a'][@href]"):
+        depth = len(link.xpath("ancestor::*[local-name()='li']"))
+        entry = _toc_entry(nav_dir, link.get('href'), "".join(link.itertext()), max(1, depth))
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def _parse_ncx_toc(ncx_bytes, ncx_path, epub_name, log_callback):
+    from lxml import etree
+    try:
+        root = etree.fromstring(ncx_bytes)
+    except etree.XMLSyntaxError as ncx_err:
+        log_callback(f"[WARN] EPUB {epub_name}: Не удалось разобрать NCX ({ncx_err}).")
+        return []
+    ncx_dir = posixpath.dirname(ncx_path)
+    entries = []
+    for nav_point in root.iter('{%s}navPoint' % _NS['ncx']):
+        content = nav_point.find('ncx:content', _NS)
+        label = nav_point.find('ncx:navLabel/ncx:text', _NS)
+        if content is None or not content.get('src'):
+            continue
+        depth = sum(1 for _ in nav_point.iterancestors('{%s}navPoint' % _NS['ncx'])) + 1
+        entry = _toc_entry(ncx_dir, content.get('src'), label.text if label is not None else None, depth)
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def _cache_file(fingerprint):
+    return os.path.join(EPUB_MANIFEST_CACHE_DIR, f"{fingerprint}.json") if EPUB_MANIFEST_CACHE_DIR else None
+
+
+def _read_disk_cache(fingerprint):
+    cache_file = _cache_file(fingerprint)
+    if not cache_file or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_FORMAT_VERSION or manifest.get('fingerprint') != fingerprint:
+        return None
+    return manifest
+
+
+def _write_disk_cache(fingerprint, manifest, log_callback=print):
+    cache_file = _cache_file(fingerprint)
+    if not cache_file:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(EPUB_MANIFEST_CACHE_DIR, exist_ok=True)
+        # запись во временный файл и замена: параллельные запуски не видят недописанный JSON
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest_", dir=EPUB_MANIFEST_CACHE_DIR)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_file)
+    except (OSError, TypeError, ValueError) as cache_err:
+        log_callback(f"[WARN] Не удалось сохранить кэш структуры EPUB: {cache_err}")
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,123 @@
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+
+from transgemini.config import EPUB_READER_CACHE_BYTES, EPUB_READER_CACHE_MAX_MEMBER
+
+# Один открытый ZipFile на EPUB вместо ZipFile(...) в каждой задаче HTML части:
+# центральный каталог читается один раз, прочитанные части кэшируются.
+# Реестр свой в каждом процессе (процессы извлечения открывают книгу один раз на процесс).
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def decode_html_bytes(data):
+    """Returns (text, encoding): utf-8, then cp1251, then latin-1 with losses."""
+    for encoding in ('utf-8', 'cp1251'):
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return data.decode('latin-1', errors='ignore'), 'latin-1'
+
+
+class EpubReader:
+    """
+    Read-only access to one EPUB shared by all tasks of a run.
+    Reads from several threads are safe: zipfile serializes seek+read of the shared
+    file handle, decompression runs in the calling thread.
+    """
+
+    def __init__(self, epub_path, cache_bytes=EPUB_READER_CACHE_BYTES):
+        self.path = epub_path
+        self.zip_file = zipfile.ZipFile(epub_path, 'r')
+        # нормализованный путь ('\\' -> '/') -> имя в архиве
+        self.names = {name.replace('\\', '/'): name for name in self.zip_file.namelist()}
+        self.signature = _file_signature(epub_path)
+        self._cache = OrderedDict()  # (kind, name) -> (bytes или (text, encoding), размер), LRU
+        self._cache_size = 0
+        self._cache_limit = cache_bytes
+        self._lock = threading.Lock()
+
+    def namelist(self):
+        return self.zip_file.namelist()
+
+    def resolve(self, name):
+        """Name of the member in the archive (accepts '\\' separators); KeyError if missing."""
+        return self.names[name.replace('\\', '/')]
+
+    def __contains__(self, name):
+        return name.replace('\\', '/') in self.names
+
+    def read(self, name):
+        """Member bytes, like ZipFile.read (KeyError if missing)."""
+        key = ('bytes', name)
+        data = self._cache_get(key)
+        if data is None:
+            data = self.zip_file.read(self.resolve(name))
+            self._cache_put(key, data, len(data))
+        return data
+
+    def read_text(self, name):
+        """(text, encoding) of an HTML/XML member, see decode_html_bytes."""
+        key = ('text', name)
+        decoded = self._cache_get(key)
+        if decoded is None:
+            decoded = decode_html_bytes(self.read(name))
+            self._cache_put(key, decoded, len(decoded[0]))
+        return decoded
+
+    def _cache_get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            self._cache.move_to_end(key)
+            return entry[0]
+
+    def _cache_put(self, key, value, size):
+        if size > EPUB_READER_CACHE_MAX_MEMBER or size > self._cache_limit:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = (value, size)
+            self._cache_size += size
+            while self._cache_size > self._cache_limit:
+                _, (_, old_size) = self._cache.popitem(last=False)
+                self._cache_size -= old_size
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_size = 0
+        self.zip_file.close()
+
+
+def _file_signature(epub_path):
+    stat = os.stat(epub_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_epub_reader(epub_path):
+    """Shared EpubReader for the file; reopened if the file changed on disk."""
+    key = os.path.abspath(epub_path)
+    signature = _file_signature(epub_path)
+    with _readers_lock:
+        reader = _readers.get(key)
+        if reader is None or reader.signature != signature:
+            # старый объект не закрываем: его еще может читать другой поток, закроется сборщиком мусора
+            reader = EpubReader(epub_path)
+            _readers[key] = reader
+        return reader
+
+
+def close_epub_readers():
+    """Closes all shared readers of this process (end of a run)."""
+    with _readers_lock:
+        readers = list(_readers.values())
+        _readers.clear()
+    for reader in readers:
+        reader.close()
@@ -0,0 +1,122 @@
+import fnmatch
+import os
+import re
+import zipfile
+from pathlib import Path
+
+from transgemini.config import TRANSLATED_SUFFIX
+from transgemini.core.epub_manifest import list_html_members, load_epub_manifest, toc_paths_from_manifest
+
+# Эвристика авто-выбора HTML частей EPUB (общая для GUI диалога и CLI)
+SKIP_INDICATORS = ['toc', 'nav', 'ncx', 'cover', 'title', 'index', 'copyright', 'about', 'meta', 'opf',
+                   'masthead', 'colophon', 'imprint', 'acknowledgments', 'dedication',
+                   'glossary', 'bibliography', 'notes', 'annotations', 'epigraph', 'halftitle',
+                   'frontmatter', 'backmatter', 'preface', 'introduction', 'appendix', 'biography',
+                   'isbn', 'legal', 'notice', 'otherbooks', 'prelims', 'team', 'promo', 'bonus']
+SKIP_DIR_INDICATORS = ['toc', 'nav', 'meta', 'frontmatter', 'backmatter', 'index', 'notes']
+CONTENT_INDICATORS = ['chapter', 'part', 'section', 'content', 'text', 'page', 'body', 'main', 'article',
+                      'chp', 'chap', 'prt', 'sec', 'glava', 'prologue', 'epilogue']
+
+
+def list_epub_html_files(epub_zip):
+    """Sorted HTML/XHTML members of an opened EPUB zip (without META-INF/__MACOSX)."""
+    return list_html_members(epub_zip.namelist())
+
+
+def classify_epub_html_part(file_path, nav_path=None):
+    """
+    Classifies an HTML part of an EPUB by its path.
+    Returns dict: is_nav, is_translated, is_likely_skip, auto_select.
+    """
+    is_nav = bool(nav_path and file_path == nav_path)
+    is_translated = Path(file_path).stem.endswith(TRANSLATED_SUFFIX)
+    path = Path(file_path.lower())
+    filename_base = path.stem.split('.')[0]  # Get stem before first dot
+
+    is_likely_skip = any(skip in filename_base for skip in SKIP_INDICATORS)
+    parent_dir_lower = str(path.parent).lower()
+    is_likely_skip = is_likely_skip or any(skip in parent_dir_lower for skip in SKIP_DIR_INDICATORS)
+    is_likely_content = any(indicator in filename_base for indicator in CONTENT_INDICATORS)
+    is_chapter_like = re.fullmatch(r'(ch|gl|chap|chapter|part|section|sec|glava)[\d_-]+.*', filename_base) or \
+                      re.fullmatch(r'[\d]+', filename_base) or \
+                      re.match(r'^[ivxlcdm]+$', filename_base)
+
+    auto_select = (not is_nav and not is_translated and not is_likely_skip and
+                   bool(is_likely_content or is_chapter_like or 'text' in filename_base))
+    return {
+        'is_nav': is_nav,
+        'is_translated': is_translated,
+        'is_likely_skip': is_likely_skip,
+        'auto_select': auto_select,
+    }
+
+
+def select_epub_parts(html_files, nav_path=None, mode='auto', include_patterns=(), exclude_patterns=()):
+    """
+    Non-interactive EPUB part selection (CLI).
+    mode: 'auto' - same heuristic as the GUI dialog pre-selection, 'all' - every part except NAV.
+    include_patterns are glob patterns that force-select parts, exclude_patterns always win.
+    """
+    selected = []
+    for file_path in html_files:
+        info = classify_epub_html_part(file_path, nav_path)
+        if mode == 'all':
+            chosen = not info['is_nav'] and not info['is_translated']
+        else:
+            chosen = info['auto_select']
+        if any(fnmatch.fnmatch(file_path, pattern) for pattern in include_patterns):
+            chosen = True
+        if any(fnmatch.fnmatch(file_path, pattern) for pattern in exclude_patterns):
+            chosen = False
+        if chosen:
+            selected.append(file_path)
+    return selected
+
+
+def load_epub_structure(epub_path, log_callback=print):
+    """
+    Loads the manifest model of an EPUB (load_epub_manifest) and logs its NAV/NCX/OPF layout.
+    Returns (manifest, toc_paths); manifest is None and toc_paths all None on critical failure.
+    """
+    from lxml import etree
+    epub_name = Path(epub_path).name
+    try:
+        manifest = load_epub_manifest(epub_path, log_callback)
+    except (KeyError, IndexError, etree.XMLSyntaxError, zipfile.BadZipFile, OSError) as e:
+        log_callback(f"[ERROR] Не удалось найти/прочитать структуру OPF/TOC в {os.path.basename(epub_path)}: {e}")
+        manifest = None
+    toc_paths = toc_paths_from_manifest(manifest)
+    if manifest is None:
+        return None, toc_paths  # Critical failure
+
+    nav_path_in_zip, ncx_path_in_zip, opf_dir_in_zip, nav_item_id, ncx_item_id = toc_paths
+    log_parts = [f"OPF_Dir='{opf_dir_in_zip or '<root>'}'"]
+    if nav_path_in_zip: log_parts.append(f"NAV='{nav_path_in_zip}'(ID={nav_item_id})")
+    if ncx_path_in_zip: log_parts.append(f"NCX='{ncx_path_in_zip}'(ID={ncx_item_id})")
+    log_callback(f"Структура {epub_name}: {', '.join(log_parts)}")
+    return manifest, toc_paths
+
+
+def find_epub_toc_paths(epub_path, log_callback=print):
+    """
+    Finds NAV, NCX paths, OPF directory, and NAV/NCX item IDs within an EPUB.
+    Returns (nav_path, ncx_path, opf_dir, nav_item_id, ncx_item_id); all None on critical failure.
+    """
+    return load_epub_structure(epub_path, log_callback)[1]
+
+
+def make_epub_rebuild_entry(html_paths, toc_paths, manifest=None):
+    """
+    Entry of the EPUB->EPUB job dict {epub_path: entry} consumed by TranslationEngine.
+    toc_paths is the tuple returned by find_epub_toc_paths(); the NAV file is never translated.
+    manifest (load_epub_manifest) is passed on to the builder so it does not parse OPF/NAV/NCX again.
+    """
+    nav_path, ncx_path, opf_dir, nav_id, ncx_id = toc_paths
+    return {
+        'html_paths': [p for p in html_paths if p != nav_path],
+        'build_metadata': {
+            'nav_path_in_zip': nav_path, 'ncx_path_in_zip': ncx_path,
+            'opf_dir': opf_dir, 'nav_item_id': nav_id, 'ncx_item_id': ncx_id,
+            'manifest': manifest
+        }
+    }
@@ -0,0 +1,33 @@
+import zipfile
+
+from transgemini.core.zip_writer import ZipOutputWriter
+
+# Потоковая запись EPUB: неизмененные члены исходного архива (шрифты, CSS, изображения,
+# непереведенные части) копируются сжатыми байтами как есть, без распаковки и повторного сжатия.
+# Заново пишутся только переведенные XHTML, OPF, NAV и NCX (сжатие по политике core/zip_writer.py).
+
+CONTAINER_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="%s" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+class EpubZipWriter(ZipOutputWriter):
+    """
+    Writes an EPUB archive member by member: 'mimetype' first and stored, then fresh members
+    (writestr) and raw copies of members of the source archive (copy_member).
+    """
+
+    def __init__(self, out_path, **kwargs):
+        super().__init__(out_path, **kwargs)
+        self._write_mimetype()
+
+    def _write_mimetype(self):
+        # первый член, без сжатия и без extra-поля: читалки проверяют его по смещению 38
+        self.writestr('mimetype', b"application/epub+zip", compress_type=zipfile.ZIP_STORED)
+
+    def write_container(self, opf_path):
+        return self.writestr('META-INF/container.xml', CONTAINER_XML % opf_path.encode('utf-8'))
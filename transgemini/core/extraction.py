@@ -0,0 +1,119 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from transgemini.core.OperationCancelledError import OperationCancelledError
+from transgemini.core.epub_reader import get_epub_reader
+from transgemini.core.image_store import ImageStore
+
+# Функции extract_* выполняются в дочерних процессах: аргументы и результат - только
+# простые типы (строки, bytes, пути, dict). Изображения возвращаются байтами {image_key: bytes},
+# вызывающий кладет их в свое хранилище (core/image_store.py).
+
+
+def extract_docx(filepath):
+    """Returns (text_with_placeholders, image_map, images) for a DOCX file."""
+    from transgemini.core.parser import read_docx_with_images
+    image_map = {}
+    image_store = ImageStore(memory_budget=None)
+    text = read_docx_with_images(filepath, image_store, image_map)
+    return text, _plain_image_map(image_map), _image_bytes(image_store, image_map)
+
+
+def extract_epub_html(html_str, epub_path, html_path_in_epub, with_images=True):
+    """
+    Returns (text_with_placeholders, image_map, images) for an HTML part; images are read from the EPUB by path.
+    with_images=False (EPUB->EPUB): image_map only references the original images, images is empty.
+    """
+    from transgemini.core.parser import process_html_images
+    image_map = {}
+    image_store = ImageStore(memory_budget=None) if with_images else None
+    # общий ZipFile процесса: книга открывается один раз на процесс, а не на каждую часть
+    epub_zip = get_epub_reader(epub_path).zip_file
+    text = process_html_images(html_str, (epub_zip, html_path_in_epub), image_store, image_map)
+    return text, _plain_image_map(image_map), _image_bytes(image_store, image_map)
+
+
+def _image_bytes(image_store, image_map):
+    if image_store is None:
+        return {}
+    return image_store.export({info['image_key'] for info in image_map.values() if info.get('image_key')})
+
+
+def _plain_image_map(image_map):
+    # атрибуты тегов из bs4 (AttributeValueList и т.п.) -> обычные list/str для pickle
+    for img_info in image_map.values():
+        attributes = img_info.get('attributes')
+        if attributes:
+            img_info['attributes'] = {key: list(value) if isinstance(value, list) else value
+                                      for key, value in attributes.items()}
+    return image_map
+
+
+class ExtractionPool:
+    """
+    Runs extract_* functions in a process pool so BeautifulSoup/python-docx parsing does not
+    hold the GIL of the API threads. workers=0 runs them in the calling thread.
+    The pool is started on first use: TXT-only runs never spawn processes.
+    """
+
+    def __init__(self, workers, log_callback=None):
+        self.workers = max(0, int(workers))
+        self.log_callback = log_callback
+        self._executor = None
+        self._lock = threading.Lock()
+        self._broken = False
+
+    def _log(self, message):
+        if self.log_callback:
+            self.log_callback(message)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None and self.workers > 0 and not self._broken:
+                try:
+                    # spawn: fork из процесса с потоками (Qt, gRPC) небезопасен
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+                    self._log(f"[INFO] Извлечение текста: {self.workers} процесс(а/ов).")
+                except Exception as e_pool:
+                    self._broken = True
+                    self._log(f"[WARN] Не удалось запустить процессы извлечения ({e_pool}). Извлечение в потоках.")
+            return None if self._broken else self._executor
+
+    def run(self, func, *args, is_cancelled=None):
+        """Calls func(*args) in the pool and waits; raises OperationCancelledError when is_cancelled() is set."""
+        executor = self._get_executor()
+        if executor is None:
+            return func(*args)
+        try:
+            future = executor.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError) as e_submit:
+            self._mark_broken(e_submit)
+            return func(*args)
+        while True:
+            if is_cancelled and is_cancelled():
+                future.cancel()
+                raise OperationCancelledError("Отменено во время извлечения текста")
+            try:
+                return future.result(timeout=0.2)
+            except FutureTimeoutError:
+                continue
+            except CancelledError:
+                raise OperationCancelledError("Извлечение текста отменено")
+            except BrokenProcessPool as e_broken:
+                self._mark_broken(e_broken)
+                return func(*args)
+
+    def _mark_broken(self, error):
+        with self._lock:
+            if not self._broken:
+                self._broken = True
+                self._log(f"[WARN] Процесс извлечения аварийно завершился ({error}). Дальше извлечение в потоках.")
+
+    def shutdown(self, cancel=False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=not cancel, cancel_futures=cancel)
@@ -1,17 +1,17 @@
-import base64
-import os
 import re
 import time
 
 from lxml import etree
 
 from transgemini.config import LXML_AVAILABLE
+from transgemini.core.image_store import get_image_store
 from transgemini.core.utils import find_image_placeholders
 
 
 def write_to_fb2(out_path, translated_content_with_placeholders, image_map, title):
     if not LXML_AVAILABLE: raise ImportError("lxml library is required to write FB2 files.")
     if image_map is None: image_map = {}
+    image_store = get_image_store()
     print(f"[INFO] FB2: Creating FB2 file with image support: {out_path}")
 
     print(f"DEBUG write_to_fb2: image_map received with {len(image_map)} entries.")
@@ -55,17 +55,15 @@ def write_to_fb2(out_path, translated_content_with_placeholders, image_map, titl
         print(f"DEBUG write_to_fb2: Processing placeholder for UUID from text: {img_uuid_from_text}")
         if img_uuid_from_text in image_map and img_uuid_from_text not in processed_uuids_for_binary:
             img_info = image_map[img_uuid_from_text]
-            img_path = img_info.get('saved_path')
-            print(f"  UUID {img_uuid_from_text} found in image_map. Path: {img_path}")
+            image_key = img_info.get('image_key')
+            print(f"  UUID {img_uuid_from_text} found in image_map. Key: {image_key}")
 
-            if img_path and os.path.exists(img_path):
+            if image_key and image_key in image_store:
                 try:
-                    with open(img_path, 'rb') as f_img:
-                        img_data = f_img.read()
                     base_id = f"img_{img_uuid_from_text[:8]}_{binary_id_counter}";
                     binary_id = re.sub(r'[^\w.-]', '_', base_id)
                     content_type = img_info.get('content_type', 'image/jpeg')
-                    base64_encoded_data = base64.b64encode(img_data).decode('ascii')
+                    base64_encoded_data = image_store.base64(image_key)  # кэш: одна картинка кодируется один раз
 
                     binary_sections.append((binary_id, content_type, base64_encoded_data))
                     placeholder_to_binary_id[img_uuid_from_text] = binary_id
@@ -75,12 +73,12 @@ def write_to_fb2(out_path, translated_content_with_placeholders, image_map, titl
                     print(
                         f"    Successfully prepared binary data for UUID {img_uuid_from_text}. Binary ID: {binary_id}")
                 except Exception as e:
-                    print(f"[ERROR] FB2: Failed to read/encode image {img_path} for UUID {img_uuid_from_text}: {e}")
-            elif not img_path:
-                print(f"[ERROR] FB2: No 'saved_path' found in image_map for UUID {img_uuid_from_text}.")
-            else:  # img_path exists in map, but file os.path.exists(img_path) is false
+                    print(f"[ERROR] FB2: Failed to read/encode image {image_key} for UUID {img_uuid_from_text}: {e}")
+            elif not image_key:
+                print(f"[ERROR] FB2: No 'image_key' found in image_map for UUID {img_uuid_from_text}.")
+            else:  # key in image_map, but the image is not in the store
                 print(
-                    f"[ERROR] FB2: Image path from image_map does not exist on disk: {img_path} (for UUID {img_uuid_from_text})")
+                    f"[ERROR] FB2: Image from image_map is not in the image store: {image_key} (for UUID {img_uuid_from_text})")
         elif img_uuid_from_text not in image_map:
             print(f"  UUID {img_uuid_from_text} from placeholder NOT FOUND in image_map.")
         elif img_uuid_from_text in processed_uuids_for_binary:
@@ -0,0 +1,86 @@
+import math
+import threading
+from collections import deque
+
+from transgemini.config import (HEDGE_LATENCY_PERCENTILE, HEDGE_LATENCY_WINDOW, HEDGE_MIN_SAMPLES,
+                                HEDGE_MIN_DELAY_SECONDS, HEDGE_MAX_FRACTION)
+
+# Хеджирование запросов: если запрос идет дольше обычного для чанков такого размера (p95),
+# отправляется дубликат, берется первый успешный ответ. Порог адаптивный - по наблюдаемым задержкам.
+
+
+def size_bucket(prompt_chars):
+    """Size class of a prompt: powers of two of its length in KiB (0: < 1 KiB, 1: < 2 KiB, ...)."""
+    return int(math.log2(prompt_chars / 1024.0)) + 1 if prompt_chars >= 1024 else 0
+
+
+class HedgeTracker:
+    """
+    Thread-safe recent latencies of successful API calls per prompt size class, the hedge
+    threshold derived from them and the hedge counters (calls, hedges fired, hedges won).
+    """
+
+    def __init__(self, percentile=HEDGE_LATENCY_PERCENTILE, window=HEDGE_LATENCY_WINDOW,
+                 min_samples=HEDGE_MIN_SAMPLES, min_delay=HEDGE_MIN_DELAY_SECONDS, max_fraction=HEDGE_MAX_FRACTION):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_fraction = max_fraction
+        self._lock = threading.Lock()
+        self._latencies = {}  # size bucket -> deque of seconds
+        self._all_latencies = deque(maxlen=window)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def observe(self, prompt_chars, latency):
+        """Adds the latency of a successful call (for a hedged one, since the original was sent)."""
+        with self._lock:
+            bucket = self._latencies.setdefault(size_bucket(prompt_chars), deque(maxlen=self.window))
+            bucket.append(latency)
+            self._all_latencies.append(latency)
+
+    def _percentile(self, samples):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(self.percentile * len(ordered))) - 1)]
+
+    def threshold(self, prompt_chars):
+        """
+        Seconds after which a call with this prompt size is hedged, or None while there are too few samples.
+        Uses the size class when it has min_samples, otherwise all sizes.
+        """
+        with self._lock:
+            samples = self._latencies.get(size_bucket(prompt_chars))
+            if not samples or len(samples) < self.min_samples:
+                samples = self._all_latencies
+            if len(samples) < self.min_samples:
+                return None
+            return max(self.min_delay, self._percentile(samples))
+
+    def count_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def try_hedge(self):
+        """Reserves a hedge if hedges stay within max_fraction of calls; returns True when reserved."""
+        with self._lock:
+            if self.hedged + 1 > max(1.0, self.max_fraction * self.calls):
+                return False
+            self.hedged += 1
+            return True
+
+    def count_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self):
+        """{'calls', 'hedged', 'hedge_wins', 'hedge_rate', 'win_rate'} (rates 0..1)."""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'hedge_rate': round(self.hedged / self.calls, 4) if self.calls else 0.0,
+                'win_rate': round(self.hedge_wins / self.hedged, 4) if self.hedged else 0.0,
+            }
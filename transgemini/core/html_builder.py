@@ -1,18 +1,71 @@
-import base64
 import html
 import os
 import re
 from pathlib import Path
 
+from transgemini.config import GENERIC_DOC_TITLES
+from transgemini.core.image_store import get_image_store
 from transgemini.core.utils import find_image_placeholders
 
 
-def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for_this_html,
-                                      epub_new_image_objects,
-                                      canonical_title,
-                                      current_html_file_path_relative_to_opf=None,
-                                      opf_dir_path=None):
-    if not text_with_placeholders: return ""
+_TAG_RE = re.compile(r'<[^>]*>')
+_FIRST_HEADING_RE = re.compile(r'<h([1-6])\b[^>]*>(.*?)</h\1\s*>', re.IGNORECASE | re.DOTALL)
+_TITLE_RE = re.compile(r'<title\b[^>]*>(.*?)</title\s*>', re.IGNORECASE | re.DOTALL)
+
+
+def _fragment_text(fragment_html):
+    """Text of an HTML fragment like bs4 get_text(strip=True): tags dropped, each piece stripped, joined."""
+    return "".join(html.unescape(piece).strip() for piece in _TAG_RE.split(fragment_html))
+
+
+def _usable_doc_title(title_text):
+    if title_text and title_text.lower() not in GENERIC_DOC_TITLES and len(title_text) > 1:
+        return title_text
+    return None
+
+
+def scan_html_title(html_str):
+    """
+    Chapter title of an (original) XHTML part from one regex scan, no DOM:
+    text of the first <h1>-<h6> if not empty, else a non-generic <title>.
+    """
+    heading_match = _FIRST_HEADING_RE.search(html_str)
+    if heading_match:
+        heading_text = _fragment_text(heading_match.group(2))
+        if heading_text:
+            return heading_text
+    title_match = _TITLE_RE.search(html_str)
+    if title_match:  # содержимое <title> - простой текст (RCDATA), теги внутри не разбираются
+        return _usable_doc_title(html.unescape(title_match.group(1)).strip())
+    return None
+
+
+def _escape_text_keeping_placeholders(text):
+    """html.escape(text, quote=False) for everything but the image placeholders, which stay as they are."""
+    escaped_parts = []
+    last_index = 0
+    for placeholder_tag, _ in find_image_placeholders(text):
+        match_start = text.find(placeholder_tag, last_index)
+        if match_start == -1: continue
+        escaped_parts.append(html.escape(text[last_index:match_start], quote=False))
+        escaped_parts.append(placeholder_tag)
+        last_index = match_start + len(placeholder_tag)
+    escaped_parts.append(html.escape(text[last_index:], quote=False))
+    return "".join(escaped_parts)
+
+
+def render_epub_part_html(text_with_placeholders, item_image_map_for_this_html,
+                          epub_new_image_objects,
+                          canonical_title,
+                          current_html_file_path_relative_to_opf=None,
+                          opf_dir_path=None):
+    """
+    Renders a translated part (Markdown-like text with image placeholders) to XHTML.
+    Returns {'html', 'title', 'headings'}: 'title' is the text of the first <h1>, else canonical_title
+    if it is not generic, else None; 'headings' is [(level, text), ...] in document order.
+    The <title> tag is written with that title, so the result needs no re-parsing.
+    """
+    if not text_with_placeholders: return {'html': "", 'title': None, 'headings': []}
     if item_image_map_for_this_html is None: item_image_map_for_this_html = {}
     if epub_new_image_objects is None: epub_new_image_objects = {}
 
@@ -28,12 +81,14 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
             temp_id_counter += 1
             return placeholder
 
-        text_with_placeholders_for_tags = re.sub(r'(<br\s*/?>|<img\s+[^>]*?/>)', tag_replacer, text_segment,
-                                                 flags=re.IGNORECASE | re.DOTALL)
+        text_with_placeholders_for_tags = re.sub(r'(<br\s*/?>|<img\s+[^>]*?/>|<!--.*?-->)', tag_replacer,
+                                                 text_segment, flags=re.IGNORECASE | re.DOTALL)
+        # текст пишется в архив как есть (без повторной сериализации): & < > экранируются здесь
+        text_with_placeholders_for_tags = html.escape(text_with_placeholders_for_tags, quote=False)
 
         def markdown_replacer(match_md):
             marker = match_md.group(1)
-            content_to_wrap = html.escape(match_md.group(2))
+            content_to_wrap = match_md.group(2)
             if marker == '**': return f'<strong>{content_to_wrap}</strong>'
             if marker == '*':  return f'<em>{content_to_wrap}</em>'
             if marker == '`':  return f'<code>{content_to_wrap}</code>'
@@ -66,7 +121,7 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
             elif img_uuid in epub_new_image_objects:
                 epub_img_object_for_new = epub_new_image_objects.get(img_uuid)
                 if epub_img_object_for_new:
-                    image_path_rel_to_opf_for_new = epub_img_object_for_new.file_name.replace('\\', '/')
+                    image_path_rel_to_opf_for_new = epub_img_object_for_new['href'].replace('\\', '/')
                     if current_html_file_path_relative_to_opf is not None:
                         html_dir_rel_to_opf_for_new = os.path.dirname(current_html_file_path_relative_to_opf).replace(
                             '\\', '/')
@@ -110,6 +165,7 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
     lines = text_normalized_newlines.splitlines()  # Делим по \n.
 
     html_body_segments = []
+    headings = []
     paragraph_part_buffer = []
     current_list_tag_md = None
     in_code_block_md = False
@@ -199,6 +255,7 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
             heading_text_raw = heading_match.group(2).strip()  # strip() здесь, т.к. это содержимое тега
             processed_heading_text = apply_inline_markdown_carefully(heading_text_raw)
             html_body_segments.append(f"<h{level}>{processed_heading_text}</h{level}>")
+            headings.append((level, _fragment_text(processed_heading_text)))
         elif hr_match:
             finalize_list_md()
             html_body_segments.append("<hr />")
@@ -229,8 +286,10 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
 
     body_content_final = "\n".join(html_body_segments)
 
+    first_h1_text = next((text for level, text in headings if level == 1), None)
+    part_title = first_h1_text or _usable_doc_title(str(canonical_title or "").strip())
     final_title_text_for_html_tag = html.escape(
-        str(canonical_title or Path(current_html_file_path_relative_to_opf or "document").stem).strip())
+        str(part_title or canonical_title or Path(current_html_file_path_relative_to_opf or "document").stem).strip())
     if not final_title_text_for_html_tag: final_title_text_for_html_tag = "Untitled Document"
     stylesheet_path_final = "../Styles/stylesheet.css"
     if current_html_file_path_relative_to_opf is not None:
@@ -254,7 +313,7 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
             else:
                 stylesheet_path_final = abs_stylesheet_path_in_epub
     stylesheet_link_tag = f'<link rel="stylesheet" type="text/css" href="{html.escape(stylesheet_path_final, quote=True)}"/>'
-    return f"""<?xml version="1.0" encoding="utf-8"?>
+    part_html = f"""<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE html>
 <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="ru" xml:lang="ru">
 <head>
@@ -266,10 +325,12 @@ def _convert_placeholders_to_html_img(text_with_placeholders, item_image_map_for
 {body_content_final}
 </body>
 </html>"""
+    return {'html': part_html, 'title': part_title, 'headings': headings}
 
 def write_to_html(out_path, translated_content_with_placeholders, image_map, title):
     """Creates HTML file with embedded Base64 images."""
     if image_map is None: image_map = {}
+    image_store = get_image_store()
     print(f"[INFO] HTML: Creating HTML file with embedded images: {out_path}")
     html_body_content = ""
 
@@ -281,11 +342,9 @@ def write_to_html(out_path, translated_content_with_placeholders, image_map, tit
         processed_parts = []
         last_index = 0
 
-        text_block_escaped_amp = text_block.replace('&', '&')
-
-        text_block_br_protected = re.sub(r'<br\s*/?>', '__TEMP_BR_TAG__', text_block_escaped_amp, flags=re.IGNORECASE)
+        text_block_br_protected = re.sub(r'<br\s*/?>', '__TEMP_BR_TAG__', text_block, flags=re.IGNORECASE)
 
-        text_block_lt_gt_escaped = text_block_br_protected.replace('<', '<').replace('>', '>')
+        text_block_lt_gt_escaped = _escape_text_keeping_placeholders(text_block_br_protected)
 
         temp_md_text = text_block_lt_gt_escaped
         temp_md_text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', temp_md_text, flags=re.DOTALL)
@@ -309,12 +368,10 @@ def write_to_html(out_path, translated_content_with_placeholders, image_map, tit
 
             if img_uuid in image_map:
                 img_info = image_map[img_uuid];
-                img_path = img_info['saved_path']
-                if os.path.exists(img_path):
+                image_key = img_info.get('image_key')
+                if image_key and image_key in image_store:
                     try:
-                        with open(img_path, 'rb') as f_img:
-                            img_data = f_img.read()
-                        b64_data = base64.b64encode(img_data).decode('ascii')
+                        b64_data = image_store.base64(image_key)  # кэш: одна картинка кодируется один раз
                         content_type = img_info.get('content_type', 'image/jpeg');
                         data_uri = f"data:{content_type};base64,{b64_data}"
                         alt_text_raw = img_info.get('original_filename', f'Image {img_uuid[:8]}');
@@ -324,10 +381,10 @@ def write_to_html(out_path, translated_content_with_placeholders, image_map, tit
                         processed_parts.append(img_tag)
                     except Exception as img_err:
                         print(
-                            f"[ERROR] HTML Write: Failed to read/encode image {img_path}: {img_err}"); processed_parts.append(
+                            f"[ERROR] HTML Write: Failed to read/encode image {image_key}: {img_err}"); processed_parts.append(
                             f"[Err embed img: {img_uuid[:8]}]")
                 else:
-                    print(f"[ERROR] HTML Write: Image path not found: {img_path}"); processed_parts.append(
+                    print(f"[ERROR] HTML Write: Image not found in image store: {image_key}"); processed_parts.append(
                         f"[Img path miss: {img_uuid[:8]}]")
             else:
                 print(f"[WARN] HTML Write: Placeholder UUID '{img_uuid}' not found."); processed_parts.append(
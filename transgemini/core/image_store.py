@@ -0,0 +1,182 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from transgemini.config import IMAGE_STORE_MEMORY_BYTES
+
+# Изображения для не-EPUB форматов: парсеры кладут байты сюда, image_map хранит только
+# ключ ('image_key'), сборщики TXT/DOCX/FB2/HTML берут байты и base64 отсюда же.
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class ImageStore:
+    """
+    Content-addressed image bytes: key = sha256 of the data, so the same picture in several
+    chapters/files is kept once. Bytes stay in memory up to memory_budget (LRU), older ones are
+    written to one temp dir and read back on demand. Derived forms (base64, converted PNG) are cached.
+    Every put() takes a reference, release() drops it; an image is deleted with its last reference.
+    memory_budget=None - no limit, nothing is written to disk (extraction processes).
+    """
+
+    def __init__(self, memory_budget=IMAGE_STORE_MEMORY_BYTES):
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self._memory = OrderedDict()  # key -> bytes, LRU
+        self._spilled = {}  # key -> путь к файлу
+        self._refs = {}  # key -> число ссылок (задач, использующих изображение)
+        self._derived = OrderedDict()  # (kind, key) -> str/bytes, LRU, тоже в бюджете
+        self._converted = {}  # (kind, key исходника) -> key результата (или None если не удалось)
+        self._spill_dir = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key_for(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data, key=None):
+        """Stores image bytes, returns their key (the same bytes -> the same key)."""
+        key = key or self.key_for(data)
+        with self._lock:
+            self._refs[key] = self._refs.get(key, 0) + 1
+            if key in self._memory:
+                self._memory.move_to_end(key)
+            elif key not in self._spilled:
+                self._memory[key] = data
+                self.memory_used += len(data)
+                self._enforce_budget()
+        return key
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._spilled
+
+    def get(self, key):
+        """Image bytes; KeyError if the key is unknown."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+            spill_path = self._spilled[key]
+        with open(spill_path, 'rb') as f:
+            return f.read()
+
+    def base64(self, key):
+        """Cached base64 (ascii str) of the image, for FB2 <binary> and HTML data: URIs."""
+        return self._derived_form('base64', key, lambda data: base64.b64encode(data).decode('ascii'))
+
+    def convert(self, data, kind, converter):
+        """
+        Key of converter(data) stored as a new image (e.g. EMF -> PNG), or None if conversion failed.
+        The result is cached per source content, so the same EMF is converted once per run.
+        """
+        cache_key = (kind, self.key_for(data))
+        with self._lock:
+            result_key = self._converted.get(cache_key)
+            if result_key is not None and result_key in self:
+                self._refs[result_key] += 1
+                return result_key
+        converted = converter(data)
+        result_key = self.put(converted) if converted else None
+        with self._lock:
+            self._converted[cache_key] = result_key
+        return result_key
+
+    def release(self, keys):
+        """Drops one reference per key; images without references are deleted."""
+        spill_paths = []
+        with self._lock:
+            for key in keys:
+                refs = self._refs.get(key, 0) - 1
+                if refs > 0:
+                    self._refs[key] = refs
+                    continue
+                self._refs.pop(key, None)
+                data = self._memory.pop(key, None)
+                if data is not None:
+                    self.memory_used -= len(data)
+                spill_path = self._spilled.pop(key, None)
+                if spill_path:
+                    spill_paths.append(spill_path)
+                for kind_key in [k for k in self._derived if k[1] == key]:
+                    self.memory_used -= len(self._derived.pop(kind_key))
+        for spill_path in spill_paths:
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+
+    def export(self, keys):
+        """{key: bytes} for the given keys (results of extraction processes)."""
+        return {key: self.get(key) for key in keys}
+
+    def _derived_form(self, kind, key, factory):
+        cache_key = (kind, key)
+        with self._lock:
+            value = self._derived.get(cache_key)
+            if value is not None:
+                self._derived.move_to_end(cache_key)
+                return value
+        value = factory(self.get(key))
+        with self._lock:
+            if cache_key not in self._derived:
+                self._derived[cache_key] = value
+                self.memory_used += len(value)
+                self._enforce_budget()
+        return value
+
+    def _enforce_budget(self):
+        if self.memory_budget is None:
+            return
+        # сначала выбрасываются производные формы (их можно пересчитать), затем байты уходят на диск
+        while self.memory_used > self.memory_budget and self._derived:
+            _, value = self._derived.popitem(last=False)
+            self.memory_used -= len(value)
+        while self.memory_used > self.memory_budget and len(self._memory) > 1:
+            key, data = self._memory.popitem(last=False)
+            self._spill(key, data)
+            self.memory_used -= len(data)
+
+    def _spill(self, key, data):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="translator_images_")
+        spill_path = os.path.join(self._spill_dir, key)
+        with open(spill_path, 'wb') as f:
+            f.write(data)
+        self._spilled[key] = spill_path
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._spilled.clear()
+            self._derived.clear()
+            self._converted.clear()
+            self._refs.clear()
+            self.memory_used = 0
+            spill_dir, self._spill_dir = self._spill_dir, None
+        if spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def get_image_store():
+    """Image store of this process (created on first use)."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
+
+
+def close_image_store():
+    """Drops all images and the spill dir (end of a run)."""
+    global _store
+    with _store_lock:
+        store, _store = _store, None
+    if store is not None:
+        store.clear()
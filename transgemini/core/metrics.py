@@ -0,0 +1,284 @@
+import os
+import threading
+import time
+
+from transgemini.core.ChunkDeadlineError import ChunkDeadlineError
+from transgemini.core.CircuitOpenError import CircuitOpenError
+from transgemini.core.FinishAbandonedError import FinishAbandonedError
+
+# Prometheus text exposition format 0.0.4 (understood by Prometheus, VictoriaMetrics and
+# node_exporter's textfile collector). Kept dependency-free on purpose.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: ожидались метки {self.label_names}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {} if self.label_names else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        """Sum over all label values."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _render_samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, buckets, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}  # key -> [bucket_counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _render_samples(self):
+        lines = []
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (bucket_counts, total, count) in items:
+            for upper, bucket_count in zip(self.buckets, bucket_counts):
+                labels = _format_labels(self.label_names, key, ('le', _format_value(upper)))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class TranslationMetrics:
+    """
+    All metrics of one translation run. The engine updates them directly from its
+    threads; the exporter reads them from its own thread (no Qt involved).
+    """
+
+    LATENCY_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.inflight_requests = Gauge("transgemini_inflight_requests", "API requests currently in flight.")
+        self.queue_depth = Gauge("transgemini_queue_depth", "Jobs waiting in a pipeline stage queue.", ("stage",))
+        self.concurrency_limit = Gauge("transgemini_concurrency_limit", "Current max concurrent API requests.")
+        self.requests = Counter("transgemini_requests_total", "Finished API requests by outcome.",
+                                ("model", "outcome"))
+        self.errors = Counter("transgemini_request_errors_total",
+                              "API errors by type (429, 503, 500, 504, content_block, ...).", ("type",))
+        self.latency = Histogram("transgemini_request_latency_seconds", "API request latency.",
+                                 self.LATENCY_BUCKETS, ("model",))
+        self.retries = Counter("transgemini_retries_total", "Retries scheduled, by error type.", ("type",))
+        self.retry_waiting = Gauge("transgemini_retry_waiting", "API calls currently waiting before a retry.")
+        self.retry_sleep = Counter("transgemini_retry_sleep_seconds_total", "Seconds spent waiting before retries.")
+        self.abandoned_calls = Counter("transgemini_abandoned_calls_total",
+                                       "In-flight API calls abandoned (cancel, finish, hung past timeout, hedge lost).",
+                                       ("reason",))
+        self.hedges = Counter("transgemini_hedged_requests_total",
+                              "Duplicate (hedged) API calls by outcome: won, lost (original answered first), failed.",
+                              ("outcome",))
+        self.circuit_state = Gauge("transgemini_circuit_state",
+                                   "Circuit breaker per model: 0 closed, 1 half-open, 2 open.", ("model",))
+        self.tokens = Counter("transgemini_tokens_total", "Tokens reported by usage_metadata.", ("kind",))
+        self.chunks = Counter("transgemini_chunks_total", "Chunks finished, by status.", ("status",))
+        self.files = Counter("transgemini_files_total", "Files/EPUB parts/EPUB builds finished, by status.",
+                             ("status",))
+        self.started = Gauge("transgemini_run_start_time_seconds", "Unix time the run was started.")
+        self.started.set(time.time())
+
+    def all_metrics(self):
+        return [value for value in vars(self).values() if isinstance(value, _Metric)]
+
+    def render(self):
+        lines = []
+        for metric in self.all_metrics():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def classify_api_error(error):
+    """Short error type label for metrics: '429', '503', '500', '504', 'content_block', ... ."""
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(error, google_exceptions.RetryError) and error.__cause__ is not None:
+        error = error.__cause__
+    mapping = (
+        (google_exceptions.ResourceExhausted, "429"),
+        (google_exceptions.ServiceUnavailable, "503"),
+        (google_exceptions.InternalServerError, "500"),
+        (google_exceptions.DeadlineExceeded, "504"),
+        (google_exceptions.RetryError, "retry_failed"),
+        (google_exceptions.InvalidArgument, "400"),
+        (google_exceptions.PermissionDenied, "403"),
+        (google_exceptions.Unauthenticated, "401"),
+        (google_exceptions.NotFound, "404"),
+    )
+    for exc_type, label in mapping:
+        if isinstance(error, exc_type):
+            return label
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, ChunkDeadlineError):
+        return "deadline"
+    if isinstance(error, FinishAbandonedError):
+        return "finish_abandoned"
+    if isinstance(error, RuntimeError):
+        text = str(error)
+        if "заблокирован" in text or "Проблема с генерацией контента" in text:
+            return "content_block"
+        return "content_error"
+    return "other"
+
+
+class MetricsExporter:
+    """
+    Serves TranslationMetrics over HTTP (/metrics) and/or periodically writes them
+    to a textfile (atomic replace) for node_exporter's textfile collector.
+    """
+
+    def __init__(self, metrics, port=0, textfile_path=None, textfile_interval=15, host="127.0.0.1"):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.textfile_path = textfile_path
+        self.textfile_interval = textfile_interval
+        self._server = None
+        self._threads = []
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self.port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            metrics = self.metrics
+
+            class _Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/metrics', '/'):
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', CONTENT_TYPE)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass  # не засоряем stderr запросами Prometheus
+
+            self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+            self._server.daemon_threads = True
+            thread = threading.Thread(target=self._server.serve_forever, name='MetricsHTTP', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.textfile_path:
+            thread = threading.Thread(target=self._textfile_loop, name='MetricsTextfile', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def describe(self):
+        parts = []
+        if self.port:
+            parts.append(f"http://{self.host}:{self.port}/metrics")
+        if self.textfile_path:
+            parts.append(f"textfile {self.textfile_path} (каждые {self.textfile_interval} сек.)")
+        return ", ".join(parts)
+
+    def write_textfile(self):
+        tmp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.metrics.render())
+        os.replace(tmp_path, self.textfile_path)
+
+    def _textfile_loop(self):
+        while not self._stop_event.wait(self.textfile_interval):
+            try:
+                self.write_textfile()
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+        if self.textfile_path:
+            try:
+                self.write_textfile()  # финальные значения после окончания запуска
+            except OSError:
+                pass
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
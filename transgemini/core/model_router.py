@@ -0,0 +1,179 @@
+import threading
+import time
+
+from transgemini.config import (MODELS, MODEL_FALLBACK_CHAIN, CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                                CIRCUIT_BREAKER_OPEN_SECONDS, CIRCUIT_BREAKER_HALF_OPEN_PROBES)
+
+# Выбор модели для запроса: автомат (circuit breaker) на каждую модель и цепочка резервных моделей.
+# Пока автомат модели разомкнут, запросы уходят следующей доступной модели цепочки.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # для метрики transgemini_circuit_state
+
+
+def model_name_for(model_config):
+    """MODELS key of model_config (by id), or its id when it is not in MODELS."""
+    return next((name for name, config in MODELS.items() if config['id'] == model_config['id']), model_config['id'])
+
+
+def fallback_models_for(model_config, chain=None):
+    """
+    Names of the fallback models for model_config: the MODELS keys after it in chain
+    (MODEL_FALLBACK_CHAIN by default); [] when the model is not in the chain.
+    """
+    chain = MODEL_FALLBACK_CHAIN if chain is None else chain
+    names = [name for name in chain if name in MODELS]
+    for position, name in enumerate(names):
+        if MODELS[name]['id'] == model_config['id']:
+            return names[position + 1:]
+    return []
+
+
+class CircuitBreaker:
+    """
+    Thread-safe breaker of one model. closed: all requests pass; after failure_threshold consecutive
+    failures it opens for open_seconds (no requests), then goes half_open: up to half_open_probes
+    requests pass, a success closes it, a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_BREAKER_HALF_OPEN_PROBES):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.open_count = 0
+        self.successes = 0
+        self._probes = 0
+
+    def _refresh(self, now):
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probes = 0
+
+    def acquire(self):
+        """Returns (allowed, is_probe, state); a granted probe must be given back by record()/release()."""
+        with self._lock:
+            self._refresh(time.monotonic())
+            if self.state == CLOSED:
+                return True, False, self.state
+            if self.state == HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return True, True, self.state
+            return False, False, self.state
+
+    def retry_in(self):
+        """Seconds until the breaker lets requests through again (0 when it does now)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refresh(now)
+            if self.state == OPEN:
+                return max(0.0, self.opened_at + self.open_seconds - now)
+            if self.state == HALF_OPEN and self._probes >= self.half_open_probes:
+                return 1.0  # ждем исхода пробного запроса
+            return 0.0
+
+    def record(self, success, is_probe=False):
+        """Counts the outcome of a request; returns the new state if it changed, else None."""
+        with self._lock:
+            if is_probe:
+                self._probes = max(0, self._probes - 1)
+            previous = self.state
+            if success:
+                self.successes += 1
+                self.consecutive_failures = 0
+                if self.state == HALF_OPEN:
+                    self.state = CLOSED
+            else:
+                self.consecutive_failures += 1
+                if self.state == HALF_OPEN or \
+                        (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+                    self.open_count += 1
+            return self.state if self.state != previous else None
+
+    def release(self, is_probe=False):
+        """Gives back a probe whose request ended without an outcome for the model (cancel, client error)."""
+        if is_probe:
+            with self._lock:
+                self._probes = max(0, self._probes - 1)
+
+
+class ModelRouter:
+    """
+    Routes API requests over [main model] + fallback models, each with its own CircuitBreaker.
+    Routes are dicts: 'name', 'config', 'model' (the client object, set by the engine), 'breaker',
+    'fallback' (False for the main model).
+    Leases returned by acquire() are dicts: 'route', 'probe', 'settled'.
+    """
+
+    def __init__(self, main_name, main_config, fallback_names=(), log_callback=None, on_state_change=None):
+        self.routes = [self._new_route(main_name, main_config, False)]
+        for name in fallback_names:
+            if MODELS[name]['id'] != main_config['id']:
+                self.routes.append(self._new_route(name, MODELS[name], True))
+        self.log_callback = log_callback or (lambda message: None)
+        self.on_state_change = on_state_change  # (route, state)
+
+    @staticmethod
+    def _new_route(name, model_config, fallback):
+        return {'name': name, 'config': model_config, 'model': None, 'breaker': CircuitBreaker(),
+                'fallback': fallback}
+
+    def acquire(self):
+        """
+        Lease on the first route (in chain order) whose breaker lets a request through,
+        or None when all are open (see retry_in()).
+        """
+        for route in self.routes:
+            allowed, is_probe, state = route['breaker'].acquire()
+            if is_probe:
+                self._state_changed(route, state)
+            if allowed:
+                return {'route': route, 'probe': is_probe, 'settled': False}
+        return None
+
+    def retry_in(self):
+        return min(route['breaker'].retry_in() for route in self.routes)
+
+    def has_alternative(self, route):
+        """True when another route would take a request now (the breaker of `route` itself is not asked)."""
+        return any(other is not route and other['breaker'].retry_in() == 0 for other in self.routes)
+
+    def settle(self, lease, success=None):
+        """Records a leased request: True/False - outcome for the breaker, None - no outcome. Once per lease."""
+        if lease is None or lease['settled']:
+            return
+        lease['settled'] = True
+        route = lease['route']
+        if success is None:
+            route['breaker'].release(lease['probe'])
+            return
+        new_state = route['breaker'].record(success, lease['probe'])
+        if new_state:
+            self._state_changed(route, new_state)
+
+    def _state_changed(self, route, state):
+        breaker = route['breaker']
+        if state == OPEN:
+            self.log_callback(f"[WARN] Модель {route['name']}: автомат разомкнут после {breaker.consecutive_failures} "
+                              f"ошибок подряд, запросы к ней остановлены на {breaker.open_seconds} сек.")
+        elif state == HALF_OPEN:
+            self.log_callback(f"[INFO] Модель {route['name']}: пробный запрос после паузы автомата.")
+        else:
+            self.log_callback(f"[INFO] Модель {route['name']}: автомат замкнут, запросы возобновлены.")
+        if self.on_state_change:
+            self.on_state_change(route, state)
+
+    def stats(self):
+        """{model name: {'id', 'fallback', 'state', 'opens', 'ok_requests'}} for the run report."""
+        return {route['name']: {'id': route['config']['id'], 'fallback': route['fallback'],
+                                'state': route['breaker'].state, 'opens': route['breaker'].open_count,
+                                'ok_requests': route['breaker'].successes}
+                for route in self.routes}
@@ -5,25 +5,22 @@ import uuid
 import zipfile
 from urllib.parse import urlparse, urljoin, unquote
 import warnings
-import docx
-
-from bs4 import BeautifulSoup, Tag, NavigableString, XMLParsedAsHTMLWarning
-from docx import Document
-from docx.shared import Pt, Inches
-from lxml import etree
+from io import BytesIO
 from pathlib import Path
 
+from transgemini.core.image_store import get_image_store
 from transgemini.core.utils import get_image_extension_from_data, convert_emf_to_png, create_image_placeholder, find_image_placeholders
-from transgemini.config import IMAGE_PLACEHOLDER_PREFIX, DOCX_AVAILABLE, BS4_AVAILABLE, LXML_AVAILABLE, EBOOKLIB_AVAILABLE, PILLOW_AVAILABLE
-
+from transgemini.config import GENERIC_DOC_TITLES, IMAGE_PLACEHOLDER_PREFIX, DOCX_AVAILABLE, BS4_AVAILABLE, LXML_AVAILABLE, PILLOW_AVAILABLE
 
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+# python-docx, bs4 and lxml are imported inside the functions that need them,
+# so reading a TXT file never pays for them.
 
 
-def read_docx_with_images(filepath, temp_dir, image_map):
-    """Reads DOCX, extracts text, replaces images with placeholders, saves images."""
+def read_docx_with_images(filepath, image_store, image_map):
+    """Reads DOCX, extracts text, replaces images with placeholders, puts images into image_store."""
     if not DOCX_AVAILABLE: raise ImportError("python-docx library is required.")
     if not os.path.exists(filepath): raise FileNotFoundError(f"DOCX file not found: {filepath}")
+    import docx
 
     doc = docx.Document(filepath)
     output_lines = []
@@ -67,9 +64,9 @@ def read_docx_with_images(filepath, temp_dir, image_map):
                                                                                                  fallback_ext=img_ext_original or "png")
 
                                                 if img_ext_original == 'emf' or img_ext_detected == 'emf':
-                                                    png_data = convert_emf_to_png(img_data)
-                                                    if png_data:
-                                                        img_data = png_data;
+                                                    # одинаковые EMF конвертируются один раз (кэш хранилища)
+                                                    image_key = image_store.convert(img_data, 'png', convert_emf_to_png)
+                                                    if image_key:
                                                         img_ext_final = 'png';
                                                         content_type = 'image/png'
                                                         print(
@@ -79,6 +76,7 @@ def read_docx_with_images(filepath, temp_dir, image_map):
                                                             f"[WARN] DOCX: Failed to convert EMF '{original_filename}', skipping.");
                                                         continue  # Skip if conversion failed
                                                 else:
+                                                    image_key = image_store.put(img_data)
                                                     img_ext_final = img_ext_detected;
                                                     content_type = f"image/{img_ext_final}"
 
@@ -93,11 +91,7 @@ def read_docx_with_images(filepath, temp_dir, image_map):
                                                     pass  # Ignore errors getting dimensions
 
                                                 img_uuid = uuid.uuid4().hex
-                                                saved_filename = f"{img_uuid}.{img_ext_final}";
-                                                saved_path = os.path.join(temp_dir, saved_filename)
-                                                with open(saved_path, 'wb') as img_file:
-                                                    img_file.write(img_data)
-                                                image_map[img_uuid] = {'saved_path': saved_path,
+                                                image_map[img_uuid] = {'image_key': image_key,
                                                                        'original_filename': original_filename,
                                                                        'content_type': content_type, 'width': width,
                                                                        'height': height}
@@ -196,31 +190,31 @@ def read_docx_with_images(filepath, temp_dir, image_map):
     print(f"[INFO] DOCX Read: Extracted {len(image_map)} images.")
     return final_text.strip()
 
-def process_html_images(html_content, source_context, temp_dir, image_map):
+def process_html_images(html_content, source_context, image_store, image_map):
     """
     Parses HTML, extracts images, replaces with placeholders, converts Hx/title to Markdown-like,
     and then extracts text content for translation.
     `source_context` can be a tuple (zipfile.ZipFile, html_path_in_zip) or a base directory path.
+    `image_store` None means EPUB->EPUB: images are only referenced (src/attributes), not read.
+    Does it in one lxml tree walk; BeautifulSoup is used only if lxml cannot parse the markup.
+    The result is the same as with BeautifulSoup (see _process_html_images_bs4).
     """
-    if not BS4_AVAILABLE: raise ImportError("BeautifulSoup4 is required for HTML processing.")
+    xml_mode = _looks_like_xml(html_content)
+    if LXML_AVAILABLE:
+        root = _parse_markup_lxml(html_content, xml_mode)
+        if root is not None:
+            return _extract_html_text_lxml(root, xml_mode, source_context, image_store, image_map)
+    return _process_html_images_bs4(html_content, source_context, image_store, image_map)
 
-    if "<svg" in html_content.lower() or "xmlns:" in html_content.lower() or \
-            html_content.strip().startswith("<?xml"):
-        parser_type = 'lxml-xml'  # Use 'lxml-xml' for stricter XML or documents with SVG/namespaces
-    else:
-        parser_type = 'lxml'  # Use 'lxml' for general HTML
 
-    try:
-        soup = BeautifulSoup(html_content, parser_type)
-    except Exception as e_parse:
-        print(f"DEBUG process_html_images: Parse failed with '{parser_type}': {e_parse}. Trying 'html.parser'.")
-        try:
-            soup = BeautifulSoup(html_content, 'html.parser')  # Fallback parser
-        except Exception as e_parse_fallback:
-            print(
-                f"[ERROR] BeautifulSoup failed to parse HTML content with primary parser '{parser_type}' and fallback 'html.parser'. Error: {e_parse_fallback}")
-            raise ValueError(f"Failed to parse HTML content after trying multiple parsers: {e_parse_fallback}")
+def _looks_like_xml(html_content):
+    # SVG/namespaces/XML declaration -> XML parser (как 'lxml-xml' в BeautifulSoup)
+    return "<svg" in html_content.lower() or "xmlns:" in html_content.lower() or \
+        html_content.strip().startswith("<?xml")
 
+
+def _resolve_image_source(source_context):
+    """Returns (image_processing_context, base_path, source_html_path) for _process_single_image."""
     zip_file_obj = None
     source_html_path = None  # e.g., OEBPS/Text/0005_SE1000.xhtml
     base_path = ""  # e.g., OEBPS
@@ -241,6 +235,267 @@ def process_html_images(html_content, source_context, temp_dir, image_map):
         source_html_path = "unknown.html"
 
     image_processing_context = zip_file_obj if zip_file_obj else base_path
+    return image_processing_context, base_path, source_html_path
+
+
+# Удаляются из текста для перевода вместе с содержимым
+TAGS_TO_DECOMPOSE = ['script', 'style', 'noscript', 'head', 'meta', 'link', 'applet', 'embed', 'object',
+                     'form', 'iframe', 'map', 'area', 'header', 'footer', 'nav', 'aside', 'figure',
+                     'figcaption']
+
+
+def _doc_title_for_api(title_string):
+    """<title> text if it is a real title (not 'toc', 'cover', ...), else None."""
+    if not title_string:
+        return None
+    title_candidate = title_string.strip()
+    if title_candidate and title_candidate.lower() not in GENERIC_DOC_TITLES and len(
+            title_candidate) > 2:  # Min length
+        return title_candidate
+    return None
+
+
+def _compose_text_for_api(body_text_md, html_doctitle_text):
+    final_text_for_api = body_text_md
+    if html_doctitle_text:
+
+        body_starts_with_title_as_h1 = False
+        if body_text_md.lstrip().startswith("# "):  # Check if it starts with any H1
+            first_line_of_body = body_text_md.lstrip().split('\n', 1)[0]
+
+            if first_line_of_body[2:].strip().lower() == html_doctitle_text.lower():
+                body_starts_with_title_as_h1 = True
+
+        if not body_starts_with_title_as_h1:
+            final_text_for_api = f"{'#'} {html_doctitle_text}\n\n{body_text_md}"
+
+    return re.sub(r'\n{3,}', '\n\n', final_text_for_api).strip()
+
+
+# --- lxml: один проход по дереву ---
+
+_HEADING_LEVELS = {f'h{level}': level for level in range(1, 7)}
+_DECOMPOSE_TAGS_SET = frozenset(TAGS_TO_DECOMPOSE)
+# HTML-парсер BeautifulSoup хранит строки внутри этих тегов в особых классах (Script, RubyTextString, ...),
+# и get_text() их пропускает; в XML режиме таких классов нет.
+_HTML_SPECIAL_STRING_TAGS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+# Атрибуты-списки BeautifulSoup (HTML-парсер) для всех тегов: class="a b" -> ['a', 'b']
+_HTML_LIST_ATTRIBUTES = ('class', 'accesskey', 'dropzone')
+_XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+
+def _parse_markup_lxml(html_content, xml_mode):
+    """Root element parsed the way BeautifulSoup feeds lxml ('lxml' / 'lxml-xml'), or None."""
+    from lxml import etree
+    if html_content[:1] == "\ufeff":
+        html_content = html_content[1:]
+    try:
+        if xml_mode:
+            parser = etree.XMLParser(strip_cdata=False, recover=True)
+        else:
+            parser = etree.HTMLParser(recover=True)
+        parser.feed(html_content)
+        return parser.close()
+    except Exception as e_parse:
+        print(f"DEBUG process_html_images: lxml parse failed ({e_parse}). Using BeautifulSoup.")
+        return None
+
+
+def _html_tag_name(element):
+    return element.tag if isinstance(element.tag, str) else None
+
+
+def _xml_tag_name(element):
+    # Имя как у BeautifulSoup в XML режиме: локальное имя, с префиксом 'prefix:' если он есть
+    if not isinstance(element.tag, str):
+        return None
+    local_name = element.tag.rpartition('}')[2]
+    return f"{element.prefix}:{local_name}" if element.prefix else local_name
+
+
+def _find_first(root, name, tag_name):
+    return next((el for el in root.iter('{*}' + name) if tag_name(el) == name), None)
+
+
+def _single_string(element):
+    """BeautifulSoup Tag.string for an lxml element: the only string inside, or None."""
+    while True:
+        children = list(element)
+        contents_count = (1 if element.text else 0) + sum(1 + (1 if child.tail else 0) for child in children)
+        if contents_count != 1:
+            return None
+        if element.text:
+            return element.text
+        element = children[0]
+        if not isinstance(element.tag, str):  # комментарий - тоже строка для BeautifulSoup
+            return element.text
+
+
+class _LxmlTagView:
+    """The part of the bs4 Tag interface used by _process_single_image (name, attrs, get)."""
+    __slots__ = ('name', 'attrs')
+
+    def __init__(self, element, name, xml_mode):
+        self.name = name
+        self.attrs = _xml_attributes(element) if xml_mode else _html_attributes(element)
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+
+def _html_attributes(element):
+    attrs = dict(element.attrib)
+    for key in _HTML_LIST_ATTRIBUTES:
+        if key in attrs:
+            attrs[key] = attrs[key].split()
+    return attrs
+
+
+def _xml_attributes(element):
+    # Ключи как у BeautifulSoup: 'xlink:href', 'xml:lang', плюс объявленные на теге 'xmlns'/'xmlns:prefix'
+    prefixes = {uri: prefix for prefix, uri in element.nsmap.items()}
+    prefixes[_XML_NAMESPACE] = 'xml'
+    attrs = {}
+    for key, value in element.attrib.items():
+        if key[:1] == '{':
+            uri, local_name = key[1:].split('}', 1)
+            prefix = prefixes.get(uri)
+            key = f"{prefix}:{local_name}" if prefix else local_name
+        attrs[key] = value
+    parent = element.getparent()
+    parent_nsmap = parent.nsmap if parent is not None else {}
+    for prefix, uri in element.nsmap.items():
+        if parent_nsmap.get(prefix) != uri:
+            attrs[f"xmlns:{prefix}" if prefix else "xmlns"] = uri
+    return attrs
+
+
+def _extract_html_text_lxml(root, xml_mode, source_context, image_store, image_map):
+    """
+    Single walk over the lxml tree with the same result as the BeautifulSoup steps:
+    img/svg -> placeholders (whole document, document order), <body> text with TAGS_TO_DECOMPOSE
+    subtrees skipped, non-empty h1-h6 prefixed with a '#'*level line, joined like get_text('\n', strip=True).
+    """
+    image_processing_context, base_path, source_html_path = _resolve_image_source(source_context)
+    tag_name = _xml_tag_name if xml_mode else _html_tag_name
+
+    body = _find_first(root, 'body', tag_name)
+    head = _find_first(root, 'head', tag_name)
+    title = None
+    if head is not None:
+        title = next((el for el in head.iter('{*}title') if el is not head and tag_name(el) == 'title'), None)
+
+    text_parts = []  # get_text(separator='\n', strip=True); None - место для префикса заголовка
+    open_headings = []  # [индекс префикса или None, уровень, есть ли текст]
+
+    def add_text(text, in_text_root, in_decomposed, detached, special_strings):
+        if not text or detached or special_strings:
+            return
+        text = text.strip()
+        if not text:
+            return
+        for heading in open_headings:
+            heading[2] = True
+        if in_text_root and not in_decomposed:
+            text_parts.append(text)
+
+    # контекст: (внутри <body>, внутри удаляемого тега, тег заменен плейсхолдером, особые строки bs4)
+    exit_marker = object()
+    stack = [(root, (body is None, False, False, False))]
+    while stack:
+        item = stack.pop()
+        if item[0] is exit_marker:
+            _, element, parent_context, heading = item
+            if heading is not None:
+                open_headings.pop()
+                if heading[2] and heading[0] is not None:
+                    text_parts[heading[0]] = '#' * heading[1]
+            add_text(element.tail, *parent_context)
+            continue
+
+        element, parent_context = item
+        name = tag_name(element)
+        if name is None:  # комментарий / PI: их текст не переводится, хвост - обычный текст
+            add_text(element.tail, *parent_context)
+            continue
+
+        in_text_root, in_decomposed, detached, special_strings = parent_context
+        if element is body:
+            in_text_root = True
+        elif in_text_root and not detached and name in _DECOMPOSE_TAGS_SET:
+            in_decomposed = True
+        if not xml_mode and name in _HTML_SPECIAL_STRING_TAGS:
+            special_strings = True
+
+        heading = None
+        if name == 'img' or name == 'svg':
+            # изображения обрабатываются во всем документе, как soup.find_all(['img', 'svg'])
+            img_uuid = None
+            try:
+                image_tag = element if name == 'img' else _svg_image_child(element, tag_name)
+                if image_tag is not None:
+                    img_uuid = _process_single_image(
+                        _LxmlTagView(image_tag, tag_name(image_tag), xml_mode), image_processing_context,
+                        base_path, source_html_path, image_store, image_map, is_svg_image=name == 'svg')
+            except Exception as replace_err:
+                print(f"[ERROR] process_html_images: Error replacing tag <{name}>: {replace_err}. Attempting removal.")
+                traceback.print_exc()
+            if img_uuid and not detached:
+                for open_heading in open_headings:
+                    open_heading[2] = True
+                if in_text_root and not in_decomposed:
+                    text_parts.append(create_image_placeholder(img_uuid))
+            detached = True  # тег заменен плейсхолдером (или удален) вместе с содержимым
+        elif name in _HEADING_LEVELS and in_text_root and not detached and element is not body:
+            prefix_index = None
+            if not in_decomposed:
+                prefix_index = len(text_parts)
+                text_parts.append(None)
+            heading = [prefix_index, _HEADING_LEVELS[name], False]
+            open_headings.append(heading)
+
+        context = (in_text_root, in_decomposed, detached, special_strings)
+        add_text(element.text, *context)
+        stack.append((exit_marker, element, parent_context, heading))
+        stack.extend((child, context) for child in reversed(element))
+
+    body_text_md = "\n".join(part for part in text_parts if part is not None)
+    html_doctitle_text = _doc_title_for_api(_single_string(title)) if title is not None else None
+    return _compose_text_for_api(body_text_md, html_doctitle_text)
+
+
+def _svg_image_child(svg_element, tag_name):
+    children = [child for child in svg_element if isinstance(child.tag, str)]
+    image_tag = next((child for child in children if tag_name(child) == 'image'), None)
+    if image_tag is None:  # If not found, try case-insensitive search
+        image_tag = next((child for child in children if tag_name(child).lower() == 'image'), None)
+    return image_tag
+
+
+# --- BeautifulSoup: запасной вариант для разметки, которую lxml не разобрал ---
+
+def _process_html_images_bs4(html_content, source_context, image_store, image_map):
+    if not BS4_AVAILABLE: raise ImportError("BeautifulSoup4 is required for HTML processing.")
+    from bs4 import BeautifulSoup, NavigableString, XMLParsedAsHTMLWarning
+    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+
+    if _looks_like_xml(html_content):
+        parser_type = 'lxml-xml'  # Use 'lxml-xml' for stricter XML or documents with SVG/namespaces
+    else:
+        parser_type = 'lxml'  # Use 'lxml' for general HTML
+
+    try:
+        soup = BeautifulSoup(html_content, parser_type)
+    except Exception as e_parse:
+        print(f"DEBUG process_html_images: Parse failed with '{parser_type}': {e_parse}. Trying 'html.parser'.")
+        try:
+            soup = BeautifulSoup(html_content, 'html.parser')  # Fallback parser
+        except Exception as e_parse_fallback:
+            print(
+                f"[ERROR] BeautifulSoup failed to parse HTML content with primary parser '{parser_type}' and fallback 'html.parser'. Error: {e_parse_fallback}")
+            raise ValueError(f"Failed to parse HTML content after trying multiple parsers: {e_parse_fallback}")
+
+    image_processing_context, base_path, source_html_path = _resolve_image_source(source_context)
     images_found_and_processed = 0  # Счетчик для лога
 
     potential_image_tags = soup.find_all(['img', 'svg'])
@@ -258,8 +513,8 @@ def process_html_images(html_content, source_context, temp_dir, image_map):
         try:
             if tag_name == 'img':
 
-                img_uuid = _process_single_image(tag, image_processing_context, base_path, source_html_path, temp_dir,
-                                                 image_map, is_svg_image=False)
+                img_uuid = _process_single_image(tag, image_processing_context, base_path, source_html_path,
+                                                 image_store, image_map, is_svg_image=False)
                 if img_uuid:
                     placeholder_str = create_image_placeholder(img_uuid)
 
@@ -278,7 +533,7 @@ def process_html_images(html_content, source_context, temp_dir, image_map):
                 if svg_image_tag:
 
                     img_uuid = _process_single_image(svg_image_tag, image_processing_context, base_path,
-                                                     source_html_path, temp_dir, image_map, is_svg_image=True)
+                                                     source_html_path, image_store, image_map, is_svg_image=True)
                     if img_uuid:
                         placeholder_str = create_image_placeholder(img_uuid)
 
@@ -302,17 +557,7 @@ def process_html_images(html_content, source_context, temp_dir, image_map):
     html_doctitle_text = None
 
     if soup.head and soup.head.title and soup.head.title.string:
-        title_candidate = soup.head.title.string.strip()
-
-        generic_titles_lower = [
-            'untitled', 'unknown', 'navigation', 'toc', 'table of contents', 'index',
-            'contents', 'оглавление', 'содержание', 'индекс',
-            'cover', 'title page', 'copyright', 'chapter'  # Added more generic terms
-        ]
-
-        if title_candidate and title_candidate.lower() not in generic_titles_lower and len(
-                title_candidate) > 2:  # Min length
-            html_doctitle_text = title_candidate
+        html_doctitle_text = _doc_title_for_api(soup.head.title.string)
 
     content_extraction_root = soup.body if soup.body else soup
     if not content_extraction_root:
@@ -332,48 +577,25 @@ def process_html_images(html_content, source_context, temp_dir, image_map):
 
                 header_tag.unwrap()
 
-    tags_to_decompose_finally = ['script', 'style', 'noscript', 'head', 'meta', 'link', 'applet', 'embed', 'object',
-                                 'form', 'iframe', 'map', 'area', 'header', 'footer', 'nav', 'aside', 'figure',
-                                 'figcaption']
-
-    for tag_type in tags_to_decompose_finally:
-        decomposed_count = 0
+    for tag_type in TAGS_TO_DECOMPOSE:
         for instance in content_extraction_root.find_all(tag_type):
             instance.decompose()
-            decomposed_count += 1
 
     body_text_md = content_extraction_root.get_text(separator='\n', strip=True)
+    return _compose_text_for_api(body_text_md, html_doctitle_text)
 
-    final_text_for_api = body_text_md
-    if html_doctitle_text:
 
-        body_starts_with_title_as_h1 = False
-        if body_text_md.lstrip().startswith("# "):  # Check if it starts with any H1
-            first_line_of_body = body_text_md.lstrip().split('\n', 1)[0]
-
-            if first_line_of_body[2:].strip().lower() == html_doctitle_text.lower():
-                body_starts_with_title_as_h1 = True
-
-        if not body_starts_with_title_as_h1:
-            final_text_for_api = f"{'#'} {html_doctitle_text}\n\n{body_text_md}"
-
-    final_text_for_api = re.sub(r'\n{3,}', '\n\n', final_text_for_api).strip()
-
-    final_placeholders_for_api = find_image_placeholders(final_text_for_api)
-
-    return final_text_for_api
-
-def _process_single_image(img_tag, source_context, base_path, source_html_path, temp_dir, image_map,
+def _process_single_image(img_tag, source_context, base_path, source_html_path, image_store, image_map,
                           is_svg_image=False):
     """
     Processes individual image tag.
-    For EPUB->EPUB: Extracts original src and attributes, stores them in image_map with a UUID. Does NOT save file.
-    For other modes: Extracts image data, saves to temp_dir, stores path and info in image_map.
+    For EPUB->EPUB (image_store is None): Extracts original src and attributes, stores them in image_map with a UUID.
+    For other modes: Extracts image data, puts it into image_store, stores its key and info in image_map.
     """
     src = None
     xlink_namespace_uri = "http://www.w3.org/1999/xlink"
 
-    is_epub_rebuild_mode = isinstance(source_context, zipfile.ZipFile)  # True if processing for EPUB->EPUB
+    is_epub_rebuild_mode = image_store is None  # True if processing for EPUB->EPUB
 
     if is_svg_image:
         src = img_tag.get(f'{{{xlink_namespace_uri}}}href')
@@ -476,21 +698,17 @@ def _process_single_image(img_tag, source_context, base_path, source_html_path,
             img_ext = 'jpg' if img_ext == 'jpeg' else img_ext
 
             if img_ext == 'emf':
-                converted_data = convert_emf_to_png(img_data)
-                if converted_data:
-                    img_data = converted_data;
+                image_key = image_store.convert(img_data, 'png', convert_emf_to_png)
+                if image_key:
                     img_ext = 'png';
                     content_type = 'image/png'
                 else:
                     return None
-
-            filename = f"{img_uuid}.{img_ext}"
-            save_path = os.path.join(temp_dir, filename)
-            with open(save_path, 'wb') as f:
-                f.write(img_data)
+            else:
+                image_key = image_store.put(img_data)
 
             image_map[img_uuid] = {
-                'saved_path': save_path,  # For non-EPUB rebuild, this is used
+                'image_key': image_key,  # For non-EPUB rebuild, this is used
                 'original_filename': original_filename,
                 'original_src': original_src_value,  # Still store original_src for consistency if needed
                 'content_type': content_type,
@@ -508,6 +726,9 @@ def write_markdown_to_docx(filepath, md_text_with_placeholders, image_map):
     """Writes Markdown-like text with placeholders back to DOCX."""
     if not DOCX_AVAILABLE: raise ImportError("python-docx library is required.")
     if image_map is None: image_map = {}
+    from docx import Document
+    from lxml import etree
+    from transgemini.core.zip_writer import save_docx
     doc = Document()
 
     lines = re.split('(\n)', md_text_with_placeholders)
@@ -572,10 +793,13 @@ def write_markdown_to_docx(filepath, md_text_with_placeholders, image_map):
         process_text_with_placeholders(current_docx_para, md_para.strip(),
                                        image_map)  # Process original (not stripped) to keep internal newlines
 
-    doc.save(filepath)
+    # изображения пишутся без повторного сжатия, XML - deflate по политике core/zip_writer.py
+    save_docx(doc, filepath)
 
 def process_text_with_placeholders(docx_paragraph, text_with_placeholders, image_map):
     """Adds runs of text and images to a docx paragraph based on placeholders."""
+    from docx.shared import Inches
+    image_store = get_image_store()
 
     last_index = 0
     placeholders_found = find_image_placeholders(text_with_placeholders)
@@ -595,8 +819,8 @@ def process_text_with_placeholders(docx_paragraph, text_with_placeholders, image
 
         if img_uuid in image_map:
             img_info = image_map[img_uuid];
-            img_path = img_info['saved_path']
-            if os.path.exists(img_path):
+            image_key = img_info.get('image_key')
+            if image_key and image_key in image_store:
                 try:
 
                     img_width_px = img_info.get('width');
@@ -614,17 +838,17 @@ def process_text_with_placeholders(docx_paragraph, text_with_placeholders, image
                         except (ValueError, TypeError):
                             pass  # Ignore invalid width values
 
-                    run.add_picture(img_path, width=target_width)
+                    run.add_picture(BytesIO(image_store.get(image_key)), width=target_width)
                 except FileNotFoundError:
-                    print(f"[ERROR] DOCX Write: Image file not found: {img_path}")
+                    print(f"[ERROR] DOCX Write: Image file not found: {image_key}")
                     docx_paragraph.add_run(
                         f"[Image NF: {img_info.get('original_filename', img_uuid)}]")  # Add error text
                 except Exception as e:
-                    print(f"[ERROR] DOCX Write: Failed to add picture {img_path}: {e}")
+                    print(f"[ERROR] DOCX Write: Failed to add picture {image_key}: {e}")
                     docx_paragraph.add_run(f"[Img Err: {img_info.get('original_filename', img_uuid)}]")
             else:
 
-                print(f"[ERROR] DOCX Write: Image path from map does not exist: {img_path}")
+                print(f"[ERROR] DOCX Write: Image from map is not in the image store: {image_key}")
                 docx_paragraph.add_run(f"[Img Path Miss: {img_info.get('original_filename', img_uuid)}]")
         else:
 
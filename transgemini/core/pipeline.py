@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class PipelineStage:
+    """
+    A pool of worker threads reading one bounded priority queue.
+
+    handler(job) returns the name of the next stage, or None when the job is finished.
+    A full queue blocks the stage that feeds it (backpressure), so e.g. parsing never
+    runs far ahead of the API stage and finished translations wait for a writer slot
+    instead of piling up in memory.
+    """
+
+    def __init__(self, pipeline, name, handler, workers, maxsize=0):
+        self.pipeline = pipeline
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        # stop() puts one sentinel per worker, so a bounded queue must fit them all
+        self.queue = queue.PriorityQueue(max(maxsize, self.workers) if maxsize else 0)
+        self.busy = 0
+        self._threads = []
+        self._busy_lock = threading.Lock()
+
+    def start(self, thread_name_prefix):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"{thread_name_prefix}{self.name.title()}_{i}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, job, priority=0, block=True):
+        """Queues a job; returns False if the queue is full (block=False) or the pipeline is aborted."""
+        item = (priority, next(self.pipeline._sequence), job)
+        while not self.pipeline.aborted:
+            try:
+                self.queue.put(item, timeout=0.2 if block else None, block=block)
+                self.pipeline.on_queue_change(self)
+                return True
+            except queue.Full:
+                if not block:
+                    return False
+        return False
+
+    def is_full(self):
+        return self.queue.full()
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put((float('inf'), next(self.pipeline._sequence), _STOP))
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def drain(self):
+        """Removes all queued jobs (after abort) and returns them."""
+        jobs = []
+        while True:
+            try:
+                _, _, job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not _STOP:
+                jobs.append(job)
+        self.pipeline.on_queue_change(self)
+        return jobs
+
+    def _worker_loop(self):
+        while True:
+            _, _, job = self.queue.get()
+            if job is _STOP:
+                break
+            self.pipeline.on_queue_change(self)
+            if self.pipeline.aborted:
+                self.pipeline.discard(job)
+                continue
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                next_stage = self.handler(job)
+            except BaseException as e:  # Ошибки обработчика уходят координатору вместе с заданием
+                job['exception'] = e
+                next_stage = None
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+            self.pipeline.route(job, next_stage)
+
+
+class DelayedQueue:
+    """
+    Timer heap of jobs waiting to re-enter a stage (e.g. an API retry after 429/5xx).
+    One thread sleeps until the nearest deadline, so a waiting job holds no stage worker.
+    """
+
+    def __init__(self, pipeline, name='delayed'):
+        self.pipeline = pipeline
+        self.name = name
+        self._heap = []  # (deadline, sequence, stage_name, job)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self, thread_name_prefix):
+        self._thread = threading.Thread(target=self._timer_loop, name=f"{thread_name_prefix}Timer", daemon=True)
+        self._thread.start()
+
+    def schedule(self, stage_name, job, delay):
+        """Routes job to stage_name after delay seconds; discards it if the pipeline is aborted."""
+        if self.pipeline.aborted:
+            self.pipeline.discard(job)
+            return
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self.pipeline._sequence), stage_name, job))
+            self._cond.notify()
+        self.pipeline.on_queue_change(self)
+
+    def pending(self):
+        return len(self._heap)
+
+    def drain(self):
+        """Removes all waiting jobs (after abort) and returns them."""
+        with self._cond:
+            jobs = [job for _, _, _, job in self._heap]
+            self._heap = []
+        self.pipeline.on_queue_change(self)
+        return jobs
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _timer_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._stopped:
+                    return
+                _, _, stage_name, job = heapq.heappop(self._heap)
+            self.pipeline.on_queue_change(self)
+            # блокирующая постановка в очередь стадии: ждет места так же, как задания из предыдущей стадии
+            self.pipeline.route(job, stage_name)
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues plus one unbounded completion queue read by the
+    coordinator (the thread that created the pipeline). Only the coordinator touches the
+    run bookkeeping, so stage handlers need no locks for it.
+    A handler that sets job['resubmit_delay'] sends the job to its next stage through the
+    delayed queue, after that many seconds.
+    """
+
+    def __init__(self, thread_name_prefix="Pipeline", on_queue_change=None, on_discard=None):
+        self.thread_name_prefix = thread_name_prefix
+        self.stages = {}
+        self.completed = queue.Queue()
+        self.aborted = False
+        self._sequence = itertools.count()
+        self._on_queue_change = on_queue_change
+        self._on_discard = on_discard
+        self.delayed = DelayedQueue(self)
+
+    def add_stage(self, name, handler, workers, maxsize=0):
+        stage = PipelineStage(self, name, handler, workers, maxsize)
+        self.stages[name] = stage
+        return stage
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start(self.thread_name_prefix)
+        self.delayed.start(self.thread_name_prefix)
+
+    def submit(self, stage_name, job, priority=0, block=True):
+        return self.stages[stage_name].put(job, priority=priority, block=block)
+
+    def route(self, job, next_stage):
+        if next_stage is None:
+            self.completed.put(job)
+            return
+        delay = job.pop('resubmit_delay', None)
+        if delay:
+            self.delayed.schedule(next_stage, job, delay)
+            return
+        if not self.stages[next_stage].put(job, priority=job.get('priority', 0)):
+            self.discard(job)  # pipeline aborted while waiting for a free slot
+
+    def discard(self, job):
+        if self._on_discard:
+            self._on_discard(job)
+
+    def on_queue_change(self, stage):
+        if self._on_queue_change:
+            self._on_queue_change(stage.name, stage.pending())
+
+    def next_completed(self, timeout=0.2):
+        """Next finished job or None after timeout."""
+        try:
+            return self.completed.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def abort(self):
+        """Drops queued jobs; jobs already running finish and are discarded on routing."""
+        self.aborted = True
+        for stage in self.stages.values():
+            for job in stage.drain():
+                self.discard(job)
+        for job in self.delayed.drain():
+            self.discard(job)
+
+    def shutdown(self, timeout=None):
+        """Stops the workers after the queued jobs (if any) and waits for them."""
+        self.delayed.stop()
+        for stage in self.stages.values():
+            stage.stop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.delayed.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        for stage in self.stages.values():
+            stage.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,188 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from transgemini.config import (CHUNK_HTML_SOURCE, MIN_CHUNK_SIZE, DEFAULT_EXTRACTION_WORKERS,
+                                PREFLIGHT_CHARS_PER_TOKEN, PREFLIGHT_NON_ASCII_CHARS_PER_TOKEN,
+                                PREFLIGHT_OUTPUT_TOKEN_RATIO, PREFLIGHT_REQUEST_OVERHEAD_SECONDS,
+                                PREFLIGHT_OUTPUT_TOKENS_PER_SECOND)
+from transgemini.core.epub_reader import get_epub_reader, close_epub_readers
+from transgemini.core.extraction import ExtractionPool, extract_docx, extract_epub_html
+from transgemini.core.utils import find_image_placeholders, format_duration, split_text_into_chunks
+
+# Пробный прогон (dry-run): тот же путь чтения/извлечения/чанкинга, что и в TranslationEngine,
+# но без API. Токены и время - оценки: токенизатор модели и реальные задержки здесь недоступны.
+
+
+def estimate_tokens(text):
+    """Rough token count: ASCII text ~4 chars per token, other scripts (CJK, Cyrillic) far fewer."""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return int(math.ceil(ascii_chars / PREFLIGHT_CHARS_PER_TOKEN +
+                         (len(text) - ascii_chars) / PREFLIGHT_NON_ASCII_CHARS_PER_TOKEN))
+
+
+def list_preflight_tasks(files_to_process_data):
+    """(input_type, path, html_path_or_None) per translation task, for both job data layouts of the engine."""
+    if isinstance(files_to_process_data, dict):
+        return [('epub', epub_path, html_path)
+                for epub_path, entry in files_to_process_data.items() for html_path in entry.get('html_paths', [])]
+    return list(files_to_process_data)
+
+
+def _read_task_text(task, extraction_pool):
+    input_type, filepath, html_path = task
+    if input_type == 'txt':
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return f.read()
+    if input_type == 'docx':
+        return extraction_pool.run(extract_docx, filepath)[0]
+    if input_type == 'epub':
+        if not html_path:
+            raise ValueError("Путь к HTML в EPUB не указан.")
+        html_str, _ = get_epub_reader(filepath).read_text(html_path)
+        # изображения не нужны: плейсхолдеры те же, что и при переводе
+        return extraction_pool.run(extract_epub_html, html_str, filepath, html_path, False)[0]
+    raise ValueError(f"Неподдерживаемый тип ввода: {input_type}")
+
+
+def analyze_task(task, extraction_pool, chunking_enabled, chunk_limit, chunk_window, prompt_tokens, tpm_limit=0):
+    """
+    Extracts and chunks one task exactly as the engine would.
+    Returns a dict: file, chars, tokens, chunks, requests, placeholders, split_placeholders,
+    oversize_chunks, max_chunk_chars, chunk_tokens [(input, output) per request], error.
+    """
+    input_type, filepath, html_path = task
+    entry = {'file': os.path.basename(filepath) + (f" -> {html_path}" if html_path else ""),
+             'chars': 0, 'tokens': 0, 'chunks': 0, 'requests': 0, 'placeholders': 0, 'split_placeholders': 0,
+             'oversize_chunks': 0, 'max_chunk_chars': 0, 'chunk_tokens': [], 'error': None}
+    try:
+        text = _read_task_text(task, extraction_pool)
+    except Exception as e:
+        entry['error'] = f"{type(e).__name__}: {e}"
+        return entry
+    if not text.strip():
+        return entry  # пустой контент: движок пропускает файл без запросов
+
+    entry['chars'] = len(text)
+    entry['placeholders'] = len(find_image_placeholders(text))
+    can_chunk = input_type != 'epub' or CHUNK_HTML_SOURCE
+    if chunking_enabled and can_chunk and len(text) > chunk_limit:
+        chunks = split_text_into_chunks(text, chunk_limit, chunk_window, MIN_CHUNK_SIZE)
+    else:
+        chunks = [text]
+
+    placeholders_in_chunks = 0
+    for chunk in chunks:
+        chunk_tokens = estimate_tokens(chunk)
+        entry['tokens'] += chunk_tokens
+        placeholders_in_chunks += len(find_image_placeholders(chunk))
+        request_tokens = prompt_tokens + chunk_tokens
+        # чанк больше лимита (чанкинг выключен/невозможен) или запрос, не помещающийся в минутный лимит токенов
+        if len(chunk) > chunk_limit or (tpm_limit and request_tokens > tpm_limit):
+            entry['oversize_chunks'] += 1
+        entry['max_chunk_chars'] = max(entry['max_chunk_chars'], len(chunk))
+        entry['chunk_tokens'].append((request_tokens, int(math.ceil(chunk_tokens * PREFLIGHT_OUTPUT_TOKEN_RATIO))))
+    entry['chunks'] = entry['requests'] = len(chunks)
+    entry['split_placeholders'] = entry['placeholders'] - placeholders_in_chunks
+    return entry
+
+
+def estimate_wall_time(file_entries, model_config, concurrency, chunk_delay_seconds=0.0):
+    """
+    Lower-bound wall time of the translate stage in seconds and the limit that dominates it:
+    'rpm', 'tpm', 'concurrency' (busy time of all slots) or 'longest file' (chunks of a file are sequential).
+    """
+    concurrency = max(1, int(concurrency or 1))
+    post_request_delay = model_config.get('post_request_delay', 0) or 0
+    total_requests = 0
+    total_tokens = 0
+    busy_seconds = 0.0
+    longest_file = 0.0
+    for entry in file_entries:
+        file_seconds = 0.0
+        for input_tokens, output_tokens in entry['chunk_tokens']:
+            # пост-задержка модели держит слот так же, как сам запрос
+            file_seconds += PREFLIGHT_REQUEST_OVERHEAD_SECONDS + \
+                output_tokens / PREFLIGHT_OUTPUT_TOKENS_PER_SECOND + post_request_delay
+            total_tokens += input_tokens + output_tokens
+        file_seconds += max(0, len(entry['chunk_tokens']) - 1) * (chunk_delay_seconds or 0)
+        total_requests += len(entry['chunk_tokens'])
+        busy_seconds += file_seconds
+        longest_file = max(longest_file, file_seconds)
+
+    bounds = {'concurrency': busy_seconds / concurrency, 'longest file': longest_file}
+    if model_config.get('rpm'):
+        bounds['rpm'] = total_requests / model_config['rpm'] * 60.0
+    if model_config.get('tpm'):
+        bounds['tpm'] = total_tokens / model_config['tpm'] * 60.0
+    limit = max(bounds, key=bounds.get)
+    return bounds[limit], limit
+
+
+def run_preflight(files_to_process_data, model_config, concurrency, chunking_enabled, chunk_limit, chunk_window,
+                  prompt_template, chunk_delay_seconds=0.0, extraction_workers=None, log_callback=print):
+    """
+    Dry run of a batch: extracts and chunks every task in parallel, without API calls.
+    Returns {'files': [analyze_task dicts in task order], 'totals': {...}}.
+    """
+    workers = DEFAULT_EXTRACTION_WORKERS if extraction_workers is None else extraction_workers
+    tasks = list_preflight_tasks(files_to_process_data)
+    prompt_tokens = estimate_tokens(prompt_template.replace("{text}", ""))
+    tpm_limit = model_config.get('tpm') or 0
+    log_callback(f"[INFO] Пробный прогон: {len(tasks)} задач, извлечение в {max(1, workers)} поток(а/ов).")
+
+    extraction_pool = ExtractionPool(workers, log_callback=log_callback)
+    try:
+        # потоки только ждут процессы извлечения (или сами извлекают при workers=0)
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='Preflight') as executor:
+            file_entries = list(executor.map(
+                lambda task: analyze_task(task, extraction_pool, chunking_enabled, chunk_limit, chunk_window,
+                                          prompt_tokens, tpm_limit), tasks))
+    finally:
+        extraction_pool.shutdown()
+        close_epub_readers()
+
+    wall_seconds, wall_limit = estimate_wall_time(file_entries, model_config, concurrency, chunk_delay_seconds)
+    totals = {key: sum(entry[key] for entry in file_entries)
+              for key in ('chars', 'tokens', 'chunks', 'requests', 'placeholders', 'split_placeholders',
+                          'oversize_chunks')}
+    totals.update(
+        files=len(file_entries),
+        errors=sum(1 for entry in file_entries if entry['error']),
+        input_tokens=sum(input_tokens for entry in file_entries for input_tokens, _ in entry['chunk_tokens']),
+        output_tokens=sum(output_tokens for entry in file_entries for _, output_tokens in entry['chunk_tokens']),
+        wall_seconds=wall_seconds, wall_limit=wall_limit, concurrency=concurrency,
+        rpm_limit=model_config.get('rpm') or 0, tpm_limit=tpm_limit, chunk_limit=chunk_limit)
+    return {'files': file_entries, 'totals': totals}
+
+
+def format_preflight_report(report):
+    """Text table of a run_preflight() report (one line per file, then totals and warnings)."""
+    totals = report['totals']
+    lines = [f"{'Символов':>10} {'Токенов~':>9} {'Чанков':>6} {'Запросов':>8} {'Изобр.':>6}  Файл"]
+    for entry in report['files']:
+        if entry['error']:
+            lines.append(f"{'-':>10} {'-':>9} {'-':>6} {'-':>8} {'-':>6}  {entry['file']}  [ERROR] {entry['error']}")
+            continue
+        flags = ""
+        if entry['oversize_chunks']:
+            flags += f"  [WARN] чанков сверх лимита: {entry['oversize_chunks']} (макс. {entry['max_chunk_chars']:,} симв.)"
+        if entry['split_placeholders']:
+            flags += f"  [WARN] плейсхолдеров разрезано: {entry['split_placeholders']}"
+        lines.append(f"{entry['chars']:>10,} {entry['tokens']:>9,} {entry['chunks']:>6} {entry['requests']:>8} "
+                     f"{entry['placeholders']:>6}  {entry['file']}{flags}")
+    lines.append(
+        f"Итого: {totals['files']} файлов, {totals['chars']:,} симв., ~{totals['input_tokens']:,} входных и "
+        f"~{totals['output_tokens']:,} выходных токенов, {totals['requests']} запросов, "
+        f"{totals['placeholders']} плейсхолдеров изображений.")
+    lines.append(
+        f"Оценка времени: ~{format_duration(totals['wall_seconds'])} (ограничивает: {totals['wall_limit']}; "
+        f"RPM {totals['rpm_limit'] or '-'}, TPM {totals['tpm_limit'] or '-'}, параллельно {totals['concurrency']}).")
+    if totals['oversize_chunks']:
+        lines.append(f"[WARN] Чанков больше лимита ({totals['chunk_limit']:,} симв.) или TPM модели: "
+                     f"{totals['oversize_chunks']}.")
+    if totals['errors']:
+        lines.append(f"[ERROR] Не удалось прочитать: {totals['errors']} файл(ов).")
+    return lines
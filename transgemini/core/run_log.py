@@ -0,0 +1,71 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from transgemini.config import RUN_LOG_FLUSH_INTERVAL_SECONDS
+
+# Машиночитаемый журнал запуска (JSON Lines): одна строка - одно событие с полями ts, run_id, event, file, chunk...
+# Потоки API только кладут dict в очередь; сериализация и запись - в отдельном потоке.
+#   pandas.read_json("transgemini_run_log.jsonl", lines=True)
+
+_STOP = object()
+
+
+class RunLog:
+    """JSON Lines event log written by a background thread; event() never waits for disk I/O."""
+
+    def __init__(self, path, flush_interval=RUN_LOG_FLUSH_INTERVAL_SECONDS):
+        self.path = path
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer_loop, name="RunLogWriter", daemon=True)
+        self._thread.start()
+
+    def event(self, kind, run_id=None, **fields):
+        """Queues a record; run_id tells apart the runs appended to the same file."""
+        if self._closed:
+            return
+        record = {'ts': round(time.time(), 3), 'run_id': run_id, 'event': kind}
+        record.update(fields)
+        self._queue.put(record)
+
+    def _writer_loop(self):
+        pending_flush = False
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if pending_flush:
+                    self._flush()
+                    pending_flush = False
+                continue
+            if record is _STOP:
+                break
+            try:
+                self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                pending_flush = True
+            except (OSError, ValueError) as e:
+                print(f"[WARN RunLog] Не удалось записать событие в {self.path}: {e}")
+        self._flush()
+        self._file.close()
+
+    def _flush(self):
+        try:
+            self._file.flush()
+        except OSError:
+            pass
+
+    def close(self, timeout=10):
+        """Writes the queued events and closes the file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
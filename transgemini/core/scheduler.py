@@ -0,0 +1,34 @@
+# Порядок подачи заданий в конвейер (TranslationEngine.run).
+# Очереди стадий - приоритетные, поэтому порядок задается через job['priority']:
+# он сохраняется при переходе задания parse -> translate -> write.
+
+BUILD_JOB_PRIORITY = -1  # Сборка EPUB обгоняет записи частей в очереди стадии write
+
+
+def order_jobs(jobs, policy, size_of, group_of):
+    """
+    Returns jobs in submission order and sets job['priority'] to the position in it.
+    policy: 'fifo' - list order; 'lpt' - largest first (longest processing time first, so a big
+    file submitted last does not become the tail while other API slots idle);
+    'balanced' - largest first within each group (EPUB), groups interleaved round-robin so a
+    large EPUB does not hold back the parts, and the build, of the other EPUBs.
+    size_of(job) is the estimated size, group_of(job) the group key.
+    """
+    jobs = list(jobs)
+    if policy == 'fifo':
+        ordered = jobs
+    elif policy == 'lpt':
+        ordered = sorted(jobs, key=size_of, reverse=True)
+    elif policy == 'balanced':
+        groups = {}
+        for job in jobs:
+            groups.setdefault(group_of(job), []).append(job)
+        lanes = [sorted(group, key=size_of, reverse=True) for group in groups.values()]
+        lanes.sort(key=lambda lane: size_of(lane[0]), reverse=True)
+        ordered = [lane[i] for i in range(max((len(lane) for lane in lanes), default=0))
+                   for lane in lanes if i < len(lane)]
+    else:
+        raise ValueError(f"Неизвестная политика порядка задач: {policy}")
+    for rank, job in enumerate(ordered):
+        job['priority'] = rank
+    return ordered
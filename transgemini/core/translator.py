@@ -1,24 +1,24 @@
 import configparser
 import os
-import time
 import traceback
-import zipfile
+from collections import deque
 from pathlib import Path
 
 from PyQt6 import QtWidgets, QtCore, QtGui
 from PyQt6.QtWidgets import (
     QApplication, QDialog, QVBoxLayout, QListWidget, QPushButton,
     QDialogButtonBox, QLabel, QWidget, QLineEdit, QComboBox, QSpinBox,
-    QCheckBox, QPlainTextEdit, QDoubleSpinBox, QProgressBar, QTextEdit,
+    QCheckBox, QPlainTextEdit, QDoubleSpinBox, QProgressBar,
     QGridLayout, QGroupBox, QHBoxLayout, QMessageBox, QFileDialog, QScrollArea
 )
 from PyQt6.QtCore import QStandardPaths, Qt
-from google.api_core import exceptions as google_exceptions
-from google import generativeai as genai
-from lxml import etree
 
 from transgemini.config import *
 from transgemini.core.EpubHtmlSelectorDialog import EpubHtmlSelectorDialog
+from transgemini.core.DashboardPanel import DashboardPanel
+from transgemini.core.EpubScanner import EpubScanner
+from transgemini.core.LogSink import GuiLogSink
+from transgemini.core.epub_structure import load_epub_structure, make_epub_rebuild_entry
 from transgemini.core.Worker import Worker
 
 
@@ -46,6 +46,17 @@ class TranslatorApp(QWidget):
         self.worker_ref = None;
         self.thread_ref = None
         self.config = configparser.ConfigParser()
+        # Экспорт метрик настраивается только через ini (MetricsPort / MetricsTextfile)
+        self.metrics_port = METRICS_PORT
+        self.metrics_textfile = METRICS_TEXTFILE_PATH
+        # Фоновый анализ EPUB при выборе файлов: результаты -> очередь диалогов выбора HTML
+        self.epub_scanner = EpubScanner(parent=self)
+        self.epub_scanner.scanned.connect(self.on_epub_scanned)
+        self.epub_scanner.log_message.connect(self.handle_log_message)
+        self.epub_scanner.all_finished.connect(self.on_epub_scans_finished)
+        self.epub_scan_queue = deque()
+        self.epub_scan_modes = {}  # epub_path -> режим EPUB->EPUB на момент выбора
+        self.epub_dialog_active = False
 
         self.file_selection_group_box = None  # Инициализируем здесь, чтобы PyCharm не ругался
         self.init_ui()
@@ -61,10 +72,9 @@ class TranslatorApp(QWidget):
         pillow_status = "Pillow OK" if PILLOW_AVAILABLE else "Pillow Missing!"
         lxml_status = "lxml OK" if LXML_AVAILABLE else "lxml Missing!"
         bs4_status = "BS4 OK" if BS4_AVAILABLE else "BS4 Missing!"
-        ebooklib_status = "EbookLib OK" if EBOOKLIB_AVAILABLE else "EbookLib Missing!"
         docx_status = "Docx OK" if DOCX_AVAILABLE else "Docx Missing!"
         self.setWindowTitle(
-            f"Batch File Translator v2.16 ({pillow_status}, {lxml_status}, {bs4_status}, {ebooklib_status}, {docx_status})")
+            f"Batch File Translator v2.16 ({pillow_status}, {lxml_status}, {bs4_status}, {docx_status})")
 
         self.setGeometry(100, 100, 950, 950)  # Уменьшил высоту по умолчанию, т.к. будет скролл
 
@@ -126,8 +136,8 @@ class TranslatorApp(QWidget):
             tooltip = f"Сохранить как .{format_code}"
             if format_code == 'docx' and not DOCX_AVAILABLE:
                 is_enabled = False; tooltip = "Требуется: python-docx"
-            elif format_code == 'epub' and (not EBOOKLIB_AVAILABLE or not LXML_AVAILABLE or not BS4_AVAILABLE):
-                is_enabled = False; tooltip = "Требуется: ebooklib, lxml, beautifulsoup4"
+            elif format_code == 'epub' and (not LXML_AVAILABLE or not BS4_AVAILABLE):
+                is_enabled = False; tooltip = "Требуется: lxml, beautifulsoup4"
             elif format_code == 'fb2' and not LXML_AVAILABLE:
                 is_enabled = False; tooltip = "Требуется: lxml"
 
@@ -198,6 +208,23 @@ class TranslatorApp(QWidget):
         self.temperature_spin.setToolTip(
             "Контроль креативности модели.\n0.0 = максимально детерминировано,\n1.0 = стандартно,\n>1.0 = более случайно/креативно.")
         api_settings_layout.addWidget(self.temperature_spin, 2, 1)
+        api_settings_layout.addWidget(QLabel("Процессы извлечения:"), 3, 0)
+        self.extraction_workers_spin = QSpinBox()
+        self.extraction_workers_spin.setRange(0, MAX_EXTRACTION_WORKERS)
+        self.extraction_workers_spin.setValue(DEFAULT_EXTRACTION_WORKERS)
+        self.extraction_workers_spin.setToolTip(
+            "Сколько процессов разбирают HTML/DOCX (извлечение текста и изображений).\n"
+            "Используют ядра CPU параллельно с запросами к API.\n0 = разбор в потоках, без отдельных процессов.")
+        api_settings_layout.addWidget(self.extraction_workers_spin, 3, 1)
+        api_settings_layout.addWidget(QLabel("Порядок задач:"), 4, 0)
+        self.scheduling_combo = QComboBox()
+        self.scheduling_combo.addItems(SCHEDULING_POLICIES.keys())
+        self.scheduling_combo.setCurrentIndex(list(SCHEDULING_POLICIES.values()).index(DEFAULT_SCHEDULING_POLICY))
+        self.scheduling_combo.setToolTip(
+            "В каком порядке файлы/главы отправляются в работу.\n"
+            "Крупные первыми: большие главы не остаются хвостом в конце, пока остальные слоты простаивают.\n"
+            "EPUB по очереди: главы нескольких книг чередуются, одна большая книга не задерживает сборку других.")
+        api_settings_layout.addWidget(self.scheduling_combo, 4, 1)
         api_settings_layout.addWidget(self.check_api_key_btn, 0, 2, 3, 1,
                                       alignment=Qt.AlignmentFlag.AlignCenter)  # Span 3 rows now
 
@@ -241,60 +268,7 @@ class TranslatorApp(QWidget):
         self.prompt_edit.setPlaceholderText("Загрузка промпта...")
         self.prompt_edit.setMinimumHeight(100)
 
-        self.prompt_edit.setPlainText("""--- PROMPT START ---
-
-**Твоя Роль:** Переводчик и редактор, адаптирующий тексты (литература, статьи, DOCX, HTML) с разных языков на русский. Учитывай культурные особенности (Япония, Китай, Корея, США), речевые обороты, форматирование текста и HTML.
-
-**Твоя Задача:** Адаптируй текст `{text}` на русский, сохраняя смысл, стиль, исходное форматирование и плейсхолдеры изображений `<||img_placeholder_...||>`.
-
-**II. ПРИНЦИПЫ АДАПТАЦИИ**
-
-1.  **Естественный русский:** Избегай буквальности, ищи русские эквиваленты.
-2.  **Смысл и тон:** Точно передавай смысл, атмосферу, авторский стиль.
-3.  **Культурная адаптация:**
-    *   **Хонорифики (-сан, -кун):** Опускай или заменяй естественными обращениями (по имени, господин/госпожа). Транслитерация – крайне редко.
-    *   **Реалии:** Адаптируй (русский эквивалент, краткое пояснение в тексте). Без сносок.
-    *   **Ономатопея:** Заменяй русскими звукоподражаниями или описаниями.
-
-**III. ФОРМАТИРОВАНИЕ И СПЕЦТЕГИ**
-
-1.  **Простой Текст / Markdown:**
-    *   **Абзацы:** Сохраняй; если нет – расставляй по правилам русского языка.
-    *   **Заголовки (Markdown `#`, `##`):** Сохраняй разметку.
-    *   **Списки (`*`, `-`, `1.`):** Переводи текст элемента, сохраняй маркеры.
-    *   **Оглавления:** Формат: **Глава X: Название главы** ... текст ... (Конец главы).
-
-2.  **HTML Контент:**
-    *   **ВАЖНО: СОХРАНЯЙ ВСЕ HTML-ТЕГИ!** Переводи **ТОЛЬКО видимый текст** (внутри `<p>`, `<h1>`, `<li>`, `<td>`, `<span>`, `<a>`, значения атрибутов `title`, `alt` и т.д.).
-    *   **НЕ МЕНЯЙ, НЕ УДАЛЯЙ, НЕ ДОБАВЛЯЙ** HTML-теги, атрибуты или структуру (исключение: плейсхолдеры изображений).
-    *   HTML-комментарии (`<!-- ... -->`), `<script>`, `<style>` – **БЕЗ ИЗМЕНЕНИЙ.**
-
-3.  **<|| ПЛЕЙСХОЛДЕРЫ ИЗОБРАЖЕНИЙ ||>**
-    *   Теги вида `<||img_placeholder_xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx||>` (где `x` - 32 шестнадцатеричных символа).
-    *   **КРИТИЧЕСКИ ВАЖНО: КОПИРУЙ ЭТИ ТЕГИ АБСОЛЮТНО ТОЧНО, СИМВОЛ В СИМВОЛ. НЕ МЕНЯЙ, НЕ УДАЛЯЙ, НЕ ДОБАВЛЯЙ ПРОБЕЛОВ ВНУТРИ, НЕ ПЕРЕВОДИ. ОНИ ДОЛЖНЫ ОСТАТЬСЯ НА СВОИХ МЕСТАХ.**
-
-4.  **Стилизация и Пунктуация (для ВСЕХ типов контента):**
-    *   Реплики `[]` -> `— Реплика`.
-    *   Японские кавычки `『』` -> русские «елочки» (`«Цитата»`).
-    *   Мысли персонажей в скобках -> `«Мысль...»` (без тире перед кавычками).
-    *   Названия навыков, предметов, квестов -> `[Название]`.
-    *   Длинные повторы символов -> 4-5 (напр., `А-а-а-а...`). Используй дефис: `П-привет`, `А-а-ах!`.
-    *   Фразы с `...!` или `...?` -> знак препинания *перед* многоточием (`Текст!..`, `Текст?..`).
-    *   Избегай множественных знаков препинания в конце фраз -> `А?`, `А!`, `А?!`.
-
-**V. ГЛОССАРИЙ**
-
-*   Если предоставлен – **строго придерживайся**.
-
-**VI. ИТОГОВЫЙ РЕЗУЛЬТАТ**
-
-*   **ТОЛЬКО** переведенный и адаптированный текст/HTML, **СОХРАНЯЯ ПЛЕЙСХОЛДЕРЫ `<||img_placeholder_...||>` БЕЗ ИЗМЕНЕНИЙ.**
-*   **БЕЗ** вводных фраз («Вот перевод:»).
-*   **БЕЗ** оригинального текста.
-*   **БЕЗ** твоих комментариев (кроме неизмененных HTML-комментариев).
-
---- PROMPT END ---
-    """)
+        self.prompt_edit.setPlainText(DEFAULT_PROMPT_TEMPLATE)
         settings_prompt_layout.addWidget(self.prompt_lbl);
         settings_prompt_layout.addWidget(self.prompt_edit, 1);
 
@@ -332,12 +306,21 @@ class TranslatorApp(QWidget):
 
         container_layout.addWidget(controls_box)
 
+        # Панель мониторинга: обновляется по таймеру из снимка состояния движка (Worker.snapshot)
+        self.dashboard_panel = DashboardPanel()
+        container_layout.addWidget(self.dashboard_panel, 1)
+        self.dashboard_timer = QtCore.QTimer(self)
+        self.dashboard_timer.setInterval(DASHBOARD_REFRESH_INTERVAL_MS)
+        self.dashboard_timer.timeout.connect(self.refresh_dashboard)
+
         self.log_lbl = QLabel("Лог выполнения:");
-        self.log_output = QTextEdit();
+        self.log_output = QPlainTextEdit();
         self.log_output.setReadOnly(True);
         self.log_output.setFont(QtGui.QFont("Consolas", 9));
-        self.log_output.setLineWrapMode(QTextEdit.LineWrapMode.WidgetWidth)
+        self.log_output.setLineWrapMode(QPlainTextEdit.LineWrapMode.WidgetWidth)
         self.log_output.setMinimumHeight(150)  # Зададим минимальную высоту логу
+        # Буферизованный вывод: пачка строк по таймеру, окно хранит последние GUI_LOG_MAX_LINES строк
+        self.log_sink = GuiLogSink(self.log_output, GUI_LOG_FILE, parent=self)
 
         container_layout.addWidget(self.log_lbl);
         container_layout.addWidget(self.log_output, 2)  # Увеличиваем растяжение для лога
@@ -436,6 +419,7 @@ class TranslatorApp(QWidget):
         skipped_count = 0
 
         current_files_set = {(p1, p2) for _, p1, p2 in self.selected_files_data_tuples}
+        epubs_to_scan = []
 
         for file_path in files:
             file_ext = os.path.splitext(file_path)[1].lower()
@@ -488,90 +472,39 @@ class TranslatorApp(QWidget):
                     skipped_count += 1
             elif file_ext == '.epub':
 
-                if not BS4_AVAILABLE or not LXML_AVAILABLE:  # Ebooklib checked based on output format later
+                if not BS4_AVAILABLE or not LXML_AVAILABLE:  # нужны и для чтения, и для записи EPUB
                     self.append_log(
                         f"[WARN] Пропуск EPUB: {base_name} (требуется 'beautifulsoup4' и 'lxml' для обработки EPUB)");
                     skipped_count += 1;
                     continue
 
-                try:
-                    self.append_log(f"Анализ EPUB: {base_name}...")
-
-                    nav_path, ncx_path, opf_dir_found, nav_id, ncx_id = self._find_epub_toc_paths(file_path)
-
-                    if opf_dir_found is None:
-                        self.append_log(f"[ERROR] Не удалось определить структуру OPF в {base_name}. Пропуск файла.")
-                        skipped_count += 1;
-                        continue
-
-                    can_process_epub = True
-                    missing_lib_reason = ""
-                    if current_output_format == 'epub' and (not EBOOKLIB_AVAILABLE):
-                        can_process_epub = False;
-                        missing_lib_reason = "EbookLib (для записи EPUB)"
-                    elif current_output_format == 'fb2' and not LXML_AVAILABLE:  # LXML already checked above
-                        pass  # Should be fine if LXML check passed
-                    elif current_output_format == 'docx' and not DOCX_AVAILABLE:
-                        can_process_epub = False;
-                        missing_lib_reason = "python-docx (для записи DOCX)"
-
-                    if not can_process_epub:
-                        self.append_log(
-                            f"[WARN] Пропуск EPUB->{current_output_format.upper()}: {base_name} (отсутствует '{missing_lib_reason}')")
-                        skipped_count += 1;
-                        continue
-
-                    with zipfile.ZipFile(file_path, 'r') as epub_zip:
-
-                        html_files_in_epub = sorted([
-                            name for name in epub_zip.namelist()
-                            if name.lower().endswith(('.html', '.xhtml', '.htm'))
-                               and not name.startswith(('__MACOSX', 'META-INF/'))  # Exclude common non-content paths
-                        ])
-                        if not html_files_in_epub:
-                            self.append_log(f"[WARN] В EPUB '{base_name}' не найдено HTML/XHTML файлов.");
-                            skipped_count += 1;
-                            continue
-
-                        dialog = EpubHtmlSelectorDialog(file_path, html_files_in_epub, nav_path, ncx_path, self)
-                        if dialog.exec():
-                            selected_html = dialog.get_selected_files()
-                            if selected_html:
-                                self.append_log(f"Выбрано {len(selected_html)} HTML из {base_name}:")
-                                for html_path in selected_html:  # html_path is relative to zip root
-                                    epub_tuple_key = (file_path, html_path)
-                                    if epub_tuple_key not in current_files_set:
-
-                                        new_files_data_tuples.append(('epub', file_path, html_path))
-                                        current_files_set.add(epub_tuple_key)
-
-                                        is_nav_file = (html_path == nav_path)
-                                        log_suffix = ""
-                                        if is_nav_file and is_potential_epub_rebuild_mode:
-                                            log_suffix = " (NAV - БУДЕТ ИЗМЕНЕН, НЕ ПЕРЕВЕДЕН)"
-                                        elif is_nav_file:
-                                            log_suffix = " (NAV)"  # For non-EPUB output
-                                        self.append_log(f"  + {html_path}{log_suffix}")
-                                        added_count += 1
-                                    else:
-                                        self.append_log(f"  - {html_path} (дубликат)");
-                                        skipped_count += 1
-                            else:  # No HTML files selected in dialog
-                                self.append_log(f"HTML не выбраны из {base_name}.");
-                                skipped_count += 1
-                        else:  # Dialog cancelled
-                            self.append_log(f"Выбор HTML из {base_name} отменен.");
-                            skipped_count += 1
-                except zipfile.BadZipFile:
-                    self.append_log(f"[ERROR] Не удалось открыть EPUB: {base_name}. Возможно, поврежден.");
-                    skipped_count += 1
-                except Exception as e:
-                    self.append_log(f"[ERROR] Ошибка обработки EPUB {base_name}: {e}\n{traceback.format_exc()}");
-                    skipped_count += 1
+                can_process_epub = True
+                missing_lib_reason = ""
+                if current_output_format == 'docx' and not DOCX_AVAILABLE:
+                    can_process_epub = False;
+                    missing_lib_reason = "python-docx (для записи DOCX)"
+
+                if not can_process_epub:
+                    self.append_log(
+                        f"[WARN] Пропуск EPUB->{current_output_format.upper()}: {base_name} (отсутствует '{missing_lib_reason}')")
+                    skipped_count += 1;
+                    continue
+                if file_path in self.epub_scan_modes:  # Уже анализируется / ждет диалога
+                    skipped_count += 1;
+                    continue
+
+                # Анализ структуры - в фоне; диалог выбора HTML откроется по готовности (on_epub_scanned)
+                self.epub_scan_modes[file_path] = is_potential_epub_rebuild_mode
+                epubs_to_scan.append(file_path)
             else:  # Unsupported file extension
                 self.append_log(f"[WARN] Пропуск неподдерживаемого файла: {base_name}");
                 skipped_count += 1
 
+        if epubs_to_scan:
+            self.append_log(f"Анализ EPUB ({len(epubs_to_scan)}) в фоне...")
+            for epub_path in epubs_to_scan:
+                self.epub_scanner.scan(epub_path)
+
         if new_files_data_tuples:
             self.selected_files_data_tuples.extend(new_files_data_tuples)
             self.update_file_list_widget()  # Sorts and updates display
@@ -580,110 +513,82 @@ class TranslatorApp(QWidget):
             self.append_log(log_msg)
         elif skipped_count > 0:
             self.append_log(f"Новые файлы не добавлены. Пропущено {skipped_count}.")
-        else:  # No files selected or all skipped/duplicates
+        elif not epubs_to_scan:  # No files selected or all skipped/duplicates
             if files:  # If files were initially selected but none added/skipped
                 self.append_log("Выбранные файлы уже в списке или не поддерживаются.")
 
-    def _find_epub_toc_paths(self, epub_path):
-        """Finds NAV, NCX paths, OPF directory, and NAV/NCX item IDs within an EPUB."""
+    def _load_epub_structure(self, epub_path):
+        """Loads the EPUB manifest model; returns (manifest, toc_paths) as load_epub_structure() does."""
+        return load_epub_structure(epub_path, log_callback=self.append_log)
+
+    @QtCore.pyqtSlot(str, object, object)
+    def on_epub_scanned(self, file_path, epub_manifest, toc_paths):
+        """Queues a scanned EPUB; its HTML selection dialog opens after the ones already shown."""
+        self.epub_scan_queue.append((file_path, epub_manifest, toc_paths))
+        if not self.epub_dialog_active:  # Иначе очередь разберет уже работающий цикл
+            self._show_epub_dialogs()
 
-        nav_path_in_zip = None;
-        ncx_path_in_zip = None
-        opf_dir_in_zip = None;
-        opf_path_in_zip = None
-        nav_item_id = None;
-        ncx_item_id = None
+    @QtCore.pyqtSlot()
+    def on_epub_scans_finished(self):
+        self.append_log("Анализ EPUB завершен.")
+
+    def _show_epub_dialogs(self):
+        """Shows the selection dialogs of scanned EPUBs one by one; scans finishing meanwhile join the queue."""
+        self.epub_dialog_active = True
         try:
-            with zipfile.ZipFile(epub_path, 'r') as zipf:
+            while self.epub_scan_queue:
+                file_path, epub_manifest, toc_paths = self.epub_scan_queue.popleft()
+                rebuild_mode = self.epub_scan_modes.pop(file_path, False)
+                self._select_epub_parts(file_path, epub_manifest, toc_paths, rebuild_mode)
+        finally:
+            self.epub_dialog_active = False
 
-                try:
-                    container_data = zipf.read('META-INF/container.xml')
-
-                    container_root = etree.fromstring(container_data)
-
-                    cnt_ns = {'oebps': 'urn:oasis:names:tc:opendocument:xmlns:container'}
-                    opf_path_rel = container_root.xpath('//oebps:rootfile/@full-path', namespaces=cnt_ns)[0]
-                    opf_path_in_zip = opf_path_rel.replace('\\', '/')  # Normalize path separator
-                    opf_dir_in_zip = os.path.dirname(opf_path_in_zip)
-                    if opf_dir_in_zip == '.': opf_dir_in_zip = ""  # Use empty string for root
-                except (KeyError, IndexError, etree.XMLSyntaxError) as container_err:
-
-                    print(
-                        f"[WARN] EPUB {Path(epub_path).name}: container.xml не найден/некорректен ({container_err}). Поиск OPF...")
-                    found_opf = False
-                    for name in zipf.namelist():
-
-                        if name.lower().endswith('.opf') and not name.lower().startswith(
-                                'meta-inf/') and name.lower() != 'mimetype':
-                            opf_path_in_zip = name.replace('\\', '/')
-
-                            opf_dir_in_zip = os.path.dirname(opf_path_in_zip)
-
-                            if opf_dir_in_zip == '.': opf_dir_in_zip = ""
-
-                            print(
-                                f"[INFO] EPUB {Path(epub_path).name}: Найден OPF: {opf_path_in_zip} (в директории: '{opf_dir_in_zip or '<root>'}')")
-                            found_opf = True;
-                            break  # Take the first one found
-                    if not found_opf:
-                        self.append_log(
-                            f"[ERROR] EPUB {Path(epub_path).name}: Не удалось найти OPF файл (ни через container.xml, ни поиском).")
-
-                        return None, None, None, None, None  # Critical failure
-
-                if opf_path_in_zip is None or opf_dir_in_zip is None:
-                    self.append_log(f"[ERROR] EPUB {Path(epub_path).name}: OPF путь или директория не определены.")
-                    return None, None, None, None, None
-
-                opf_data = zipf.read(opf_path_in_zip)
-                opf_root = etree.fromstring(opf_data)  # Use lxml for parsing OPF
-                ns = {'opf': 'http://www.idpf.org/2007/opf'}  # OPF namespace
-
-                ncx_id_from_spine = None
-                spine_node = opf_root.find('opf:spine', ns)
-                if spine_node is not None:
-                    ncx_id_from_spine = spine_node.get('toc')  # 'toc' attribute points to NCX ID
-
-                manifest_node = opf_root.find('opf:manifest', ns)
-                if manifest_node is not None:
-                    for item in manifest_node.findall('opf:item', ns):
-                        item_id = item.get('id');
-                        item_href = item.get('href');
-                        item_media_type = item.get('media-type');
-                        item_properties = item.get('properties')
-
-                        if item_href:  # Ensure href exists
-
-                            item_path_abs = os.path.normpath(os.path.join(opf_dir_in_zip, item_href)).replace('\\', '/')
-
-                            if item_properties and 'nav' in item_properties.split():
-                                if nav_path_in_zip is None:  # Take the first one found
-                                    nav_path_in_zip = item_path_abs
-                                    nav_item_id = item_id
-                                else:
-                                    print(
-                                        f"[WARN] EPUB {Path(epub_path).name}: Найдено несколько элементов с 'properties=nav'. Используется первый: {nav_path_in_zip}")
-
-                            if item_media_type == 'application/x-dtbncx+xml' or (
-                                    ncx_id_from_spine and item_id == ncx_id_from_spine):
-                                if ncx_path_in_zip is None:  # Take the first one found
-                                    ncx_path_in_zip = item_path_abs
-                                    ncx_item_id = item_id
-                                else:
-                                    print(
-                                        f"[WARN] EPUB {Path(epub_path).name}: Найдено несколько NCX файлов. Используется первый: {ncx_path_in_zip}")
-
-            log_parts = [f"OPF_Dir='{opf_dir_in_zip or '<root>'}'"]
-            if nav_path_in_zip: log_parts.append(f"NAV='{nav_path_in_zip}'(ID={nav_item_id})")
-            if ncx_path_in_zip: log_parts.append(f"NCX='{ncx_path_in_zip}'(ID={ncx_item_id})")
-            self.append_log(f"Структура {Path(epub_path).name}: {', '.join(log_parts)}")
-
-            return nav_path_in_zip, ncx_path_in_zip, opf_dir_in_zip, nav_item_id, ncx_item_id
-
-        except (KeyError, IndexError, etree.XMLSyntaxError, zipfile.BadZipFile) as e:
-            self.append_log(
-                f"[ERROR] Не удалось найти/прочитать структуру OPF/TOC в {os.path.basename(epub_path)}: {e}")
-            return None, None, None, None, None  # Return None for all on error
+    def _select_epub_parts(self, file_path, epub_manifest, toc_paths, is_potential_epub_rebuild_mode):
+        """Runs EpubHtmlSelectorDialog for a scanned EPUB and adds the chosen parts to the file list."""
+        base_name = os.path.basename(file_path)
+        if epub_manifest is None:
+            self.append_log(f"[ERROR] Не удалось определить структуру OPF в {base_name}. Пропуск файла.")
+            return
+        nav_path, ncx_path = toc_paths[0], toc_paths[1]
+        html_files_in_epub = epub_manifest['html_files']
+        if not html_files_in_epub:
+            self.append_log(f"[WARN] В EPUB '{base_name}' не найдено HTML/XHTML файлов.");
+            return
+
+        try:
+            dialog = EpubHtmlSelectorDialog(file_path, html_files_in_epub, nav_path, ncx_path, self)
+            if not dialog.exec():  # Dialog cancelled
+                self.append_log(f"Выбор HTML из {base_name} отменен.");
+                return
+            selected_html = dialog.get_selected_files()
+        except Exception as e:
+            self.append_log(f"[ERROR] Ошибка обработки EPUB {base_name}: {e}\n{traceback.format_exc()}");
+            return
+        if not selected_html:  # No HTML files selected in dialog
+            self.append_log(f"HTML не выбраны из {base_name}.");
+            return
+
+        current_files_set = {(p1, p2) for _, p1, p2 in self.selected_files_data_tuples}
+        added_count = 0
+        self.append_log(f"Выбрано {len(selected_html)} HTML из {base_name}:")
+        for html_path in selected_html:  # html_path is relative to zip root
+            epub_tuple_key = (file_path, html_path)
+            if epub_tuple_key in current_files_set:
+                self.append_log(f"  - {html_path} (дубликат)");
+                continue
+            self.selected_files_data_tuples.append(('epub', file_path, html_path))
+            current_files_set.add(epub_tuple_key)
+
+            is_nav_file = (html_path == nav_path)
+            log_suffix = ""
+            if is_nav_file and is_potential_epub_rebuild_mode:
+                log_suffix = " (NAV - БУДЕТ ИЗМЕНЕН, НЕ ПЕРЕВЕДЕН)"
+            elif is_nav_file:
+                log_suffix = " (NAV)"  # For non-EPUB output
+            self.append_log(f"  + {html_path}{log_suffix}")
+            added_count += 1
+        if added_count:
+            self.update_file_list_widget()
 
     def update_file_list_widget(self):
         """ Updates the list widget display, sorting items. """
@@ -709,10 +614,16 @@ class TranslatorApp(QWidget):
     def clear_file_list(self):
 
         self.selected_files_data_tuples = []  # Clear internal data
+        self._cancel_epub_scans()
         self.file_list_widget.clear()  # Clear display
         self.append_log("Список файлов очищен.")
         self.update_file_count_display()  # <<< И СЮДА ТОЖЕ ДОБАВИЛИ
 
+    def _cancel_epub_scans(self):
+        self.epub_scanner.cancel()
+        self.epub_scan_queue.clear()
+        self.epub_scan_modes.clear()
+
     def select_output_folder(self):
 
         current_path = self.out_lbl.text()
@@ -738,6 +649,8 @@ class TranslatorApp(QWidget):
         default_temperature = 1.0
         default_chunk_delay = 0.0  # <-- Новое значение по умолчанию
         default_proxy_url = ""  # <-- Новое значение по умолчанию для прокси
+        default_extraction_workers = DEFAULT_EXTRACTION_WORKERS
+        default_scheduling_policy = DEFAULT_SCHEDULING_POLICY
 
         settings_loaded_successfully = False
         settings_source_message = f"Файл '{SETTINGS_FILE}' не найден или пуст. Используются умолчания."
@@ -776,10 +689,18 @@ class TranslatorApp(QWidget):
                     self.temperature_spin.setValue(settings.getfloat('Temperature', default_temperature))
 
                     self.chunk_delay_spin.setValue(settings.getfloat('ChunkDelay', default_chunk_delay))
+                    self.extraction_workers_spin.setValue(
+                        settings.getint('ExtractionWorkers', default_extraction_workers))
+                    self.set_scheduling_policy(settings.get('SchedulingPolicy', default_scheduling_policy).strip())
 
                     # --- ЗАГРУЗКА ПРОКСИ ---
                     self.proxy_url_edit.setText(settings.get('ProxyURL', default_proxy_url))
                     # --- КОНЕЦ ЗАГРУЗКИ ПРОКСИ ---
+                    self.metrics_port = settings.getint('MetricsPort', METRICS_PORT)
+                    self.metrics_textfile = settings.get('MetricsTextfile', METRICS_TEXTFILE_PATH).strip()
+                    self.log_sink.set_min_level(settings.get('GuiLogLevel', GUI_LOG_LEVEL).strip())
+                    gui_log_file = settings.get('GuiLogFile', GUI_LOG_FILE).strip()
+                    if gui_log_file != GUI_LOG_FILE: self.log_sink.set_log_file(gui_log_file)
 
                     settings_loaded_successfully = True
                     settings_source_message = f"Настройки загружены из '{SETTINGS_FILE}'."
@@ -808,6 +729,8 @@ class TranslatorApp(QWidget):
             self.temperature_spin.setValue(default_temperature)
 
             self.chunk_delay_spin.setValue(default_chunk_delay)
+            self.extraction_workers_spin.setValue(default_extraction_workers)
+            self.set_scheduling_policy(default_scheduling_policy)
             # --- УСТАНОВКА ПРОКСИ ПО УМОЛЧАНИЮ ---
             self.proxy_url_edit.setText(default_proxy_url)
             # --- КОНЕЦ УСТАНОВКИ ПРОКСИ ---
@@ -816,6 +739,14 @@ class TranslatorApp(QWidget):
         self.update_concurrency_suggestion(self.model_combo.currentText())
         self.update_chunking_checkbox_suggestion(self.model_combo.currentText())
 
+    def set_scheduling_policy(self, policy):
+        """Selects the combo entry of a policy value ('balanced', 'lpt', 'fifo'); unknown values keep the default."""
+        policies = list(SCHEDULING_POLICIES.values())
+        if policy not in policies:
+            self.append_log(f"[WARN] Неизвестный порядок задач '{policy}'. Используется '{DEFAULT_SCHEDULING_POLICY}'.")
+            policy = DEFAULT_SCHEDULING_POLICY
+        self.scheduling_combo.setCurrentIndex(policies.index(policy))
+
     def save_settings(self):
         try:
             if 'Settings' not in self.config: self.config['Settings'] = {}
@@ -831,6 +762,8 @@ class TranslatorApp(QWidget):
             settings['Temperature'] = str(self.temperature_spin.value())
 
             settings['ChunkDelay'] = str(self.chunk_delay_spin.value())
+            settings['ExtractionWorkers'] = str(self.extraction_workers_spin.value())
+            settings['SchedulingPolicy'] = SCHEDULING_POLICIES[self.scheduling_combo.currentText()]
 
             # --- СОХРАНЕНИЕ ПРОКСИ ---
             settings['ProxyURL'] = self.proxy_url_edit.text().strip()
@@ -843,6 +776,8 @@ class TranslatorApp(QWidget):
 
     def check_api_key(self):
         """Checks if the API key is valid by listing models."""
+        from google.api_core import exceptions as google_exceptions
+        from google import generativeai as genai
 
         current_api_key_to_check = self.api_key
         prompt_for_new_key = not current_api_key_to_check
@@ -924,17 +859,8 @@ class TranslatorApp(QWidget):
         self.append_log(message)
 
     def append_log(self, message):
-        """Appends a timestamped message to the log widget."""
-
-        current_time = time.strftime("%H:%M:%S")
-
-        message_str = str(message).strip()
-
-        for line in message_str.splitlines():
-            self.log_output.append(f"[{current_time}] {line}")
-
-        scrollbar = self.log_output.verticalScrollBar()
-        scrollbar.setValue(scrollbar.maximum())
+        """Queues a timestamped message for the log widget (GuiLogSink flushes it on a timer)."""
+        self.log_sink.add(message)
 
     @QtCore.pyqtSlot(int)
     def update_file_progress(self, processed_count):
@@ -983,11 +909,15 @@ class TranslatorApp(QWidget):
         temperature = self.temperature_spin.value()
 
         chunk_delay = self.chunk_delay_spin.value()
+        extraction_workers = self.extraction_workers_spin.value()
 
         # --- ПОЛУЧЕНИЕ ПРОКСИ ИЗ GUI ---
         proxy_string = self.proxy_url_edit.text().strip()
         # --- КОНЕЦ ПОЛУЧЕНИЯ ПРОКСИ ---
 
+        if self.epub_scanner.pending or self.epub_scan_queue:
+            QMessageBox.warning(self, "Ошибка", "Дождитесь завершения анализа и выбора частей EPUB.");
+            return
         if not selected_files_tuples:
             QMessageBox.warning(self, "Ошибка", "Не выбраны файлы для перевода.");
             return
@@ -1011,9 +941,9 @@ class TranslatorApp(QWidget):
             QMessageBox.critical(self, "Ошибка",
                                  "Выбран формат вывода DOCX, но библиотека 'python-docx' не установлена.");
             return
-        if output_format == 'epub' and (not EBOOKLIB_AVAILABLE or not LXML_AVAILABLE or not BS4_AVAILABLE):
+        if output_format == 'epub' and (not LXML_AVAILABLE or not BS4_AVAILABLE):
             QMessageBox.critical(self, "Ошибка",
-                                 "Выбран формат вывода EPUB, но не установлены: 'ebooklib', 'lxml' и 'beautifulsoup4'.");
+                                 "Выбран формат вывода EPUB, но не установлены: 'lxml' и 'beautifulsoup4'.");
             return
         if output_format == 'fb2' and not LXML_AVAILABLE:
             QMessageBox.critical(self, "Ошибка", "Выбран формат вывода FB2, но библиотека 'lxml' не установлена.");
@@ -1065,22 +995,16 @@ class TranslatorApp(QWidget):
             valid_epubs_found = False
             failed_epub_structures = []
             for epub_path in epub_paths_in_list:
-                nav_path, ncx_path, opf_dir, nav_id, ncx_id = self._find_epub_toc_paths(epub_path)
-                if opf_dir is None:
+                epub_manifest, toc_paths = self._load_epub_structure(epub_path)
+                if epub_manifest is None:
                     QMessageBox.warning(self, "Ошибка EPUB",
                                         f"Не удалось обработать структуру EPUB:\n{Path(epub_path).name}\n\nПропуск этого файла.")
                     failed_epub_structures.append(epub_path)
                     continue
                 html_paths_for_this_epub = [p2 for ft, p1, p2 in selected_files_tuples if
                                             ft == 'epub' and p1 == epub_path and p2]
-                html_to_translate_for_worker = [p for p in html_paths_for_this_epub if p != nav_path]
-                epub_groups_for_worker[epub_path] = {
-                    'html_paths': html_to_translate_for_worker,
-                    'build_metadata': {
-                        'nav_path_in_zip': nav_path, 'ncx_path_in_zip': ncx_path,
-                        'opf_dir': opf_dir, 'nav_item_id': nav_id, 'ncx_item_id': ncx_id
-                    }
-                }
+                epub_groups_for_worker[epub_path] = make_epub_rebuild_entry(
+                    html_paths_for_this_epub, toc_paths, epub_manifest)
                 valid_epubs_found = True
             if failed_epub_structures:
                 self.selected_files_data_tuples = [t for t in self.selected_files_data_tuples if
@@ -1100,7 +1024,7 @@ class TranslatorApp(QWidget):
         else:
             worker_data = selected_files_tuples
 
-        self.log_output.clear();
+        self.log_sink.clear();
         self.progress_bar.setRange(0, 100);
         self.progress_bar.setValue(0);
         self.progress_bar.setFormat("Подготовка...")
@@ -1109,6 +1033,7 @@ class TranslatorApp(QWidget):
         self.append_log(f"Режим: {'EPUB->EPUB Rebuild' if is_epub_to_epub_mode else 'Стандартный'}")
         self.append_log(f"Модель: {selected_model_name}");
         self.append_log(f"Паралл. запросы: {max_concurrency}");
+        self.append_log(f"Процессы извлечения: {extraction_workers or 'нет (потоки)'}")
         self.append_log(f"Формат вывода: .{output_format}")
 
         chunking_log_msg = f"Чанкинг GUI: {'Да' if chunking_enabled_gui else 'Нет'} (Лимит: {chunk_limit:,}, Окно: {chunk_window:,}"
@@ -1121,7 +1046,7 @@ class TranslatorApp(QWidget):
         if not CHUNK_HTML_SOURCE and chunking_enabled_gui: self.append_log("[INFO] Чанкинг HTML/EPUB отключен.")
         self.append_log(f"Папка вывода: {self.out_folder}")
         self.append_log(
-            f"Поддержка: DOCX={'ДА' if DOCX_AVAILABLE else 'НЕТ'}, BS4={'ДА' if BS4_AVAILABLE else 'НЕТ'}, LXML={'ДА' if LXML_AVAILABLE else 'НЕТ'}, EbookLib={'ДА' if EBOOKLIB_AVAILABLE else 'НЕТ'}, Pillow={'ДА' if PILLOW_AVAILABLE else 'НЕТ'}")
+            f"Поддержка: DOCX={'ДА' if DOCX_AVAILABLE else 'НЕТ'}, BS4={'ДА' if BS4_AVAILABLE else 'НЕТ'}, LXML={'ДА' if LXML_AVAILABLE else 'НЕТ'}, Pillow={'ДА' if PILLOW_AVAILABLE else 'НЕТ'}")
         self.append_log("=" * 40);
         self.set_controls_enabled(False)
         self.thread = QtCore.QThread()
@@ -1132,8 +1057,11 @@ class TranslatorApp(QWidget):
             chunking_enabled_gui, chunk_limit, chunk_window,
             temperature,
             chunk_delay,  # <-- Вот этот аргумент был пропущен
-            proxy_string=proxy_string  # <--- Передаем строку прокси в Worker
-
+            proxy_string=proxy_string,  # <--- Передаем строку прокси в Worker
+            metrics_port=self.metrics_port,
+            metrics_textfile=self.metrics_textfile,
+            extraction_workers=extraction_workers,
+            scheduling_policy=SCHEDULING_POLICIES[self.scheduling_combo.currentText()]
         )
         self.worker.moveToThread(self.thread)
         self.worker_ref = self.worker
@@ -1156,6 +1084,8 @@ class TranslatorApp(QWidget):
             self.append_log("Прокси для Worker: Не используется")
         # --- КОНЕЦ ЛОГИРОВАНИЯ ПРОКСИ ---
         self.thread.start()
+        self.dashboard_panel.reset()
+        self.dashboard_timer.start()
         self.append_log("Рабочий поток запущен...")
         self.status_label.setText("Запуск...")
 
@@ -1172,6 +1102,8 @@ class TranslatorApp(QWidget):
 
     @QtCore.pyqtSlot(int, int, list)
     def on_translation_finished(self, success_count, error_count, errors):
+        self.refresh_dashboard()  # Итоговый снимок
+        self.dashboard_timer.stop()
         worker_ref_exists = self.worker_ref is not None
         was_cancelled = worker_ref_exists and self.worker_ref.is_cancelled
         was_finishing = worker_ref_exists and hasattr(self.worker_ref, 'is_finishing') and self.worker_ref.is_finishing
@@ -1247,8 +1179,19 @@ class TranslatorApp(QWidget):
         else:  # Если окно не видимо (например, закрыто во время выполнения), просто логируем
             self.append_log(f"Диалог завершения: {title} - {final_message}")
 
+    @QtCore.pyqtSlot()
+    def refresh_dashboard(self):
+        if self.worker_ref is None:
+            return
+        try:
+            self.dashboard_panel.update_snapshot(self.worker_ref.snapshot())
+        except Exception as e:  # Мониторинг не должен мешать переводу
+            self.dashboard_timer.stop()
+            self.append_log(f"[WARN] Панель мониторинга отключена: {e}")
+
     @QtCore.pyqtSlot()
     def clear_worker_refs(self):
+        self.dashboard_timer.stop()
 
         self.append_log("Фоновый поток завершен. Очистка ссылок...");
         self.worker = None
@@ -1261,7 +1204,8 @@ class TranslatorApp(QWidget):
     def set_controls_enabled(self, enabled):
         widgets_to_toggle = [
             self.file_select_btn, self.clear_list_btn, self.out_btn, self.format_combo,
-            self.model_combo, self.concurrency_spin, self.temperature_spin,
+            self.model_combo, self.concurrency_spin, self.temperature_spin, self.extraction_workers_spin,
+            self.scheduling_combo,
             self.chunking_checkbox, self.proxy_url_edit,  # <-- Добавлено поле прокси
 
             self.chunk_delay_spin,  # <-- Добавлено
@@ -1280,8 +1224,8 @@ class TranslatorApp(QWidget):
                     tooltip = f"Сохранить как .{code}"
                     if code == 'docx' and not DOCX_AVAILABLE:
                         is_available = False; tooltip = "Требуется: python-docx"
-                    elif code == 'epub' and (not EBOOKLIB_AVAILABLE or not LXML_AVAILABLE or not BS4_AVAILABLE):
-                        is_available = False; tooltip = "Требуется: ebooklib, lxml, beautifulsoup4"
+                    elif code == 'epub' and (not LXML_AVAILABLE or not BS4_AVAILABLE):
+                        is_available = False; tooltip = "Требуется: lxml, beautifulsoup4"
                     elif code == 'fb2' and not LXML_AVAILABLE:
                         is_available = False; tooltip = "Требуется: lxml"
                     if code in ['docx', 'epub', 'fb2', 'html'] and not PILLOW_AVAILABLE:
@@ -1312,4 +1256,7 @@ class TranslatorApp(QWidget):
             else:
                 event.ignore()
         else:
-            event.accept()
\ No newline at end of file
+            event.accept()
+        if event.isAccepted():
+            self._cancel_epub_scans()
+            self.log_sink.close()
\ No newline at end of file
@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+def _empty_totals():
+    return {'requests': 0, 'prompt_tokens': 0, 'candidates_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+
+
+def extract_usage(response_obj):
+    """Returns token counts from response.usage_metadata (or None if the response has no usage data)."""
+    usage_metadata = getattr(response_obj, 'usage_metadata', None)
+    if not usage_metadata:
+        return None
+    prompt_tokens = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+    candidates_tokens = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    cached_tokens = getattr(usage_metadata, 'cached_content_token_count', 0) or 0
+    total_tokens = getattr(usage_metadata, 'total_token_count', 0) or (prompt_tokens + candidates_tokens)
+    return {
+        'prompt_tokens': int(prompt_tokens),
+        'candidates_tokens': int(candidates_tokens),
+        'cached_tokens': int(cached_tokens),
+        'total_tokens': int(total_tokens),
+    }
+
+
+def mask_api_key(api_key):
+    """Short, non-secret label for an API key (used as aggregation key in reports)."""
+    if not api_key:
+        return "unknown"
+    return f"...{api_key[-4:]}" if len(api_key) > 4 else "***"
+
+
+class UsageTracker:
+    """
+    Thread-safe accumulator of Gemini token usage.
+    Aggregates totals per file, per EPUB, per model and per API key and keeps sliding windows
+    of sent requests (any outcome) and of response tokens to compute live requests/min and tokens/min.
+    """
+
+    def __init__(self, window_seconds=60):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._recent = deque()  # (monotonic_ts, total_tokens) успешных ответов
+        self._recent_requests = deque()  # monotonic_ts каждого отправленного запроса, включая 429/5xx и дубликаты
+        self.started_at = time.time()
+        self.totals = _empty_totals()
+        self.by_file = {}
+        self.by_epub = {}
+        self.by_model = {}
+        self.by_key = {}
+
+    @staticmethod
+    def _add(bucket, usage):
+        bucket['requests'] += 1
+        for key in ('prompt_tokens', 'candidates_tokens', 'cached_tokens', 'total_tokens'):
+            bucket[key] += usage.get(key, 0)
+
+    def note_request(self):
+        """Counts one request sent to the API in the requests/min window, whatever its outcome."""
+        now = time.monotonic()
+        with self._lock:
+            self._recent_requests.append(now)
+            self._trim(now)
+
+    def record(self, usage, file_label=None, epub_path=None, model_id=None, api_key=None):
+        """
+        Adds one successful request. `usage` is the dict returned by extract_usage().
+        The request itself is counted in the rate window by note_request().
+        """
+        if usage is None:
+            usage = _empty_totals()
+        now = time.monotonic()
+        with self._lock:
+            self._add(self.totals, usage)
+            if file_label:
+                self._add(self.by_file.setdefault(file_label, _empty_totals()), usage)
+            if epub_path:
+                self._add(self.by_epub.setdefault(epub_path, _empty_totals()), usage)
+            if model_id:
+                self._add(self.by_model.setdefault(model_id, _empty_totals()), usage)
+            self._add(self.by_key.setdefault(mask_api_key(api_key), _empty_totals()), usage)
+            self._recent.append((now, usage.get('total_tokens', 0)))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._recent and now - self._recent[0][0] > self.window_seconds:
+            self._recent.popleft()
+        while self._recent_requests and now - self._recent_requests[0] > self.window_seconds:
+            self._recent_requests.popleft()
+
+    def rates(self):
+        """Returns (tokens_per_minute, requests_per_minute) over the sliding window."""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            tokens = sum(t for _, t in self._recent)
+            requests = len(self._recent_requests)
+        scale = 60.0 / self.window_seconds
+        return tokens * scale, requests * scale
+
+    def format_rates(self, model_config):
+        """Human readable 'TPM x/limit, RPM y/limit' line with the current bottleneck marked."""
+        tpm, rpm = self.rates()
+        tpm_limit = model_config.get('tpm') or 0
+        rpm_limit = model_config.get('rpm') or 0
+        tpm_part = f"TPM: {tpm:,.0f}" + (f"/{tpm_limit:,}" if tpm_limit else "")
+        rpm_part = f"RPM: {rpm:.0f}" + (f"/{rpm_limit}" if rpm_limit else "")
+        tpm_ratio = tpm / tpm_limit if tpm_limit else 0.0
+        rpm_ratio = rpm / rpm_limit if rpm_limit else 0.0
+        bound = ""
+        if max(tpm_ratio, rpm_ratio) >= 0.8:
+            bound = " [упор в TPM]" if tpm_ratio >= rpm_ratio else " [упор в RPM]"
+        return f"{tpm_part}, {rpm_part}{bound}"
+
+    def snapshot(self):
+        """Deep copy of all aggregates, safe to serialize or read from another thread."""
+        tpm, rpm = self.rates()
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'elapsed_seconds': round(time.time() - self.started_at, 1),
+                'tokens_per_minute': round(tpm, 1),
+                'requests_per_minute': round(rpm, 1),
+                'totals': dict(self.totals),
+                'by_file': {k: dict(v) for k, v in self.by_file.items()},
+                'by_epub': {k: dict(v) for k, v in self.by_epub.items()},
+                'by_model': {k: dict(v) for k, v in self.by_model.items()},
+                'by_key': {k: dict(v) for k, v in self.by_key.items()},
+            }
+
+    def write_report(self, path, extra=None):
+        """Writes the usage snapshot (plus optional run info) as JSON."""
+        report = self.snapshot()
+        if extra:
+            report.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return path
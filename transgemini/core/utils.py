@@ -1,9 +1,7 @@
 import math
 import re
 from pathlib import Path
-from PIL import Image
 from io import BytesIO
-import imghdr
 
 from transgemini.config import IMAGE_PLACEHOLDER_PREFIX, TRANSLATED_SUFFIX, PILLOW_AVAILABLE
 
@@ -43,6 +41,14 @@ def format_size(size_bytes):
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
 
+
+def format_duration(seconds):
+    """HH:MM:SS, or a dash when the duration is unknown (None)."""
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
 def split_text_into_chunks(text, limit_chars, search_window, min_chunk_size):
     """Splits text into chunks, respecting paragraphs and sentences where possible."""
     chunks = []
@@ -111,10 +117,12 @@ def split_text_into_chunks(text, limit_chars, search_window, min_chunk_size):
 def get_image_extension_from_data(image_data, fallback_ext="jpeg"):
     """Determines image extension from binary data."""
     if not image_data: return fallback_ext
+    import imghdr
     ext = imghdr.what(None, image_data)
     if ext == 'jpeg': return 'jpg'
     if ext is None and PILLOW_AVAILABLE:
         try:
+            from PIL import Image
             with Image.open(BytesIO(image_data)) as img:
                 img_format = img.format
                 if img_format:
@@ -131,7 +139,7 @@ def convert_emf_to_png(emf_data):
         print("[WARN] Pillow library not found, cannot convert EMF image. Skipping.")
         return None
     try:
-
+        from PIL import Image
         with Image.open(BytesIO(emf_data)) as img:
 
             if img.mode == 'CMYK':
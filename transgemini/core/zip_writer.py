@@ -0,0 +1,223 @@
+import os
+import struct
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from transgemini.config import (ZIP_COMPRESS_WORKERS, ZIP_DEFAULT_DEFLATE_LEVEL, ZIP_DEFLATE_LEVELS,
+                                ZIP_PARALLEL_MIN_BYTES, ZIP_STORED_EXTENSIONS, ZIP_STORED_MEDIA_TYPES)
+
+# Запись выходных ZIP (EPUB, DOCX) с политикой сжатия:
+# уже сжатые форматы (JPEG/PNG/WebP/WOFF...) пишутся без сжатия, уровень deflate выбирается по типу,
+# большие текстовые члены сжимаются в пуле потоков, а члены исходного архива можно скопировать сжатыми как есть.
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+_COPY_CHUNK = 1024 * 1024
+
+
+def compression_for(name, media_type=None):
+    """Returns (compress_type, level) for a member: ZIP_STORED for already compressed media, else deflate level."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in ZIP_STORED_EXTENSIONS or (media_type and media_type.lower() in ZIP_STORED_MEDIA_TYPES):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, ZIP_DEFLATE_LEVELS.get(extension, ZIP_DEFAULT_DEFLATE_LEVEL)
+
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data) & 0xFFFFFFFF
+
+
+class ZipOutputWriter:
+    """
+    Writes a ZIP archive member by member with the compression policy of compression_for().
+    Not thread-safe: callers serialize writestr/copy_member/close (the EPUB builder holds its lock).
+    """
+
+    def __init__(self, out_path, compress_workers=ZIP_COMPRESS_WORKERS, parallel_min_bytes=ZIP_PARALLEL_MIN_BYTES):
+        self.out_path = out_path
+        self._zip = zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED)
+        self._names = set()
+        self._date_time = time.localtime(time.time())[:6]
+        self._compress_workers = max(0, int(compress_workers))
+        self._parallel_min_bytes = parallel_min_bytes
+        self._executor = None
+        self._pending = deque()  # (ZipInfo, future) сжимаемых в пуле членов, в порядке добавления
+        self.copied_members = 0
+        self.copied_bytes = 0
+        self.stored_members = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def _claim(self, name):
+        if name in self._names:
+            print(f"[WARN ZipOutputWriter] '{name}' уже записан в архив. Пропуск дубликата.")
+            return False
+        self._names.add(name)
+        return True
+
+    def _new_info(self, name, compress_type, date_time=None):
+        info = zipfile.ZipInfo(name, date_time or self._date_time)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        return info
+
+    def writestr(self, name, data, media_type=None, compress_type=None):
+        """
+        Writes a new member; compress_type=None applies the policy (compression_for).
+        Large deflated members are compressed in the thread pool and written later (next call or close()).
+        Returns False if a member with this name was already written.
+        """
+        if not self._claim(name):
+            return False
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        level = None
+        if compress_type is None:
+            compress_type, level = compression_for(name, media_type)
+        info = self._new_info(name, compress_type)
+        if compress_type == zipfile.ZIP_STORED:
+            self.stored_members += 1
+        if compress_type == zipfile.ZIP_DEFLATED and self._compress_workers and len(data) >= self._parallel_min_bytes:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._compress_workers,
+                                                    thread_name_prefix="ZipCompress")
+            info.file_size = len(data)
+            self._pending.append((info, self._executor.submit(_deflate, data, level or ZIP_DEFAULT_DEFLATE_LEVEL)))
+            self._write_finished(block=False)
+            return True
+        self._write_finished(block=False)
+        self._zip.writestr(info, data, compress_type=compress_type, compresslevel=level)
+        return True
+
+    def _write_finished(self, block):
+        """Writes members compressed in the pool: the finished ones at the head, or all when block=True."""
+        while self._pending and (block or self._pending[0][1].done()):
+            info, future = self._pending.popleft()
+            payload, crc = future.result()
+            info.CRC = crc
+            info.compress_size = len(payload)
+            self._write_raw(info, [payload])
+
+    def _write_raw(self, info, chunks):
+        """Writes a local header and already compressed data, then registers the member like ZipFile does."""
+        out = self._zip
+        zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+        info.header_offset = out.fp.tell()
+        out.fp.write(info.FileHeader(zip64))
+        for chunk in chunks:
+            out.fp.write(chunk)
+        out.filelist.append(info)
+        out.NameToInfo[info.filename] = info
+        out.start_dir = out.fp.tell()
+        out._didModify = True
+
+    def copy_member(self, source_zip, member_name, target_name=None, source_file=None):
+        """
+        Copies a member of source_zip (zipfile.ZipFile) with its compressed bytes as is.
+        source_file: an open binary handle of the source archive (one per build), so the
+        copy does not contend with readers of source_zip's shared handle.
+        """
+        target_name = target_name or member_name
+        if not self._claim(target_name):
+            return False
+        self._write_finished(block=False)
+        src_info = source_zip.getinfo(member_name)
+        own_file = source_file is None
+        src = open(source_zip.filename, 'rb') if own_file else source_file
+        try:
+            src.seek(src_info.header_offset)
+            header = src.read(_LOCAL_HEADER.size)
+            fields = _LOCAL_HEADER.unpack(header) if len(header) == _LOCAL_HEADER.size else None
+            if not fields or fields[0] != _LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"Bad local header for '{member_name}'")
+            src.seek(fields[10] + fields[11], 1)  # имя файла и extra локального заголовка
+
+            info = self._new_info(target_name, src_info.compress_type, src_info.date_time)
+            info.flag_bits = src_info.flag_bits & ~0x08  # размеры пишутся в локальный заголовок
+            info.CRC = src_info.CRC
+            info.compress_size = src_info.compress_size
+            info.file_size = src_info.file_size
+            info.external_attr = src_info.external_attr
+            info.create_system = src_info.create_system
+
+            def read_chunks():
+                remaining = info.compress_size
+                while remaining > 0:
+                    chunk = src.read(min(_COPY_CHUNK, remaining))
+                    if not chunk:
+                        raise zipfile.BadZipFile(f"Truncated data for '{member_name}'")
+                    remaining -= len(chunk)
+                    yield chunk
+
+            self._write_raw(info, read_chunks())
+        finally:
+            if own_file:
+                src.close()
+        self.copied_members += 1
+        self.copied_bytes += src_info.compress_size
+        return True
+
+    def close(self):
+        if self._zip is None:
+            return
+        try:
+            self._write_finished(block=True)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+            self._zip.close()
+            self._zip = None
+
+
+class _OpcPartWriter:
+    """python-docx PhysPkgWriter interface (write(pack_uri, blob)) on top of ZipOutputWriter."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, pack_uri, blob):
+        self.writer.writestr(pack_uri.membername, blob)
+
+
+def save_docx(document, filepath):
+    """
+    Saves a python-docx Document through ZipOutputWriter (images stored, XML deflated by policy).
+    Falls back to document.save() if python-docx internals differ from the expected ones.
+    """
+    try:
+        from docx.opc.pkgwriter import PackageWriter
+        package = document.part.package
+        write_steps = (PackageWriter._write_content_types_stream, PackageWriter._write_pkg_rels,
+                       PackageWriter._write_parts)
+    except (ImportError, AttributeError):
+        document.save(filepath)
+        return
+    parts = list(package.parts)
+    for part in parts:
+        part.before_marshal()
+    try:
+        with ZipOutputWriter(filepath) as writer:
+            phys_writer = _OpcPartWriter(writer)
+            write_steps[0](phys_writer, parts)
+            write_steps[1](phys_writer, package.rels)
+            write_steps[2](phys_writer, parts)
+    except BaseException:
+        if os.path.exists(filepath):
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        raise
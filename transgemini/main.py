@@ -1,4 +1,9 @@
-from transgemini.ui.app import run_app
+import multiprocessing
+
+from transgemini.config import ensure_packages
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # процессы извлечения текста в собранном exe
+    ensure_packages()  # GUI start: install missing dependencies via pip (not done on import anymore)
+    from transgemini.ui.app import run_app
     run_app()
@@ -5,7 +5,7 @@ import traceback
 
 from PyQt6.QtWidgets import QApplication, QMessageBox
 
-from transgemini.config import DOCX_AVAILABLE, BS4_AVAILABLE, LXML_AVAILABLE, EBOOKLIB_AVAILABLE, PILLOW_AVAILABLE
+from transgemini.config import DOCX_AVAILABLE, BS4_AVAILABLE, LXML_AVAILABLE, PILLOW_AVAILABLE
 from transgemini.core.translator import TranslatorApp
 
 
@@ -51,7 +51,6 @@ def main():
     if not BS4_AVAILABLE: missing_libs_msg.append("'beautifulsoup4' (для EPUB/HTML входа/выхода)"); install_pkgs.append(
         "beautifulsoup4")
     if not LXML_AVAILABLE: missing_libs_msg.append("'lxml' (для FB2/EPUB выхода/анализа)"); install_pkgs.append("lxml")
-    if not EBOOKLIB_AVAILABLE: missing_libs_msg.append("'ebooklib' (для EPUB выхода)"); install_pkgs.append("ebooklib")
     if not PILLOW_AVAILABLE: missing_libs_msg.append("'Pillow' (для изобр.)"); install_pkgs.append("Pillow")
     if missing_libs_msg: lib_list = "\n - ".join(
         missing_libs_msg); install_cmd = f"pip install {' '.join(install_pkgs)}"; QMessageBox(QMessageBox.Icon.Warning,